@@ -9,22 +9,221 @@
 from __future__ import absolute_import
 
 import ast
+import errno
+import hashlib
 import json
 import logging
 import os
+import random
 import re
+import stat
+import tempfile
+import tokenize
 
-from twisted.internet import task
-from twisted.web import client
+import treq.client
+from twisted.internet import defer, task
+from twisted.python import filepath
+from twisted.web import client, http
+
+try:
+    from twisted.internet import inotify
+except ImportError:
+    inotify = None
 
 from pybal.util import get_subclasses, log
+from pybal.version import USER_AGENT_STRING
 
 
 class PyBalConfigurationError(Exception):
     pass
 
 
+def decode_value(key, value):
+    """Decode a key and JSON value, as stored in etcd or Consul, into a
+    host name and its configuration."""
+    key = key.rsplit('/', 1)[-1]
+    # handle deletions by returning the key and a value of None
+    if value is None:
+        return key, None
+    value = json.loads(value)
+    pooled = value.pop('pooled', None)
+    if pooled == 'inactive':
+        return key, None
+    if pooled is not None:
+        value['enabled'] = pooled == 'yes'
+    return key, value
+
+
+def encode_value(config):
+    """Encode the configuration of a host as a JSON value, as stored in
+    etcd or Consul. The enabled flag is stored as pooled, so the value
+    stays compatible with conftool."""
+    value = dict(config)
+    if 'enabled' in value:
+        value['pooled'] = value.pop('enabled') and 'yes' or 'no'
+    return json.dumps(value, sort_keys=True)
+
+
+def merge_changes(coordinator, changes):
+    """Returns the complete configuration of the hosts in changes, with
+    the changes applied to their configuration in the coordinator. Raises
+    ValueError for hosts the coordinator doesn't know, as there is no
+    configuration to write for them."""
+    unknown = sorted(host for host in changes if host not in coordinator.serverConfig)
+    if unknown:
+        raise ValueError("Unknown hosts: %s" % ", ".join(unknown))
+    return {host: dict(coordinator.serverConfig[host], **change)
+            for host, change in changes.iteritems()}
+
+
+def split_comment(line):
+    """Split a line of Python source into its code and its trailing
+    comment, including the whitespace before it."""
+    try:
+        for token in tokenize.generate_tokens(iter([line]).next):
+            if token[0] == tokenize.COMMENT:
+                code = line[:token[2][1]].rstrip()
+                return code, line[len(code):]
+    except tokenize.TokenError:
+        pass
+    return line, ''
+
+
+def write_atomically(path, data):
+    """Write data to path through a uniquely named temporary file in the
+    same directory, renamed into place, so that readers see either the
+    old or the new content as a whole. The mode and owner of an existing
+    file are kept."""
+    fd, tmpPath = tempfile.mkstemp(prefix='.%s.' % os.path.basename(path),
+                                   dir=os.path.dirname(path) or '.')
+    try:
+        with os.fdopen(fd, 'w') as f:
+            try:
+                fileStat = os.stat(path)
+            except OSError as e:
+                if e.errno != errno.ENOENT:
+                    raise
+                # As open() would have created it
+                umask = os.umask(0)
+                os.umask(umask)
+                os.fchmod(f.fileno(), 0o666 & ~umask)
+            else:
+                os.fchmod(f.fileno(), stat.S_IMODE(fileStat.st_mode))
+                if (fileStat.st_uid, fileStat.st_gid) != (os.geteuid(), os.getegid()):
+                    os.fchown(f.fileno(), fileStat.st_uid, fileStat.st_gid)
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        os.rename(tmpPath, path)
+    except Exception:
+        os.unlink(tmpPath)
+        raise
+
+
+def apply_update(coordinator, config, update, full=False):
+    """Apply a decoded configuration update to config, and notify the
+    coordinator.
+
+    If full, update is the complete new configuration, which is handed to
+    the coordinator as a whole. Otherwise, update holds only the hosts that
+    changed, and the coordinator is handed only the hosts that were
+    actually added, changed or removed. Returns the new configuration.
+
+    config is None before the first update, so that the first full
+    update is always handed over, even when empty: the coordinator may
+    hold servers from the configuration cache that have to go."""
+    if full:
+        newConfig = {k: v for k, v in update.iteritems() if v is not None}
+        if newConfig != config:
+            coordinator.onConfigUpdate(dict(newConfig))
+        return newConfig
+
+    if config is None:
+        config = {}
+    changed = {}
+    removed = []
+    for k, v in update.iteritems():
+        if v is None:
+            # Removed hosts
+            if config.pop(k, None) is not None:
+                removed.append(k)
+        elif config.get(k) != v:
+            config[k] = changed[k] = v
+    if changed or removed:
+        coordinator.onConfigDelta(changed, removed)
+    return config
+
+
+class ConfigCache(object):
+    """On-disk cache of the last server configuration applied to a
+    service, so that it can be applied at startup before its
+    configuration source answers.
+
+    Updates are coalesced and written saveDelay seconds later, to a
+    temporary file that is then renamed into place, so the cache is
+    always either the old or the new configuration as a whole.
+    """
+
+    saveDelay = 1
+
+    def __init__(self, path, reactor=None):
+        if reactor is None:
+            from twisted.internet import reactor
+        self.reactor = reactor
+        self.path = path
+        self.config = None
+        self.saveCall = None
+        self.savedAt = None
+
+    def load(self):
+        """Returns the cached configuration, or None if there is none"""
+        try:
+            with open(self.path) as f:
+                config = json.load(f)
+                savedAt = os.fstat(f.fileno()).st_mtime
+        except IOError as e:
+            if e.errno != errno.ENOENT:
+                log.warn("Could not read config cache %s: %s" % (self.path, e),
+                         system="config-cache")
+            return None
+        except ValueError as e:
+            log.warn("Invalid config cache %s: %s" % (self.path, e),
+                     system="config-cache")
+            return None
+        if not isinstance(config, dict):
+            log.warn("Invalid config cache %s" % self.path, system="config-cache")
+            return None
+        self.savedAt = savedAt
+        return config
+
+    def update(self, config):
+        """Caches config, after saveDelay seconds"""
+        self.config = config
+        if self.saveCall is None:
+            self.saveCall = self.reactor.callLater(self.saveDelay, self.save)
+
+    def save(self):
+        self.saveCall = None
+        try:
+            write_atomically(self.path, json.dumps(self.config, sort_keys=True))
+        except (IOError, OSError) as e:
+            log.error("Could not write config cache %s: %s" % (self.path, e),
+                      system="config-cache")
+        else:
+            self.savedAt = self.reactor.seconds()
+
+    def age(self):
+        """Returns the age of the cached configuration in seconds, or NaN
+        if there is none"""
+        if self.savedAt is None:
+            return float('nan')
+        return max(0, self.reactor.seconds() - self.savedAt)
+
+
 class ConfigurationObserver(object):
+    # Whether persist() can write changes back to the configuration source
+    writable = False
+
     @classmethod
     def fromUrl(cls, coordinator, configUrl):
         """Construct an instance of the appropriate subclass for a URL."""
@@ -33,6 +232,104 @@ class ConfigurationObserver(object):
                 return subclass(coordinator, configUrl)
         raise PyBalConfigurationError('No handler for URL "%s"' % configUrl)
 
+    def persist(self, changes):
+        """Write changes, a dictionary of server hostnames to the
+        configuration attributes to change, back to the configuration
+        source. May return a deferred.
+
+        Raises NotImplementedError for sources that can't be written."""
+        raise NotImplementedError("Can't write to %s" % self.urlScheme)
+
+
+class FileWatcher(object):
+    """Watches files for changes with a single inotify instance, shared by
+    all FileConfigurationObservers.
+
+    The directories of the files are watched rather than the files
+    themselves, so that files atomically renamed into place are noticed
+    as well as files written in place. Symbolic links are resolved when
+    first watched, and the directory of their target is watched instead.
+    Observers are notified with
+    fileChanged() on every change to their file, and with watchLost() if
+    the directory watch is removed.
+    """
+
+    # Written files and files moved into place, but not files still
+    # being written
+    WATCH_MASK = (inotify.IN_CLOSE_WRITE | inotify.IN_MOVED_TO |
+                  inotify.IN_DELETE | inotify.IN_MOVED_FROM) if inotify else 0
+
+    def __init__(self, reactor=None):
+        if reactor is None:
+            from twisted.internet import reactor
+        self.reactor = reactor
+        self.notifier = None
+        self.observers = {}
+        self.realPaths = {}
+
+    def watch(self, path, observer):
+        """Notifies observer of changes to the file path. Returns False if
+        the file can't be watched, and should be polled instead."""
+
+        realPath = os.path.realpath(path)
+        directory, name = os.path.split(realPath)
+        if directory not in self.observers:
+            try:
+                if self.notifier is None:
+                    if inotify is None:
+                        return False
+                    self.notifier = inotify.INotify(self.reactor)
+                    self.notifier.startReading()
+                self.notifier.watch(filepath.FilePath(directory), mask=self.WATCH_MASK,
+                                    callbacks=[self._notify])
+            except (inotify.INotifyError, OSError) as ex:
+                log.warn('Cannot watch %s, falling back to polling: %s' % (path, ex))
+                self._stopIfUnused()
+                return False
+            self.observers[directory] = {}
+        self.observers[directory].setdefault(name, set()).add(observer)
+        self.realPaths[(path, observer)] = realPath
+        return True
+
+    def unwatch(self, path, observer):
+        """Stops notifying observer of changes to the file path."""
+
+        realPath = self.realPaths.pop((path, observer), None)
+        if realPath is None:
+            return
+        directory, name = os.path.split(realPath)
+        watched = self.observers.get(directory, {})
+        watched.get(name, set()).discard(observer)
+        if not watched.get(name, True):
+            del watched[name]
+        if directory in self.observers and not watched:
+            del self.observers[directory]
+            try:
+                self.notifier.ignore(filepath.FilePath(directory))
+            except KeyError:
+                pass    # Already removed along with the directory
+        self._stopIfUnused()
+
+    def _stopIfUnused(self):
+        if not self.observers and self.notifier is not None:
+            self.notifier.loseConnection()
+            self.notifier = None
+
+    def _notify(self, ignored, path, mask):
+        if mask & inotify.IN_DELETE_SELF:
+            for key, realPath in list(self.realPaths.items()):
+                if os.path.dirname(realPath) == path.path:
+                    del self.realPaths[key]
+            for observers in self.observers.pop(path.path, {}).values():
+                for observer in list(observers):
+                    observer.watchLost()
+            self._stopIfUnused()
+            return
+
+        directory, name = os.path.split(path.path)
+        for observer in list(self.observers.get(directory, {}).get(name, ())):
+            observer.fileChanged()
+
 
 class FileConfigurationObserver(ConfigurationObserver):
     """ConfigurationObserver for local configuration files.
@@ -60,9 +357,16 @@ class FileConfigurationObserver(ConfigurationObserver):
         { 'host': 'pybal-test2002.codfw.wmnet', 'weight':10, 'enabled': True }
         { 'host': 'pybal-test2003.codfw.wmnet', 'weight':10, 'enabled': True }
 
+    Changes are picked up through the FileWatcher shared by all file
+    observers where inotify is available, and by polling the file every
+    reloadIntervalSeconds otherwise.
     """
 
     urlScheme = 'file://'
+    writable = True
+
+    # FileWatcher shared by all file configuration observers
+    fileWatcher = None
 
     def __init__(self, coordinator, configUrl, reloadIntervalSeconds=1):
         self.coordinator = coordinator
@@ -70,22 +374,54 @@ class FileConfigurationObserver(ConfigurationObserver):
         self.filePath = configUrl[len(self.urlScheme):]
         self.reloadIntervalSeconds = reloadIntervalSeconds
         self.lastFileStat = None
+        self.lastHash = None
         self.lastConfig = None
+        self.watching = False
         self.reloadTask = task.LoopingCall(self.reloadConfig)
 
     def startObserving(self):
-        """Start (or re-start) watching the configuration file for changes."""
+        """Start watching the configuration file for changes, falling back
+        to polling if it can't be watched."""
+        if FileConfigurationObserver.fileWatcher is None:
+            FileConfigurationObserver.fileWatcher = FileWatcher()
+        self.watching = self.fileWatcher.watch(self.filePath, self)
+        if self.watching:
+            self.fileChanged()
+        else:
+            self.startPolling()
+
+    def stopObserving(self):
+        """Stop watching or polling the configuration file."""
+        if self.watching:
+            self.fileWatcher.unwatch(self.filePath, self)
+            self.watching = False
+        if self.reloadTask.running:
+            self.reloadTask.stop()
+
+    def startPolling(self):
+        """Start (or re-start) polling the configuration file for changes."""
         self.reloadTask \
             .start(self.reloadIntervalSeconds) \
             .addErrback(self.logError)
 
+    def fileChanged(self):
+        """Called by the FileWatcher when the configuration file changed."""
+        return defer.maybeDeferred(self.reloadConfig).addErrback(self.logError)
+
+    def watchLost(self):
+        """Called by the FileWatcher when the file can no longer be
+        watched."""
+        log.warn('Lost the watch on %s, falling back to polling' % self.filePath)
+        self.watching = False
+        self.startPolling()
+
     def logError(self, failure):
         """Log an error and re-schedule the configuration file monitor."""
         failure.trap(Exception)
         log.err(failure)
-        self.fileStat = None
-        if not self.reloadTask.running:
-            self.startObserving()
+        self.lastFileStat = None
+        if not self.watching and not self.reloadTask.running:
+            self.startPolling()
 
     def parseLegacyConfig(self, rawConfig):
         """Parse a legacy (eval) configuration file."""
@@ -117,15 +453,48 @@ class FileConfigurationObserver(ConfigurationObserver):
         else:
             return self.parseLegacyConfig(rawConfig)
 
+    def persist(self, changes):
+        """Write changes to the servers in the configuration file, leaving
+        the rest of the file, including comments, as it is."""
+        with open(self.filePath, 'rt') as f:
+            rawConfig = f.read()
+        if self.configUrl.endswith('.json'):
+            config = self.parseJsonConfig(rawConfig)
+            for host, change in changes.iteritems():
+                config[host].update(change)
+            rawConfig = json.dumps(config, indent=2, sort_keys=True) + '\n'
+        else:
+            lines = rawConfig.split('\n')
+            for i, line in enumerate(lines):
+                code, comment = split_comment(line)
+                try:
+                    server = ast.literal_eval(code.strip())
+                except (SyntaxError, ValueError):
+                    continue
+                if isinstance(server, dict) and server.get('host') in changes:
+                    server.update(changes[server['host']])
+                    keys = ['host', 'weight', 'enabled']
+                    keys += sorted(set(server) - set(keys))
+                    indent = code[:len(code) - len(code.lstrip())]
+                    lines[i] = '%s{ %s }%s' % (indent, ', '.join(
+                        '%r: %r' % (k, server[k]) for k in keys if k in server), comment)
+            rawConfig = '\n'.join(lines)
+        write_atomically(self.filePath, rawConfig)
+
     def reloadConfig(self):
-        """If the configuration file has changed, re-read it. If the parsed
-        configuration object has changed, notify the coordinator."""
+        """If the configuration file has changed, re-read it. If its content
+        and the parsed configuration object have changed, notify the
+        coordinator."""
         fileStat = os.stat(self.filePath)
         if fileStat == self.lastFileStat:
             return
         self.lastFileStat = fileStat
         with open(self.filePath, 'rt') as f:
             rawConfig = f.read()
+        contentHash = hashlib.sha1(rawConfig).digest()
+        if contentHash == self.lastHash:
+            return
+        self.lastHash = contentHash
         config = self.parseConfig(rawConfig)
         if config != self.lastConfig:
             self.coordinator.onConfigUpdate(config)
@@ -133,17 +502,127 @@ class FileConfigurationObserver(ConfigurationObserver):
 
 
 class HttpConfigurationObserver(FileConfigurationObserver):
-    """ConfigurationObserver for configuration served over HTTP."""
+    """ConfigurationObserver for configuration served over HTTP.
+
+    The configuration is fetched every config-interval seconds (from the
+    service configuration), give or take reloadJitter, over a persistent
+    connection. Requests are conditional on the ETag and Last-Modified
+    validators of the last response, so unchanged configuration is
+    neither downloaded nor parsed again. Failed fetches are retried with
+    exponential backoff, up to config-max-backoff seconds.
+    """
 
     urlScheme = 'http://'
+    writable = False
+
+    timeout = 5
+    reloadJitter = 0.1
+    maxBackoffSeconds = 60
+
+    def __init__(self, coordinator, configUrl, reloadIntervalSeconds=1):
+        super(HttpConfigurationObserver, self).__init__(
+            coordinator, configUrl, reloadIntervalSeconds)
+        from twisted.internet import reactor
+        self.reactor = reactor
+        configuration = coordinator.lvsservice.configuration
+        self.reloadIntervalSeconds = configuration.getfloat(
+            'config-interval', reloadIntervalSeconds)
+        self.maxBackoffSeconds = configuration.getfloat(
+            'config-max-backoff', self.maxBackoffSeconds)
+        self.etag = None
+        self.lastModified = None
+        self.failures = 0
+        self.observing = False
+        self.reloadCall = None
+        self.reloadDeferred = None
+        self.pool = client.HTTPConnectionPool(self.reactor)
+        self.pool.maxPersistentPerHost = 1
+        self.client = treq.client.HTTPClient(agent=client.Agent(
+            self.reactor, connectTimeout=self.timeout, pool=self.pool))
+
+    def startObserving(self):
+        """Start (or re-start) polling the configuration URL."""
+        self.observing = True
+        self.scheduleReload(0)
+
+    def persist(self, changes):
+        """The configuration URL is read-only."""
+        return ConfigurationObserver.persist(self, changes)
+
+    def stopObserving(self):
+        """Stop polling the configuration URL."""
+        self.observing = False
+        if self.reloadCall is not None and self.reloadCall.active():
+            self.reloadCall.cancel()
+        self.reloadCall = None
+        if self.reloadDeferred is not None:
+            self.reloadDeferred.cancel()
+        self.pool.closeCachedConnections()
+
+    def scheduleReload(self, delay):
+        self.reloadCall = self.reactor.callLater(delay, self.reload)
+
+    def getReloadDelay(self):
+        """Returns the delay until the next fetch, backing off
+        exponentially after failures"""
+        delay = self.reloadIntervalSeconds
+        if self.failures:
+            delay = min(self.maxBackoffSeconds, delay * 2 ** self.failures)
+        return delay * random.uniform(1 - self.reloadJitter, 1 + self.reloadJitter)
+
+    def reload(self):
+        self.reloadCall = None
+        self.reloadDeferred = self.reloadConfig()
+        self.reloadDeferred.addCallbacks(self.onReloadSucceeded, self.onReloadFailed)
+        return self.reloadDeferred
+
+    def onReloadSucceeded(self, result):
+        self.reloadDeferred = None
+        self.failures = 0
+        if self.observing:
+            self.scheduleReload(self.getReloadDelay())
+
+    def onReloadFailed(self, failure):
+        self.reloadDeferred = None
+        if not self.observing:
+            return
+        self.failures += 1
+        log.err(failure, 'Failed to fetch %s' % self.configUrl)
+        self.scheduleReload(self.getReloadDelay())
 
     def reloadConfig(self):
-        dfd = client.getPage(self.configUrl)
-        dfd.addCallbacks(self.onConfigReceived, self.logError)
+        headers = {'User-Agent': USER_AGENT_STRING}
+        if self.etag is not None:
+            headers['If-None-Match'] = self.etag
+        if self.lastModified is not None:
+            headers['If-Modified-Since'] = self.lastModified
+        dfd = self.client.get(self.configUrl, headers=headers,
+                              reactor=self.reactor, timeout=self.timeout)
+        dfd.addCallback(self.onResponse)
+        return dfd
+
+    def onResponse(self, response):
+        if response.code == http.NOT_MODIFIED:
+            return None
+        elif response.code != http.OK:
+            raise PyBalConfigurationError(
+                'Unexpected status code %d from %s' % (response.code, self.configUrl))
+        dfd = response.content()
+        dfd.addCallback(self.onConfigReceived)
+        # Only condition the next request on a configuration we've parsed
+        dfd.addCallback(lambda ignored: self.updateValidators(response.headers))
         return dfd
 
+    def updateValidators(self, headers):
+        self.etag = (headers.getRawHeaders('ETag') or [None])[-1]
+        self.lastModified = (headers.getRawHeaders('Last-Modified') or [None])[-1]
+
     def onConfigReceived(self, rawConfig):
+        contentHash = hashlib.sha1(rawConfig).digest()
+        if contentHash == self.lastHash:
+            return
         config = self.parseConfig(rawConfig)
+        self.lastHash = contentHash
         if config != self.lastConfig:
             self.coordinator.onConfigUpdate(config)
             self.lastConfig = config
@@ -0,0 +1,245 @@
+# -*- coding: utf-8 -*-
+"""
+  PyBal Consul client
+  ~~~~~~~~~~~~~~~~~~~
+
+  This module allows PyBal to be configured via Consul.
+
+"""
+from __future__ import absolute_import
+
+import base64
+import json
+
+import treq.client
+from twisted.internet import defer, reactor
+from twisted.web import error, http
+from twisted.web.client import Agent, HTTPConnectionPool
+from twisted.web.http import urlparse
+
+from .config import (ConfigurationObserver, apply_update, decode_value, encode_value,
+                     merge_changes)
+from .version import USER_AGENT_STRING
+from .util import log
+
+
+def decode_kv_entries(entries):
+    """Decode the entries of a recursive KV read into a configuration.
+    Values are JSON, as in etcd."""
+    config = {}
+    for entry in entries:
+        # Folder keys have no value
+        if entry.get('Value') is None:
+            continue
+        key, value = decode_value(entry['Key'], base64.b64decode(entry['Value']))
+        if value is not None:
+            config[key] = value
+    return config
+
+
+def decode_health_entries(entries):
+    """Decode the entries of a service health query into a configuration.
+    Service instances are enabled unless a check is critical, and
+    weighted with the Consul weight for their state. Servers are keyed
+    by address, as PyBal balances over one port per service; of several
+    instances on the same address only the first is used."""
+    config = {}
+    for entry in entries:
+        service = entry['Service']
+        host = service.get('Address') or entry['Node']['Address']
+        if host in config:
+            log.warn("Ignoring instance %s on node %s: duplicate address %s" % (
+                service.get('ID', service.get('Service')), entry['Node']['Node'], host),
+                system="config-consul")
+            continue
+        statuses = set(check['Status'] for check in entry.get('Checks', ()))
+        weights = service.get('Weights') or {}
+        if 'warning' in statuses and 'critical' not in statuses:
+            weight = weights.get('Warning', 1)
+        else:
+            weight = weights.get('Passing', 1)
+        config[host] = {
+            'enabled': 'critical' not in statuses,
+            'weight': weight
+        }
+    return config
+
+
+class ConsulConfigurationObserver(ConfigurationObserver):
+    """Monitors a Consul KV prefix or service with blocking queries.
+
+    Handles the 'consul://' scheme, in two forms:
+
+        consul://[token@]host:8500/kv/<prefix>
+        consul://[token@]host:8500/health/<service>[?tag=<tag>]
+
+    Both take an optional dc query parameter. Every query blocks until
+    the Consul index moves past the last index seen, or until
+    waitSeconds pass, so changes arrive as soon as they happen over a
+    single persistent connection.
+    """
+
+    urlScheme = 'consul://'
+
+    scheme = 'http'
+    connectTimeout = 5
+    timeout = 10
+    waitSeconds = 300
+    reconnectTimeout = 1
+    maxTxnOps = 64
+    queryParams = ('dc', 'tag')
+
+    def __init__(self, coordinator, configUrl):
+        self.reactor = reactor
+        self.coordinator = coordinator
+        self.configUrl = configUrl
+        (self.host, self.port, self.token, self.endpoint, self.name,
+         self.params) = self.parseConfigUrl(configUrl)
+        # Service health can't be written
+        self.writable = self.endpoint == 'kv'
+        self.index = None
+        self.lastConfig = None
+        self.observing = False
+        self.request = None
+        self.pollCall = None
+        self.pool = HTTPConnectionPool(self.reactor)
+        self.pool.maxPersistentPerHost = 1
+        self.client = treq.client.HTTPClient(agent=Agent(
+            self.reactor, connectTimeout=self.connectTimeout, pool=self.pool))
+
+    def parseConfigUrl(self, configUrl):
+        parsed = urlparse(configUrl)
+        endpoint, _, name = parsed.path.lstrip('/').partition('/')
+        if endpoint not in ('kv', 'health') or not name:
+            raise ValueError("Invalid Consul URL, expected consul://host:port/kv/<prefix> "
+                             "or consul://host:port/health/<service>")
+        query = http.parse_qs(parsed.query)
+        params = {k: v[-1] for k, v in query.items() if k in self.queryParams}
+        return (parsed.hostname, parsed.port or 8500, parsed.username,
+                endpoint, name, params)
+
+    def getURL(self):
+        if self.endpoint == 'kv':
+            path = 'kv/%s' % self.name
+        else:
+            path = 'health/service/%s' % self.name
+        return '%s://%s:%d/v1/%s' % (self.scheme, self.host, self.port, path)
+
+    def getParams(self):
+        params = dict(self.params)
+        if self.endpoint == 'kv':
+            params['recurse'] = 'true'
+        if self.index is not None:
+            params['index'] = str(self.index)
+            params['wait'] = '%ds' % self.waitSeconds
+        return params
+
+    def getHeaders(self):
+        headers = {'User-Agent': USER_AGENT_STRING}
+        if self.token:
+            headers['X-Consul-Token'] = self.token
+        return headers
+
+    def startObserving(self):
+        """Start (or re-start) watching Consul for changes."""
+        self.observing = True
+        self.poll()
+
+    def stopObserving(self):
+        """Stop watching Consul, and close the connection."""
+        self.observing = False
+        if self.pollCall is not None and self.pollCall.active():
+            self.pollCall.cancel()
+        self.pollCall = None
+        if self.request is not None:
+            self.request.cancel()
+        return self.pool.closeCachedConnections()
+
+    def poll(self):
+        self.pollCall = None
+        self.request = self.query()
+        self.request.addCallbacks(lambda ignored: 0, self.onFailure)
+        self.request.addCallback(self.schedulePoll)
+
+    def schedulePoll(self, delay):
+        self.request = None
+        if self.observing:
+            self.pollCall = self.reactor.callLater(delay, self.poll)
+
+    @defer.inlineCallbacks
+    def query(self):
+        """Run a single (blocking) query, and apply its result."""
+        # Consul adds up to wait / 16 of jitter to the wait time
+        timeout = self.timeout
+        if self.index is not None:
+            timeout += self.waitSeconds * 17 / 16.0
+        response = yield self.client.get(self.getURL(),
+                                         params=self.getParams(),
+                                         headers=self.getHeaders(),
+                                         reactor=self.reactor,
+                                         timeout=timeout)
+        if response.code == http.NOT_FOUND and self.endpoint == 'kv':
+            # No keys under the prefix (yet)
+            yield response.content()
+            entries = []
+        elif response.code != http.OK:
+            body = yield response.content()
+            raise error.Error(str(response.code), http.RESPONSES.get(response.code), body)
+        else:
+            entries = yield response.json()
+
+        index = int((response.headers.getRawHeaders('X-Consul-Index') or ['0'])[0])
+        if self.index is not None and index == self.index:
+            # The wait time passed without changes
+            return
+
+        if self.endpoint == 'kv':
+            config = decode_kv_entries(entries)
+        else:
+            config = decode_health_entries(entries)
+        self.onUpdate(config, full=self.index is None)
+
+        # An index going backwards means the Consul state was reset
+        if self.index is not None and index < self.index:
+            log.warn("Consul index went back from %d to %d" % (self.index, index),
+                     system="config-consul")
+            index = 0
+        self.index = index
+
+    def onUpdate(self, config, full=False):
+        if not full:
+            # Hand only the changes to the coordinator
+            config = dict(config)
+            config.update((host, None) for host in self.lastConfig or {}
+                          if host not in config)
+        self.lastConfig = apply_update(self.coordinator, self.lastConfig, config, full)
+
+    @defer.inlineCallbacks
+    def persist(self, changes):
+        """Write changes to the keys of their hosts, in as few transactions
+        as Consul allows. Service health can't be written."""
+        if self.endpoint != 'kv':
+            raise NotImplementedError("Can't write to Consul service health")
+
+        ops = []
+        for host, value in sorted(merge_changes(self.coordinator, changes).iteritems()):
+            ops.append({'KV': {'Verb': 'set',
+                               'Key': '%s/%s' % (self.name.rstrip('/'), host),
+                               'Value': base64.b64encode(encode_value(value))}})
+        url = '%s://%s:%d/v1/txn' % (self.scheme, self.host, self.port)
+        for i in range(0, len(ops), self.maxTxnOps):
+            response = yield self.client.put(url,
+                                             data=json.dumps(ops[i:i + self.maxTxnOps]),
+                                             params=dict(self.params),
+                                             headers=self.getHeaders(),
+                                             reactor=self.reactor,
+                                             timeout=self.timeout)
+            body = yield response.content()
+            if response.code != http.OK:
+                raise error.Error(str(response.code), http.RESPONSES.get(response.code), body)
+
+    def onFailure(self, reason):
+        # Queries cancelled by stopObserving aren't failures
+        if self.observing:
+            log.error('failed: %s' % reason.getErrorMessage(), system="config-consul")
+        return self.reconnectTimeout
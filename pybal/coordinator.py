@@ -23,6 +23,7 @@ class Coordinator:
     """
 
     serverConfigUrl = 'file:///etc/pybal/squids'
+    configCacheDir = '/var/cache/pybal'
 
     intvLoadServers = 60
 
@@ -65,6 +66,10 @@ class Coordinator:
             'depool_threshold',
             "Threshold of up servers vs total servers below which pybal can't depool any more",
             **metric_keywords),
+        'config_cache_age_seconds': Gauge(
+            'config_cache_age_seconds',
+            'Age of the cached last known good configuration',
+            **metric_keywords),
     }
 
     def __init__(self, lvsservice, configUrl):
@@ -79,7 +84,23 @@ class Coordinator:
         self.configHash = None
         self.serverConfigUrl = configUrl
         self.serverInitDeferredList = defer.Deferred()
+        self.serverConfig = {}
+        self.configCache = self._getConfigCache()
         self.configObserver = config.ConfigurationObserver.fromUrl(self, configUrl)
+
+        # Start with the last known good configuration, until the
+        # configuration source answers
+        if self.configCache is not None:
+            cachedConfig = self.configCache.load()
+            if cachedConfig:
+                log.info("{} Applying cached configuration of {} server(s)".format(
+                         self, len(cachedConfig)), system=self.lvsservice.name)
+                self.serverConfig = cachedConfig
+                self._applyConfig(cachedConfig)
+            self.metrics['config_cache_age_seconds'].labels(
+                **self.metric_labels
+                ).set_function(self.configCache.age)
+
         self.configObserver.startObserving()
 
         self.metrics['depool_threshold'].labels(
@@ -89,6 +110,16 @@ class Coordinator:
     def __str__(self):
         return "[%s]" % self.lvsservice.name
 
+    def _getConfigCache(self):
+        """Returns the ConfigCache of the service, or None if disabled with
+        config-cache = no"""
+
+        path = self.lvsservice.configuration.get(
+            'config-cache', '%s/%s.json' % (self.configCacheDir, self.lvsservice.name))
+        if path.strip().lower() in ('', 'no', 'false', 'off'):
+            return None
+        return config.ConfigCache(path)
+
     def assignServers(self):
         """
         Hands over the set of servers that should get pooled (.pool == True)
@@ -226,6 +257,13 @@ class Coordinator:
         accordingly.
         """
 
+        self.serverConfig = dict(config)
+        self._cacheConfig()
+        return self._applyConfig(config)
+
+    def _applyConfig(self, config):
+        """Makes the servers in config the complete set of servers"""
+
         delServers = self.servers.copy()    # Shallow copy
 
         initList = []
@@ -241,30 +279,11 @@ class Coordinator:
         for hostName, hostConfig in config.items():
             if hostName in self.servers:
                 # Existing server. merge
-                server = delServers.pop(hostName)
-                server.merge(hostConfig)
-                # Calculate up status for the previously existing server
-                self.refreshPreexistingServer(server)
-                data = {'status': (server.enabled and "enabled" or "disabled"),
-                        'host': hostName, 'weight': server.weight}
-                log.info(
-                    "Merged {status} server {host}, weight {weight}".format(**data),
-                    system=self.lvsservice.name
-                )
+                del delServers[hostName]
+                self._mergeServer(hostName, hostConfig)
             else:
                 # New server
-                server = pybal.server.Server.buildServer(hostName, hostConfig, self.lvsservice)
-                data = {'status': (server.enabled and "enabled" or "disabled"),
-                        'host': hostName, 'weight': server.weight}
-                # Initialize with LVS service specific configuration
-                self.lvsservice.initServer(server)
-                self.servers[hostName] = server
-                initList.append(server.initialize(self))
-                util._log(
-                          "New {status} server {host}, weight {weight}".format(**data),
-                          lvl,
-                          system=self.lvsservice.name
-                )
+                initList.append(self._addServer(hostName, hostConfig, lvl))
 
         if new_config:
             enabled_servers = sum(1 for server in self.servers.itervalues() if server.enabled)
@@ -278,11 +297,83 @@ class Coordinator:
             )
 
         # Remove old servers
-        for hostName, server in delServers.iteritems():
-            log.info("{} Removing server {} (no longer found in new configuration)".format(self, hostName),
-                     system=self.lvsservice.name)
-            server.destroy()
-            del self.servers[hostName]
+        for hostName in delServers:
+            self._removeServer(hostName)
+
+        return self._configApplied(initList)
+
+    def onConfigDelta(self, changed, removed):
+        """
+        Takes a dictionary of server hostnames to configuration dicts of
+        only the added and changed servers, and an iterable of the hostnames
+        of removed servers, and updates the state of the coordinator
+        accordingly. Servers not mentioned are left alone.
+        """
+
+        self.serverConfig.update(changed)
+        for hostName in removed:
+            self.serverConfig.pop(hostName, None)
+        self._cacheConfig()
+
+        initList = []
+
+        for hostName, hostConfig in changed.items():
+            if hostName in self.servers:
+                self._mergeServer(hostName, hostConfig)
+            else:
+                initList.append(self._addServer(hostName, hostConfig, logging.INFO))
+
+        for hostName in removed:
+            if hostName in self.servers:
+                self._removeServer(hostName)
+
+        return self._configApplied(initList)
+
+    def _cacheConfig(self):
+        if self.configCache is not None:
+            self.configCache.update(dict(self.serverConfig))
+
+    def _mergeServer(self, hostName, hostConfig):
+        """Merges new configuration into an existing server"""
+
+        server = self.servers[hostName]
+        server.merge(hostConfig)
+        # Calculate up status for the previously existing server
+        self.refreshPreexistingServer(server)
+        data = {'status': (server.enabled and "enabled" or "disabled"),
+                'host': hostName, 'weight': server.weight}
+        log.info(
+            "Merged {status} server {host}, weight {weight}".format(**data),
+            system=self.lvsservice.name
+        )
+
+    def _addServer(self, hostName, hostConfig, lvl):
+        """Adds a new server, and returns the deferred of its initialization"""
+
+        server = pybal.server.Server.buildServer(hostName, hostConfig, self.lvsservice)
+        data = {'status': (server.enabled and "enabled" or "disabled"),
+                'host': hostName, 'weight': server.weight}
+        # Initialize with LVS service specific configuration
+        self.lvsservice.initServer(server)
+        self.servers[hostName] = server
+        initDeferred = server.initialize(self)
+        util._log(
+                  "New {status} server {host}, weight {weight}".format(**data),
+                  lvl,
+                  system=self.lvsservice.name
+        )
+        return initDeferred
+
+    def _removeServer(self, hostName):
+        """Removes a server no longer in the configuration"""
+
+        log.info("{} Removing server {} (no longer found in new configuration)".format(self, hostName),
+                 system=self.lvsservice.name)
+        self.servers.pop(hostName).destroy()
+
+    def _configApplied(self, initList):
+        """Waits for the new servers in initList to initialize, and
+        updates metrics"""
 
         # Wait for all new servers to finish initializing
         self.serverInitDeferredList = defer.DeferredList(initList).addCallback(self._serverInitDone)
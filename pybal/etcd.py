@@ -8,34 +8,27 @@
 """
 from __future__ import absolute_import
 
-import copy
+import base64
 import json
 import urllib
 
+import treq.client
 from twisted.internet import defer, reactor, ssl
+from twisted.protocols import basic
 from twisted.python import failure
-from twisted.web import error
-from twisted.web.client import HTTPClientFactory
+from twisted.web import error, http
+from twisted.web.client import Agent, HTTPClientFactory, HTTPConnectionPool
 from twisted.web.http import HTTPClient, urlparse
 from twisted.internet.error import ConnectionDone
 
-from .config import ConfigurationObserver
+from .config import (ConfigurationObserver, apply_update, decode_value, encode_value,
+                     merge_changes)
 from .version import USER_AGENT_STRING
 from .util import log
 
 def decode_node(node):
     """Decode an individual node from an etcd response."""
-    key = node['key'].rsplit('/', 1)[-1]
-    # handle deletions by returning the key and a value of None
-    if 'value' not in node:
-        return key, None
-    value = json.loads(node['value'])
-    pooled = value.pop('pooled', None)
-    if pooled == 'inactive':
-        return key, None
-    if pooled is not None:
-        value['enabled'] = pooled == 'yes'
-    return key, value
+    return decode_value(node['key'], node.get('value'))
 
 
 def decode_etcd_data(data):
@@ -43,7 +36,8 @@ def decode_etcd_data(data):
     from key names, decoding JSON values, and removing etcd metadata."""
     node = data['node']
     if node.get('dir'):
-        return dict(decode_node(child) for child in node['nodes'])
+        # Empty directories have no nodes
+        return dict(decode_node(child) for child in node.get('nodes', ()))
     else:
         key, value = decode_node(node)
         return {key: value}
@@ -110,15 +104,19 @@ class EtcdClient(HTTPClient):
 
 
 class EtcdConfigurationObserver(ConfigurationObserver, HTTPClientFactory):
-    """A factory that will continuously monitor an etcd key for changes."""
+    """A factory that will continuously monitor an etcd key for changes.
+    Changes are written back with a PUT per host key."""
 
     urlScheme = 'etcd://'
+    writable = True
 
     agent = USER_AGENT_STRING
     method = 'GET'
     protocol = EtcdClient
     scheme = 'https'
     timeout = 0
+    connectTimeout = 5
+    persistTimeout = 10
     reconnectTimeout = 1
     followRedirect = False
     afterFoundGet = False
@@ -129,7 +127,9 @@ class EtcdConfigurationObserver(ConfigurationObserver, HTTPClientFactory):
         self.configUrl = configUrl
         self.host, self.port, self.key = self.parseConfigUrl(configUrl)
         self.waitIndex = None
-        self.lastConfig = {}
+        self.lastConfig = None
+        self.client = treq.client.HTTPClient(agent=Agent(
+            self.reactor, connectTimeout=self.connectTimeout))
 
     def startObserving(self):
         """Start (or re-start) watching etcd for changes."""
@@ -179,24 +179,266 @@ class EtcdConfigurationObserver(ConfigurationObserver, HTTPClientFactory):
         if self.waitIndex is not None:
             # This is already the result yielded by a watch operation
             self.waitIndex = self.getMaxModifiedIndex(update) + 1
+            full = False
         else:
+            # Not a watch, but a (re)load of the whole directory
             self.waitIndex = etcdIdx + 1
-        config = copy.deepcopy(self.lastConfig)
-
-        # Read new data
-        new_data = decode_etcd_data(update)
-        config.update(new_data)
-
-        # Remove deleted/inactive nodes
-        to_remove = [k for k, v in new_data.items() if v is None]
-        for k in to_remove:
-            if k in config:
-                del config[k]
+            full = True
 
         # Now update pybal config
-        if config != self.lastConfig:
-            self.coordinator.onConfigUpdate(copy.deepcopy(config))
-            self.lastConfig = config
+        self.lastConfig = apply_update(self.coordinator, self.lastConfig,
+                                       decode_etcd_data(update), full)
 
     def onFailure(self, reason):
         log.error('failed: %s' % reason, system="config-etcd")
+
+    @defer.inlineCallbacks
+    def persist(self, changes):
+        """Write changes to the keys of their hosts, one key at a time."""
+        for host, value in sorted(merge_changes(self.coordinator, changes).iteritems()):
+            url = '%s://%s:%d/v2/keys/%s/%s' % (self.scheme, self.host, self.port,
+                                                self.key.strip('/'), host)
+            response = yield self.client.put(url,
+                                             data={'value': encode_value(value)},
+                                             headers={'User-Agent': USER_AGENT_STRING},
+                                             reactor=self.reactor,
+                                             timeout=self.persistTimeout)
+            body = yield response.content()
+            if response.code not in (http.OK, http.CREATED):
+                raise error.Error(str(response.code), http.RESPONSES.get(response.code), body)
+
+
+def decode_kv(kv):
+    """Decode a key-value pair from an etcd v3 JSON gateway response."""
+    value = kv.get('value')
+    return decode_value(base64.b64decode(kv['key']),
+                        base64.b64decode(value) if value is not None else None)
+
+
+def decode_event(event):
+    """Decode an event from an etcd v3 watch response."""
+    if event.get('type', 'PUT') == 'DELETE':
+        return decode_value(base64.b64decode(event['kv']['key']), None)
+    return decode_kv(event['kv'])
+
+
+def prefix_range(prefix):
+    """Return the base64 encoded key and range_end of all etcd v3 keys
+    starting with prefix."""
+    range_end = prefix[:-1] + chr(ord(prefix[-1]) + 1)
+    return {'key': base64.b64encode(prefix),
+            'range_end': base64.b64encode(range_end)}
+
+
+class EtcdWatchProtocol(basic.LineOnlyReceiver):
+    """Receives the newline delimited JSON messages of an etcd v3 watch
+    stream, and hands their results to the observer. Streams that stay
+    silent for the watchIdleTimeout of the observer, not even sending
+    progress notifications, are assumed dead and stopped."""
+
+    delimiter = b'\n'
+    MAX_LENGTH = 16 * 1024 * 1024
+
+    def __init__(self, observer):
+        self.observer = observer
+        self.stopped = False
+        self.finished = defer.Deferred()
+        self.idleCall = None
+
+    def connectionMade(self):
+        self.idleCall = self.observer.reactor.callLater(
+            self.observer.watchIdleTimeout, self.idleTimeout)
+
+    def idleTimeout(self):
+        self.idleCall = None
+        log.warn("no watch response in %d seconds, watching again" %
+                 self.observer.watchIdleTimeout, system="config-etcd")
+        self.stop()
+
+    def lineReceived(self, line):
+        if self.stopped:
+            return
+        if self.idleCall is not None:
+            self.idleCall.reset(self.observer.watchIdleTimeout)
+        try:
+            message = json.loads(line)
+            if 'error' in message:
+                raise ValueError(message['error'])
+            self.observer.onWatchResponse(message['result'])
+        except Exception as err:
+            log.error("invalid watch response: %s - %s" % (line, err),
+                      system="config-etcd")
+            self.stop()
+
+    def lineLengthExceeded(self, line):
+        log.error("watch response too long", system="config-etcd")
+        self.stop()
+
+    def stop(self):
+        self.stopped = True
+        self.transport.stopProducing()
+
+    def connectionLost(self, reason):
+        if self.idleCall is not None:
+            self.idleCall.cancel()
+            self.idleCall = None
+        self.finished.callback(reason.value)
+
+
+class Etcd3ConfigurationObserver(ConfigurationObserver):
+    """Monitors a key prefix with the etcd v3 watch API.
+
+    Handles the 'etcd3://' scheme, e.g. 'etcd3://example.com/config/text',
+    through the JSON gateway of etcd. The configuration is loaded once
+    with a range request, after which changes are streamed by a single,
+    long-lived watch request. When the stream is interrupted, the watch
+    resumes from the last revision seen; if that revision has been
+    compacted in the meantime, the configuration is loaded again.
+    """
+
+    urlScheme = 'etcd3://'
+    writable = True
+
+    scheme = 'https'
+    connectTimeout = 5
+    timeout = 10
+    reconnectTimeout = 1
+    # etcd sends progress notifications every 10 minutes by default
+    watchIdleTimeout = 15 * 60
+
+    def __init__(self, coordinator, configUrl):
+        self.reactor = reactor
+        self.coordinator = coordinator
+        self.configUrl = configUrl
+        self.host, self.port, self.key = self.parseConfigUrl(configUrl)
+        self.prefix = self.key.rstrip('/') + '/'
+        self.revision = None
+        self.lastConfig = None
+        self.observing = False
+        self.request = None
+        self.watch = None
+        self.reconnectCall = None
+        self.pool = HTTPConnectionPool(self.reactor)
+        self.client = treq.client.HTTPClient(agent=Agent(
+            self.reactor, connectTimeout=self.connectTimeout, pool=self.pool))
+
+    def parseConfigUrl(self, configUrl):
+        parsed = urlparse(configUrl)
+        return parsed.hostname, parsed.port or 2379, parsed.path
+
+    def getURL(self, method):
+        return '%s://%s:%d/v3/%s' % (self.scheme, self.host, self.port, method)
+
+    def startObserving(self):
+        """Start (or re-start) watching etcd for changes."""
+        self.observing = True
+        self.connect()
+
+    def stopObserving(self):
+        """Stop watching etcd, and close all connections."""
+        self.observing = False
+        if self.reconnectCall is not None and self.reconnectCall.active():
+            self.reconnectCall.cancel()
+        self.reconnectCall = None
+        if self.request is not None:
+            self.request.cancel()
+        if self.watch is not None:
+            self.watch.stop()
+        return self.pool.closeCachedConnections()
+
+    def connect(self):
+        self.reconnectCall = None
+        if self.revision is None:
+            self.request = self.loadConfig()
+            self.request.addCallback(lambda ignored: self.startWatch())
+        else:
+            self.request = self.startWatch()
+        self.request.addErrback(self.onFailure)
+        self.request.addBoth(self.reconnect)
+
+    def reconnect(self, result):
+        self.request = None
+        self.watch = None
+        if self.observing:
+            log.info("reconnecting to etcd in %d seconds" % self.reconnectTimeout,
+                     system="config-etcd")
+            self.reconnectCall = self.reactor.callLater(self.reconnectTimeout,
+                                                        self.connect)
+
+    def post(self, method, body, **kwargs):
+        return self.client.post(
+            self.getURL(method), data=json.dumps(body),
+            headers={'User-Agent': USER_AGENT_STRING,
+                     'Content-Type': 'application/json'},
+            reactor=self.reactor, **kwargs).addCallback(self.checkResponse)
+
+    def checkResponse(self, response):
+        if response.code != http.OK:
+            raise error.Error(str(response.code), http.RESPONSES.get(response.code))
+        return response
+
+    @defer.inlineCallbacks
+    def loadConfig(self):
+        """Load the full configuration under the key prefix."""
+        response = yield self.post('kv/range', prefix_range(self.prefix),
+                                   timeout=self.timeout)
+        result = yield response.json()
+        self.onUpdate(dict(decode_kv(kv) for kv in result.get('kvs', ())),
+                      full=True)
+        self.revision = int(result['header']['revision'])
+
+    @defer.inlineCallbacks
+    def startWatch(self):
+        """Watch the key prefix for changes after the last revision seen.
+        Returns a deferred that fires when the watch stream ends."""
+        request = prefix_range(self.prefix)
+        request['start_revision'] = self.revision + 1
+        request['progress_notify'] = True
+        response = yield self.post('watch', {'create_request': request},
+                                   unbuffered=True)
+        log.info("watching %s from revision %d" % (self.configUrl, self.revision + 1),
+                 system="config-etcd")
+        self.watch = EtcdWatchProtocol(self)
+        response.deliverBody(self.watch)
+        reason = yield self.watch.finished
+        log.info("watch stream ended: %s" % reason,
+                 system="config-etcd")
+
+    def onWatchResponse(self, result):
+        if result.get('canceled') or int(result.get('compact_revision', 0)):
+            # The revision to resume from is gone; load everything again
+            log.warn("watch canceled: %s" % result.get('cancel_reason', 'compacted'),
+                     system="config-etcd")
+            self.revision = None
+            self.watch.stop()
+            return
+
+        events = result.get('events', ())
+        if events:
+            update = dict(decode_event(event) for event in events)
+            self.revision = max(int(event['kv']['mod_revision']) for event in events)
+            self.onUpdate(update)
+        elif not result.get('created'):
+            # Progress notification: all changes up to here have been sent
+            self.revision = max(self.revision, int(result['header']['revision']))
+
+    def onUpdate(self, update, full=False):
+        self.lastConfig = apply_update(self.coordinator, self.lastConfig, update, full)
+
+    @defer.inlineCallbacks
+    def persist(self, changes):
+        """Write changes to the keys of their hosts, in a single
+        transaction."""
+        puts = []
+        for host, value in sorted(merge_changes(self.coordinator, changes).iteritems()):
+            puts.append({'request_put': {
+                'key': base64.b64encode(self.prefix + host),
+                'value': base64.b64encode(encode_value(value))}})
+        response = yield self.post('kv/txn', {'success': puts},
+                                   timeout=self.timeout)
+        yield response.content()
+
+    def onFailure(self, reason):
+        if reason.check(defer.CancelledError) and not self.observing:
+            return
+        log.error('failed: %s' % reason.getErrorMessage(), system="config-etcd")
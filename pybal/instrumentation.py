@@ -13,9 +13,32 @@
 
   All results are returned either as human-readable lists or as json
   structures, depending on the Accept header of the request.
+
+  If an admin token is configured (instrumentation_admin_token), servers
+  can be changed with POST requests authorized with the header
+  "Authorization: Bearer <token>", and a JSON body:
+
+  /pools - {"pattern": <glob>, "enabled": <bool>, "weight": <int>}
+           changes all servers matching the glob in all pools, or in
+           the pools listed as "pools"
+  /pools/<pool> - {<host>: {"enabled": <bool>, "weight": <int>}, ...}
+  /pools/<pool>/<host> - {"enabled": <bool>, "weight": <int>}
+
+  Either of enabled and weight may be left out. The changes to each pool
+  are written to its configuration source first, and applied as a single
+  batch once written, so the servers never disagree with their source.
+  Requests for pools whose source can't be written are rejected with 409
+  Conflict. The response lists the changed servers and whether the
+  changes were persisted, by pool; if any pool could not be written, it
+  is answered with 502 Bad Gateway, and that pool is left unchanged.
 """
 
+import fnmatch
+import hmac
+
+from twisted.internet import defer
 from twisted.web.resource import Resource
+from twisted.web.server import NOT_DONE_YET
 
 try:
     from prometheus_client.twisted import MetricsResource
@@ -25,6 +48,8 @@ except ImportError:
 
 import json
 
+from pybal.util import log
+
 
 def wantJson(request):
     if (request.requestHeaders.hasHeader('Accept')
@@ -48,6 +73,127 @@ class Resp404(Resource):
         else:
             return msg['error']
 
+    render_POST = render_GET
+
+
+class AdminError(Exception):
+    """An admin request that can't be applied, with the HTTP status code
+    to answer it with"""
+
+    def __init__(self, code, message):
+        Exception.__init__(self, message)
+        self.code = code
+
+
+def parseChange(body):
+    """Returns the configuration attributes to change from a request body"""
+
+    change = {}
+    if 'enabled' in body:
+        if not isinstance(body['enabled'], bool):
+            raise AdminError(400, "enabled must be true or false")
+        change['enabled'] = body['enabled']
+    if 'weight' in body:
+        if type(body['weight']) is not int or body['weight'] < 0:
+            raise AdminError(400, "weight must be a non-negative integer")
+        change['weight'] = body['weight']
+    if not change:
+        raise AdminError(400, "Nothing to change, expected enabled and/or weight")
+    return change
+
+
+def checkWritable(changes):
+    """Raises AdminError unless the configuration sources of all pools in
+    changes can be written"""
+
+    readOnly = sorted(coordinator.lvsservice.name for coordinator in changes
+                      if not coordinator.configObserver.writable)
+    if readOnly:
+        raise AdminError(409, "The configuration of {} can't be written".format(
+            ", ".join(readOnly)))
+
+
+def applyChanges(changes):
+    """
+    Applies changes, a dictionary of coordinators to dictionaries of
+    server hostnames to the configuration attributes to change. The
+    changes to each pool are written back through its configuration
+    observer, and once written handed to its coordinator as one delta,
+    so they result in a single batch of IPVS commands. Returns a
+    deferred that fires with the results by pool.
+    """
+
+    results = {}
+    deferreds = []
+    for coordinator, poolChanges in changes.iteritems():
+        pool = coordinator.lvsservice.name
+        log.info("Admin request: {}".format(", ".join(
+            "{} {}".format(host, change) for host, change in sorted(poolChanges.items()))),
+            system=pool)
+        results[pool] = {'changed': [], 'persisted': False}
+
+        d = defer.maybeDeferred(coordinator.configObserver.persist, poolChanges)
+        d.addCallbacks(_persisted, _notPersisted,
+                       callbackArgs=(coordinator, poolChanges, results[pool]),
+                       errbackArgs=(results[pool], pool))
+        deferreds.append(d)
+    return defer.DeferredList(deferreds).addCallback(lambda ignored: results)
+
+
+def _persisted(ignored, coordinator, poolChanges, result):
+    coordinator.onConfigDelta(
+        {host: dict(coordinator.serverConfig.get(host, {}), **change)
+         for host, change in poolChanges.iteritems()}, [])
+    result['changed'] = sorted(poolChanges)
+    result['persisted'] = True
+
+
+def _notPersisted(failure, result, pool):
+    result['error'] = failure.getErrorMessage()
+    log.error("Could not persist admin changes, not applying them: {}".format(
+        result['error']), system=pool)
+
+
+def renderAdmin(request, getChanges):
+    """
+    Renders an admin request: checks its authorization, gets the changes
+    by coordinator from its JSON body with getChanges, and applies them.
+    The response is sent once the changes have been persisted.
+    """
+
+    request.responseHeaders.addRawHeader(b"content-type", b"application/json")
+    try:
+        token = PoolsRoot.adminToken
+        if not token:
+            raise AdminError(403, "The admin API is disabled")
+        if not hmac.compare_digest(str(request.getHeader('Authorization') or ''),
+                                   'Bearer ' + token):
+            raise AdminError(401, "Not authorized")
+        try:
+            body = json.loads(request.content.read())
+        except ValueError:
+            raise AdminError(400, "The request body is not valid JSON")
+        if not isinstance(body, dict):
+            raise AdminError(400, "The request body must be a JSON object")
+        changes = getChanges(body)
+        checkWritable(changes)
+    except AdminError as e:
+        request.setResponseCode(e.code)
+        return json.dumps({'error': str(e)})
+
+    finished = []
+    request.notifyFinish().addBoth(finished.append)
+
+    def respond(results):
+        if not finished:
+            if not all(result['persisted'] for result in results.itervalues()):
+                request.setResponseCode(502)
+            request.write(json.dumps(results))
+            request.finish()
+
+    applyChanges(changes).addCallback(respond)
+    return NOT_DONE_YET
+
 
 class ServerRoot(Resource):
     """Root url resource"""
@@ -104,6 +250,9 @@ class PoolsRoot(Resource):
     """
     _pools = {}
 
+    # Bearer token of admin requests; the admin API is disabled without it
+    adminToken = None
+
     @classmethod
     def addPool(cls, path, coordinator):
         cls._pools[path] = coordinator
@@ -122,6 +271,33 @@ class PoolsRoot(Resource):
         else:
             return "\n".join(pools) + "\n"
 
+    def render_POST(self, request):
+        return renderAdmin(request, self.getChanges)
+
+    def getChanges(self, body):
+        """Returns the change of body for all servers matching its pattern,
+        by coordinator"""
+
+        change = parseChange(body)
+        pattern = body.get('pattern')
+        if not isinstance(pattern, basestring) or not pattern:
+            raise AdminError(400, "Expected a pattern of servers to change")
+        pools = body.get('pools', self._pools.keys())
+        if not isinstance(pools, list):
+            raise AdminError(400, "pools must be a list")
+
+        changes = {}
+        for pool in pools:
+            if pool not in self._pools:
+                raise AdminError(404, "Pool {} not found".format(pool))
+            coordinator = self._pools[pool]
+            hosts = fnmatch.filter(coordinator.servers.keys(), pattern)
+            if hosts:
+                changes[coordinator] = {host: change for host in hosts}
+        if not changes:
+            raise AdminError(404, "No servers match {}".format(pattern))
+        return changes
+
 
 class PoolServers(Resource):
     """Single pool resource.
@@ -138,7 +314,7 @@ class PoolServers(Resource):
         if not path:
             return self
         if path in self.coordinator.servers:
-            return PoolServer(self.coordinator.servers[path])
+            return PoolServer(self.coordinator.servers[path], self.coordinator)
         return Resp404()
 
     def render_GET(self, request):
@@ -153,6 +329,23 @@ class PoolServers(Resource):
                 res += "{}:\t{}\n".format(hostname, server.textStatus())
             return res
 
+    def render_POST(self, request):
+        return renderAdmin(request, self.getChanges)
+
+    def getChanges(self, body):
+        """Returns the changes by server in body"""
+
+        changes = {}
+        for host, change in body.iteritems():
+            if host not in self.coordinator.servers:
+                raise AdminError(404, "Server {} not found".format(host))
+            if not isinstance(change, dict):
+                raise AdminError(400, "Expected an object of changes for {}".format(host))
+            changes[host] = parseChange(change)
+        if not changes:
+            raise AdminError(400, "No servers to change")
+        return {self.coordinator: changes}
+
 
 class PoolServer(Resource):
     """
@@ -162,11 +355,16 @@ class PoolServer(Resource):
     """
     isLeaf = True
 
-    def __init__(self, server):
+    def __init__(self, server, coordinator=None):
         self.server = server
+        self.coordinator = coordinator
 
     def render_GET(self, request):
         if wantJson(request):
             return json.dumps(self.server.dumpState())
         else:
             return self.server.textStatus() + "\n"
+
+    def render_POST(self, request):
+        return renderAdmin(request, lambda body: {
+            self.coordinator: {self.server.host: parseChange(body)}})
@@ -3,40 +3,106 @@
   PyBal kubernetes client
   ~~~~~~~~~~~~~~~~~~~~~~~
 
-  This module allows PyBal to generate config based on k8s services.
+  This module allows PyBal to generate config based on k8s nodes, or on
+  the endpoints of k8s services.
 
 """
 
 from __future__ import absolute_import
 
 import copy
+import json
 
+import treq
 import treq.client
-from twisted.internet import defer, reactor, task
+from twisted.internet import defer, reactor, task, threads
+from twisted.protocols import basic
 from twisted.web import http
 from twisted.web.client import Agent
 from twisted.web.http import urlparse
 
-from .config import ConfigurationObserver
+from .config import ConfigurationObserver, apply_update
 from .util import log
 
 UNSCHEDULABLE_SPEC = 'unschedulable'
+SERVICE_NAME_LABEL = 'kubernetes.io/service-name'
+
+
+class KubernetesWatchProtocol(basic.LineOnlyReceiver):
+    """Receives the newline delimited JSON events of a Kubernetes watch
+    stream, and hands them to the observer."""
+
+    delimiter = b'\n'
+    MAX_LENGTH = 16 * 1024 * 1024
+
+    def __init__(self, observer):
+        self.observer = observer
+        self.stopped = False
+        self.finished = defer.Deferred()
+
+    def lineReceived(self, line):
+        if self.stopped:
+            return
+        try:
+            self.observer.onWatchEvent(json.loads(line))
+        except Exception as e:
+            log.error("Invalid watch event: %s" % e, system="config-kubernetes")
+            self.stop()
+
+    def lineLengthExceeded(self, line):
+        log.error("Watch event too long", system="config-kubernetes")
+        self.stop()
+
+    def stop(self):
+        self.stopped = True
+        self.transport.stopProducing()
+
+    def connectionLost(self, reason):
+        self.finished.callback(reason.value)
 
 
 class KubernetesConfigurationObserver(ConfigurationObserver):
+    """ConfigurationObserver for Kubernetes nodes.
+
+    The nodes are listed once, after which changes are followed with a
+    watch from the resourceVersion of the list. Watches that time out are
+    resumed from the last resourceVersion seen, and the nodes are listed
+    again if that is too old (410 Gone). Watches that fail or end within
+    minWatchSeconds are retried after reconnectTimeout seconds, doubling
+    up to maxReconnectTimeout while that keeps happening. After list
+    failures, observing starts over every reloadIntervalSeconds.
+
+    Nodes are listed in pages of at most listLimit nodes, which are
+    decoded in a thread. The nodes can be narrowed down with the
+    labelSelector and fieldSelector query parameters of the URL, e.g.
+    k8s://token@host:6443/?labelSelector=node-role%3Dlvs
+    """
 
     urlScheme = 'k8s://'
+    scheme = 'https'
     connectTimeout = 1
     timeout = 3
+    watchTimeoutSeconds = 300
+    minWatchSeconds = 10
+    reconnectTimeout = 1
+    maxReconnectTimeout = 60
+    listLimit = 250
+    selectorParams = ('labelSelector', 'fieldSelector')
 
     def __init__(self, coordinator, configUrl, reloadIntervalSeconds=60):
         self.loop = None
         self.lastConfig = None
+        self.objects = {}
+        self.resourceVersion = None
+        self.watching = False
+        self.watchProtocol = None
+        self.backoffCall = None
         self.reactor = reactor
         self.coordinator = coordinator
         self.reloadIntervalSeconds = reloadIntervalSeconds
         self.configUrl = configUrl
         self.host, self.port, self.token = self.parseConfigUrl(configUrl)
+        self.selectors = self.parseSelectors(configUrl)
         self.client = treq.client.HTTPClient(agent=self.getAgent())
 
     @staticmethod
@@ -45,15 +111,20 @@ class KubernetesConfigurationObserver(ConfigurationObserver):
         # k8s API uses an authorization token, so no password on the URL, only username
         return parsed.hostname, parsed.port or 443, parsed.username
 
-    def getNodesURL(self):
-        return 'https://%s:%s/v1/nodes' % (self.host, self.port)
+    @classmethod
+    def parseSelectors(cls, configUrl):
+        query = http.parse_qs(urlparse(configUrl).query)
+        return {k: v[-1] for k, v in query.items() if k in cls.selectorParams}
+
+    def getResourceURL(self):
+        return '%s://%s:%s/v1/nodes' % (self.scheme, self.host, self.port)
 
     def getAgent(self):
         return Agent(reactor=self.reactor,
                      connectTimeout=self.connectTimeout)
 
     def getParams(self):
-        return {'pretty': 'false'}
+        return dict(self.selectors, pretty='false')
 
     def getHeaders(self):
         return {
@@ -61,50 +132,203 @@ class KubernetesConfigurationObserver(ConfigurationObserver):
             'Authorization': 'Bearer %s' % self.token,
         }
 
+    def parseNode(self, item):
+        """Returns the hostname and configuration of a node, or None as
+        configuration for nodes that shouldn't be pooled. Unschedulable
+        (cordoned) nodes aren't pooled; the API server sends
+        spec.unschedulable as a boolean, older fixtures as 'true'."""
+        hostname = item['metadata']['name']
+        if item['spec'].get(UNSCHEDULABLE_SPEC) in ('true', True):
+            return hostname, None
+
+        enabled = False
+        for condition in item['status']['conditions']:
+            if condition['type'] == 'Ready':
+                if condition['status'] == 'True':
+                    enabled = True
+                break
+
+        return hostname, {
+            'weight': 1,
+            'enabled': enabled
+        }
+
+    def parseItem(self, item):
+        """Returns the servers of a listed or watched object, as a dict of
+        {hostname: config}."""
+        hostname, config = self.parseNode(item)
+        return {hostname: config} if config is not None else {}
+
     def parseKubernetesPayload(self, payload):
-        ret = {}
+        """Returns the servers of each object in a list, by object name."""
+        return {item['metadata']['name']: self.parseItem(item)
+                for item in payload['items']}
 
-        try:
-            for item in payload['items']:
-                hostname = item['metadata']['name']
-                enabled = False
-                if UNSCHEDULABLE_SPEC in item['spec']:
-                    if item['spec'][UNSCHEDULABLE_SPEC] == 'true':
-                        continue
-
-                for condition in item['status']['conditions']:
-                    if condition['type'] == 'Ready':
-                        if condition['status'] == 'True':
-                            enabled = True
-                        break
-
-                ret[hostname] = {
-                    'weight': 1,
-                    'enabled': enabled
-                }
-            return ret
-        except KeyError as e:
-            log.error("Invalid API response: %s" % e, system="config-kubernetes")
-            raise Exception('Invalid payload')
+    def decodeList(self, body):
+        """Decodes a page of a list. Returns the servers of its objects and
+        the list metadata.
+
+        Called in a thread; only the server configuration is kept of the
+        decoded page."""
+        payload = json.loads(body)
+        return self.parseKubernetesPayload(payload), payload.get('metadata', {})
+
+    @staticmethod
+    def mergeServers(objects, hostnames=None):
+        """Returns the configuration of the servers of all objects, or of
+        only those in hostnames. Servers of several objects are enabled if
+        they are enabled in any of them."""
+        config = {}
+        for servers in objects.itervalues():
+            for hostname, server in servers.iteritems():
+                if hostnames is not None and hostname not in hostnames:
+                    continue
+                if hostname not in config or (server['enabled'] and
+                                              not config[hostname]['enabled']):
+                    config[hostname] = server
+        return config
 
     @defer.inlineCallbacks
     def observe(self):
-        response = yield self.client.get(self.getNodesURL(),
-                                         params=self.getParams(),
+        """List the nodes if needed. When observing, watch them for changes
+        until stopped."""
+        if self.resourceVersion is None:
+            yield self.list()
+        failures = 0
+        while self.watching:
+            started = self.reactor.seconds()
+            try:
+                yield self.watch()
+            except Exception as e:
+                log.error("Watch failed: %s" % e, system="config-kubernetes")
+                failures += 1
+            else:
+                if self.reactor.seconds() - started < self.minWatchSeconds:
+                    failures += 1
+                else:
+                    failures = 0
+            if failures and self.watching:
+                try:
+                    yield self.backoff(failures)
+                except defer.CancelledError:
+                    return
+            if self.resourceVersion is None and self.watching:
+                yield self.list()
+
+    def backoff(self, failures):
+        """Returns a deferred that fires after the reconnect timeout for
+        the number of consecutive failed or short watches."""
+        delay = min(self.maxReconnectTimeout,
+                    self.reconnectTimeout * 2 ** (failures - 1))
+        log.debug("Watching again in %d seconds" % delay,
+                  system="config-kubernetes")
+        self.backoffCall = task.deferLater(self.reactor, delay, lambda: None)
+        return self.backoffCall.addBoth(self._backoffDone)
+
+    def _backoffDone(self, result):
+        self.backoffCall = None
+        return result
+
+    @defer.inlineCallbacks
+    def list(self):
+        """List the objects, one page at a time."""
+        objects = {}
+        params = dict(self.getParams(), limit=str(self.listLimit))
+        while True:
+            response = yield self.client.get(self.getResourceURL(),
+                                             params=params,
+                                             headers=self.getHeaders(),
+                                             reactor=self.reactor,
+                                             timeout=self.timeout)
+            if response.code == http.GONE and 'continue' in params:
+                # The list expired before we got all pages; start over
+                yield response.content()
+                log.info("List expired, listing again",
+                         system="config-kubernetes")
+                objects = {}
+                del params['continue']
+                continue
+            elif response.code != http.OK:
+                raise Exception("Unexpected status code: %d" % response.code)
+
+            body = yield response.content()
+            try:
+                page, metadata = yield threads.deferToThreadPool(
+                    self.reactor, self.reactor.getThreadPool(),
+                    self.decodeList, body)
+            except ValueError as e:
+                log.error("Invalid response format: %s" % e,
+                          system="config-kubernetes")
+                raise Exception('Invalid payload')
+            except (KeyError, TypeError, AttributeError) as e:
+                log.error("Invalid API response: %s" % e, system="config-kubernetes")
+                raise Exception('Invalid payload')
+
+            objects.update(page)
+            if not metadata.get('continue'):
+                break
+            params['continue'] = metadata['continue']
+
+        self.objects = objects
+        self.resourceVersion = metadata.get('resourceVersion')
+        self.onUpdate(self.mergeServers(objects))
+
+    @defer.inlineCallbacks
+    def watch(self):
+        """Watch the nodes for changes after the last resourceVersion seen.
+        Returns a deferred that fires when the watch ends."""
+        params = dict(self.getParams(), watch='true', allowWatchBookmarks='true',
+                      timeoutSeconds=str(self.watchTimeoutSeconds))
+        if self.resourceVersion is not None:
+            params['resourceVersion'] = self.resourceVersion
+        response = yield self.client.get(self.getResourceURL(),
+                                         params=params,
                                          headers=self.getHeaders(),
                                          reactor=self.reactor,
-                                         timeout=self.timeout)
-        if response.code != http.OK:
+                                         timeout=self.timeout,
+                                         unbuffered=True)
+        if response.code == http.GONE:
+            # Our resourceVersion is too old; list the nodes again
+            self.resourceVersion = None
+            yield treq.content(response)
+            return
+        elif response.code != http.OK:
             raise Exception("Unexpected status code: %d" % response.code)
-        try:
-            payload = yield response.json()
-        except ValueError as e:
-            log.error("Invalid response format: %s" % e,
-                      system="config-kubernetes")
-            raise Exception('Invalid payload')
 
-        newConfig = self.parseKubernetesPayload(payload)
-        self.onUpdate(newConfig)
+        self.watchProtocol = KubernetesWatchProtocol(self)
+        response.deliverBody(self.watchProtocol)
+        reason = yield self.watchProtocol.finished
+        self.watchProtocol = None
+        log.debug("Watch ended: %s" % reason,
+                  system="config-kubernetes")
+
+    def onWatchEvent(self, event):
+        """Applies a single watch event."""
+        eventType, item = event['type'], event['object']
+        if eventType == 'ERROR':
+            if item.get('code') == http.GONE:
+                # Our resourceVersion is too old; list the nodes again
+                log.info("Watch expired: %s" % item.get('message'),
+                         system="config-kubernetes")
+                self.resourceVersion = None
+                self.watchProtocol.stop()
+                return
+            raise Exception("Watch error: %s" % item.get('message'))
+
+        self.resourceVersion = item['metadata']['resourceVersion']
+        if eventType not in ('ADDED', 'MODIFIED', 'DELETED'):
+            return
+
+        # Update only the servers that the object had or has
+        name = item['metadata']['name']
+        hostnames = set(self.objects.pop(name, {}))
+        if eventType != 'DELETED':
+            self.objects[name] = self.parseItem(item)
+            hostnames.update(self.objects[name])
+        servers = self.mergeServers(self.objects, hostnames)
+        self.lastConfig = apply_update(self.coordinator, self.lastConfig,
+                                       {hostname: servers.get(hostname)
+                                        for hostname in hostnames})
 
     def onUpdate(self, config):
         if config != self.lastConfig:
@@ -113,15 +337,94 @@ class KubernetesConfigurationObserver(ConfigurationObserver):
 
     def onFailure(self, failure):
         log.error("failed: %s" % failure, system="config-kubernetes")
-        if not self.loop.running:
+        if self.watching and not self.loop.running:
             self.startObserving(now=False)
 
     def startObserving(self, now=True):
+        self.watching = True
         self.loop = task.LoopingCall(self.observe)
         self.loop.clock = self.reactor
         self.loop.start(self.reloadIntervalSeconds,
                         now=now).addErrback(self.onFailure)
 
     def stopObserving(self):
-        if self.loop is not None:
+        self.watching = False
+        if self.watchProtocol is not None:
+            self.watchProtocol.stop()
+        if self.backoffCall is not None:
+            self.backoffCall.cancel()
+        if self.loop is not None and self.loop.running:
             self.loop.stop()
+
+
+class KubernetesEndpointSliceObserver(KubernetesConfigurationObserver):
+    """ConfigurationObserver for the endpoints of a Kubernetes service.
+
+    The discovery.k8s.io/v1 EndpointSlices of the service are listed and
+    watched like nodes are, and each of their endpoint addresses becomes
+    a server, so traffic goes straight to the pods. Pods must listen on
+    the port of the LVS service. The URL names the namespace and the
+    service:
+
+        k8s-endpointslices://token@host:6443/namespace/service
+
+    Endpoints are enabled when they are ready. With the zone query
+    parameter, endpoints with topology hints for that zone, or in that
+    zone if they have no hints, get zoneWeight (10) as weight instead of
+    1. Only slices of addressType (IPv4) are used.
+    """
+
+    urlScheme = 'k8s-endpointslices://'
+    ZONE_WEIGHT = 10
+    ADDRESS_TYPE = 'IPv4'
+
+    def __init__(self, coordinator, configUrl, reloadIntervalSeconds=60):
+        super(KubernetesEndpointSliceObserver, self).__init__(
+            coordinator, configUrl, reloadIntervalSeconds)
+        parsed = urlparse(configUrl)
+        try:
+            self.namespace, self.service = parsed.path.strip('/').split('/')
+        except ValueError:
+            raise ValueError("Invalid EndpointSlice URL, expected "
+                             "k8s-endpointslices://token@host:port/namespace/service")
+        query = http.parse_qs(parsed.query)
+        self.zone = query.get('zone', [None])[-1]
+        self.zoneWeight = int(query.get('zoneWeight', [self.ZONE_WEIGHT])[-1])
+        self.addressType = query.get('addressType', [self.ADDRESS_TYPE])[-1]
+
+    def getResourceURL(self):
+        return '%s://%s:%s/apis/discovery.k8s.io/v1/namespaces/%s/endpointslices' % (
+            self.scheme, self.host, self.port, self.namespace)
+
+    def getParams(self):
+        params = super(KubernetesEndpointSliceObserver, self).getParams()
+        selector = '%s=%s' % (SERVICE_NAME_LABEL, self.service)
+        if params.get('labelSelector'):
+            selector += ',' + params['labelSelector']
+        params['labelSelector'] = selector
+        return params
+
+    def parseItem(self, item):
+        """Returns the endpoint addresses of an EndpointSlice as servers."""
+        servers = {}
+        if item.get('addressType') != self.addressType:
+            return servers
+
+        for endpoint in item.get('endpoints') or []:
+            # A missing ready condition means ready
+            enabled = endpoint.get('conditions', {}).get('ready') is not False
+            weight = 1
+            if self.zone is not None:
+                hints = endpoint.get('hints', {}).get('forZones')
+                if hints is not None:
+                    local = self.zone in [hint['name'] for hint in hints]
+                else:
+                    local = endpoint.get('zone') == self.zone
+                if local:
+                    weight = self.zoneWeight
+            for address in endpoint['addresses']:
+                servers[address] = {
+                    'weight': weight,
+                    'enabled': enabled
+                }
+        return servers
@@ -17,9 +17,9 @@ from ConfigParser import SafeConfigParser, NoOptionError
 
 from twisted.internet import reactor
 
-# Note: these etcd & kubernetes import here might look unused (and it is!)
+# Note: these etcd, kubernetes & consul import here might look unused (and it is!)
 # but is needed by the magic performed by ConfigurationObserver.fromUrl
-from pybal import util, ipvs, instrumentation, etcd, kubernetes
+from pybal import util, ipvs, instrumentation, etcd, kubernetes, consul
 from pybal.bgpfailover import BGPFailover
 from pybal.coordinator import Coordinator
 
@@ -132,6 +132,10 @@ def main():
             from twisted.web.server import Site
             factory = Site(instrumentation.ServerRoot())
 
+            # Changes through the admin API need this bearer token
+            instrumentation.PoolsRoot.adminToken = configdict.get(
+                'instrumentation_admin_token')
+
             port = configdict.getint('instrumentation_port', 9090)
 
             # Bind on the IPs listed in 'instrumentation_ips'. Default to
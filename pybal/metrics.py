@@ -25,9 +25,18 @@ class DummyGauge(DummyMetric):
     def set(self, *args, **kwargs):
         pass
 
+    def set_function(self, *args, **kwargs):
+        pass
+
+class DummyHistogram(DummyMetric):
+    def observe(self, *args, **kwargs):
+        pass
+
 if metrics_implementation == 'prometheus':
     Counter = prometheus_client.Counter
     Gauge = prometheus_client.Gauge
+    Histogram = prometheus_client.Histogram
 else:
     Counter = DummyCounter
     Gauge = DummyGauge
+    Histogram = DummyHistogram
@@ -14,7 +14,7 @@ from twisted.internet import task
 
 # Pybal imports
 from . import util
-from pybal.metrics import Counter, Gauge
+from pybal.metrics import Counter, Gauge, Histogram
 
 
 _log = util._log
@@ -40,9 +40,15 @@ class MonitoringProtocol(object):
         'down_transitions_total': Counter('down_transitions_total', 'Monitor down transition count', **metric_keywords),
         'up_results_total': Counter('up_results_total', 'Monitor up result count', **metric_keywords),
         'down_results_total': Counter('down_results_total', 'Monitor down result count', **metric_keywords),
-        'status': Gauge('status', 'Monitor up status', **metric_keywords)
+        'status': Gauge('status', 'Monitor up status', **metric_keywords),
+        'timeout_seconds': Gauge('timeout_seconds', 'Monitor adaptive check timeout', **metric_keywords)
     }
 
+    HISTOGRAM_BUCKETS = (.005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10, 30)
+
+    # Latency histograms of all monitor types, created on first use
+    histograms = {}
+
     def __init__(self, coordinator, server, configuration={}, reactor=None):
         """Constructor"""
 
@@ -55,6 +61,7 @@ class MonitoringProtocol(object):
         self.active = False
         self.firstCheck = True
         self._shutdownTriggerID = None
+        self.adaptiveTimeout = None
 
         self.metric_labels = {
             'service': self.server.lvsservice.name,
@@ -120,6 +127,57 @@ class MonitoringProtocol(object):
         s = "%s %s" % (self.server.lvsservice.name, self.__name__)
         _log(msg, level, s)
 
+    def _getAdaptiveTimeout(self, timeout):
+        """Returns an AdaptiveTimeout bounded by <monitor>.timeout-min and
+        <monitor>.timeout-max if <monitor>.timeout-adaptive is enabled,
+        None otherwise. The (static) timeout is used as the default maximum."""
+
+        if not self._getConfigBool('timeout-adaptive', False):
+            return None
+
+        adaptiveTimeout = AdaptiveTimeout(
+            self._getConfigFloat('timeout-min', min(AdaptiveTimeout.MIN_TIMEOUT, timeout)),
+            self._getConfigFloat('timeout-max', timeout))
+        self.metrics['timeout_seconds'].labels(**self.metric_labels).set(
+            adaptiveTimeout.timeout)
+        return adaptiveTimeout
+
+    def _currentTimeout(self, timeout):
+        """Returns the timeout to use for the next check."""
+        if self.adaptiveTimeout is None:
+            return timeout
+        return self.adaptiveTimeout.timeout
+
+    def _sampleTimeout(self, duration):
+        """Feeds the duration of a successful check to the adaptive timeout."""
+        if self.adaptiveTimeout is None:
+            return
+        self.metrics['timeout_seconds'].labels(**self.metric_labels).set(
+            self.adaptiveTimeout.sample(duration))
+
+    def _backoffTimeout(self):
+        """Backs off the adaptive timeout after a check has timed out."""
+        if self.adaptiveTimeout is None:
+            return
+        self.metrics['timeout_seconds'].labels(**self.metric_labels).set(
+            self.adaptiveTimeout.backoff())
+
+    def _getHistogram(self, name, documentation, labelnames=()):
+        """Returns the latency histogram of this monitor type with the given
+        name, creating it on first use. As a metric can only have one set of
+        buckets, those configured in <monitor>.histogram-buckets of the
+        first monitor of this type to use it apply to all services."""
+
+        subsystem = 'monitor_' + self.__name__.lower()
+        if (subsystem, name) not in self.histograms:
+            self.histograms[(subsystem, name)] = Histogram(
+                name, documentation,
+                labelnames=self.metric_labelnames + labelnames,
+                namespace='pybal',
+                subsystem=subsystem,
+                buckets=self._getConfigBuckets('histogram-buckets'))
+        return self.histograms[(subsystem, name)]
+
     def _getConfigBool(self, optionname, default=None):
         return self.configuration.getboolean(
             '%s.%s' % (self.__name__.lower(), optionname), default)
@@ -128,6 +186,10 @@ class MonitoringProtocol(object):
         return self.configuration.getint(
             '%s.%s' % (self.__name__.lower(), optionname), default)
 
+    def _getConfigFloat(self, optionname, default=None):
+        return self.configuration.getfloat(
+            '%s.%s' % (self.__name__.lower(), optionname), default)
+
     def _getConfigString(self, optionname):
         val = self.configuration[self.__name__.lower() + '.' + optionname]
         if type(val) == str:
@@ -152,14 +214,88 @@ class MonitoringProtocol(object):
             raise ValueError("Value of %s is not a string or stringlist" %
                              optionname)
 
+    def _getConfigBuckets(self, optionname):
+        """Takes a (string) value, eval()s it and checks whether it
+        consists of a non-empty, increasing list of numbers. Defaults
+        to HISTOGRAM_BUCKETS."""
+        key = self.__name__.lower() + '.' + optionname
+        try:
+            val = eval(self.configuration[key])
+        except KeyError:
+            return self.HISTOGRAM_BUCKETS
+        if (isinstance(val, (list, tuple)) and val and
+            all(isinstance(x, (int, float)) for x in val) and
+            list(val) == sorted(set(val))):
+            return tuple(val)
+        else:
+            raise ValueError("Value of %s is not an increasing list of numbers" %
+                             optionname)
+
+
+class AdaptiveTimeout(object):
+    """
+    Check timeout derived from observed check durations, in the same way
+    TCP derives its retransmission timeout from round trip times (RFC 6298):
+    a smoothed duration plus K times its smoothed mean deviation, bounded
+    by a minimum and maximum.
+    """
+
+    ALPHA = 1 / 8.0
+    BETA = 1 / 4.0
+    K = 4
+
+    MIN_TIMEOUT = 1
+
+    def __init__(self, minimum, maximum):
+        if not 0 < minimum <= maximum:
+            raise ValueError("timeout-min must be positive and not exceed timeout-max")
+
+        self.minimum = minimum
+        self.maximum = maximum
+        self.srtt = None
+        self.rttvar = None
+        # Be conservative until the first duration has been observed
+        self.timeout = maximum
+
+    def sample(self, duration):
+        """Updates the estimate with the duration of a successful check,
+        and returns the new timeout."""
+
+        if self.srtt is None:
+            self.srtt = duration
+            self.rttvar = duration / 2.0
+        else:
+            self.rttvar = ((1 - self.BETA) * self.rttvar +
+                           self.BETA * abs(self.srtt - duration))
+            self.srtt = (1 - self.ALPHA) * self.srtt + self.ALPHA * duration
+
+        self.timeout = self._bound(self.srtt + self.K * self.rttvar)
+        return self.timeout
+
+    def backoff(self):
+        """Doubles the timeout after a check timed out, and returns it."""
+
+        self.timeout = self._bound(self.timeout * 2)
+        return self.timeout
+
+    def _bound(self, timeout):
+        return max(self.minimum, min(timeout, self.maximum))
+
 
 class LoopingCheckMonitoringProtocol(MonitoringProtocol):
     """
     Class that sets up a looping call (self.check) to do a monitoring check with
     a semi-fixed interval.
+
+    If <monitor>.interval-min and/or <monitor>.interval-max are configured,
+    the interval adapts to the state of the server: checks run every
+    interval-min seconds while the server is failing, recovering or being
+    checked for the first time, and the interval doubles (up to
+    interval-max) after every interval-stable-checks consecutive up results.
     """
 
     INTV_CHECK = 10
+    INTV_STABLE_CHECKS = 10
 
     def __init__(self, coordinator, server, configuration={}, reactor=None):
 
@@ -171,7 +307,18 @@ class LoopingCheckMonitoringProtocol(MonitoringProtocol):
             configuration,
             reactor)
 
-        self.intvCheck = self._getConfigInt('interval', self.INTV_CHECK)
+        self.intvCheck = self._getConfigFloat('interval', self.INTV_CHECK)
+        self.intvCheckMin = self._getConfigFloat('interval-min', self.intvCheck)
+        self.intvCheckMax = self._getConfigFloat('interval-max',
+                                                 max(self.intvCheck, self.intvCheckMin))
+        if not 0 < self.intvCheckMin <= self.intvCheckMax:
+            raise ValueError("interval-min must be positive and not exceed interval-max")
+        self.intvStableChecks = self._getConfigInt('interval-stable-checks',
+                                                   self.INTV_STABLE_CHECKS)
+        if self.intvStableChecks < 1:
+            raise ValueError("interval-stable-checks must be at least 1")
+        self.adaptiveInterval = self.intvCheckMin < self.intvCheckMax
+        self.stableChecks = 0
 
         self.checkCall = None
 
@@ -184,7 +331,7 @@ class LoopingCheckMonitoringProtocol(MonitoringProtocol):
 
         self.checkCall = task.LoopingCall(self.check)
         self.checkCall.clock = self.reactor
-        self.checkCall.start(self.intvCheck, now=False).addErrback(self.onCheckFailure)
+        self.checkCall.start(self._initialInterval(), now=False).addErrback(self.onCheckFailure)
 
     def stop(self):
         """
@@ -211,4 +358,44 @@ class LoopingCheckMonitoringProtocol(MonitoringProtocol):
             level=logging.WARN)
 
         if not self.checkCall.running:
-            self.checkCall.start(self.intvCheck, now=False)
+            self.checkCall.start(self.checkCall.interval or self._initialInterval(),
+                                 now=False)
+
+    def _initialInterval(self):
+        """Returns the interval to start the looping call with."""
+        return self.adaptiveInterval and self.intvCheckMin or self.intvCheck
+
+    def _resultUp(self):
+        transition = self.up is not True
+        super(LoopingCheckMonitoringProtocol, self)._resultUp()
+        self._adaptInterval(up=True, transition=transition)
+
+    def _resultDown(self, reason=None):
+        super(LoopingCheckMonitoringProtocol, self)._resultDown(reason)
+        self._adaptInterval(up=False, transition=True)
+
+    def _adaptInterval(self, up, transition):
+        """
+        Adapts the check interval to the monitoring result: check at the
+        minimum interval while the server is down or has just come up, and
+        back off exponentially towards the maximum interval while it stays up.
+        """
+
+        if not self.adaptiveInterval or self.checkCall is None:
+            return
+
+        if not up or transition:
+            self.stableChecks = 0
+            interval = self.intvCheckMin
+        else:
+            self.stableChecks += 1
+            if self.stableChecks < self.intvStableChecks:
+                return
+            self.stableChecks = 0
+            interval = min(self.checkCall.interval * 2, self.intvCheckMax)
+
+        if interval != self.checkCall.interval:
+            self.report("Check interval changed to %.3f s" % interval)
+            # LoopingCall picks up the new interval when it schedules the
+            # next call.
+            self.checkCall.interval = interval
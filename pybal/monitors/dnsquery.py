@@ -6,19 +6,173 @@ DNS Monitor class implementation for PyBal
 """
 
 # Python imports
-import random, socket
+import random, socket, struct
 import logging
 
 # Twisted imports
-from twisted.internet import defer
-from twisted.names import client, dns, error
-from twisted.python import runtime
+from twisted.internet import defer, protocol
+from twisted.names import client, common, dns, error
+from twisted.python import failure, runtime
 
 # Pybal imports
 from pybal import monitor
 from pybal.metrics import Gauge
 
 
+class DNSQueryEngine(object):
+    """
+    Sends DNS queries to any number of servers from a single UDP socket per
+    address family, and matches replies to queries by server address and
+    transaction ID. Query packets are encoded once per question, after which
+    only their transaction ID is filled in.
+    """
+
+    def __init__(self, reactor):
+        self.reactor = reactor
+        self.ports = {}
+        self.packets = {}
+        self.pendingQueries = {}
+        self.monitors = set()
+
+    def query(self, address, port, query, timeout):
+        """Sends a query to the server at (address, port). Returns a deferred
+        that fires with the dns.Message of the reply, or errbacks with
+        DNSQueryTimeoutError after timeout seconds."""
+
+        family = ':' in address and socket.AF_INET6 or socket.AF_INET
+        server = (socket.inet_pton(family, address), port)
+
+        txid = random.randint(0, 0xffff)
+        while server + (txid,) in self.pendingQueries:
+            txid = random.randint(0, 0xffff)
+        key = server + (txid,)
+
+        def cancel(deferred):
+            self.pendingQueries.pop(key)[2].cancel()
+
+        deferred = defer.Deferred(cancel)
+        timeoutCall = self.reactor.callLater(timeout, self._queryTimeout, key)
+        self.pendingQueries[key] = (deferred, query, timeoutCall)
+
+        packet = struct.pack('!H', txid) + self._getPacket(query)[2:]
+        try:
+            self._getPort(family).write(packet, (address, port))
+        except Exception:
+            # e.g. ENETUNREACH or EPERM; nothing will answer this query
+            del self.pendingQueries[key]
+            timeoutCall.cancel()
+            return defer.fail()
+        return deferred
+
+    def stop(self):
+        """Closes the sockets and cancels all pending queries"""
+
+        for deferred, query, timeoutCall in self.pendingQueries.values():
+            deferred.cancel()
+        for port in self.ports.itervalues():
+            port.stopListening()
+        self.ports = {}
+
+    def _getPacket(self, query):
+        """Returns the encoded query packet for a question"""
+
+        key = (query.name.name, query.type, query.cls)
+        if key not in self.packets:
+            message = dns.Message(recDes=1)
+            message.queries = [query]
+            self.packets[key] = message.toStr()
+        return self.packets[key]
+
+    def _getPort(self, family):
+        """Returns the UDP port for an address family, listening if needed"""
+
+        if family not in self.ports:
+            self.ports[family] = self.reactor.listenUDP(
+                0, DNSQueryEngineProtocol(self, family),
+                interface=family == socket.AF_INET6 and '::' or '')
+        return self.ports[family]
+
+    def _queryTimeout(self, key):
+        deferred, query, timeoutCall = self.pendingQueries.pop(key)
+        deferred.errback(error.DNSQueryTimeoutError(query))
+
+    def datagramReceived(self, family, data, addr):
+        """Called with every datagram received on one of the sockets"""
+
+        message = dns.Message()
+        try:
+            message.fromStr(data)
+        except Exception:
+            return
+
+        try:
+            key = (socket.inet_pton(family, addr[0]), addr[1], message.id)
+        except socket.error:
+            return
+        if key not in self.pendingQueries:
+            return
+
+        deferred, query, timeoutCall = self.pendingQueries[key]
+        if not message.answer or message.queries != [query]:
+            return
+
+        del self.pendingQueries[key]
+        timeoutCall.cancel()
+        deferred.callback(message)
+
+
+class DNSQueryEngineProtocol(protocol.DatagramProtocol):
+    """Passes datagrams received on a socket of a DNSQueryEngine to it"""
+
+    def __init__(self, engine, family):
+        self.engine = engine
+        self.family = family
+
+    def datagramReceived(self, data, addr):
+        self.engine.datagramReceived(self.family, data, addr)
+
+
+class SharedSocketResolver(common.ResolverBase):
+    """
+    Resolver that queries a single DNS server through a (shared)
+    DNSQueryEngine, and retries truncated replies over TCP if
+    tcpFallback is set.
+    """
+
+    TIMEOUT = 10
+
+    def __init__(self, engine, address, port=53, tcpFallback=True):
+        common.ResolverBase.__init__(self)
+        self.engine = engine
+        self.address = address
+        self.port = port
+        self.tcpFallback = tcpFallback
+        self.tcpResolver = None
+
+    def _lookup(self, name, cls, type, timeout):
+        timeout = timeout and sum(timeout) or self.TIMEOUT
+        return self.engine.query(self.address, self.port,
+                                 dns.Query(name, type, cls), timeout
+            ).addCallback(self.filterAnswers, timeout)
+
+    def filterAnswers(self, message, timeout=TIMEOUT):
+        """Extracts the results from a reply, like client.Resolver does."""
+
+        if message.trunc and self.tcpFallback:
+            return self._getTCPResolver().queryTCP(message.queries, timeout
+                ).addCallback(self.filterAnswers)
+        if message.rCode != dns.OK:
+            return failure.Failure(self.exceptionForCode(message.rCode)(message))
+        return (message.answers, message.authority, message.additional)
+
+    def _getTCPResolver(self):
+        if self.tcpResolver is None:
+            self.tcpResolver = client.Resolver(
+                servers=[(self.address, self.port)],
+                reactor=self.engine.reactor)
+        return self.tcpResolver
+
+
 class DNSQueryMonitoringProtocol(monitor.LoopingCheckMonitoringProtocol):
     """
     Monitor that checks a DNS server by doing repeated DNS queries
@@ -28,6 +182,9 @@ class DNSQueryMonitoringProtocol(monitor.LoopingCheckMonitoringProtocol):
 
     TIMEOUT_QUERY = 5
 
+    SHARED_SOCKET = False
+    TCP_FALLBACK = True
+
     catchList = (defer.TimeoutError, error.DomainError,
                  error.AuthoritativeDomainError, error.DNSFormatError, error.DNSNameError,
                  error.DNSQueryRefusedError, error.DNSQueryTimeoutError,
@@ -47,6 +204,9 @@ class DNSQueryMonitoringProtocol(monitor.LoopingCheckMonitoringProtocol):
             **metric_keywords)
     }
 
+    # DNS query engines, shared by all DNSQuery monitors of an LVS service
+    engines = {}
+
     def __init__(self, coordinator, server, configuration, reactor=None):
         """Constructor"""
 
@@ -58,9 +218,16 @@ class DNSQueryMonitoringProtocol(monitor.LoopingCheckMonitoringProtocol):
             reactor=reactor)
 
         self.toQuery = self._getConfigInt('timeout', self.TIMEOUT_QUERY)
+        self.adaptiveTimeout = self._getAdaptiveTimeout(self.toQuery)
         self.hostnames = self._getConfigStringList('hostnames')
         self.failOnNXDOMAIN = self._getConfigBool('fail-on-nxdomain', False)
 
+        # Query through a DNSQueryEngine shared by all servers of the
+        # service, rather than through a resolver of our own
+        self.sharedSocket = self._getConfigBool('shared-socket', self.SHARED_SOCKET)
+        self.tcpFallback = self._getConfigBool('tcp-fallback', self.TCP_FALLBACK)
+        self.engine = None
+
         self.resolver = None
         self.DNSQueryDeferred = None
         self.checkStartTime = None
@@ -70,10 +237,14 @@ class DNSQueryMonitoringProtocol(monitor.LoopingCheckMonitoringProtocol):
 
         super(DNSQueryMonitoringProtocol, self).run()
 
-        # Create a resolver. Use the DNS server IPv4 addresses instead of
-        # self.server.ip as Twisted's createResolver (< 17.1.0) does not
-        # support querying a nameserver over IPv6.
-        self.resolver = client.createResolver([(ip, 53) for ip in self.server.ip4_addresses])
+        if self.sharedSocket:
+            self.resolver = SharedSocketResolver(self._getEngine(), self.server.ip,
+                                                 tcpFallback=self.tcpFallback)
+        else:
+            # Create a resolver. Use the DNS server IPv4 addresses instead of
+            # self.server.ip as Twisted's createResolver (< 17.1.0) does not
+            # support querying a nameserver over IPv6.
+            self.resolver = client.createResolver([(ip, 53) for ip in self.server.ip4_addresses])
 
     def stop(self):
         """Stop the monitoring"""
@@ -82,6 +253,30 @@ class DNSQueryMonitoringProtocol(monitor.LoopingCheckMonitoringProtocol):
         if self.DNSQueryDeferred is not None:
             self.DNSQueryDeferred.cancel()
 
+        if self.engine is not None:
+            self._releaseEngine()
+
+    def _getEngine(self):
+        """Returns the DNS query engine of this service, creating it if needed"""
+
+        if self.engine is None:
+            service = self.server.lvsservice.name
+            if service not in self.engines:
+                self.engines[service] = DNSQueryEngine(self.reactor)
+            self.engine = self.engines[service]
+            self.engine.monitors.add(self)
+        return self.engine
+
+    def _releaseEngine(self):
+        """Stops using the DNS query engine, and stops the engine if no
+        other monitor uses it"""
+
+        self.engine.monitors.discard(self)
+        if not self.engine.monitors:
+            self.engine.stop()
+            del self.engines[self.server.lvsservice.name]
+        self.engine = None
+
     def check(self):
         """Periodically called method that does a single uptime check."""
 
@@ -89,11 +284,12 @@ class DNSQueryMonitoringProtocol(monitor.LoopingCheckMonitoringProtocol):
         query = dns.Query(hostname, type=random.choice([dns.A, dns.AAAA]))
 
         self.checkStartTime = runtime.seconds()
+        timeout = [self._currentTimeout(self.toQuery)]
 
         if query.type == dns.A:
-            self.DNSQueryDeferred = self.resolver.lookupAddress(hostname, timeout=[self.toQuery])
+            self.DNSQueryDeferred = self.resolver.lookupAddress(hostname, timeout=timeout)
         elif query.type == dns.AAAA:
-            self.DNSQueryDeferred = self.resolver.lookupIPV6Address(hostname, timeout=[self.toQuery])
+            self.DNSQueryDeferred = self.resolver.lookupIPV6Address(hostname, timeout=timeout)
 
         self.DNSQueryDeferred.addCallback(self._querySuccessful, query
                 ).addErrback(self._queryFailed, query
@@ -115,12 +311,14 @@ class DNSQueryMonitoringProtocol(monitor.LoopingCheckMonitoringProtocol):
         duration = runtime.seconds() - self.checkStartTime
         self.report('DNS query successful, %.3f s' % (duration)
                     + (resultStr and (': ' + resultStr) or ""))
+        self._sampleTimeout(duration)
         self._resultUp()
 
         self.dnsquery_metrics['request_duration_seconds'].labels(
             result='successful',
             **self.metric_labels
             ).set(duration)
+        self._observeLatency('successful', duration)
 
         return answers, authority, additional
 
@@ -134,6 +332,7 @@ class DNSQueryMonitoringProtocol(monitor.LoopingCheckMonitoringProtocol):
             return None
         elif failure.check(error.DNSQueryTimeoutError):
             errorStr = "DNS query timeout" + queryStr
+            self._backoffTimeout()
         elif failure.check(error.DNSServerError):
             errorStr = "DNS server error" + queryStr
         elif failure.check(error.DNSNameError):
@@ -159,9 +358,18 @@ class DNSQueryMonitoringProtocol(monitor.LoopingCheckMonitoringProtocol):
             result='failed',
             **self.metric_labels
             ).set(duration)
+        self._observeLatency('failed', duration)
 
         failure.trap(*self.catchList)
 
+    def _observeLatency(self, result, duration):
+        """Records the duration of a DNS query in the latency histogram."""
+        self._getHistogram(
+            'request_latency_seconds',
+            'DNS query duration distribution',
+            labelnames=('result',)
+            ).labels(result=result, **self.metric_labels).observe(duration)
+
     def _checkFinished(self, result):
         """
         Called when the DNS query finished with either success or failure,
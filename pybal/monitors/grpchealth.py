@@ -0,0 +1,522 @@
+"""
+grpchealth.py
+
+gRPC health checking monitor class implementation for PyBal
+"""
+
+# Python imports
+import logging
+import struct
+
+# HTTP/2 imports
+from h2.config import H2Configuration
+from h2.connection import H2Connection
+from h2.errors import ErrorCodes
+from h2 import events as h2events, exceptions as h2exceptions
+
+# Twisted imports
+from twisted.internet import defer, endpoints, error, protocol, ssl
+from twisted.internet.interfaces import IHandshakeListener
+from twisted.python import runtime
+from zope.interface import implementer
+
+# Pybal imports
+from pybal import monitor
+from pybal.metrics import Gauge
+from pybal.version import USER_AGENT_STRING
+
+
+# grpc.health.v1.HealthCheckResponse.ServingStatus
+UNKNOWN = 0
+SERVING = 1
+NOT_SERVING = 2
+SERVICE_UNKNOWN = 3
+
+SERVING_STATUS_NAMES = {
+    UNKNOWN: 'UNKNOWN',
+    SERVING: 'SERVING',
+    NOT_SERVING: 'NOT_SERVING',
+    SERVICE_UNKNOWN: 'SERVICE_UNKNOWN'
+}
+
+
+class GRPCError(Exception):
+    """The health check RPC failed"""
+
+
+class HTTP2Error(Exception):
+    """The HTTP/2 connection failed"""
+
+
+class StreamResetError(Exception):
+    """The server reset the stream of a request"""
+
+    def __init__(self, errorCode):
+        Exception.__init__(self, "Stream reset with error code %d" % errorCode)
+        self.errorCode = errorCode
+
+
+def encodeVarint(value):
+    encoded = []
+    while value >= 0x80:
+        encoded.append(chr(value & 0x7f | 0x80))
+        value >>= 7
+    encoded.append(chr(value))
+    return b''.join(encoded)
+
+
+def decodeVarint(data, pos):
+    value = shift = 0
+    while True:
+        byte = ord(data[pos])
+        pos += 1
+        value |= (byte & 0x7f) << shift
+        shift += 7
+        if not byte & 0x80:
+            return value, pos
+
+
+def encodeHealthCheckRequest(service):
+    """Returns a length-prefixed gRPC message of a HealthCheckRequest
+    for service"""
+
+    message = service and (b'\x0a' + encodeVarint(len(service)) + service) or b''
+    return struct.pack('!BI', 0, len(message)) + message
+
+
+def decodeHealthCheckResponse(data):
+    """Returns the serving status from a length-prefixed gRPC message of
+    a HealthCheckResponse"""
+
+    if len(data) < 5:
+        raise GRPCError("Truncated gRPC message")
+    compressed, length = struct.unpack('!BI', data[:5])
+    message = data[5:5 + length]
+    if compressed:
+        raise GRPCError("Compressed gRPC message")
+    if len(message) < length:
+        raise GRPCError("Truncated gRPC message")
+
+    # Skip all fields but status (1), which defaults to UNKNOWN
+    status = UNKNOWN
+    pos = 0
+    try:
+        while pos < len(message):
+            tag, pos = decodeVarint(message, pos)
+            wireType = tag & 0x7
+            if wireType == 0:
+                value, pos = decodeVarint(message, pos)
+                if tag >> 3 == 1:
+                    status = value
+            elif wireType == 1:
+                pos += 8
+            elif wireType == 2:
+                length, pos = decodeVarint(message, pos)
+                pos += length
+            elif wireType == 5:
+                pos += 4
+            else:
+                raise GRPCError("Invalid protobuf wire type %d" % wireType)
+    except IndexError:
+        raise GRPCError("Truncated HealthCheckResponse")
+    return status
+
+
+class HTTP2Response(object):
+    """Response to a request over an H2ClientProtocol"""
+
+    def __init__(self):
+        self.headers = {}
+        self.trailers = {}
+        self.data = []
+
+    @property
+    def status(self):
+        return int(self.headers.get(':status', 0))
+
+    @property
+    def body(self):
+        return b''.join(self.data)
+
+    def getHeader(self, name, default=None):
+        """Returns a header from the trailers, or else the headers (as in
+        gRPC trailers-only responses)"""
+        return self.trailers.get(name, self.headers.get(name, default))
+
+
+@implementer(IHandshakeListener)
+class H2ClientProtocol(protocol.Protocol):
+    """
+    Client side of an HTTP/2 connection, driven by h2. Requests are sent
+    as concurrent streams, with their bodies sent as the flow control
+    windows of the server allow. With requireALPN, the connection fails
+    unless the TLS handshake negotiated h2.
+    """
+
+    def __init__(self, requireALPN=False):
+        self.conn = H2Connection(H2Configuration(client_side=True,
+                                                 header_encoding='utf-8'))
+        self.requireALPN = requireALPN
+        self.connected = False
+        self.goingAway = False
+        # (deferred, HTTP2Response) by stream ID
+        self.streams = {}
+        # Request bodies waiting for a flow control window, by stream ID
+        self.pendingData = {}
+
+    def connectionMade(self):
+        self.connected = True
+        self.conn.initiate_connection()
+        self._flush()
+
+    def handshakeCompleted(self):
+        """Called when the TLS handshake has completed"""
+
+        negotiated = self.transport.negotiatedProtocol
+        if self.requireALPN and negotiated != b'h2':
+            self._failStreams(HTTP2Error(
+                "Server negotiated %s instead of h2" % (negotiated or "no protocol")))
+            self.transport.abortConnection()
+
+    def isUsable(self):
+        """Returns whether new requests can be sent on this connection"""
+
+        return (self.connected and not self.goingAway and
+                self.conn.open_outbound_streams < self.conn.remote_settings.max_concurrent_streams)
+
+    def request(self, headers, body=b''):
+        """Sends a request. Returns a deferred that fires with the
+        HTTP2Response, and resets the stream when cancelled."""
+
+        if not self.connected or self.goingAway:
+            return defer.fail(error.ConnectionLost("HTTP/2 connection not usable"))
+
+        streamID = self.conn.get_next_available_stream_id()
+        self.conn.send_headers(streamID, headers, end_stream=not body)
+        deferred = defer.Deferred(lambda d: self._cancelStream(streamID))
+        self.streams[streamID] = (deferred, HTTP2Response())
+        if body:
+            self.pendingData[streamID] = body
+            self._sendPendingData(streamID)
+        self._flush()
+        return deferred
+
+    def dataReceived(self, data):
+        try:
+            events = self.conn.receive_data(data)
+        except h2exceptions.ProtocolError as e:
+            self.goingAway = True
+            self._flush()
+            self._failStreams(HTTP2Error("HTTP/2 protocol error: %s" % e))
+            self.transport.loseConnection()
+            return
+
+        for event in events:
+            if isinstance(event, h2events.ResponseReceived):
+                self._response(event.stream_id).headers = dict(event.headers)
+            elif isinstance(event, h2events.TrailersReceived):
+                self._response(event.stream_id).trailers = dict(event.headers)
+            elif isinstance(event, h2events.DataReceived):
+                self._response(event.stream_id).data.append(event.data)
+                self.conn.acknowledge_received_data(event.flow_controlled_length,
+                                                    event.stream_id)
+            elif isinstance(event, h2events.StreamEnded):
+                self._streamEnded(event.stream_id)
+            elif isinstance(event, h2events.StreamReset):
+                self._streamFailed(event.stream_id, StreamResetError(event.error_code))
+            elif isinstance(event, h2events.WindowUpdated):
+                if event.stream_id:
+                    streamIDs = [event.stream_id]
+                else:
+                    streamIDs = list(self.pendingData)
+                for streamID in streamIDs:
+                    if streamID in self.pendingData:
+                        self._sendPendingData(streamID)
+            elif isinstance(event, h2events.ConnectionTerminated):
+                self.goingAway = True
+                # Streams above the last stream ID were not processed
+                lastStreamID = event.last_stream_id or 0
+                for streamID in list(self.streams):
+                    if streamID > lastStreamID:
+                        self._streamFailed(streamID, error.ConnectionLost(
+                            "GOAWAY received, error code %d" % event.error_code))
+        self._flush()
+
+    def connectionLost(self, reason):
+        self.connected = False
+        self._failStreams(reason.value)
+
+    def _response(self, streamID):
+        return self.streams.get(streamID, (None, HTTP2Response()))[1]
+
+    def _sendPendingData(self, streamID):
+        """Sends as much of the pending body of a stream as the flow
+        control windows allow"""
+
+        data = self.pendingData.pop(streamID)
+        while data:
+            size = min(self.conn.local_flow_control_window(streamID),
+                       self.conn.max_outbound_frame_size, len(data))
+            if size <= 0:
+                self.pendingData[streamID] = data
+                return
+            chunk, data = data[:size], data[size:]
+            self.conn.send_data(streamID, chunk, end_stream=not data)
+
+    def _streamEnded(self, streamID):
+        if streamID in self.streams:
+            deferred, response = self.streams.pop(streamID)
+            deferred.callback(response)
+
+    def _streamFailed(self, streamID, exception):
+        self.pendingData.pop(streamID, None)
+        if streamID in self.streams:
+            deferred, response = self.streams.pop(streamID)
+            deferred.errback(exception)
+
+    def _failStreams(self, exception):
+        for streamID in list(self.streams):
+            self._streamFailed(streamID, exception)
+
+    def _cancelStream(self, streamID):
+        self.streams.pop(streamID, None)
+        self.pendingData.pop(streamID, None)
+        if self.connected:
+            try:
+                self.conn.reset_stream(streamID, ErrorCodes.CANCEL)
+            except h2exceptions.StreamClosedError:
+                return
+            self._flush()
+
+    def _flush(self):
+        data = self.conn.data_to_send()
+        if data:
+            self.transport.write(data)
+
+
+class GRPCHealthMonitoringProtocol(monitor.LoopingCheckMonitoringProtocol):
+    """
+    Monitor that checks a server with the standard gRPC health checking
+    protocol (grpc.health.v1.Health/Check). One HTTP/2 connection is kept
+    open to the server, over which the configured service names are
+    checked as concurrent streams. The server is up if all services are
+    SERVING.
+    """
+
+    __name__ = 'GRPCHealth'
+
+    PATH = '/grpc.health.v1.Health/Check'
+
+    INTV_CHECK = 10
+    TIMEOUT = 5
+    TLS = False
+
+    catchList = (defer.TimeoutError, error.ConnectError, error.ConnectionLost,
+                 error.ConnectionDone, HTTP2Error, StreamResetError, GRPCError)
+
+    metric_labelnames = ('service', 'host', 'monitor')
+    metric_keywords = {
+        'namespace': 'pybal',
+        'subsystem': 'monitor_' + __name__.lower()
+    }
+
+    grpc_metrics = {
+        'request_duration_seconds': Gauge(
+            'request_duration_seconds',
+            'gRPC health check duration',
+            labelnames=metric_labelnames + ('result',),
+            **metric_keywords)
+    }
+
+    def __init__(self, coordinator, server, configuration, reactor=None):
+        """Constructor"""
+
+        # Call ancestor constructor
+        super(GRPCHealthMonitoringProtocol, self).__init__(
+            coordinator,
+            server,
+            configuration,
+            reactor=reactor)
+
+        self.port = self._getConfigInt('port', server.port)
+        self.toCheck = self._getConfigFloat('timeout', self.TIMEOUT)
+        self.adaptiveTimeout = self._getAdaptiveTimeout(self.toCheck)
+        self.tls = self._getConfigBool('tls', self.TLS)
+
+        # CA certificate(s) to verify the server with, instead of the
+        # system CAs
+        try:
+            ca = self._getConfigString('ca')
+        except KeyError:
+            self.trustRoot = None
+        else:
+            with open(ca) as f:
+                self.trustRoot = ssl.Certificate.loadPEM(f.read())
+
+        # The empty service name checks the server as a whole
+        try:
+            services = self._getConfigStringList('services')
+        except KeyError:
+            services = ['']
+        self.services = isinstance(services, list) and services or [services]
+
+        self.connection = None
+        self.checkDeferred = None
+        self.checkStartTime = None
+
+    def stop(self):
+        """Stop the monitoring"""
+
+        super(GRPCHealthMonitoringProtocol, self).stop()
+
+        if self.checkDeferred is not None:
+            self.checkDeferred.cancel()
+
+        if self.connection is not None:
+            self.connection.transport.loseConnection()
+            self.connection = None
+
+    def check(self):
+        """Periodically called method that does a single check"""
+
+        if not self.active:
+            return
+
+        self.checkStartTime = runtime.seconds()
+        timeout = self._currentTimeout(self.toCheck)
+
+        if self.connection is not None and self.connection.isUsable():
+            self.checkDeferred = defer.succeed(self.connection)
+        else:
+            self.checkDeferred = self._connect(timeout).addCallback(self._connected)
+
+        self.checkDeferred.addCallback(self._checkServices, timeout
+            ).addTimeout(timeout, self.reactor
+            ).addCallbacks(self._checkSuccessful, self._checkFailed
+            ).addBoth(self._checkFinished)
+        return self.checkDeferred
+
+    def _connect(self, timeout):
+        """Opens an HTTP/2 connection to the server. Returns a deferred
+        that fires with the H2ClientProtocol."""
+
+        if ':' in self.server.ip:
+            endpoint = endpoints.TCP6ClientEndpoint(
+                self.reactor, self.server.ip, self.port, timeout=timeout)
+        else:
+            endpoint = endpoints.TCP4ClientEndpoint(
+                self.reactor, self.server.ip, self.port, timeout=timeout)
+        if self.tls:
+            endpoint = endpoints.wrapClientTLS(
+                ssl.optionsForClientTLS(self.server.host.decode('ascii'),
+                                        trustRoot=self.trustRoot,
+                                        acceptableProtocols=[b'h2']),
+                endpoint)
+        return endpoints.connectProtocol(endpoint,
+                                         H2ClientProtocol(requireALPN=self.tls))
+
+    def _connected(self, connection):
+        if self.connection is not None:
+            self.connection.transport.loseConnection()
+        self.connection = connection
+        return connection
+
+    def _checkServices(self, connection, timeout):
+        """Checks all services concurrently. Returns a deferred that fires
+        with the list of their serving statuses."""
+
+        headers = [
+            (':method', 'POST'),
+            (':scheme', self.tls and 'https' or 'http'),
+            (':path', self.PATH),
+            (':authority', '%s:%d' % (self.server.host, self.port)),
+            ('content-type', 'application/grpc'),
+            ('te', 'trailers'),
+            ('grpc-timeout', '%dm' % (timeout * 1000)),
+            ('user-agent', USER_AGENT_STRING)
+        ]
+        return defer.gatherResults([
+            connection.request(headers, encodeHealthCheckRequest(service)
+                ).addCallback(self._decodeResponse)
+            for service in self.services], consumeErrors=True
+            ).addErrback(lambda failure: failure.value.subFailure)
+
+    def _decodeResponse(self, response):
+        if response.status != 200:
+            raise GRPCError("HTTP status %d" % response.status)
+        grpcStatus = response.getHeader('grpc-status')
+        if grpcStatus != '0':
+            raise GRPCError("gRPC status %s: %s" % (
+                grpcStatus, response.getHeader('grpc-message', '')))
+        return decodeHealthCheckResponse(response.body)
+
+    def _checkSuccessful(self, statuses):
+        """Called when all health check RPCs completed"""
+
+        duration = runtime.seconds() - self.checkStartTime
+        notServing = ["%s: %s" % (service or '(server)',
+                                  SERVING_STATUS_NAMES.get(status, status))
+                      for service, status in zip(self.services, statuses)
+                      if status != SERVING]
+        self._sampleTimeout(duration)
+
+        if notServing:
+            self.report('gRPC health check not serving, %.3f s: %s' % (
+                duration, ', '.join(notServing)), level=logging.WARN)
+            self._resultDown('Not serving: ' + ', '.join(notServing))
+            result = 'not_serving'
+        else:
+            self.report('gRPC health check serving, %.3f s' % duration)
+            self._resultUp()
+            result = 'serving'
+
+        self.grpc_metrics['request_duration_seconds'].labels(
+            result=result,
+            **self.metric_labels
+            ).set(duration)
+        self._observeLatency(result, duration)
+
+    def _checkFailed(self, failure):
+        """Called when a health check RPC or the connection failed"""
+
+        # Don't act as if the check failed if we cancelled it
+        if failure.check(defer.CancelledError):
+            return None
+        elif failure.check(defer.TimeoutError, error.TimeoutError):
+            errorStr = "gRPC health check timeout"
+            self._backoffTimeout()
+        else:
+            errorStr = failure.getErrorMessage()
+
+        # Reconnect for the next check unless only the RPC failed
+        if not failure.check(GRPCError) and self.connection is not None:
+            self.connection.transport.abortConnection()
+            self.connection = None
+
+        duration = runtime.seconds() - self.checkStartTime
+        self.report('gRPC health check failed, %.3f s: %s' % (duration, errorStr),
+                    level=logging.ERROR)
+        self._resultDown(errorStr)
+
+        self.grpc_metrics['request_duration_seconds'].labels(
+            result='failed',
+            **self.metric_labels
+            ).set(duration)
+        self._observeLatency('failed', duration)
+
+        failure.trap(*self.catchList)
+
+    def _observeLatency(self, result, duration):
+        """Records the duration of a check in the latency histogram."""
+        self._getHistogram(
+            'request_latency_seconds',
+            'gRPC health check duration distribution',
+            labelnames=('result',)
+            ).labels(result=result, **self.metric_labels).observe(duration)
+
+    def _checkFinished(self, result):
+        """Called when the check finished with either success or failure"""
+
+        self.checkDeferred = None
+        self.checkStartTime = None
+        return result
@@ -0,0 +1,344 @@
+"""
+heartbeat.py
+
+Push based heartbeat monitor class implementation for PyBal
+
+Backends send heartbeats to a PyBal listener, as UDP datagrams or as
+lines on a long-lived TCP connection, of the form:
+
+    pybal-heartbeat 1 <host> <up|down> <load|-> <timestamp> <signature>
+
+where signature is the hex HMAC-SHA256 of everything before it (without
+the separating space), keyed with the configured heartbeat.secret.
+"""
+
+# Python imports
+import hashlib
+import heapq
+import hmac
+import itertools
+import logging
+
+# Twisted imports
+from twisted.internet import protocol
+from twisted.protocols import basic
+
+# Pybal imports
+from pybal import monitor
+from pybal.metrics import Counter, Gauge
+from pybal.util import log
+
+
+MAGIC = 'pybal-heartbeat'
+VERSION = '1'
+
+
+class Heartbeat(object):
+    """A parsed, but not yet verified, heartbeat message"""
+
+    def __init__(self, host, healthy, load, timestamp, signedData, signature):
+        self.host = host
+        self.healthy = healthy
+        self.load = load
+        self.timestamp = timestamp
+        self.signedData = signedData
+        self.signature = signature
+
+    @classmethod
+    def fromString(cls, message):
+        """Parses a heartbeat message. Returns None if it is invalid."""
+
+        fields = message.strip().split(' ')
+        if len(fields) != 7 or fields[0] != MAGIC or fields[1] != VERSION:
+            return None
+        magic, version, host, state, load, timestamp, signature = fields
+        if state not in ('up', 'down'):
+            return None
+        try:
+            load = None if load == '-' else float(load)
+            timestamp = float(timestamp)
+        except ValueError:
+            return None
+        return cls(host, state == 'up', load, timestamp,
+                   message.strip().rsplit(' ', 1)[0], signature)
+
+    def verify(self, secret):
+        """Returns whether the heartbeat was signed with secret"""
+        return hmac.compare_digest(sign(secret, self.signedData), self.signature)
+
+
+def sign(secret, data):
+    return hmac.new(secret, data, hashlib.sha256).hexdigest()
+
+
+def heartbeatMessage(secret, host, healthy, timestamp, load=None):
+    """Returns a signed heartbeat message, as sent by backends"""
+
+    data = ' '.join([MAGIC, VERSION, host, healthy and 'up' or 'down',
+                     load is None and '-' or repr(float(load)), repr(float(timestamp))])
+    return data + ' ' + sign(secret, data)
+
+
+class HeartbeatDatagramProtocol(protocol.DatagramProtocol):
+    """Passes every datagram to the HeartbeatListener as a message"""
+
+    def __init__(self, listener):
+        self.listener = listener
+
+    def datagramReceived(self, data, addr):
+        self.listener.messageReceived(data, addr)
+
+
+class HeartbeatStreamProtocol(basic.LineOnlyReceiver):
+    """Passes every line of a TCP stream to the HeartbeatListener as a
+    message"""
+
+    MAX_LENGTH = 1024
+
+    def lineReceived(self, line):
+        self.factory.listener.messageReceived(line, self.transport.getPeer())
+
+    def lineLengthExceeded(self, line):
+        self.transport.loseConnection()
+
+
+class HeartbeatStreamFactory(protocol.ServerFactory):
+    protocol = HeartbeatStreamProtocol
+    noisy = False
+
+    def __init__(self, listener):
+        self.listener = listener
+
+
+class HeartbeatListener(object):
+    """
+    Receives heartbeats on one UDP or TCP socket for all heartbeat monitors
+    configured with it, and passes them to the monitors of their host.
+
+    Monitors are expired when their deadline passes without a heartbeat
+    extending it. Deadlines are kept in a heap with a single timer for the
+    earliest one; entries superseded by a later deadline are discarded
+    when they reach the top of the heap.
+    """
+
+    def __init__(self, reactor, proto, interface, port):
+        self.reactor = reactor
+        self.proto = proto
+        self.interface = interface
+        self.portNumber = port
+        self.port = None
+        self.monitors = {}
+        self.deadlines = {}
+        self.heap = []
+        self.counter = itertools.count()
+        self.timer = None
+
+    def start(self):
+        if self.proto == 'tcp':
+            self.port = self.reactor.listenTCP(
+                self.portNumber, HeartbeatStreamFactory(self), interface=self.interface)
+        else:
+            self.port = self.reactor.listenUDP(
+                self.portNumber, HeartbeatDatagramProtocol(self), interface=self.interface)
+
+    def stop(self):
+        if self.port is not None:
+            self.port.stopListening()
+            self.port = None
+        if self.timer is not None and self.timer.active():
+            self.timer.cancel()
+        self.timer = None
+
+    def register(self, monitor):
+        self.monitors.setdefault(monitor.server.host, set()).add(monitor)
+
+    def unregister(self, monitor):
+        """Stops passing heartbeats to monitor. Returns True if no
+        monitors are left."""
+
+        self.monitors.get(monitor.server.host, set()).discard(monitor)
+        if not self.monitors.get(monitor.server.host, True):
+            del self.monitors[monitor.server.host]
+        self.deadlines.pop(monitor, None)
+        return not self.monitors
+
+    def messageReceived(self, message, addr):
+        heartbeat = Heartbeat.fromString(message)
+        if heartbeat is None:
+            log.debug("Ignoring invalid heartbeat from %s" % (addr,))
+            return
+        for monitor in list(self.monitors.get(heartbeat.host, ())):
+            monitor.heartbeatReceived(heartbeat)
+
+    def setDeadline(self, monitor, deadline):
+        """Expires monitor at deadline, unless this is called again for it
+        before then"""
+
+        self.deadlines[monitor] = deadline
+        heapq.heappush(self.heap, (deadline, next(self.counter), monitor))
+        if self.timer is None:
+            self.timer = self.reactor.callLater(
+                max(0, deadline - self.reactor.seconds()), self._expire)
+        elif deadline < self.timer.getTime():
+            self.timer.reset(max(0, deadline - self.reactor.seconds()))
+
+    def _expire(self):
+        self.timer = None
+        now = self.reactor.seconds()
+        while self.heap and self.heap[0][0] <= now:
+            deadline, count, monitor = heapq.heappop(self.heap)
+            if self.deadlines.get(monitor) == deadline:
+                del self.deadlines[monitor]
+                monitor.heartbeatExpired()
+        if self.heap:
+            self.timer = self.reactor.callLater(self.heap[0][0] - now, self._expire)
+
+
+class HeartbeatMonitoringProtocol(monitor.MonitoringProtocol):
+    """
+    Monitor that doesn't check servers itself, but relies on servers
+    pushing signed heartbeats to a listener shared by all heartbeat
+    monitors. A server is down when it reports itself down or overloaded,
+    or when no heartbeat has been received for heartbeat.timeout seconds.
+    """
+
+    __name__ = 'Heartbeat'
+
+    PROTOCOL = 'udp'
+    PORT = 7081
+    INTERFACE = ''
+    TIMEOUT = 10.0
+    MAX_SKEW = 30.0
+    MAX_LOAD = 0
+
+    metric_labelnames = ('service', 'host', 'monitor')
+    metric_keywords = {
+        'namespace': 'pybal',
+        'subsystem': 'monitor_' + __name__.lower()
+    }
+
+    heartbeat_metrics = {
+        'heartbeats_total': Counter(
+            'heartbeats_total',
+            'Heartbeats received',
+            labelnames=metric_labelnames + ('result',),
+            **metric_keywords),
+        'load': Gauge(
+            'load',
+            'Load reported in the last heartbeat',
+            labelnames=metric_labelnames,
+            **metric_keywords)
+    }
+
+    # Heartbeat listeners by (protocol, interface, port), shared by all
+    # heartbeat monitors configured with them
+    listeners = {}
+
+    def __init__(self, coordinator, server, configuration, reactor=None):
+        """Constructor"""
+
+        # Call ancestor constructor
+        super(HeartbeatMonitoringProtocol, self).__init__(
+            coordinator,
+            server,
+            configuration,
+            reactor=reactor)
+
+        try:
+            self.listenProtocol = self._getConfigString('protocol')
+        except KeyError:
+            self.listenProtocol = self.PROTOCOL
+        if self.listenProtocol not in ('udp', 'tcp'):
+            raise ValueError("heartbeat.protocol must be udp or tcp")
+        self.port = self._getConfigInt('port', self.PORT)
+        try:
+            self.interface = self._getConfigString('interface')
+        except KeyError:
+            self.interface = self.INTERFACE
+        self.secret = self._getConfigString('secret')
+        self.timeout = self._getConfigFloat('timeout', self.TIMEOUT)
+        self.maxSkew = self._getConfigFloat('max-skew', self.MAX_SKEW)
+        self.maxLoad = self._getConfigFloat('max-load', self.MAX_LOAD)
+
+        self.listener = None
+        self.lastTimestamp = 0
+
+    def run(self):
+        """Start the monitoring"""
+
+        super(HeartbeatMonitoringProtocol, self).run()
+
+        key = (self.listenProtocol, self.interface, self.port)
+        if key not in self.listeners:
+            self.listeners[key] = HeartbeatListener(self.reactor, *key)
+            self.listeners[key].start()
+        self.listener = self.listeners[key]
+        self.listener.register(self)
+
+        # The server has until the timeout to send its first heartbeat
+        self.listener.setDeadline(self, self.reactor.seconds() + self.timeout)
+
+    def stop(self):
+        """Stop the monitoring"""
+
+        super(HeartbeatMonitoringProtocol, self).stop()
+
+        if self.listener is not None:
+            if self.listener.unregister(self):
+                self.listener.stop()
+                self.listeners.pop((self.listenProtocol, self.interface, self.port), None)
+            self.listener = None
+
+    def heartbeatReceived(self, heartbeat):
+        """Called by the listener with every heartbeat for our host"""
+
+        if not self.active:
+            return
+
+        if not heartbeat.verify(self.secret):
+            self._countHeartbeat('bad_signature')
+            return
+
+        # Reject replayed and delayed heartbeats
+        now = self.reactor.seconds()
+        if (heartbeat.timestamp <= self.lastTimestamp
+                or abs(now - heartbeat.timestamp) > self.maxSkew):
+            self._countHeartbeat('stale')
+            return
+        self.lastTimestamp = heartbeat.timestamp
+        self._countHeartbeat('accepted')
+
+        self.listener.setDeadline(self, now + self.timeout)
+
+        if heartbeat.load is not None:
+            self.heartbeat_metrics['load'].labels(**self.metric_labels).set(heartbeat.load)
+
+        if not heartbeat.healthy:
+            reason = "Server reported down"
+        elif self.maxLoad and heartbeat.load is not None and heartbeat.load > self.maxLoad:
+            reason = "Server load %.2f exceeds %.2f" % (heartbeat.load, self.maxLoad)
+        else:
+            if self.up is not True:
+                self.report("Heartbeat received, server up")
+            self._resultUp()
+            return
+
+        if self.up is not False:
+            self.report(reason, level=logging.WARN)
+        self._resultDown(reason)
+
+    def heartbeatExpired(self):
+        """Called by the listener when no heartbeat was received in time"""
+
+        if not self.active:
+            return
+
+        reason = "No heartbeat received for %s s" % self.timeout
+        self.report(reason, level=logging.WARN)
+        self._resultDown(reason)
+
+    def _countHeartbeat(self, result):
+        self.heartbeat_metrics['heartbeats_total'].labels(
+            result=result,
+            **self.metric_labels
+            ).inc()
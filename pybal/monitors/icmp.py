@@ -0,0 +1,344 @@
+"""
+icmp.py
+
+ICMP reachability monitor class implementation for PyBal
+"""
+
+# Python imports
+import collections
+import errno
+import logging
+import os
+import socket
+import struct
+
+# Twisted imports
+from twisted.internet import abstract, defer, main
+from twisted.python import runtime
+
+# Pybal imports
+from pybal import monitor
+from pybal.metrics import Gauge
+from pybal.util import log
+
+
+ICMP_ECHO_REPLY = 0
+ICMP_ECHO_REQUEST = 8
+ICMP6_ECHO_REQUEST = 128
+ICMP6_ECHO_REPLY = 129
+
+
+def checksum(data):
+    """Returns the internet checksum (RFC 1071) of data"""
+
+    if len(data) % 2:
+        data += b'\0'
+    total = sum(struct.unpack('!%dH' % (len(data) // 2), data))
+    total = (total >> 16) + (total & 0xffff)
+    total += total >> 16
+    return ~total & 0xffff
+
+
+class ICMPSocket(abstract.FileDescriptor):
+    """
+    Reactor reader for an ICMP (ping or raw) socket of an ICMPEchoEngine,
+    which passes every received packet to the engine.
+    """
+
+    def __init__(self, engine, family, sock, raw, reactor):
+        abstract.FileDescriptor.__init__(self, reactor)
+        self.engine = engine
+        self.family = family
+        self.socket = sock
+        self.raw = raw
+        self.connected = 1
+
+    def fileno(self):
+        return self.socket.fileno()
+
+    def doRead(self):
+        while True:
+            try:
+                data, addr = self.socket.recvfrom(65536)
+            except socket.error, e:
+                if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
+                    return
+                log.error("Could not read from ICMP socket: %s" % e)
+                return
+            self.engine.packetReceived(self, data, addr)
+
+    def write(self, data, addr):
+        try:
+            self.socket.sendto(data, addr)
+        except socket.error, e:
+            # Treated as a lost echo request
+            log.debug("Could not send ICMP echo request to %s: %s" % (addr[0], e))
+
+    def connectionLost(self, reason):
+        abstract.FileDescriptor.connectionLost(self, reason)
+        self.socket.close()
+
+    def logPrefix(self):
+        return 'ICMPSocket'
+
+
+class ICMPEchoEngine(object):
+    """
+    Sends ICMP echo requests to any number of targets through a single socket
+    per address family, and matches the replies to the requests by target
+    address and sequence number.
+
+    An unprivileged ping socket (SOCK_DGRAM) is used if the kernel allows it
+    (net.ipv4.ping_group_range), a raw socket otherwise.
+    """
+
+    PAYLOAD = b'PyBal ICMP check'
+
+    def __init__(self, reactor, socketFactory=socket.socket):
+        self.reactor = reactor
+        self.socketFactory = socketFactory
+        self.sockets = {}
+        self.identifier = os.getpid() & 0xffff
+        self.sequences = collections.defaultdict(int)
+        self.pendingRequests = {}
+        self.monitors = set()
+
+    def ping(self, address, timeout):
+        """Sends an echo request to address. Returns a deferred that fires
+        with the round trip time, or errbacks with defer.TimeoutError if no
+        reply is received within timeout seconds."""
+
+        family = ':' in address and socket.AF_INET6 or socket.AF_INET
+        target = socket.inet_pton(family, address)
+        try:
+            icmpSocket = self._getSocket(family)
+        except socket.error:
+            return defer.fail()
+
+        # Use the next sequence number that isn't still pending
+        sequence = self.sequences[target]
+        while (target, sequence) in self.pendingRequests:
+            sequence = (sequence + 1) & 0xffff
+        self.sequences[target] = (sequence + 1) & 0xffff
+        key = (target, sequence)
+
+        def cancel(deferred):
+            self.pendingRequests.pop(key)[1].cancel()
+
+        deferred = defer.Deferred(cancel)
+        timeoutCall = self.reactor.callLater(timeout, self._requestTimeout, key)
+        self.pendingRequests[key] = (deferred, timeoutCall, runtime.seconds())
+
+        icmpSocket.write(self._echoRequest(family, sequence), (address, 0))
+        return deferred
+
+    def openSocket(self, address):
+        """Opens the socket for the address family of address, if it isn't
+        open yet. Raises socket.error if neither a ping socket nor a raw
+        socket can be opened."""
+
+        self._getSocket(':' in address and socket.AF_INET6 or socket.AF_INET)
+
+    def stop(self):
+        """Closes the sockets and cancels all pending requests"""
+
+        for deferred, timeoutCall, sent in self.pendingRequests.values():
+            deferred.cancel()
+        for icmpSocket in self.sockets.itervalues():
+            icmpSocket.stopReading()
+            icmpSocket.connectionLost(main.CONNECTION_DONE)
+        self.sockets = {}
+
+    def packetReceived(self, icmpSocket, data, addr):
+        """Called with every packet received on one of the sockets"""
+
+        # Raw IPv4 sockets include the IP header
+        if icmpSocket.family == socket.AF_INET and icmpSocket.raw:
+            data = data[(ord(data[0]) & 0x0f) * 4:]
+        if len(data) < 8:
+            return
+
+        type, code, cksum, identifier, sequence = struct.unpack('!BBHHH', data[:8])
+        if type not in (ICMP_ECHO_REPLY, ICMP6_ECHO_REPLY):
+            return
+        # Ping sockets only receive replies to their own requests
+        if icmpSocket.raw and identifier != self.identifier:
+            return
+
+        try:
+            key = (socket.inet_pton(icmpSocket.family, addr[0]), sequence)
+        except socket.error:
+            return
+        if key not in self.pendingRequests:
+            return
+
+        deferred, timeoutCall, sent = self.pendingRequests.pop(key)
+        timeoutCall.cancel()
+        deferred.callback(runtime.seconds() - sent)
+
+    def _requestTimeout(self, key):
+        deferred, timeoutCall, sent = self.pendingRequests.pop(key)
+        deferred.errback(defer.TimeoutError("No ICMP echo reply"))
+
+    def _echoRequest(self, family, sequence):
+        """Returns an encoded echo request packet. The kernel computes the
+        checksum of ICMPv6 packets."""
+
+        if family == socket.AF_INET6:
+            type = ICMP6_ECHO_REQUEST
+        else:
+            type = ICMP_ECHO_REQUEST
+        header = struct.pack('!BBHHH', type, 0, 0, self.identifier, sequence)
+        if family == socket.AF_INET:
+            header = struct.pack('!BBHHH', type, 0,
+                                 checksum(header + self.PAYLOAD),
+                                 self.identifier, sequence)
+        return header + self.PAYLOAD
+
+    def _getSocket(self, family):
+        """Returns the ICMP socket for an address family, opening it if
+        needed"""
+
+        if family not in self.sockets:
+            proto = family == socket.AF_INET6 and socket.IPPROTO_ICMPV6 or socket.IPPROTO_ICMP
+            try:
+                sock = self.socketFactory(family, socket.SOCK_DGRAM, proto)
+                raw = False
+            except socket.error:
+                sock = self.socketFactory(family, socket.SOCK_RAW, proto)
+                raw = True
+            sock.setblocking(False)
+
+            icmpSocket = ICMPSocket(self, family, sock, raw, self.reactor)
+            icmpSocket.startReading()
+            self.sockets[family] = icmpSocket
+        return self.sockets[family]
+
+
+class ICMPMonitoringProtocol(monitor.LoopingCheckMonitoringProtocol):
+    """
+    Monitor that checks whether a server is reachable on its service IP by
+    sending ICMP echo requests, and considers it down when more than
+    max-loss of the last window requests went unanswered.
+    """
+
+    __name__ = 'ICMP'
+
+    INTV_CHECK = 1.0
+    TIMEOUT = 1.0
+    WINDOW = 10
+    MAX_LOSS = 0.5
+
+    metric_labelnames = ('service', 'host', 'monitor')
+    metric_keywords = {
+        'labelnames': metric_labelnames,
+        'namespace': 'pybal',
+        'subsystem': 'monitor_' + __name__.lower()
+    }
+
+    icmp_metrics = {
+        'rtt_seconds': Gauge('rtt_seconds', 'ICMP echo round trip time', **metric_keywords),
+        'loss_ratio': Gauge('loss_ratio', 'ICMP echo loss over the window', **metric_keywords)
+    }
+
+    # Echo engine shared by all ICMP monitors
+    echoEngine = None
+
+    def __init__(self, coordinator, server, configuration={}, reactor=None):
+        """Constructor"""
+
+        # Call ancestor constructor
+        super(ICMPMonitoringProtocol, self).__init__(
+            coordinator,
+            server,
+            configuration,
+            reactor=reactor)
+
+        self.timeout = self._getConfigFloat('timeout', self.TIMEOUT)
+        self.window = collections.deque(maxlen=self._getConfigInt('window', self.WINDOW))
+        self.maxLoss = self._getConfigFloat('max-loss', self.MAX_LOSS)
+        self.engine = None
+        self.engineError = None
+        self.pingDeferred = None
+
+    def run(self):
+        """Start the monitoring"""
+
+        if ICMPMonitoringProtocol.echoEngine is None:
+            ICMPMonitoringProtocol.echoEngine = ICMPEchoEngine(self.reactor)
+        self.engine = self.echoEngine
+        self.engine.monitors.add(self)
+
+        super(ICMPMonitoringProtocol, self).run()
+
+        # Without CAP_NET_RAW or a ping_group_range that includes us, no
+        # ICMP socket can be opened, and no check can ever succeed
+        try:
+            self.engine.openSocket(self.server.ip)
+        except socket.error, e:
+            self.engineError = "Could not open an ICMP socket: %s" % e
+            self.report("%s; a raw socket needs CAP_NET_RAW, a ping socket "
+                        "net.ipv4.ping_group_range" % self.engineError,
+                        level=logging.ERROR)
+            self._resultDown(self.engineError)
+
+    def stop(self):
+        """Stop the monitoring"""
+
+        super(ICMPMonitoringProtocol, self).stop()
+
+        if self.pingDeferred is not None:
+            self.pingDeferred.cancel()
+
+        if self.engine is not None:
+            self.engine.monitors.discard(self)
+            if not self.engine.monitors:
+                self.engine.stop()
+                ICMPMonitoringProtocol.echoEngine = None
+            self.engine = None
+
+    def check(self):
+        """Periodically called method that does a single check"""
+
+        if not self.active:
+            return
+
+        if self.engineError is not None:
+            self._resultDown(self.engineError)
+            return
+
+        self.pingDeferred = self.engine.ping(self.server.ip, self.timeout)
+        self.pingDeferred.addCallbacks(self._echoReplied, self._echoLost)
+        return self.pingDeferred
+
+    def _echoReplied(self, rtt):
+        """Called when an echo reply was received"""
+
+        self.pingDeferred = None
+        self.icmp_metrics['rtt_seconds'].labels(**self.metric_labels).set(rtt)
+        self._update(True)
+
+    def _echoLost(self, failure):
+        """Called when no echo reply was received in time"""
+
+        self.pingDeferred = None
+        # Don't act as if the check failed if we cancelled it
+        if failure.check(defer.CancelledError):
+            return None
+        failure.trap(defer.TimeoutError, socket.error)
+        self._update(False)
+
+    def _update(self, replied):
+        """Adds a result to the window, and sets the state from the loss"""
+
+        self.window.append(replied)
+        loss = float(self.window.count(False)) / len(self.window)
+        self.icmp_metrics['loss_ratio'].labels(**self.metric_labels).set(loss)
+
+        if loss > self.maxLoss:
+            if self.up is not False:
+                self.report("%s unreachable, %d%% packet loss" % (
+                    self.server.ip, loss * 100), level=logging.WARN)
+            self._resultDown("%d%% ICMP echo loss" % (loss * 100))
+        else:
+            self._resultUp()
@@ -6,15 +6,42 @@ Monitor class implementations for PyBal
 """
 
 from pybal import monitor, util
-from pybal.metrics import Counter
+from pybal.metrics import Counter, Gauge
 
-from twisted.internet import reactor, protocol
+from twisted.internet import reactor, protocol, task
 import logging
 
 import socket
+import struct
 
 log = util.log
 
+# Not exported by the socket module of Python 2
+TCP_USER_TIMEOUT = getattr(socket, 'TCP_USER_TIMEOUT', 18)
+
+# The first, stable part of Linux' struct tcp_info (see linux/tcp.h)
+TCP_INFO_FORMAT = '8B24I'
+TCP_INFO_FIELDS = {
+    'retransmits': 2,
+    'probes': 3,
+    'unacked': 12,
+    'rtt': 23,
+    'rttvar': 24
+}
+
+def getTCPInfo(sock):
+    """Returns a dict of TCP_INFO fields of a connected TCP socket, with
+    the rtt and rttvar in seconds. Raises socket.error or AttributeError
+    if TCP_INFO is not supported."""
+
+    size = struct.calcsize(TCP_INFO_FORMAT)
+    values = struct.unpack(TCP_INFO_FORMAT,
+        sock.getsockopt(socket.SOL_TCP, socket.TCP_INFO, size)[:size])
+    info = dict((name, values[i]) for name, i in TCP_INFO_FIELDS.iteritems())
+    info['rtt'] /= 1000000.0
+    info['rttvar'] /= 1000000.0
+    return info
+
 class IdleConnectionMonitoringProtocol(monitor.MonitoringProtocol, protocol.ReconnectingClientFactory):
     """
     Monitor that checks uptime by keeping an idle TCP connection open to the
@@ -30,7 +57,15 @@ class IdleConnectionMonitoringProtocol(monitor.MonitoringProtocol, protocol.Reco
     KEEPALIVE_RETRIES = 3
     KEEPALIVE_IDLE = 10
     KEEPALIVE_INTERVAL = 30
-
+    # Longer than KEEPALIVE_INTERVAL, so a single lost keepalive probe
+    # doesn't drop the connection, while retransmits that would otherwise
+    # last for tcp_retries2 (~15 minutes) are cut short
+    USER_TIMEOUT = 60
+    TCP_INFO_INTERVAL = 5
+    # Down-marking on retransmits is opt-in; TCP_INFO is sampled for the
+    # metrics and max-rtt regardless
+    MAX_RETRANSMITS = 0
+    MAX_RTT = 0
     __name__ = 'IdleConnection'
 
     metric_labelnames = ('service', 'host', 'monitor')
@@ -49,10 +84,34 @@ class IdleConnectionMonitoringProtocol(monitor.MonitoringProtocol, protocol.Reco
             'connections_lost_total',
             'Connections lost uncleanly',
             labelnames=metric_labelnames + ('reason',),
+            **metric_keywords),
+        'tcp_rtt_seconds': Gauge(
+            'tcp_rtt_seconds',
+            'Smoothed round trip time of the connection (TCP_INFO)',
+            labelnames=metric_labelnames,
+            **metric_keywords),
+        'tcp_rttvar_seconds': Gauge(
+            'tcp_rttvar_seconds',
+            'Round trip time variance of the connection (TCP_INFO)',
+            labelnames=metric_labelnames,
+            **metric_keywords),
+        'tcp_retransmits': Gauge(
+            'tcp_retransmits',
+            'Unanswered retransmits or keepalive probes of the connection (TCP_INFO)',
+            labelnames=metric_labelnames,
+            **metric_keywords),
+        'tcp_unacked': Gauge(
+            'tcp_unacked',
+            'Unacknowledged segments of the connection (TCP_INFO)',
+            labelnames=metric_labelnames,
+            **metric_keywords),
+        'degraded': Gauge(
+            'degraded',
+            'Whether the round trip time of the connection exceeds max-rtt',
+            labelnames=metric_labelnames,
             **metric_keywords)
     }
 
-
     def __init__(self, coordinator, server, configuration):
         """Constructor"""
 
@@ -66,6 +125,17 @@ class IdleConnectionMonitoringProtocol(monitor.MonitoringProtocol, protocol.Reco
         self.keepAliveIdle = self._getConfigInt('keepalive-idle', self.KEEPALIVE_IDLE)
         self.keepAliveInterval = self._getConfigInt('keepalive-interval', self.KEEPALIVE_INTERVAL)
 
+        # Bound the time data (including keepalive probes) may remain
+        # unacknowledged before the kernel drops the connection; 0 disables
+        self.userTimeout = self._getConfigFloat('user-timeout', self.USER_TIMEOUT)
+
+        # Passive health checking of the held connection by sampling TCP_INFO
+        self.tcpInfoInterval = self._getConfigFloat('tcp-info-interval', self.TCP_INFO_INTERVAL)
+        self.maxRetransmits = self._getConfigInt('max-retransmits', self.MAX_RETRANSMITS)
+        self.maxRTT = self._getConfigFloat('max-rtt', self.MAX_RTT)
+        self.tcpInfoCall = None
+        self.degraded = False
+
     def run(self):
         """Start the monitoring"""
 
@@ -78,6 +148,7 @@ class IdleConnectionMonitoringProtocol(monitor.MonitoringProtocol, protocol.Reco
         super(IdleConnectionMonitoringProtocol, self).stop()
 
         self.stopTrying()
+        self._stopSampling()
 
     def startedConnecting(self, connector):
         self.transport = getattr(connector, 'transport', None)
@@ -92,6 +163,8 @@ class IdleConnectionMonitoringProtocol(monitor.MonitoringProtocol, protocol.Reco
         if not self.active:
             return
 
+        self._stopSampling()
+
         # Immediately set status to down
         self._resultDown(reason.getErrorMessage())
 
@@ -111,6 +184,8 @@ class IdleConnectionMonitoringProtocol(monitor.MonitoringProtocol, protocol.Reco
         if not self.active:
             return
 
+        self._stopSampling()
+
         from twisted.internet import error
         if reason.check(error.ConnectionDone):
             # Connection lost in a clean way. May be idle timeout - try a fast reconnect
@@ -145,14 +220,84 @@ class IdleConnectionMonitoringProtocol(monitor.MonitoringProtocol, protocol.Reco
             except AttributeError:
                 log.warn("Could not set TCP_KEEPIDLE, TCP_KEEPCNT, TCP_KEEPINTVL socket options (not Linux?)")
 
+        if self.transport is not None and self.userTimeout:
+            try:
+                self.transport.getHandle().setsockopt(
+                    socket.SOL_TCP, TCP_USER_TIMEOUT, int(self.userTimeout * 1000))
+            except socket.error:
+                log.warn("Could not set TCP_USER_TIMEOUT socket option (not Linux?)")
+
         # Set status to up
         self._resultUp()
+        self._setDegraded(False)
 
         # Reset reconnection delay
         self.resetDelay()
 
         self.report("%s established." % self._report_prefix())
 
+        self._startSampling()
+
+    def _startSampling(self):
+        """Starts periodically sampling TCP_INFO of the connection"""
+
+        if self.transport is None or not self.tcpInfoInterval:
+            return
+
+        self._stopSampling()
+        self.tcpInfoCall = task.LoopingCall(self.sampleTCPInfo)
+        self.tcpInfoCall.clock = self.reactor
+        self.tcpInfoCall.start(self.tcpInfoInterval, now=False)
+
+    def _stopSampling(self):
+        if self.tcpInfoCall is not None and self.tcpInfoCall.running:
+            self.tcpInfoCall.stop()
+        self.tcpInfoCall = None
+
+    def sampleTCPInfo(self):
+        """
+        Samples TCP_INFO of the held connection into the metrics. With
+        max-retransmits set, also sets the status to down while that many
+        retransmits or keepalive probes remain unanswered, before the
+        kernel gives up on the connection.
+        """
+
+        if not self.active or self.transport is None:
+            return
+
+        try:
+            info = getTCPInfo(self.transport.getHandle())
+        except (socket.error, AttributeError), e:
+            log.warn("Could not sample TCP_INFO (not Linux?): %s" % e)
+            self._stopSampling()
+            return
+
+        unanswered = max(info['retransmits'], info['probes'])
+        self.idleconnection_metrics['tcp_rtt_seconds'].labels(**self.metric_labels).set(info['rtt'])
+        self.idleconnection_metrics['tcp_rttvar_seconds'].labels(**self.metric_labels).set(info['rttvar'])
+        self.idleconnection_metrics['tcp_retransmits'].labels(**self.metric_labels).set(unanswered)
+        self.idleconnection_metrics['tcp_unacked'].labels(**self.metric_labels).set(info['unacked'])
+
+        if self.maxRetransmits and unanswered >= self.maxRetransmits:
+            if self.up is not False:
+                self.report("%s has %d unanswered retransmits." % (
+                    self._report_prefix(), unanswered), level=logging.WARN)
+            self._resultDown("%d unanswered TCP retransmits" % unanswered)
+            return
+        elif self.up is False:
+            self.report("%s recovered." % self._report_prefix())
+            self._resultUp()
+
+        degraded = bool(self.maxRTT) and info['rtt'] > self.maxRTT
+        if degraded and not self.degraded:
+            self.report("%s degraded, rtt %.3f s." % (
+                self._report_prefix(), info['rtt']), level=logging.WARN)
+        self._setDegraded(degraded)
+
+    def _setDegraded(self, degraded):
+        self.degraded = degraded
+        self.idleconnection_metrics['degraded'].labels(**self.metric_labels).set(int(degraded))
+
     def buildProtocol(self, addr):
         """
         Called to build a new Protocol instance. Implies that the TCP connection
@@ -0,0 +1,289 @@
+"""
+ipvsconn.py
+
+Passive IPVS connection state monitor class implementation for PyBal
+"""
+
+# Python imports
+import binascii
+import logging
+import socket
+import struct
+
+# Twisted imports
+from twisted.internet import defer, threads
+from twisted.python import failure
+
+# Pybal imports
+from pybal import monitor
+from pybal.metrics import Gauge
+
+
+PROC_IPVS_CONN = '/proc/net/ip_vs_conn'
+
+
+def ipvsAddress(ip):
+    """Returns an IP address formatted as in /proc/net/ip_vs_conn"""
+
+    if ':' in ip:
+        packed = binascii.hexlify(socket.inet_pton(socket.AF_INET6, ip))
+        return ':'.join(packed[i:i + 4] for i in range(0, 32, 4))
+    else:
+        return '%08X' % struct.unpack('!I', socket.inet_aton(ip))[0]
+
+
+def connectionKey(protocol, vip, vport, rip, rport):
+    """Returns the (protocol, virtual address, virtual port, real address,
+    real port) fields of /proc/net/ip_vs_conn lines for a destination"""
+
+    return (protocol.upper(), ipvsAddress(vip), '%04X' % vport,
+            ipvsAddress(rip), '%04X' % rport)
+
+
+def countConnections(lines, destinations):
+    """
+    Counts the connections per state of each destination key in
+    destinations, from lines of /proc/net/ip_vs_conn. Lines are consumed
+    one at a time, and only the counts are kept, so tables of any size
+    can be read in constant memory. Returns a dict of {key: {state: count}}.
+    """
+
+    counts = {}
+    for line in lines:
+        fields = line.split(None, 8)
+        if len(fields) < 8:
+            continue
+        key = (fields[0], fields[3], fields[4], fields[5], fields[6])
+        if key in destinations:
+            states = counts.setdefault(key, {})
+            states[fields[7]] = states.get(fields[7], 0) + 1
+    return counts
+
+
+def readConnectionTable(path, destinations):
+    with open(path) as f:
+        return countConnections(f, destinations)
+
+
+class IPVSConnectionTable(object):
+    """
+    Reads the IPVS connection table for all IPVSConn monitors at once, in
+    a thread. Concurrent requests for counts share a single read, and
+    counts no older than the requested age are reused.
+    """
+
+    def __init__(self, reactor, path=PROC_IPVS_CONN):
+        self.reactor = reactor
+        self.path = path
+        self.monitors = set()
+        self.destinations = set()
+        self.counts = None
+        self.readTime = None
+        self.waiting = None
+
+    def register(self, monitor):
+        self.monitors.add(monitor)
+        self.destinations.add(monitor.destination)
+        self.counts = None
+
+    def unregister(self, monitor):
+        """Returns True if no monitors are left"""
+
+        self.monitors.discard(monitor)
+        self.destinations = set(m.destination for m in self.monitors)
+        return not self.monitors
+
+    def getCounts(self, maxAge):
+        """Returns a deferred that fires with the connection counts of all
+        registered destinations, read at most maxAge seconds ago"""
+
+        if self.counts is not None and self.reactor.seconds() - self.readTime < maxAge:
+            return defer.succeed(self.counts)
+
+        deferred = defer.Deferred()
+        if self.waiting is None:
+            self.waiting = [deferred]
+            threads.deferToThreadPool(
+                self.reactor, self.reactor.getThreadPool(),
+                readConnectionTable, self.path, frozenset(self.destinations)
+                ).addBoth(self._readFinished)
+        else:
+            self.waiting.append(deferred)
+        return deferred
+
+    def _readFinished(self, result):
+        waiting, self.waiting = self.waiting, None
+        if not isinstance(result, failure.Failure):
+            self.counts = result
+            self.readTime = self.reactor.seconds()
+        for deferred in waiting:
+            # Skip requests cancelled in the meantime
+            if not deferred.called:
+                if isinstance(result, failure.Failure):
+                    deferred.errback(result)
+                else:
+                    deferred.callback(result)
+
+
+class IPVSConnMonitoringProtocol(monitor.LoopingCheckMonitoringProtocol):
+    """
+    Monitor that sends no probes, but looks at the IPVS connection table
+    for the server. The server is down when connections pile up in
+    SYN_RECV, and degraded when it has no established connections while
+    its peers in the service are busy.
+    """
+
+    __name__ = 'IPVSConn'
+
+    INTV_CHECK = 10
+    MAX_SYN_RECV = 20
+    SYN_RECV_RATIO = 0.5
+    MIN_PEER_CONNECTIONS = 10
+    IDLE_DOWN = False
+
+    metric_labelnames = ('service', 'host', 'monitor')
+    metric_keywords = {
+        'namespace': 'pybal',
+        'subsystem': 'monitor_' + __name__.lower()
+    }
+
+    ipvsconn_metrics = {
+        'connections': Gauge(
+            'connections',
+            'IPVS connections to the server',
+            labelnames=metric_labelnames + ('state',),
+            **metric_keywords),
+        'degraded': Gauge(
+            'degraded',
+            'Whether the server has no established connections while its peers are busy',
+            labelnames=metric_labelnames,
+            **metric_keywords)
+    }
+
+    # Connection table reader shared by all IPVSConn monitors
+    connectionTable = None
+
+    def __init__(self, coordinator, server, configuration, reactor=None):
+        """Constructor"""
+
+        # Call ancestor constructor
+        super(IPVSConnMonitoringProtocol, self).__init__(
+            coordinator,
+            server,
+            configuration,
+            reactor=reactor)
+
+        self.maxSynRecv = self._getConfigInt('max-syn-recv', self.MAX_SYN_RECV)
+        self.synRecvRatio = self._getConfigFloat('syn-recv-ratio', self.SYN_RECV_RATIO)
+        self.minPeerConnections = self._getConfigInt(
+            'min-peer-connections', self.MIN_PEER_CONNECTIONS)
+        self.idleDown = self._getConfigBool('idle-down', self.IDLE_DOWN)
+
+        self.destination = None
+        self.degraded = False
+        self.checkDeferred = None
+
+    def run(self):
+        """Start the monitoring"""
+
+        # Real servers are added without a port, i.e. on the service port
+        service = self.server.lvsservice
+        self.destination = connectionKey(service.protocol, service.ip, service.port,
+                                         self.server.ip, service.port)
+
+        if IPVSConnMonitoringProtocol.connectionTable is None:
+            IPVSConnMonitoringProtocol.connectionTable = IPVSConnectionTable(
+                self.reactor, PROC_IPVS_CONN)
+        self.connectionTable.register(self)
+
+        super(IPVSConnMonitoringProtocol, self).run()
+
+    def stop(self):
+        """Stop the monitoring"""
+
+        super(IPVSConnMonitoringProtocol, self).stop()
+
+        if self.checkDeferred is not None:
+            self.checkDeferred.cancel()
+
+        if self.connectionTable is not None and self.destination is not None:
+            if self.connectionTable.unregister(self):
+                IPVSConnMonitoringProtocol.connectionTable = None
+
+    def check(self):
+        """Periodically called method that does a single check"""
+
+        if not self.active:
+            return
+
+        self.checkDeferred = self.connectionTable.getCounts(self.intvCheck)
+        self.checkDeferred.addCallbacks(self._evaluate, self._readFailed
+            ).addBoth(self._checkFinished)
+        return self.checkDeferred
+
+    def _evaluate(self, counts):
+        """Sets the state from the connection counts of the server and its
+        peers"""
+
+        states = counts.get(self.destination, {})
+        established = states.get('ESTABLISHED', 0)
+        synRecv = states.get('SYN_RECV', 0)
+        for state in ('ESTABLISHED', 'SYN_RECV'):
+            self.ipvsconn_metrics['connections'].labels(
+                state=state.lower(),
+                **self.metric_labels
+                ).set(states.get(state, 0))
+
+        if (self.maxSynRecv and synRecv >= self.maxSynRecv
+                and synRecv >= self.synRecvRatio * (established + synRecv)):
+            reason = "%d connections stuck in SYN_RECV" % synRecv
+            if self.up is not False:
+                self.report(reason, level=logging.WARN)
+            self._resultDown(reason)
+            return
+
+        degraded = self._isIdle(established, counts)
+        if degraded and not self.degraded:
+            self.report("No established connections while peers are busy",
+                        level=logging.WARN)
+        self._setDegraded(degraded)
+
+        if degraded and self.idleDown:
+            self._resultDown("No established connections while peers are busy")
+        else:
+            self._resultUp()
+
+    def _isIdle(self, established, counts):
+        """Returns whether the server has no established connections while
+        its pooled peers average at least min-peer-connections"""
+
+        if established or not self.minPeerConnections or not self.server.pool:
+            return False
+        peers = set(monitor.destination for monitor in self.connectionTable.monitors
+                    if monitor.destination[:3] == self.destination[:3]
+                    and monitor.destination != self.destination
+                    and monitor.server.pool)
+        if not peers:
+            return False
+        peerConnections = sum(counts.get(key, {}).get('ESTABLISHED', 0) for key in peers)
+        return peerConnections >= self.minPeerConnections * len(peers)
+
+    def _setDegraded(self, degraded):
+        self.degraded = degraded
+        self.ipvsconn_metrics['degraded'].labels(**self.metric_labels).set(int(degraded))
+
+    def _readFailed(self, failure):
+        """Called when the connection table could not be read"""
+
+        # Don't act as if the check failed if we cancelled it
+        if failure.check(defer.CancelledError):
+            return None
+
+        # Without connection state there is nothing to base a state on
+        self.report("Could not read the IPVS connection table: %s" %
+                    failure.getErrorMessage(), level=logging.ERROR)
+        failure.trap(IOError, OSError)
+
+    def _checkFinished(self, result):
+        self.checkDeferred = None
+        return result
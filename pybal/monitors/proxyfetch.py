@@ -9,36 +9,232 @@ Monitor class implementations for PyBal
 import hashlib
 import logging
 import random
+import re
+import weakref
+
+# PyOpenSSL imports
+from OpenSSL import SSL
 
 # Twisted imports
-from twisted.internet import defer
+from twisted.internet import defer, endpoints, protocol, ssl
+from twisted.internet.interfaces import IOpenSSLClientConnectionCreator
+from twisted.internet.interfaces import IStreamClientEndpoint
 from twisted.web import client
+from twisted.web.error import SchemeNotSupported
+from twisted.web.http_headers import Headers
+from twisted.web.iweb import IAgentEndpointFactory
 from twisted.python.runtime import seconds
-import twisted.internet.reactor
+from zope.interface import implementer
 
 # Pybal imports
 from pybal import monitor, util
-from pybal.metrics import Gauge
+from pybal.metrics import Counter, Gauge
+from pybal.version import USER_AGENT_STRING
 
 
 log = util.log
 
 
-class RedirHTTPPageGetter(client.HTTPPageGetter):
-    """PageGetter that accepts redirects as valid responses"""
+class BodyPrefixReader(protocol.Protocol):
+    """
+    Reads a response body as it streams in, keeping at most maxLength bytes.
+    If the body is longer than that, the transfer is stopped (closing the
+    connection), and the deferred fires with the prefix read so far.
+    """
+
+    def __init__(self, deferred, maxLength):
+        self.deferred = deferred
+        self.maxLength = maxLength
+        self.buffer = []
+        self.length = 0
+        self.truncated = False
+
+    def dataReceived(self, data):
+        if self.deferred is None or self.deferred.called:
+            return
+
+        remaining = self.maxLength - self.length
+        self.buffer.append(data[:remaining])
+        self.length += min(len(data), remaining)
+        if len(data) > remaining:
+            self.truncated = True
+            self._finish()
+            self.transport.stopProducing()
+
+    def connectionLost(self, reason):
+        if self.deferred is None or self.deferred.called:
+            return
+
+        # Without Content-Length the end of the body can't be verified
+        if reason.check(client.ResponseDone, client.PotentialDataLoss):
+            self._finish()
+        else:
+            deferred, self.deferred = self.deferred, None
+            deferred.errback(reason)
+
+    def _finish(self):
+        deferred, self.deferred = self.deferred, None
+        deferred.callback(b''.join(self.buffer))
 
-    # Handle 3xx (redirect) status as 200 OK
-    handleStatus_301 = client.HTTPPageGetter.handleStatus_200
-    handleStatus_302 = client.HTTPPageGetter.handleStatus_200
-    handleStatus_303 = client.HTTPPageGetter.handleStatus_200
 
-    # Fail on 200 (we're expecting a redirect here)
-    handleStatus_200 = client.HTTPPageGetter.handleStatusDefault
+class RequestTimings(object):
+    """
+    Records when the phases of a single HTTP(S) request completed: setting up
+    a new connection (if one couldn't be reused) and its TLS handshake,
+    receiving the response headers and receiving the (prefix of the) body.
+    """
 
+    def __init__(self):
+        self.start = seconds()
+        self.connected = None
+        self.tlsConnection = None
+        self.handshakeDone = None
+        self.responseReceived = None
+        self.finished = None
+
+    def durations(self):
+        """Returns a dict with the durations of the completed phases: connect,
+        tls, ttfb (time to first byte) and total."""
+        durations = {}
+        if self.connected is not None:
+            durations['connect'] = self.connected - self.start
+            if self.handshakeDone is not None:
+                durations['tls'] = self.handshakeDone - self.connected
+        if self.responseReceived is not None:
+            durations['ttfb'] = self.responseReceived - self.start
+        if self.finished is not None:
+            durations['total'] = self.finished - self.start
+        return durations
+
+
+@implementer(IStreamClientEndpoint)
+class TimedEndpoint(object):
+    """
+    Endpoint wrapper that records in a RequestTimings when the connection
+    was established, and which TLS connection (if any) it uses.
+    """
 
-class RedirHTTPClientFactory(client.HTTPClientFactory):
-    """HTTPClientFactory that accepts redirects as valid responses"""
-    protocol = RedirHTTPPageGetter
+    def __init__(self, endpoint, timings):
+        self.endpoint = endpoint
+        self.timings = timings
+
+    def connect(self, protocolFactory):
+        return self.endpoint.connect(protocolFactory).addCallback(self._connected)
+
+    def _connected(self, protocol):
+        self.timings.connected = seconds()
+        handle = protocol.transport.getHandle()
+        if isinstance(handle, SSL.Connection):
+            self.timings.tlsConnection = handle
+        return protocol
+
+
+@implementer(IAgentEndpointFactory)
+class ServerEndpointFactory(object):
+    """
+    Endpoint factory that connects to a fixed (real)server address and port,
+    regardless of the host in the URL, which is only used for the Host header.
+    If timings are given, new connections are recorded in them.
+    """
+
+    def __init__(self, reactor, host, port, contextFactory=None, timings=None):
+        self.reactor = reactor
+        self.host = host
+        self.port = port
+        self.contextFactory = contextFactory
+        self.timings = timings
+
+    def endpointForURI(self, uri):
+        if uri.scheme == b'http':
+            endpoint = endpoints.TCP4ClientEndpoint(self.reactor, self.host, self.port)
+        elif uri.scheme == b'https':
+            contextFactory = self.contextFactory or ssl.ClientContextFactory()
+            endpoint = endpoints.SSL4ClientEndpoint(self.reactor, self.host, self.port,
+                                                    contextFactory)
+        else:
+            raise SchemeNotSupported("Unsupported scheme: %r" % (uri.scheme,))
+
+        if self.timings is not None:
+            return TimedEndpoint(endpoint, self.timings)
+        return endpoint
+
+
+def sessionReused(connection):
+    """Returns whether the TLS handshake of an OpenSSL.SSL.Connection resumed
+    a previous session, or None if it can't be told.
+
+    PyOpenSSL has no public API for this, and its Session objects can't be
+    compared, so this calls SSL_session_reused through the private
+    OpenSSL.SSL._lib bindings. It returns None when those bindings (or the
+    private _ssl handle of the connection) aren't available."""
+    lib = getattr(SSL, '_lib', None)
+    ssl = getattr(connection, '_ssl', None)
+    if ssl is None or not hasattr(lib, 'SSL_session_reused'):
+        return None
+    try:
+        return bool(lib.SSL_session_reused(ssl))
+    except Exception:
+        return None
+
+
+@implementer(IOpenSSLClientConnectionCreator)
+class ResumingTLSConnectionCreator(object):
+    """
+    Creates TLS client connections to a single (real)server from a shared
+    SSL context, and offers the session of the previous handshake with that
+    server in each new connection, so it can be resumed (through a session
+    ticket or session ID) instead of doing a full handshake.
+    """
+
+    def __init__(self, context, resume=True, onHandshake=None):
+        self.context = context
+        self.resume = resume
+        self.onHandshake = onHandshake
+        self.session = None
+        # Handshake completion times by connection
+        self.handshakenConnections = weakref.WeakKeyDictionary()
+
+    @staticmethod
+    def createContext():
+        """Returns a new client SSL context, configured like
+        ssl.ClientContextFactory, that reports completed handshakes to the
+        ResumingTLSConnectionCreator of the connection."""
+        context = ssl.ClientContextFactory().getContext()
+        context.set_session_cache_mode(SSL.SESS_CACHE_CLIENT)
+        context.set_info_callback(ResumingTLSConnectionCreator._infoCallback)
+        return context
+
+    @staticmethod
+    def _infoCallback(connection, where, ret):
+        creator = connection.get_app_data()
+        if not isinstance(creator, ResumingTLSConnectionCreator):
+            return
+        if where & SSL.SSL_CB_HANDSHAKE_DONE:
+            creator.handshakeDone(connection)
+        elif where & SSL.SSL_CB_CONNECT_EXIT:
+            creator.sessionUpdated(connection)
+
+    def clientConnectionForTLS(self, tlsProtocol):
+        connection = SSL.Connection(self.context, None)
+        connection.set_app_data(self)
+        if self.resume and self.session is not None:
+            connection.set_session(self.session)
+        return connection
+
+    def handshakeDone(self, connection):
+        """Called when a handshake on one of our connections has completed."""
+        if connection in self.handshakenConnections:
+            return
+        self.handshakenConnections[connection] = seconds()
+        self.sessionUpdated(connection)
+        if self.onHandshake is not None:
+            self.onHandshake(sessionReused(connection))
+
+    def sessionUpdated(self, connection):
+        """Saves the session of a connection for the next one. With TLS 1.3
+        session tickets only arrive after the handshake has completed."""
+        if self.resume and connection in self.handshakenConnections:
+            self.session = connection.get_session()
 
 
 class ProxyFetchMonitoringProtocol(monitor.LoopingCheckMonitoringProtocol):
@@ -52,11 +248,20 @@ class ProxyFetchMonitoringProtocol(monitor.LoopingCheckMonitoringProtocol):
 
     CHECK_ALL = False
 
+    KEEPALIVE = False
+    KEEPALIVE_MAX_CONNECTIONS = 2
+    KEEPALIVE_IDLE_TIMEOUT = 60
+
+    TLS_SESSION_RESUMPTION = True
+
+    MAX_BODY_SIZE = 65536
+
     __name__ = 'ProxyFetch'
 
     from twisted.internet import error
     from twisted.web import error as weberror
-    catchList = ( defer.TimeoutError, weberror.Error, error.ConnectError, error.DNSLookupError )
+    catchList = ( defer.TimeoutError, weberror.Error, error.ConnectError, error.DNSLookupError,
+                  client.ResponseFailed, client.RequestTransmissionFailed )
 
     metric_labelnames = ('service', 'host', 'monitor')
     metric_keywords = {
@@ -69,9 +274,17 @@ class ProxyFetchMonitoringProtocol(monitor.LoopingCheckMonitoringProtocol):
             'request_duration_seconds',
             'HTTP(S) request duration',
             labelnames=metric_labelnames + ('result', 'url', ), # TODO: statuscode
+            **metric_keywords),
+        'tls_handshakes_total': Counter(
+            'tls_handshakes_total',
+            'TLS handshakes, full or resumed',
+            labelnames=metric_labelnames + ('type', ),
             **metric_keywords)
     }
 
+    # SSL contexts, shared by all ProxyFetch monitors of an LVS service
+    tlsContexts = {}
+
     def __init__(self, coordinator, server, configuration={}, reactor=None):
         """Constructor"""
 
@@ -83,12 +296,34 @@ class ProxyFetchMonitoringProtocol(monitor.LoopingCheckMonitoringProtocol):
             reactor=reactor)
 
         self.toGET = self._getConfigInt('timeout', self.TIMEOUT_GET)
+        self.adaptiveTimeout = self._getAdaptiveTimeout(self.toGET)
         self.expectedStatus = self._getConfigInt('http_status',
                                                  self.HTTP_STATUS)
         self.URLs = self._getConfigStringList('url')
         self.checkAllUrls = self._getConfigBool('check_all', self.CHECK_ALL)
         self.getPageDeferredList = None
 
+        # Persistent (HTTP/1.1 keep-alive) connections to the server. If
+        # disabled, every check uses a fresh connection.
+        self.keepAlive = self._getConfigBool('keepalive', self.KEEPALIVE)
+        self.keepAliveMaxConnections = self._getConfigInt(
+            'keepalive-max-connections', self.KEEPALIVE_MAX_CONNECTIONS)
+        self.keepAliveIdleTimeout = self._getConfigInt(
+            'keepalive-idle-timeout', self.KEEPALIVE_IDLE_TIMEOUT)
+        self.pool = None
+
+        self.tlsSessionResumption = self._getConfigBool(
+            'tls-session-resumption', self.TLS_SESSION_RESUMPTION)
+        self.tlsConnectionCreator = None
+
+        # Response bodies are read up to maxBodySize bytes, and only
+        # buffered if they need to match a pattern.
+        self.maxBodySize = self._getConfigInt('max-body-size', self.MAX_BODY_SIZE)
+        try:
+            self.bodyMatch = re.compile(self._getConfigString('body-match'))
+        except KeyError:
+            self.bodyMatch = None
+
         self.checkStartTime = None
         self.currentFailures = []
         # Maximum number of failures to tolerate:
@@ -105,6 +340,10 @@ class ProxyFetchMonitoringProtocol(monitor.LoopingCheckMonitoringProtocol):
         if self.getPageDeferredList is not None:
             self.getPageDeferredList.cancel()
 
+        if self.pool is not None:
+            self.pool.closeCachedConnections()
+            self.pool = None
+
     def check(self):
         """Periodically called method that does a single uptime check."""
 
@@ -124,15 +363,10 @@ class ProxyFetchMonitoringProtocol(monitor.LoopingCheckMonitoringProtocol):
         deferreds = []
         for url in urls:
             self.checkStartTime[self._keyFromUrl(url)] = seconds()
-            deferred = self.getProxyPage(
+            deferred = self.getPooledPage(
                 url,
-                method='GET',
-                host=self.server.ip,
-                port=self.server.port,
                 status=self.expectedStatus,
-                timeout=self.toGET,
-                followRedirect=False,
-                reactor=self.reactor
+                timeout=self._currentTimeout(self.toGET)
             ).addCallback(
                 self._fetchSuccessful,
                 url=url
@@ -146,10 +380,11 @@ class ProxyFetchMonitoringProtocol(monitor.LoopingCheckMonitoringProtocol):
         return self.getPageDeferredList
 
     def _fetchSuccessful(self, result, url=None):
-        """Called when getProxyPage is finished successfully."""
+        """Called when getPooledPage is finished successfully."""
         # Here we don't add anything to self.currentFailures.
         duration = seconds() - self.checkStartTime[self._keyFromUrl(url)]
         self.report('Fetch successful (%s), %.3f s' % (url, duration))
+        self._sampleTimeout(duration)
 
         self.proxyfetch_metrics['request_duration_seconds'].labels(
             result='successful',
@@ -160,7 +395,7 @@ class ProxyFetchMonitoringProtocol(monitor.LoopingCheckMonitoringProtocol):
         return result
 
     def _fetchFailed(self, failure, url=None):
-        """Called when getProxyPage finished with a failure."""
+        """Called when getPooledPage finished with a failure."""
 
         # Don't act as if the check failed if we cancelled it
         if failure.check(defer.CancelledError):
@@ -171,6 +406,8 @@ class ProxyFetchMonitoringProtocol(monitor.LoopingCheckMonitoringProtocol):
                     level=logging.WARN)
 
         self.currentFailures.append(failure.getErrorMessage())
+        if failure.check(defer.TimeoutError):
+            self._backoffTimeout()
 
         self.proxyfetch_metrics['request_duration_seconds'].labels(
             result='failed',
@@ -182,7 +419,7 @@ class ProxyFetchMonitoringProtocol(monitor.LoopingCheckMonitoringProtocol):
 
     def _checkFinished(self, result):
         """
-        Called when all getProxyPage finished with either success or failure,
+        Called when all getPooledPage finished with either success or failure,
         to do after-check cleanups and fire reportDown or reportUp.
         """
         self.checkStartTime = None
@@ -193,32 +430,132 @@ class ProxyFetchMonitoringProtocol(monitor.LoopingCheckMonitoringProtocol):
         self.currentFailures = []
         return result
 
-    @staticmethod
-    def getProxyPage(url, contextFactory=None, host=None, port=None,
-                     status=None, reactor=twisted.internet.reactor, *args, **kwargs):
-        """Download a web page as a string. (modified from twisted.web.client.getPage)
-
-        Download a page. Return a deferred, which will callback with a
-        page (as a string) or errback with a description of the error.
+    def getPooledPage(self, url, status=None, timeout=None):
+        """Fetch a web page from the server over a connection from this
+        monitor's connection pool. With keep-alive the connection is
+        returned to the pool afterwards, otherwise it is closed.
 
-        See HTTPClientFactory to see what extra args can be passed.
+        Return a deferred, which will callback with (a prefix of) the page
+        as a string or errback with a description of the error. Redirects
+        are accepted only if status is a redirect code. The durations of the phases of
+        successful requests are recorded in the latency histogram.
         """
-        if status > 300 and status < 304:
-            factory = RedirHTTPClientFactory(url, *args, **kwargs)
+        timings = RequestTimings()
+
+        def responseReceived(response):
+            timings.responseReceived = seconds()
+            return self._pooledResponseReceived(response, status)
+
+        deferred = self._getAgent(timings).request(
+            'GET',
+            url,
+            Headers({'User-Agent': [USER_AGENT_STRING]})
+        ).addCallback(responseReceived
+        ).addCallback(self._observeTimings, timings, url)
+        if timeout:
+            deferred.addTimeout(timeout, self.reactor)
+        return deferred
+
+    def _getAgent(self, timings=None):
+        """Returns an Agent using this monitor's connection pool, which
+        records new connections in timings if given."""
+        endpointFactory = ServerEndpointFactory(
+            self.reactor, self.server.ip, self.server.port,
+            self._getTLSConnectionCreator(), timings)
+        return client.Agent.usingEndpointFactory(
+            self.reactor, endpointFactory, pool=self._getPool())
+
+    def _getPool(self):
+        """Returns this monitor's connection pool, creating it if needed."""
+        if self.pool is None:
+            self.pool = client.HTTPConnectionPool(self.reactor,
+                                                  persistent=self.keepAlive)
+            self.pool.maxPersistentPerHost = self.keepAliveMaxConnections
+            self.pool.cachedConnectionTimeout = self.keepAliveIdleTimeout
+        return self.pool
+
+    def _getTLSConnectionCreator(self):
+        """Returns the TLS connection creator for this monitor's server,
+        using the SSL context shared by the LVS service."""
+        if self.tlsConnectionCreator is None:
+            service = self.server.lvsservice.name
+            if service not in self.tlsContexts:
+                self.tlsContexts[service] = ResumingTLSConnectionCreator.createContext()
+            self.tlsConnectionCreator = ResumingTLSConnectionCreator(
+                self.tlsContexts[service],
+                resume=self.tlsSessionResumption,
+                onHandshake=self._tlsHandshakeDone)
+        return self.tlsConnectionCreator
+
+    def _tlsHandshakeDone(self, resumed):
+        """Called when a TLS handshake with the server has completed.
+        Handshakes not known to be full or resumed aren't counted."""
+        if resumed is None:
+            return
+        self.proxyfetch_metrics['tls_handshakes_total'].labels(
+            type=resumed and 'resumed' or 'full',
+            **self.metric_labels
+            ).inc()
+
+    def _observeTimings(self, result, timings, url):
+        """Records the phase durations of a successful request in the
+        latency histogram."""
+        timings.finished = seconds()
+        if timings.tlsConnection is not None:
+            timings.handshakeDone = self._getTLSConnectionCreator(
+                ).handshakenConnections.get(timings.tlsConnection)
+
+        histogram = self._getHistogram(
+            'request_latency_seconds',
+            'HTTP(S) request phase duration distribution',
+            labelnames=('url', 'phase'))
+        for phase, duration in timings.durations().iteritems():
+            histogram.labels(url=url, phase=phase, **self.metric_labels
+                ).observe(duration)
+
+        return result
+
+    def _pooledResponseReceived(self, response, status):
+        """Streams in the body of a response and fails unless the status is
+        acceptable and, if configured, the body matches the pattern.
+
+        The body is read up to maxBodySize bytes, beyond which the connection
+        is closed. Reading it completely allows a persistent connection to be
+        reused; without keep-alive or a pattern to match, the connection is
+        closed as soon as the body starts."""
+
+        if self.keepAlive or self.bodyMatch is not None:
+            maxLength = self.maxBodySize
         else:
-            factory = client.HTTPClientFactory(url, *args, **kwargs)
+            maxLength = 0
+
+        def cancel(deferred):
+            bodyReader.transport.stopProducing()
+
+        deferred = defer.Deferred(cancel)
+        bodyReader = BodyPrefixReader(deferred, maxLength)
+        response.deliverBody(bodyReader)
 
-        host = host or factory.host
-        port = port or factory.port
+        def checkResponse(body):
+            if not self._statusAccepted(response.code, status):
+                raise self.weberror.Error(str(response.code), response.phrase, body)
+            if self.bodyMatch is not None and not self.bodyMatch.search(body):
+                raise self.weberror.Error(
+                    str(response.code),
+                    "Response body does not match '%s'" % self.bodyMatch.pattern,
+                    body)
+            return body
 
-        if factory.scheme == 'https':
-            from twisted.internet import ssl
-            if contextFactory is None:
-                contextFactory = ssl.ClientContextFactory()
-            reactor.connectSSL(host, port, factory, contextFactory)
+        return deferred.addCallback(checkResponse)
+
+    @staticmethod
+    def _statusAccepted(code, status):
+        """Returns whether a response status code counts as a successful
+        fetch: a redirect if status is one, or a 2xx response otherwise."""
+        if status > 300 and status < 304:
+            return code in (301, 302, 303)
         else:
-            reactor.connectTCP(host, port, factory)
-        return factory.deferred
+            return code in (200, 201, 202)
 
     @staticmethod
     def _keyFromUrl(url):
@@ -7,10 +7,11 @@ Monitor class implementations for PyBal
 
 # Python imports
 import os, sys, signal, errno
+import itertools, json
 import logging
 
 # Twisted imports
-from twisted.internet import process, error, defer
+from twisted.internet import process, error, defer, protocol
 from twisted.python.runtime import seconds
 import twisted.internet.reactor
 
@@ -86,6 +87,127 @@ class ProcessGroupProcess(process.Process, object):
     def signalProcessGroup(self, signal, pgid=None):
         os.kill(pgid or -self.pid, signal)
 
+
+def spawnProcessGroup(reactor, processProtocol, executable, args=(),
+                      env={}, path=None,
+                      uid=None, gid=None, childFDs=None,
+                      sessionLeader=False, timeout=None):
+    """
+    Replacement for posixbase.PosixReactorBase.spawnProcess with added
+    process group / session and timeout support, and support for
+    non-POSIX platforms and PTYs removed.
+    """
+
+    # Use the default reactor instead of reactor as not all (testing)
+    # reactors provide _checkProcessArgs, and it's harmless anyway.
+    args, env = twisted.internet.reactor._checkProcessArgs(args, env)
+    return ProcessGroupProcess(reactor, executable, args, env, path,
+                               processProtocol, uid, gid, childFDs,
+                               sessionLeader, timeout)
+
+
+class WorkerError(Exception):
+    """The check worker failed to answer a check request"""
+
+
+class CheckWorker(protocol.ProcessProtocol, object):
+    """
+    Long-lived helper process that performs checks on request, to avoid
+    spawning a new process for every check. Requests are written to its
+    stdin and responses are read from its stdout, both as JSON objects,
+    one per line:
+
+        {"id": 1, "host": "...", "ip": "...", "port": 80, "arguments": [...]}
+        {"id": 1, "up": false, "reason": "..."}
+
+    Responses may be sent in any order. The worker is started on the first
+    request, and restarted on the next request after it has exited.
+    """
+
+    def __init__(self, reactor, command, arguments=[]):
+        self.reactor = reactor
+        self.command = command
+        self.arguments = arguments
+        self.process = None
+        self.buffer = b''
+        self.requestIDs = itertools.count(1)
+        self.pendingRequests = {}
+        self.monitors = set()
+
+    def __report_prefix(self):
+        return "Check worker %s:" % self.command
+
+    def request(self, **parameters):
+        """Sends a check request to the worker, starting it if needed.
+        Returns a deferred that fires with a tuple (up, reason) when the
+        worker responds, or errbacks with WorkerError if the worker exits
+        before that. Cancelling it discards the response."""
+
+        if self.process is None:
+            self._start()
+
+        requestID = next(self.requestIDs)
+        deferred = defer.Deferred(lambda d: self.pendingRequests.pop(requestID, None))
+        self.pendingRequests[requestID] = deferred
+
+        parameters['id'] = requestID
+        self.process.write(json.dumps(parameters) + '\n')
+        return deferred
+
+    def stop(self):
+        """Kills the worker, if running"""
+
+        if self.process is not None:
+            try: self.process.signalProcess(signal.SIGKILL)
+            except error.ProcessExitedAlready: pass
+
+    def _start(self):
+        log.info("%s starting" % self.__report_prefix())
+        self.buffer = b''
+        self.process = spawnProcessGroup(self.reactor, self, self.command,
+                                         [self.command] + self.arguments,
+                                         sessionLeader=True)
+
+    def outReceived(self, data):
+        lines = (self.buffer + data).split(b'\n')
+        self.buffer = lines.pop()
+        for line in lines:
+            self.responseReceived(line)
+
+    def errReceived(self, data):
+        log.info("%s stderr: %s" % (self.__report_prefix(), data.rstrip()))
+
+    def responseReceived(self, line):
+        """Called with every line the worker writes to stdout"""
+
+        try:
+            response = json.loads(line)
+            deferred = self.pendingRequests.pop(response['id'], None)
+            result = bool(response['up']), response.get('reason')
+        except (ValueError, TypeError, KeyError):
+            log.warn("%s invalid response: %r" % (self.__report_prefix(), line))
+            return
+
+        # Requests that have been cancelled (timed out) are ignored
+        if deferred is not None:
+            deferred.callback(result)
+
+    def processEnded(self, reason):
+        """Called when the worker has exited. Fails all pending requests."""
+
+        log.warn("%s exited: %s" % (self.__report_prefix(), reason.getErrorMessage()))
+        self.process = None
+        pendingRequests, self.pendingRequests = self.pendingRequests, {}
+        for deferred in pendingRequests.itervalues():
+            deferred.errback(WorkerError(
+                "Check worker exited: %s" % reason.getErrorMessage()))
+
+    def leftoverProcesses(self, allKilled):
+        """Called when the worker left some of its child processes behind"""
+        if not allKilled:
+            log.warn("%s left child processes behind, and not all could be killed!"
+                     % self.__report_prefix())
+
 class RunCommandMonitoringProtocol(monitor.LoopingCheckMonitoringProtocol):
     """
     Monitor that checks server uptime by repeatedly fetching a certain URL
@@ -97,6 +219,8 @@ class RunCommandMonitoringProtocol(monitor.LoopingCheckMonitoringProtocol):
 
     TIMEOUT_RUN = 20
 
+    WORKER = False
+
     metric_labelnames = ('service', 'host', 'monitor')
     metric_keywords = {
         'namespace': 'pybal',
@@ -111,6 +235,9 @@ class RunCommandMonitoringProtocol(monitor.LoopingCheckMonitoringProtocol):
             **metric_keywords)
     }
 
+    # Check workers by LVS service and command line
+    workers = {}
+
     def __init__(self, coordinator, server, configuration={}, reactor=None):
         """Constructor"""
 
@@ -135,6 +262,17 @@ class RunCommandMonitoringProtocol(monitor.LoopingCheckMonitoringProtocol):
 
         self.logOutput = self._getConfigBool('log-output', True)
 
+        # Check through a long-lived worker process shared by the service,
+        # instead of running the command for every check
+        self.useWorker = self._getConfigBool('worker', self.WORKER)
+        try:
+            self.workerArguments = self._getConfigStringList('worker-arguments')
+        except KeyError:
+            self.workerArguments = []
+        if isinstance(self.workerArguments, str):
+            self.workerArguments = [self.workerArguments]
+        self.worker = None
+
         self.runningProcess = None
         self.runningProcessDeferred = None
 
@@ -148,9 +286,17 @@ class RunCommandMonitoringProtocol(monitor.LoopingCheckMonitoringProtocol):
             try: self.runningProcess.signalProcess(signal.SIGKILL)
             except error.ProcessExitedAlready: pass
 
+        if self.worker is not None:
+            if self.runningProcessDeferred is not None:
+                self.runningProcessDeferred.cancel()
+            self._releaseWorker()
+
     def runCommand(self):
         """Periodically called method that does a single uptime check."""
 
+        if self.useWorker:
+            return self.requestCheck()
+
         self.checkStartTime = seconds()
         self.runningProcess = self._spawnProcess(self, self.command, [self.command] + self.arguments,
                                                  sessionLeader=True, timeout=(self.timeout or None))
@@ -194,13 +340,95 @@ class RunCommandMonitoringProtocol(monitor.LoopingCheckMonitoringProtocol):
             result = None
             exitcode = None
 
+        self._recordDuration(result, exitcode, duration)
+
+        self.runningProcessDeferred.callback(reason.type)
+        reason.trap(error.ProcessDone, error.ProcessTerminated)
+
+    def requestCheck(self):
+        """Requests a single uptime check from the check worker."""
+
+        self.checkStartTime = seconds()
+        self.runningProcessDeferred = self._getWorker().request(
+            host=self.server.host,
+            ip=self.server.ip,
+            port=self.server.port,
+            arguments=self.arguments)
+        if self.timeout:
+            self.runningProcessDeferred.addTimeout(self.timeout, self.reactor)
+        self.runningProcessDeferred.addCallbacks(
+            self._checkResponseReceived, self._checkRequestFailed)
+        return self.runningProcessDeferred
+
+    def _checkResponseReceived(self, (up, reason)):
+        """Called when the check worker responded to a check request"""
+
+        duration = seconds() - self.checkStartTime
+        if up:
+            self._resultUp()
+            self._recordDuration('successful', 0, duration)
+        else:
+            self._resultDown(reason)
+            self._recordDuration('failed', None, duration)
+        self.runningProcessDeferred = None
+
+    def _checkRequestFailed(self, failure):
+        """Called when a check request timed out or the worker exited"""
+
+        self.runningProcessDeferred = None
+
+        # Don't act as if the check failed if we cancelled it
+        if failure.check(defer.CancelledError):
+            return None
+
+        duration = seconds() - self.checkStartTime
+        if failure.check(defer.TimeoutError):
+            reason = "Check worker timed out after %s s" % self.timeout
+        else:
+            reason = failure.getErrorMessage()
+        self.report(reason, level=logging.WARN)
+        self._resultDown(reason)
+        self._recordDuration('failed', None, duration)
+        failure.trap(defer.TimeoutError, WorkerError)
+
+    def _getWorker(self):
+        """Returns the check worker of this service, creating it if needed"""
+
+        if self.worker is None:
+            key = (self.server.lvsservice.name, self.command,
+                   tuple(self.workerArguments))
+            if key not in self.workers:
+                self.workers[key] = CheckWorker(self.reactor, self.command,
+                                                self.workerArguments)
+            self.worker = self.workers[key]
+            self.worker.monitors.add(self)
+        return self.worker
+
+    def _releaseWorker(self):
+        """Stops using the check worker, and stops the worker if no other
+        monitor uses it"""
+
+        self.worker.monitors.discard(self)
+        if not self.worker.monitors:
+            self.worker.stop()
+            for key, worker in self.workers.items():
+                if worker is self.worker:
+                    del self.workers[key]
+        self.worker = None
+
+    def _recordDuration(self, result, exitcode, duration):
+        """Records the duration of a check in the metrics"""
+
         self.runcommand_metrics['run_duration_seconds'].labels(
             result=result, exitcode=exitcode,
             **self.metric_labels
             ).set(duration)
-
-        self.runningProcessDeferred.callback(reason.type)
-        reason.trap(error.ProcessDone, error.ProcessTerminated)
+        if result is not None:
+            self._getHistogram(
+                'run_latency_seconds',
+                'Command duration distribution',
+                labelnames=('result',)
+                ).labels(result=result, **self.metric_labels).observe(duration)
 
     def leftoverProcesses(self, allKilled):
         """
@@ -220,14 +448,9 @@ class RunCommandMonitoringProtocol(monitor.LoopingCheckMonitoringProtocol):
                      uid=None, gid=None, childFDs=None,
                      sessionLeader=False, timeout=None):
         """
-        Replacement for posixbase.PosixReactorBase.spawnProcess with added
-        process group / session and timeout support, and support for
-        non-POSIX platforms and PTYs removed.
+        Spawns a process in its own process group, see spawnProcessGroup.
         """
 
-        # Use the default reactor instead of self.reactor as not all (testing)
-        # reactors provide _checkProcessArgs, and it's harmless anyway.
-        args, env = twisted.internet.reactor._checkProcessArgs(args, env)
-        return ProcessGroupProcess(self.reactor, executable, args, env, path,
-                               processProtocol, uid, gid, childFDs,
-                               sessionLeader, timeout)
+        return spawnProcessGroup(self.reactor, processProtocol, executable,
+                                 args, env, path, uid, gid, childFDs,
+                                 sessionLeader, timeout)
@@ -0,0 +1,247 @@
+"""
+tcpconnect.py
+
+TCP connect monitor class implementation for PyBal
+"""
+
+# Python imports
+import logging
+import socket
+import struct
+
+# Twisted imports
+from twisted.internet import defer, error, protocol
+from twisted.python import runtime
+
+# Pybal imports
+from pybal import monitor
+from pybal.metrics import Gauge
+
+
+class PrefixMismatchError(Exception):
+    """The reply of the server did not start with the expected prefix"""
+
+
+class TCPConnectProtocol(protocol.Protocol):
+    """
+    Sends the configured payload (if any) once connected, and closes the
+    connection as soon as the connect, or the expected reply prefix, has
+    been confirmed.
+    """
+
+    def connectionMade(self):
+        self.buffer = b''
+        self.factory.connectionMade(self)
+        if self.factory.send:
+            self.transport.write(self.factory.send)
+        if not self.factory.expect:
+            self.factory.succeeded(self)
+
+    def dataReceived(self, data):
+        if not self.factory.expect:
+            return
+        self.buffer += data
+        expect = self.factory.expect
+        if not expect.startswith(self.buffer[:len(expect)]):
+            self.factory.failed(self, PrefixMismatchError(
+                "Reply does not start with %r" % expect))
+        elif len(self.buffer) >= len(expect):
+            self.factory.succeeded(self)
+
+    def close(self, reset):
+        """Closes the connection, with a RST if reset is set"""
+
+        if reset:
+            # A zero linger timeout makes close(2) send a RST, and avoids
+            # TIME_WAIT sockets piling up at short check intervals
+            try:
+                self.transport.getHandle().setsockopt(
+                    socket.SOL_SOCKET, socket.SO_LINGER, struct.pack('ii', 1, 0))
+            except (AttributeError, socket.error):
+                pass
+        self.transport.abortConnection()
+
+
+class TCPConnectFactory(protocol.ClientFactory):
+    """
+    Client factory for a single TCP connect check. Its deferred fires with
+    the connect latency, or errbacks with the reason the check failed.
+    """
+
+    protocol = TCPConnectProtocol
+    noisy = False
+
+    def __init__(self, send=b'', expect=b'', reset=False):
+        self.send = send
+        self.expect = expect
+        self.reset = reset
+        self.connector = None
+        self.startTime = runtime.seconds()
+        self.connectLatency = None
+        self.deferred = defer.Deferred(self._cancel)
+
+    def connectionMade(self, proto):
+        self.connectLatency = runtime.seconds() - self.startTime
+
+    def succeeded(self, proto):
+        proto.close(self.reset)
+        if not self.deferred.called:
+            self.deferred.callback(self.connectLatency)
+
+    def failed(self, proto, reason):
+        proto.close(self.reset)
+        if not self.deferred.called:
+            self.deferred.errback(reason)
+
+    def clientConnectionFailed(self, connector, reason):
+        if not self.deferred.called:
+            self.deferred.errback(reason)
+
+    def clientConnectionLost(self, connector, reason):
+        # Only reached before success if the server closed the
+        # connection before sending the expected reply
+        if not self.deferred.called:
+            self.deferred.errback(reason)
+
+    def _cancel(self, deferred):
+        # Fire first, as disconnecting may call clientConnectionFailed
+        deferred.errback(defer.CancelledError())
+        if self.connector is not None:
+            self.connector.disconnect()
+
+
+class TCPConnectMonitoringProtocol(monitor.LoopingCheckMonitoringProtocol):
+    """
+    Monitor that checks whether a server accepts TCP connections, by
+    connecting and immediately closing the connection again at a (short)
+    interval. Optionally a payload is sent, and the reply has to start
+    with an expected prefix.
+    """
+
+    __name__ = 'TCPConnect'
+
+    INTV_CHECK = 1.0
+    TIMEOUT = 1.0
+    RESET = False
+
+    catchList = (defer.TimeoutError, error.ConnectError, error.ConnectionLost,
+                 error.ConnectionDone, PrefixMismatchError)
+
+    metric_labelnames = ('service', 'host', 'monitor')
+    metric_keywords = {
+        'namespace': 'pybal',
+        'subsystem': 'monitor_' + __name__.lower()
+    }
+
+    tcpconnect_metrics = {
+        'connect_duration_seconds': Gauge(
+            'connect_duration_seconds',
+            'TCP connect duration',
+            labelnames=metric_labelnames + ('result',),
+            **metric_keywords)
+    }
+
+    def __init__(self, coordinator, server, configuration, reactor=None):
+        """Constructor"""
+
+        # Call ancestor constructor
+        super(TCPConnectMonitoringProtocol, self).__init__(
+            coordinator,
+            server,
+            configuration,
+            reactor=reactor)
+
+        self.port = self._getConfigInt('port', server.port)
+        self.toConnect = self._getConfigFloat('timeout', self.TIMEOUT)
+        self.adaptiveTimeout = self._getAdaptiveTimeout(self.toConnect)
+        self.reset = self._getConfigBool('reset', self.RESET)
+
+        # Payload to send, and reply prefix to expect, with escape
+        # sequences such as \r\n
+        try:
+            self.send = self._getConfigString('send').decode('string_escape')
+        except KeyError:
+            self.send = b''
+        try:
+            self.expect = self._getConfigString('expect').decode('string_escape')
+        except KeyError:
+            self.expect = b''
+
+        self.checkDeferred = None
+
+    def stop(self):
+        """Stop the monitoring"""
+
+        super(TCPConnectMonitoringProtocol, self).stop()
+
+        if self.checkDeferred is not None:
+            self.checkDeferred.cancel()
+
+    def check(self):
+        """Periodically called method that does a single check"""
+
+        if not self.active:
+            return
+
+        timeout = self._currentTimeout(self.toConnect)
+        factory = TCPConnectFactory(self.send, self.expect, self.reset)
+        factory.connector = self.reactor.connectTCP(
+            self.server.ip, self.port, factory, timeout=timeout)
+
+        self.checkDeferred = factory.deferred.addTimeout(timeout, self.reactor)
+        self.checkDeferred.addCallbacks(self._connectSuccessful, self._connectFailed,
+                                        errbackArgs=(factory,)
+            ).addBoth(self._checkFinished)
+        return self.checkDeferred
+
+    def _connectSuccessful(self, latency):
+        """Called when the connect (and reply match) succeeded"""
+
+        self.report('TCP connect successful, %.3f s' % latency)
+        self._sampleTimeout(latency)
+        self._resultUp()
+
+        self.tcpconnect_metrics['connect_duration_seconds'].labels(
+            result='successful',
+            **self.metric_labels
+            ).set(latency)
+        self._observeLatency('successful', latency)
+
+    def _connectFailed(self, failure, factory):
+        """Called when the connect or reply match failed"""
+
+        # Don't act as if the check failed if we cancelled it
+        if failure.check(defer.CancelledError):
+            return None
+        elif failure.check(defer.TimeoutError, error.TimeoutError):
+            errorStr = "TCP connect timeout"
+            self._backoffTimeout()
+        else:
+            errorStr = failure.getErrorMessage()
+
+        duration = runtime.seconds() - factory.startTime
+        self.report('TCP connect failed, %.3f s: %s' % (duration, errorStr),
+                    level=logging.ERROR)
+        self._resultDown(errorStr)
+
+        self.tcpconnect_metrics['connect_duration_seconds'].labels(
+            result='failed',
+            **self.metric_labels
+            ).set(duration)
+        self._observeLatency('failed', duration)
+
+        failure.trap(*self.catchList)
+
+    def _observeLatency(self, result, duration):
+        """Records the duration of a check in the latency histogram."""
+        self._getHistogram(
+            'connect_latency_seconds',
+            'TCP connect duration distribution',
+            labelnames=('result',)
+            ).labels(result=result, **self.metric_labels).observe(duration)
+
+    def _checkFinished(self, result):
+        """Called when the check finished with either success or failure"""
+
+        self.checkDeferred = None
+        return result
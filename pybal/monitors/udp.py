@@ -6,14 +6,263 @@ UDP Monitor class implementation for PyBal
 """
 
 # Python imports
+import ctypes, ctypes.util
+import errno
 import logging
+import socket
+import struct
 
 # Twisted imports
 from twisted.internet import protocol
+from twisted.internet.interfaces import IHalfCloseableDescriptor, IReadDescriptor
 from twisted.python import runtime
+from zope.interface import implementer
 
 # Pybal imports
 from pybal import monitor
+from pybal.util import log
+
+
+# Linux constants not provided by the Python 2 socket module
+IP_RECVERR = 11
+IPV6_RECVERR = 25
+MSG_ERRQUEUE = 0x2000
+SO_EE_ORIGIN_ICMP = 2
+SO_EE_ORIGIN_ICMP6 = 3
+ICMP_DEST_UNREACH = 3
+ICMP6_DST_UNREACH = 1
+
+
+class _iovec(ctypes.Structure):
+    _fields_ = [('iov_base', ctypes.c_void_p),
+                ('iov_len', ctypes.c_size_t)]
+
+
+class _msghdr(ctypes.Structure):
+    _fields_ = [('msg_name', ctypes.c_void_p),
+                ('msg_namelen', ctypes.c_uint32),
+                ('msg_iov', ctypes.POINTER(_iovec)),
+                ('msg_iovlen', ctypes.c_size_t),
+                ('msg_control', ctypes.c_void_p),
+                ('msg_controllen', ctypes.c_size_t),
+                ('msg_flags', ctypes.c_int)]
+
+
+_libc = None
+
+
+def recvErrorQueue(sock):
+    """
+    Reads one error from the error queue of a socket with IP_RECVERR or
+    IPV6_RECVERR set, using recvmsg(2) as the Python 2 socket module doesn't
+    provide it. Returns a tuple (ee_errno, ee_origin, ee_type, ee_code,
+    destination) where destination is the (address, port) the packet that
+    caused the error was sent to, or None if the queue is empty.
+    """
+
+    global _libc
+    if _libc is None:
+        _libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+
+    name = ctypes.create_string_buffer(128)
+    control = ctypes.create_string_buffer(512)
+    data = ctypes.create_string_buffer(1)
+    iov = _iovec(ctypes.cast(data, ctypes.c_void_p), len(data))
+    msg = _msghdr(ctypes.cast(name, ctypes.c_void_p), len(name),
+                  ctypes.pointer(iov), 1,
+                  ctypes.cast(control, ctypes.c_void_p), len(control), 0)
+
+    if _libc.recvmsg(sock.fileno(), ctypes.byref(msg),
+                     MSG_ERRQUEUE | socket.MSG_DONTWAIT) < 0:
+        err = ctypes.get_errno()
+        if err in (errno.EAGAIN, errno.EWOULDBLOCK):
+            return None
+        raise socket.error(err, errno.errorcode.get(err, str(err)))
+
+    # Original destination, from the sockaddr_in(6) in msg_name
+    family, = struct.unpack_from('=H', name.raw)
+    if family == socket.AF_INET6:
+        port, = struct.unpack_from('!H', name.raw, 2)
+        destination = (socket.inet_ntop(family, name.raw[8:24]), port)
+    else:
+        port, = struct.unpack_from('!H', name.raw, 2)
+        destination = (socket.inet_ntop(socket.AF_INET, name.raw[4:8]), port)
+
+    # struct sock_extended_err, from the IP(V6)_RECVERR control message
+    cmsgHeader = struct.Struct('@Lii')
+    offset = 0
+    while offset + cmsgHeader.size <= msg.msg_controllen:
+        length, level, type = cmsgHeader.unpack_from(control.raw, offset)
+        if length < cmsgHeader.size:
+            break
+        if ((level, type) in ((socket.SOL_IP, IP_RECVERR),
+                              (socket.IPPROTO_IPV6, IPV6_RECVERR))):
+            ee = struct.unpack_from('=IBBB', control.raw, offset + cmsgHeader.size)
+            return ee + (destination,)
+        offset += (length + ctypes.sizeof(ctypes.c_size_t) - 1) & ~(ctypes.sizeof(ctypes.c_size_t) - 1)
+    return (0, 0, 0, 0, destination)
+
+
+@implementer(IReadDescriptor, IHalfCloseableDescriptor)
+class ErrorQueueReader(object):
+    """
+    Reads the error queue of a probe socket as soon as the reactor reports
+    the socket readable or in error. A non-empty error queue only makes a
+    socket report an error condition, which Twisted's poll based reactors
+    treat as the end of the connection: the reader is removed and told
+    with readConnectionLost. The reader then reads the queue and adds
+    itself back.
+    """
+
+    def __init__(self, engine, sock):
+        self.engine = engine
+        self.sock = sock
+        self.reading = False
+
+    def startReading(self):
+        self.reading = True
+        self.engine.reactor.addReader(self)
+
+    def stopReading(self):
+        if self.reading:
+            self.reading = False
+            self.engine.reactor.removeReader(self)
+
+    def fileno(self):
+        return self.sock.fileno()
+
+    def logPrefix(self):
+        return 'UDPProbeEngine'
+
+    def doRead(self):
+        self.engine.readErrors(self.sock)
+
+    def readConnectionLost(self, reason):
+        self.reading = False
+        if self.sock in self.engine.sockets.values():
+            self.engine.readErrors(self.sock)
+            self.startReading()
+
+    def writeConnectionLost(self, reason):
+        pass
+
+    def connectionLost(self, reason):
+        self.reading = False
+
+
+class UDPProbeEngine(object):
+    """
+    Sends the probes of all shared-socket UDP monitors from one unconnected
+    socket per address family. With IP_RECVERR/IPV6_RECVERR set, ICMP errors
+    for any destination are queued on the socket's error queue, which is
+    read as soon as the reactor reports it, and mapped back to the monitors
+    by destination.
+    """
+
+    def __init__(self, reactor, socketFactory=socket.socket):
+        self.reactor = reactor
+        self.socketFactory = socketFactory
+        self.sockets = {}
+        self.readers = {}
+        self.monitors = {}
+
+    def register(self, monitor):
+        """Starts delivering ICMP errors for the server of monitor to it"""
+
+        key = self._destination(monitor.server.ip, monitor.server.port)
+        self.monitors.setdefault(key, set()).add(monitor)
+
+    def unregister(self, monitor):
+        """Stops delivering errors to monitor. Returns True if no monitors
+        are left."""
+
+        key = self._destination(monitor.server.ip, monitor.server.port)
+        self.monitors.get(key, set()).discard(monitor)
+        if not self.monitors.get(key, True):
+            del self.monitors[key]
+        return not self.monitors
+
+    def stop(self):
+        """Stops reading errors and closes the sockets"""
+
+        for reader in self.readers.itervalues():
+            reader.stopReading()
+        self.readers = {}
+        for sock in self.sockets.itervalues():
+            sock.close()
+        self.sockets = {}
+
+    def probe(self, ip, port):
+        """Sends a zero length probe datagram to (ip, port). Raises
+        socket.error if it can't be sent."""
+
+        sock = self._getSocket(ip)
+        # A send may fail with (and clear) the error of an earlier ICMP
+        # message, which is also on the error queue; just try again.
+        for attempt in range(2):
+            try:
+                sock.sendto(b'', (ip, port))
+            except socket.error, e:
+                if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    return
+                if attempt:
+                    raise
+            else:
+                return
+
+    def readErrors(self, sock):
+        """Reads all queued errors of sock, and notifies the monitors of
+        servers that responded with an ICMP destination unreachable message"""
+
+        while True:
+            try:
+                error = recvErrorQueue(sock)
+            except socket.error, e:
+                log.error("Could not read UDP socket error queue: %s" % e)
+                break
+            if error is None:
+                break
+
+            eeErrno, eeOrigin, eeType, eeCode, destination = error
+            if (eeOrigin, eeType) not in ((SO_EE_ORIGIN_ICMP, ICMP_DEST_UNREACH),
+                                          (SO_EE_ORIGIN_ICMP6, ICMP6_DST_UNREACH)):
+                continue
+            for monitor in list(self.monitors.get(
+                    self._destination(*destination), ())):
+                monitor.connectionRefused()
+
+        # Clear a pending socket error, so the socket doesn't keep
+        # reporting an error condition
+        try:
+            sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+        except socket.error:
+            pass
+
+        # Discard any datagrams the servers sent back
+        while True:
+            try:
+                sock.recv(65536)
+            except socket.error:
+                break
+
+    def _getSocket(self, ip):
+        family = ':' in ip and socket.AF_INET6 or socket.AF_INET
+        if family not in self.sockets:
+            sock = self.socketFactory(family, socket.SOCK_DGRAM)
+            sock.setblocking(False)
+            if family == socket.AF_INET6:
+                sock.setsockopt(socket.IPPROTO_IPV6, IPV6_RECVERR, 1)
+            else:
+                sock.setsockopt(socket.SOL_IP, IP_RECVERR, 1)
+            self.sockets[family] = sock
+            self.readers[family] = ErrorQueueReader(self, sock)
+            self.readers[family].startReading()
+        return self.sockets[family]
+
+    @staticmethod
+    def _destination(ip, port):
+        family = ':' in ip and socket.AF_INET6 or socket.AF_INET
+        return socket.inet_pton(family, ip), port
 
 
 class UDPMonitoringProtocol(monitor.LoopingCheckMonitoringProtocol, protocol.DatagramProtocol):
@@ -28,14 +277,21 @@ class UDPMonitoringProtocol(monitor.LoopingCheckMonitoringProtocol, protocol.Dat
     # After ICMP_TIMEOUT seconds it will consider the monitor up again
     ICMP_TIMEOUT = 20
 
-    def __init__(self, coordinator, server, configuration):
+    SHARED_SOCKET = False
+
+    # Probe engine shared by all shared-socket UDP monitors
+    probeEngine = None
+
+    def __init__(self, coordinator, server, configuration, reactor=None):
         """Constructor"""
 
-        super(UDPMonitoringProtocol, self).__init__(coordinator, server, configuration)
+        super(UDPMonitoringProtocol, self).__init__(coordinator, server, configuration,
+                                                    reactor=reactor)
 
         self.port = None
         self.last_down_timestamp = 0
         self.icmp_timeout = self._getConfigInt('icmp-timeout', self.ICMP_TIMEOUT)
+        self.sharedSocket = self._getConfigBool('shared-socket', self.SHARED_SOCKET)
 
     def __report_prefix(self):
         return '{}:{}:'.format(self.server.ip, self.server.port)
@@ -48,7 +304,10 @@ class UDPMonitoringProtocol(monitor.LoopingCheckMonitoringProtocol, protocol.Dat
 
         super(UDPMonitoringProtocol, self).run()
 
-        self.port = self.reactor.listenUDP(0, self)
+        if self.sharedSocket:
+            self._getProbeEngine().register(self)
+        else:
+            self.port = self.reactor.listenUDP(0, self)
 
     def stop(self):
         """Stop the monitoring"""
@@ -58,15 +317,37 @@ class UDPMonitoringProtocol(monitor.LoopingCheckMonitoringProtocol, protocol.Dat
         if self.port:
             self.port.loseConnection()
 
+        if self.sharedSocket and self.probeEngine is not None:
+            if self.probeEngine.unregister(self):
+                self.probeEngine.stop()
+                UDPMonitoringProtocol.probeEngine = None
+
     def check(self):
         "Periodically called method that does a single check"
 
         if not self.active:
             return
 
-        self.transport.write("")
+        if self.sharedSocket:
+            try:
+                self.probeEngine.probe(self.server.ip, self.server.port)
+            except socket.error, e:
+                reason = "Could not send probe: {}".format(e)
+                self.report("{} {}".format(self.__report_prefix(), reason),
+                            level=logging.ERROR)
+                self._resultDown(reason)
+                return
+        else:
+            self.transport.write("")
         self.is_up()
 
+    def _getProbeEngine(self):
+        """Returns the shared probe engine, creating it if needed"""
+
+        if UDPMonitoringProtocol.probeEngine is None:
+            UDPMonitoringProtocol.probeEngine = UDPProbeEngine(self.reactor)
+        return self.probeEngine
+
     def is_up(self):
         """
         Mark the monitor as up iff no ICMP errors were received
@@ -10,6 +10,7 @@ import random
 import socket
 
 from twisted.internet import defer, reactor
+from twisted.internet.abstract import isIPAddress, isIPv6Address
 from twisted.names import client, dns
 from twisted.names.error import AuthoritativeDomainError
 from twisted.python import failure
@@ -82,6 +83,14 @@ class Server:
     def resolveHostname(self):
         """Attempts to resolve the server's hostname to an IP address for better reliability."""
 
+        # IP literals, e.g. from discovery backends, need no lookup
+        if isIPAddress(self.host):
+            self.ip4_addresses, self.ip6_addresses = set([self.host]), set()
+            return defer.maybeDeferred(self._allLookupsCompleted, [])
+        elif isIPv6Address(self.host):
+            self.ip4_addresses, self.ip6_addresses = set(), set([self.host])
+            return defer.maybeDeferred(self._allLookupsCompleted, [])
+
         timeout = [1, 2, 5]
         lookups = []
 
@@ -60,6 +60,42 @@ class StubCoordinator(object):
     def onConfigUpdate(self, config):
         self.config = config
 
+    def onConfigDelta(self, changed, removed):
+        self.delta = (changed, removed)
+
+
+class RecordingCoordinator(StubCoordinator):
+    """Coordinator stand-in that applies config deltas, and lets tests wait
+    for config updates."""
+
+    def __init__(self):
+        StubCoordinator.__init__(self)
+        self.config = None
+        self.delta = None
+        self.waiters = []
+
+    @property
+    def serverConfig(self):
+        return self.config or {}
+
+    def waitForUpdate(self):
+        self.waiters.append(defer.Deferred())
+        return self.waiters[-1]
+
+    def onConfigUpdate(self, config):
+        self.config = config
+        waiters, self.waiters = self.waiters, []
+        for waiter in waiters:
+            waiter.callback(config)
+
+    def onConfigDelta(self, changed, removed):
+        StubCoordinator.onConfigDelta(self, changed, removed)
+        config = dict(self.serverConfig)
+        config.update(changed)
+        for hostName in removed:
+            del config[hostName]
+        self.onConfigUpdate(config)
+
 
 class StubLVSService(object):
     """Test stub for `pybal.ipvs.LVSService`."""
@@ -10,9 +10,14 @@
 
 __all__ = [
     'test_dnsquery',
+    'test_grpchealth',
+    'test_heartbeat',
+    'test_icmp',
     'test_idleconnection',
+    'test_ipvsconn',
     'test_proxyfetch',
     'test_runcommand',
     'test_skeleton',
+    'test_tcpconnect',
     'test_udp'
 ]
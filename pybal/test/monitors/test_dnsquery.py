@@ -6,14 +6,21 @@
   This module contains tests for `pybal.monitors.dnsquery`.
 """
 
+# Python imports
+import mock
+import errno
+import socket
+
 # Twisted imports
-from twisted.internet import defer, reactor
+from twisted.trial import unittest
+from twisted.internet import defer, reactor, task
 from twisted.names.common import ResolverBase
 from twisted.names import dns, error
 
 # Pybal imports
 import pybal.monitor
 from pybal.monitors.dnsquery import DNSQueryMonitoringProtocol
+from pybal.monitors.dnsquery import DNSQueryEngine, SharedSocketResolver
 
 # Testing imports
 from .. import test_monitor
@@ -92,6 +99,31 @@ class DNSQueryMonitoringProtocolTestCase(test_monitor.BaseLoopingCheckMonitoring
         self.monitor.run()
         self.assert_(len(self.monitor.resolver.resolvers) > 0)
 
+    def testRunSharedSocket(self):
+        self.config['dnsquery.shared-socket'] = 'yes'
+        monitor = DNSQueryMonitoringProtocol(
+            self.coordinator, self.server, self.config, reactor=self.reactor)
+        self.addCleanup(DNSQueryMonitoringProtocol.engines.clear)
+        monitor.run()
+        self.assertIsInstance(monitor.resolver, SharedSocketResolver)
+        self.assertEqual(monitor.resolver.address, self.server.ip)
+        self.assertTrue(monitor.resolver.tcpFallback)
+
+        # All monitors of a service share the engine
+        otherMonitor = DNSQueryMonitoringProtocol(
+            self.coordinator, self.server, self.config, reactor=self.reactor)
+        otherMonitor.run()
+        self.assertIs(otherMonitor.engine, monitor.engine)
+        engine = monitor.engine
+
+        with mock.patch.object(engine, 'stop') as mock_stop:
+            monitor.stop()
+            self.assertIsNone(monitor.engine)
+            mock_stop.assert_not_called()
+            otherMonitor.stop()
+            mock_stop.assert_called_once()
+        self.assertEqual(DNSQueryMonitoringProtocol.engines, {})
+
     def __testQuery(self, expectSuccess, fakeResolver):
         """Install a mocked resolver to test different lookup results"""
         self.monitor.resolver = fakeResolver()
@@ -137,6 +169,140 @@ class DNSQueryMonitoringProtocolTestCase(test_monitor.BaseLoopingCheckMonitoring
         self.__testQuery(expectSuccess=False,
                          fakeResolver=FakeResolverQueryRefusedError)
 
+    def testObserveLatency(self):
+        with mock.patch.object(self.monitor, '_getHistogram') as mock_getHistogram:
+            self.monitor._observeLatency('successful', 0.25)
+        histogram = mock_getHistogram.return_value
+        histogram.labels.assert_called_once_with(
+            result='successful', **self.monitor.metric_labels)
+        histogram.labels.return_value.observe.assert_called_once_with(0.25)
+
     def testQueryFailedUnknownError(self):
         self.__testQuery(expectSuccess=False,
                          fakeResolver=FakeResolverUnknownError)
+
+
+class DNSQueryEngineTestCase(unittest.TestCase):
+    """Test case for `pybal.monitors.dnsquery.DNSQueryEngine`."""
+
+    def setUp(self):
+        self.reactor = task.Clock()
+        self.reactor.listenUDP = mock.Mock()
+        self.engine = DNSQueryEngine(self.reactor)
+        self.query = dns.Query('en.wikipedia.org', dns.A)
+
+    def sentPacket(self):
+        port = self.reactor.listenUDP.return_value
+        packet, addr = port.write.call_args[0]
+        message = dns.Message()
+        message.fromStr(packet)
+        return message, addr
+
+    def reply(self, message, addr, family=socket.AF_INET, **kwargs):
+        reply = dns.Message(id=message.id, answer=1, **kwargs)
+        reply.queries = message.queries
+        self.engine.datagramReceived(family, reply.toStr(), addr)
+
+    def testQuery(self):
+        d = self.engine.query('192.0.2.1', 53, self.query, 5)
+        message, addr = self.sentPacket()
+        self.assertEqual(addr, ('192.0.2.1', 53))
+        self.assertEqual(message.queries, [self.query])
+        self.assertTrue(message.recDes)
+        self.assertEqual(self.reactor.listenUDP.call_args[1]['interface'], '')
+
+        # Replies from another server or with another ID are ignored
+        self.reply(message, ('192.0.2.2', 53))
+        self.engine.datagramReceived(socket.AF_INET, 'garbage', addr)
+        self.assertFalse(d.called)
+        self.reply(message, addr)
+        self.assertTrue(self.successResultOf(d).answer)
+        self.assertEqual(self.engine.pendingQueries, {})
+        self.assertEqual(self.reactor.getDelayedCalls(), [])
+
+    def testQueryWriteFailed(self):
+        """A query that can't be sent fails right away, and leaves nothing
+        pending."""
+        port = self.reactor.listenUDP.return_value
+        port.write.side_effect = socket.error(errno.ENETUNREACH, "Network is unreachable")
+        d = self.engine.query('192.0.2.1', 53, self.query, 5)
+        self.failureResultOf(d, socket.error)
+        self.assertEqual(self.engine.pendingQueries, {})
+        self.assertEqual(self.reactor.getDelayedCalls(), [])
+
+    def testQueryIPv6(self):
+        d = self.engine.query('2001:db8::1', 53, self.query, 5)
+        message, addr = self.sentPacket()
+        self.assertEqual(self.reactor.listenUDP.call_args[1]['interface'], '::')
+        # Addresses are compared in binary form
+        self.reply(message, ('2001:db8:0::1', 53, 0, 0), family=socket.AF_INET6)
+        self.successResultOf(d)
+
+    def testPreEncodedPackets(self):
+        self.engine.query('192.0.2.1', 53, self.query, 5)
+        self.engine.query('192.0.2.1', 53, self.query, 5)
+        self.assertEqual(len(self.engine.packets), 1)
+        self.assertEqual(len(self.engine.pendingQueries), 2)
+        # One socket for all queries of an address family
+        self.reactor.listenUDP.assert_called_once()
+
+    def testQueryTimeout(self):
+        d = self.engine.query('192.0.2.1', 53, self.query, 5)
+        self.reactor.advance(5)
+        self.failureResultOf(d, error.DNSQueryTimeoutError)
+        self.assertEqual(self.engine.pendingQueries, {})
+
+    def testStop(self):
+        d = self.engine.query('192.0.2.1', 53, self.query, 5)
+        port = self.reactor.listenUDP.return_value
+        self.engine.stop()
+        self.failureResultOf(d, defer.CancelledError)
+        port.stopListening.assert_called_once()
+        self.assertEqual(self.engine.pendingQueries, {})
+        self.assertEqual(self.reactor.getDelayedCalls(), [])
+
+
+class SharedSocketResolverTestCase(unittest.TestCase):
+    """Test case for `pybal.monitors.dnsquery.SharedSocketResolver`."""
+
+    def setUp(self):
+        self.engine = mock.Mock(spec=DNSQueryEngine)
+        self.engine.reactor = task.Clock()
+        self.resolver = SharedSocketResolver(self.engine, '192.0.2.1')
+
+    def testLookup(self):
+        reply = dns.Message(answer=1)
+        reply.answers = [dns.RRHeader('en.wikipedia.org')]
+        self.engine.query.return_value = defer.succeed(reply)
+        d = self.resolver.lookupAddress('en.wikipedia.org', timeout=[3])
+        self.engine.query.assert_called_once_with(
+            '192.0.2.1', 53, dns.Query('en.wikipedia.org', dns.A), 3)
+        self.assertEqual(self.successResultOf(d), (reply.answers, [], []))
+
+    def testLookupError(self):
+        self.engine.query.return_value = defer.succeed(
+            dns.Message(answer=1, rCode=dns.ENAME))
+        d = self.resolver.lookupIPV6Address('en.wikipedia.org')
+        self.failureResultOf(d, error.DNSNameError)
+
+    def testTCPFallback(self):
+        reply = dns.Message(answer=1, trunc=1)
+        reply.queries = [dns.Query('en.wikipedia.org', dns.A)]
+        self.engine.query.return_value = defer.succeed(reply)
+        with mock.patch.object(self.resolver, '_getTCPResolver') as mock_tcp:
+            mock_tcp.return_value.queryTCP.return_value = defer.succeed(
+                dns.Message(answer=1))
+            d = self.resolver.lookupAddress('en.wikipedia.org', timeout=[3])
+        mock_tcp.return_value.queryTCP.assert_called_once_with(reply.queries, 3)
+        self.assertEqual(self.successResultOf(d), ([], [], []))
+
+        # Without TCP fallback, truncated replies are used as is
+        self.resolver.tcpFallback = False
+        self.engine.query.return_value = defer.succeed(reply)
+        d = self.resolver.lookupAddress('en.wikipedia.org', timeout=[3])
+        self.successResultOf(d)
+
+    def testTCPResolver(self):
+        tcpResolver = self.resolver._getTCPResolver()
+        self.assertEqual(tcpResolver.servers, [('192.0.2.1', 53)])
+        self.assertIs(self.resolver._getTCPResolver(), tcpResolver)
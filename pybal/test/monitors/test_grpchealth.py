@@ -0,0 +1,363 @@
+# -*- coding: utf-8 -*-
+"""
+  PyBal unit tests
+  ~~~~~~~~~~~~~~~~
+
+  This module contains tests for `pybal.monitors.grpchealth`.
+"""
+
+# Python imports
+import mock
+import struct
+
+# HTTP/2 imports
+from h2.config import H2Configuration
+from h2.connection import H2Connection
+from h2.errors import ErrorCodes
+from h2 import events as h2events
+
+# Twisted imports
+from twisted.internet import defer, error, protocol
+from twisted.test import iosim
+
+# Testing imports
+from .. import test_monitor
+from ..fixtures import PyBalTestCase
+
+# Pybal imports
+from pybal.monitors import grpchealth
+from pybal.monitors.grpchealth import GRPCHealthMonitoringProtocol, H2ClientProtocol
+
+
+class H2ServerProtocol(protocol.Protocol):
+    """Server side of an HTTP/2 connection, which responds to every
+    request with the response of respond(headers, body)"""
+
+    def __init__(self):
+        self.conn = H2Connection(H2Configuration(client_side=False,
+                                                 header_encoding='utf-8'))
+        self.requests = {}
+        self.resets = []
+
+    def connectionMade(self):
+        self.conn.initiate_connection()
+        self.flush()
+
+    def dataReceived(self, data):
+        for event in self.conn.receive_data(data):
+            if isinstance(event, h2events.RequestReceived):
+                self.requests[event.stream_id] = (event.headers, [])
+            elif isinstance(event, h2events.DataReceived):
+                self.requests[event.stream_id][1].append(event.data)
+                self.conn.acknowledge_received_data(event.flow_controlled_length,
+                                                    event.stream_id)
+            elif isinstance(event, h2events.StreamEnded):
+                self._requestReceived(event.stream_id)
+            elif isinstance(event, h2events.StreamReset):
+                self.resets.append((event.stream_id, event.error_code))
+        self.flush()
+
+    def flush(self):
+        self.transport.write(self.conn.data_to_send())
+
+    def _requestReceived(self, streamID):
+        headers, body = self.requests[streamID]
+        response = self.respond(headers, b''.join(body))
+        if response is None:
+            return
+        headers, body, trailers = response
+        self.conn.send_headers(streamID, headers, end_stream=not body and not trailers)
+        if body:
+            self.conn.send_data(streamID, body, end_stream=not trailers)
+        if trailers:
+            self.conn.send_headers(streamID, trailers, end_stream=True)
+
+    def respond(self, headers, body):
+        return [(':status', '200')], body, []
+
+
+class HealthServerProtocol(H2ServerProtocol):
+    """In-process stand-in for a server implementing grpc.health.v1.Health,
+    serving the statuses in the statuses dict"""
+
+    def __init__(self, statuses):
+        H2ServerProtocol.__init__(self)
+        self.statuses = statuses
+        self.checked = []
+
+    def respond(self, headers, body):
+        headers = dict(headers)
+        if headers[':path'] != GRPCHealthMonitoringProtocol.PATH:
+            return [(':status', '404')], b'', []
+        length = struct.unpack('!I', body[1:5])[0]
+        service = body[7:5 + length]
+        self.checked.append(service)
+        if service not in self.statuses:
+            return [(':status', '200'), ('grpc-status', '5'),
+                    ('grpc-message', 'unknown service')], b'', []
+        status = self.statuses[service]
+        if status is None:
+            return None
+        message = status and b'\x08' + chr(status) or b''
+        return ([(':status', '200'), ('content-type', 'application/grpc')],
+                struct.pack('!BI', 0, len(message)) + message,
+                [('grpc-status', '0')])
+
+
+def connectH2(serverProtocol, client=None):
+    """Returns a client protocol and an IOPump, connected to serverProtocol"""
+    client = client or H2ClientProtocol()
+    pump = iosim.connect(serverProtocol, iosim.makeFakeServer(serverProtocol),
+                         client, iosim.makeFakeClient(client))
+    return client, pump
+
+
+class GRPCFunctionsTestCase(PyBalTestCase):
+    """Test case for the protobuf helpers in `pybal.monitors.grpchealth`."""
+
+    def testEncodeHealthCheckRequest(self):
+        self.assertEqual(grpchealth.encodeHealthCheckRequest(''), b'\x00\x00\x00\x00\x00')
+        self.assertEqual(grpchealth.encodeHealthCheckRequest('svc'),
+                         b'\x00\x00\x00\x00\x05\x0a\x03svc')
+
+    def testDecodeHealthCheckResponse(self):
+        self.assertEqual(grpchealth.decodeHealthCheckResponse(b'\x00\x00\x00\x00\x00'),
+                         grpchealth.UNKNOWN)
+        self.assertEqual(grpchealth.decodeHealthCheckResponse(b'\x00\x00\x00\x00\x02\x08\x02'),
+                         grpchealth.NOT_SERVING)
+        # Unknown fields are skipped
+        self.assertEqual(grpchealth.decodeHealthCheckResponse(
+            b'\x00\x00\x00\x00\x07\x12\x03abc\x08\x01'), grpchealth.SERVING)
+        self.assertRaises(grpchealth.GRPCError, grpchealth.decodeHealthCheckResponse,
+                          b'\x00\x00\x00\x00\x05\x08')
+        self.assertRaises(grpchealth.GRPCError, grpchealth.decodeHealthCheckResponse,
+                          b'\x01\x00\x00\x00\x00')
+
+
+class H2ClientProtocolTestCase(PyBalTestCase):
+    """Test case for `pybal.monitors.grpchealth.H2ClientProtocol`."""
+
+    def setUp(self):
+        super(H2ClientProtocolTestCase, self).setUp()
+        self.server = H2ServerProtocol()
+        self.client, self.pump = connectH2(self.server)
+        self.pump.flush()
+
+    def testConcurrentRequests(self):
+        requests = [self.client.request([(':method', 'POST'), (':path', '/%d' % i),
+                                         (':scheme', 'http'), (':authority', 'x')],
+                                        b'body %d' % i)
+                    for i in range(3)]
+        self.pump.flush()
+        self.assertEqual(sorted(self.server.requests), [1, 3, 5])
+        for i, d in enumerate(requests):
+            response = self.successResultOf(d)
+            self.assertEqual(response.status, 200)
+            self.assertEqual(response.body, b'body %d' % i)
+        self.assertEqual(self.client.streams, {})
+
+    def testTrailers(self):
+        self.server.respond = lambda headers, body: (
+            [(':status', '200')], b'data', [('grpc-status', '0')])
+        d = self.client.request([(':method', 'POST'), (':path', '/'),
+                                 (':scheme', 'http'), (':authority', 'x')], b'x')
+        self.pump.flush()
+        response = self.successResultOf(d)
+        self.assertEqual(response.trailers, {'grpc-status': '0'})
+        self.assertEqual(response.getHeader('grpc-status'), '0')
+        self.assertEqual(response.getHeader(':status'), '200')
+
+    def testFlowControl(self):
+        """Bodies larger than the flow control window are sent as the
+        server opens the window"""
+        self.server.respond = lambda headers, body: (
+            [(':status', '200')], str(len(body)), [])
+        body = b'x' * 100000
+        d = self.client.request([(':method', 'POST'), (':path', '/'),
+                                 (':scheme', 'http'), (':authority', 'x')], body)
+        self.assertIn(1, self.client.pendingData)
+        self.pump.flush()
+        self.assertEqual(self.client.pendingData, {})
+        self.assertEqual(self.successResultOf(d).body, b'100000')
+
+    def testCancel(self):
+        self.server.respond = lambda headers, body: None
+        d = self.client.request([(':method', 'GET'), (':path', '/'),
+                                 (':scheme', 'http'), (':authority', 'x')])
+        self.pump.flush()
+        d.cancel()
+        self.pump.flush()
+        self.failureResultOf(d, defer.CancelledError)
+        self.assertEqual(self.server.resets, [(1, ErrorCodes.CANCEL)])
+
+    def testStreamReset(self):
+        self.server.respond = lambda headers, body: None
+        d = self.client.request([(':method', 'GET'), (':path', '/'),
+                                 (':scheme', 'http'), (':authority', 'x')])
+        self.pump.flush()
+        self.server.conn.reset_stream(1, ErrorCodes.PROTOCOL_ERROR)
+        self.server.flush()
+        self.pump.flush()
+        self.failureResultOf(d, grpchealth.StreamResetError)
+
+    def testGoAway(self):
+        self.server.respond = lambda headers, body: None
+        headers = [(':method', 'GET'), (':path', '/'),
+                   (':scheme', 'http'), (':authority', 'x')]
+        d1 = self.client.request(headers)
+        d2 = self.client.request(headers)
+        self.pump.flush()
+        self.server.conn.close_connection(last_stream_id=1)
+        self.server.flush()
+        self.pump.flush()
+        self.assertNoResult(d1)
+        self.failureResultOf(d2, error.ConnectionLost)
+        self.assertFalse(self.client.isUsable())
+        self.failureResultOf(self.client.request(headers), error.ConnectionLost)
+
+    def testConnectionLost(self):
+        self.server.respond = lambda headers, body: None
+        d = self.client.request([(':method', 'GET'), (':path', '/'),
+                                 (':scheme', 'http'), (':authority', 'x')])
+        self.pump.flush()
+        self.server.transport.loseConnection()
+        self.pump.flush()
+        self.failureResultOf(d, error.ConnectionDone)
+        self.assertFalse(self.client.isUsable())
+
+    def testProtocolError(self):
+        d = self.client.request([(':method', 'GET'), (':path', '/'),
+                                 (':scheme', 'http'), (':authority', 'x')])
+        # A CONTINUATION frame without preceding HEADERS
+        self.client.dataReceived(b'\x00\x00\x00\x09\x04\x00\x00\x00\x01')
+        self.failureResultOf(d, grpchealth.HTTP2Error)
+        self.assertFalse(self.client.isUsable())
+
+    def testALPN(self):
+        """With requireALPN, the connection fails unless h2 was negotiated"""
+        client = H2ClientProtocol(requireALPN=True)
+        client.makeConnection(mock.Mock(negotiatedProtocol=b'h2'))
+        client.handshakeCompleted()
+        self.assertFalse(client.transport.abortConnection.called)
+
+        client = H2ClientProtocol(requireALPN=True)
+        client.makeConnection(mock.Mock(negotiatedProtocol=b'http/1.1'))
+        d = client.request([(':method', 'GET'), (':path', '/'),
+                            (':scheme', 'https'), (':authority', 'x')])
+        client.handshakeCompleted()
+        client.transport.abortConnection.assert_called_once_with()
+        self.failureResultOf(d, grpchealth.HTTP2Error)
+
+
+class GRPCHealthMonitoringProtocolTestCase(test_monitor.BaseLoopingCheckMonitoringProtocolTestCase):
+    """Test case for `pybal.monitors.grpchealth.GRPCHealthMonitoringProtocol`."""
+
+    monitorClass = GRPCHealthMonitoringProtocol
+
+    def setUp(self):
+        self.config['grpchealth.services'] = "['', 'search', 'index']"
+        super(GRPCHealthMonitoringProtocolTestCase, self).setUp()
+        self.healthServer = HealthServerProtocol(
+            {'': grpchealth.SERVING, 'search': grpchealth.SERVING,
+             'index': grpchealth.SERVING})
+        self.connections = []
+        self.monitor._connect = mock.Mock(side_effect=self._connect)
+
+    def _connect(self, timeout):
+        client, self.pump = connectH2(self.healthServer)
+        self.connections.append(client)
+        return defer.succeed(client)
+
+    def _check(self):
+        self.monitor.active = True
+        d = self.monitor.check()
+        self.pump.flush()
+        return d
+
+    def testInit(self):
+        self.assertEqual(self.monitor.services, ['', 'search', 'index'])
+        self.assertEqual(self.monitor.port, self.server.port)
+        self.assertFalse(self.monitor.tls)
+        self.assertIsNone(self.monitor.trustRoot)
+        del self.config['grpchealth.services']
+        monitor = GRPCHealthMonitoringProtocol(self.coordinator, self.server, self.config)
+        self.assertEqual(monitor.services, [''])
+
+    def testInitCA(self):
+        self.config['grpchealth.ca'] = '/etc/ssl/certs/grpc-ca.pem'
+        with mock.patch('pybal.monitors.grpchealth.open', mock.mock_open(read_data='PEM'),
+                        create=True) as mock_open, \
+                mock.patch('twisted.internet.ssl.Certificate.loadPEM') as mock_loadPEM:
+            monitor = GRPCHealthMonitoringProtocol(self.coordinator, self.server, self.config)
+        mock_open.assert_called_once_with('/etc/ssl/certs/grpc-ca.pem')
+        mock_loadPEM.assert_called_once_with('PEM')
+        self.assertIs(monitor.trustRoot, mock_loadPEM.return_value)
+
+    def testServing(self):
+        self._check()
+        self.assertTrue(self.monitor.up)
+        self.assertEqual(self.healthServer.checked, ['', 'search', 'index'])
+        self.assertIsNone(self.monitor.checkDeferred)
+
+        # The connection is reused, and the services multiplexed over it
+        self._check()
+        self.assertEqual(len(self.connections), 1)
+        self.assertEqual(sorted(self.healthServer.requests), [1, 3, 5, 7, 9, 11])
+
+    def testNotServing(self):
+        self.healthServer.statuses['index'] = grpchealth.NOT_SERVING
+        self._check()
+        self.assertFalse(self.monitor.up)
+        self.assertEqual(self.coordinator.reason, 'Not serving: index: NOT_SERVING')
+        # RPC level failures keep the connection
+        self.assertIs(self.monitor.connection, self.connections[0])
+
+        self.healthServer.statuses['index'] = grpchealth.SERVING
+        self._check()
+        self.assertTrue(self.monitor.up)
+
+    def testGRPCError(self):
+        del self.healthServer.statuses['search']
+        self._check()
+        self.assertFalse(self.monitor.up)
+        self.assertEqual(self.coordinator.reason, 'gRPC status 5: unknown service')
+
+    def testTimeout(self):
+        self.healthServer.statuses['search'] = None
+        self._check()
+        self.assertIsNone(self.monitor.up)
+        self.reactor.advance(self.monitor.toCheck)
+        self.pump.flush()
+        self.assertFalse(self.monitor.up)
+        # The pending stream is reset, and the connection dropped
+        self.assertEqual(self.healthServer.resets, [(3, ErrorCodes.CANCEL)])
+        self.assertIsNone(self.monitor.connection)
+
+    def testConnectFailed(self):
+        self.monitor._connect.side_effect = lambda timeout: defer.fail(
+            error.ConnectionRefusedError())
+        self.monitor.active = True
+        self.monitor.check()
+        self.assertFalse(self.monitor.up)
+
+    def testReconnect(self):
+        self._check()
+        self.healthServer.transport.loseConnection()
+        self.pump.flush()
+        self.healthServer = HealthServerProtocol(
+            {'': grpchealth.SERVING, 'search': grpchealth.SERVING,
+             'index': grpchealth.SERVING})
+        self._check()
+        self.assertEqual(len(self.connections), 2)
+        self.assertTrue(self.monitor.up)
+
+    def testStopClosesConnection(self):
+        self.healthServer.statuses['search'] = None
+        d = self._check()
+        connection = self.monitor.connection
+        self.monitor.stop()
+        self.pump.flush()
+        self.assertIsNone(self.successResultOf(d))    # Cancelled
+        self.assertIsNone(self.monitor.connection)
+        self.assertFalse(connection.connected)
+        self.assertIsNone(self.monitor.up)
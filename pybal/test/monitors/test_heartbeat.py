@@ -0,0 +1,193 @@
+# -*- coding: utf-8 -*-
+"""
+  PyBal unit tests
+  ~~~~~~~~~~~~~~~~
+
+  This module contains tests for `pybal.monitors.heartbeat`.
+"""
+
+# Python imports
+import mock
+
+# Twisted imports
+from twisted.test import proto_helpers
+
+# Testing imports
+from .. import test_monitor
+from ..fixtures import PyBalTestCase
+
+# Pybal imports
+from pybal.monitors import heartbeat
+from pybal.monitors.heartbeat import HeartbeatMonitoringProtocol, HeartbeatListener
+
+
+SECRET = 'sekrit'
+
+
+class HeartbeatTestCase(PyBalTestCase):
+    """Test case for `pybal.monitors.heartbeat.Heartbeat`."""
+
+    def testRoundTrip(self):
+        message = heartbeat.heartbeatMessage(SECRET, 'srv1', True, 1000.5, load=0.25)
+        hb = heartbeat.Heartbeat.fromString(message + '\n')
+        self.assertEqual((hb.host, hb.healthy, hb.load, hb.timestamp),
+                         ('srv1', True, 0.25, 1000.5))
+        self.assertTrue(hb.verify(SECRET))
+        self.assertFalse(hb.verify('other'))
+
+        hb = heartbeat.Heartbeat.fromString(
+            heartbeat.heartbeatMessage(SECRET, 'srv1', False, 1000))
+        self.assertFalse(hb.healthy)
+        self.assertIsNone(hb.load)
+
+    def testTampered(self):
+        message = heartbeat.heartbeatMessage(SECRET, 'srv1', False, 1000)
+        hb = heartbeat.Heartbeat.fromString(message.replace(' down ', ' up '))
+        self.assertFalse(hb.verify(SECRET))
+
+    def testInvalid(self):
+        for message in ('', 'pybal-heartbeat 1 srv1 up - 1000',
+                        'pybal-heartbeat 2 srv1 up - 1000 sig',
+                        'pybal-heartbeat 1 srv1 maybe - 1000 sig',
+                        'pybal-heartbeat 1 srv1 up x 1000 sig'):
+            self.assertIsNone(heartbeat.Heartbeat.fromString(message))
+
+
+class HeartbeatListenerTestCase(PyBalTestCase):
+    """Test case for `pybal.monitors.heartbeat.HeartbeatListener`."""
+
+    def setUp(self):
+        super(HeartbeatListenerTestCase, self).setUp()
+        self.listener = HeartbeatListener(self.reactor, 'udp', '', 7081)
+        self.monitors = [mock.Mock() for i in range(3)]
+
+    def testDeadlines(self):
+        for i, monitor in enumerate(self.monitors):
+            self.listener.setDeadline(monitor, 10 + i)
+        # A single timer for the earliest deadline
+        self.assertEqual(len(self.reactor.getDelayedCalls()), 1)
+
+        # Extending a deadline supersedes the earlier one
+        self.listener.setDeadline(self.monitors[0], 20)
+        self.reactor.advance(11)
+        self.monitors[0].heartbeatExpired.assert_not_called()
+        self.monitors[1].heartbeatExpired.assert_called_once()
+        self.monitors[2].heartbeatExpired.assert_not_called()
+
+        self.reactor.advance(10)
+        self.monitors[0].heartbeatExpired.assert_called_once()
+        self.monitors[2].heartbeatExpired.assert_called_once()
+        self.assertEqual(self.listener.heap, [])
+        self.assertEqual(self.reactor.getDelayedCalls(), [])
+
+    def testEarlierDeadline(self):
+        self.listener.setDeadline(self.monitors[0], 10)
+        self.listener.setDeadline(self.monitors[1], 5)
+        self.reactor.advance(5)
+        self.monitors[1].heartbeatExpired.assert_called_once()
+        self.monitors[0].heartbeatExpired.assert_not_called()
+
+    def testTCPStream(self):
+        self.listener.proto = 'tcp'
+        self.listener.start()
+        monitor = mock.Mock()
+        monitor.server.host = 'srv1'
+        self.listener.register(monitor)
+
+        factory = self.reactor.tcpServers[0][1]
+        proto = factory.buildProtocol(None)
+        proto.makeConnection(proto_helpers.StringTransport())
+        proto.dataReceived(heartbeat.heartbeatMessage(SECRET, 'srv1', True, 1) + '\r\n' +
+                           heartbeat.heartbeatMessage(SECRET, 'srv2', True, 1) + '\r\n')
+        self.assertEqual(monitor.heartbeatReceived.call_count, 1)
+
+        self.assertTrue(self.listener.unregister(monitor))
+        self.listener.stop()
+        self.assertIsNone(self.listener.port)
+
+
+class HeartbeatMonitoringProtocolTestCase(test_monitor.BaseMonitoringProtocolTestCase):
+    """Test case for `pybal.monitors.heartbeat.HeartbeatMonitoringProtocol`."""
+
+    monitorClass = HeartbeatMonitoringProtocol
+
+    def setUp(self):
+        self.config['heartbeat.secret'] = SECRET
+        self.config['heartbeat.max-load'] = '0.9'
+        super(HeartbeatMonitoringProtocolTestCase, self).setUp()
+        self.reactor.listenUDP = mock.Mock()
+        self.reactor.advance(1000)
+        self.addCleanup(HeartbeatMonitoringProtocol.listeners.clear)
+
+    def _heartbeat(self, healthy=True, load=None, timestamp=None, secret=SECRET):
+        self.reactor.advance(0.1)
+        if timestamp is None:
+            timestamp = self.reactor.seconds()
+        message = heartbeat.heartbeatMessage(secret, self.server.host, healthy,
+                                             timestamp, load=load)
+        self.monitor.listener.messageReceived(message, ('192.0.2.1', 12345))
+
+    def testInit(self):
+        self.assertEqual(self.monitor.listenProtocol, 'udp')
+        self.assertEqual(self.monitor.port, HeartbeatMonitoringProtocol.PORT)
+        self.assertEqual(self.monitor.timeout, HeartbeatMonitoringProtocol.TIMEOUT)
+        self.assertEqual(self.monitor.maxLoad, 0.9)
+
+        self.config['heartbeat.protocol'] = 'sctp'
+        self.assertRaises(ValueError, HeartbeatMonitoringProtocol,
+                          self.coordinator, self.server, self.config)
+
+    def testRunSharesListener(self):
+        self.monitor.run()
+        self.reactor.listenUDP.assert_called_once()
+        monitor = HeartbeatMonitoringProtocol(self.coordinator, self.server, self.config,
+                                              reactor=self.reactor)
+        monitor.run()
+        self.assertIs(monitor.listener, self.monitor.listener)
+        self.reactor.listenUDP.assert_called_once()
+
+        monitor.stop()
+        self.reactor.listenUDP.return_value.stopListening.assert_not_called()
+        self.monitor.stop()
+        self.reactor.listenUDP.return_value.stopListening.assert_called_once()
+        self.assertEqual(HeartbeatMonitoringProtocol.listeners, {})
+
+    def testHeartbeat(self):
+        self.monitor.run()
+        self._heartbeat(load=0.5)
+        self.assertTrue(self.monitor.up)
+
+        self._heartbeat(healthy=False)
+        self.assertFalse(self.monitor.up)
+        self.assertEqual(self.coordinator.reason, "Server reported down")
+
+        self._heartbeat(load=0.95)
+        self.assertFalse(self.monitor.up)
+        self._heartbeat(load=0.1)
+        self.assertTrue(self.monitor.up)
+
+    def testRejected(self):
+        self.monitor.run()
+        self._heartbeat(healthy=False, secret='wrong')
+        self.assertIsNone(self.monitor.up)
+
+        # Replayed and delayed heartbeats
+        self._heartbeat(healthy=True)
+        self._heartbeat(healthy=False, timestamp=self.monitor.lastTimestamp)
+        self._heartbeat(healthy=False, timestamp=self.reactor.seconds() - 60)
+        self.assertTrue(self.monitor.up)
+
+    def testExpired(self):
+        self.monitor.run()
+        # No first heartbeat within the timeout
+        self.reactor.advance(self.monitor.timeout)
+        self.assertFalse(self.monitor.up)
+
+        self._heartbeat()
+        self.assertTrue(self.monitor.up)
+        self.reactor.advance(self.monitor.timeout - 1)
+        self._heartbeat()
+        self.reactor.advance(self.monitor.timeout - 0.5)
+        self.assertTrue(self.monitor.up)
+        self.reactor.advance(0.5)
+        self.assertFalse(self.monitor.up)
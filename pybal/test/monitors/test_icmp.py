@@ -0,0 +1,262 @@
+# -*- coding: utf-8 -*-
+"""
+  PyBal unit tests
+  ~~~~~~~~~~~~~~~~
+
+  This module contains tests for `pybal.monitors.icmp`.
+"""
+
+# Python imports
+import errno
+import mock
+import socket
+import struct
+
+# Twisted imports
+from twisted.internet import defer
+from twisted.python import failure
+from twisted.test import proto_helpers
+from twisted.trial import unittest
+
+# Testing imports
+from .. import test_monitor
+
+# Pybal imports
+from pybal.monitors import icmp
+from pybal.monitors.icmp import ICMPMonitoringProtocol, ICMPEchoEngine
+
+
+class FakeSocket(object):
+    """Non-blocking ICMP socket that records sent packets, and returns
+    queued packets when read."""
+
+    def __init__(self, family, type, proto):
+        self.family = family
+        self.type = type
+        self.proto = proto
+        self.sent = []
+        self.received = []
+        self.closed = False
+
+    def fileno(self):
+        return 42
+
+    def setblocking(self, flag):
+        self.blocking = flag
+
+    def sendto(self, data, addr):
+        self.sent.append((data, addr))
+
+    def recvfrom(self, bufsize):
+        if not self.received:
+            raise socket.error(errno.EAGAIN, 'Resource temporarily unavailable')
+        return self.received.pop(0)
+
+    def close(self):
+        self.closed = True
+
+
+class FakeSocketFactory(object):
+    """Creates FakeSockets, or fails to create ping sockets if
+    allowPing is False"""
+
+    def __init__(self, allowPing=True):
+        self.allowPing = allowPing
+        self.sockets = []
+
+    def __call__(self, family, type, proto):
+        if type == socket.SOCK_DGRAM and not self.allowPing:
+            raise socket.error(errno.EACCES, 'Permission denied')
+        sock = FakeSocket(family, type, proto)
+        self.sockets.append(sock)
+        return sock
+
+
+def echoReply(request, ipHeader=False):
+    """Returns the echo reply to an echo request"""
+    type, code, cksum, identifier, sequence = struct.unpack('!BBHHH', request[:8])
+    replyType = type == icmp.ICMP_ECHO_REQUEST and icmp.ICMP_ECHO_REPLY or icmp.ICMP6_ECHO_REPLY
+    reply = struct.pack('!BBHHH', replyType, 0, 0, identifier, sequence) + request[8:]
+    if ipHeader:
+        reply = b'\x45' + b'\0' * 19 + reply
+    return reply
+
+
+class ICMPEchoEngineTestCase(unittest.TestCase):
+    """Test case for `pybal.monitors.icmp.ICMPEchoEngine`."""
+
+    def setUp(self):
+        self.reactor = proto_helpers.MemoryReactorClock()
+        self.socketFactory = FakeSocketFactory()
+        self.engine = ICMPEchoEngine(self.reactor, socketFactory=self.socketFactory)
+
+    def testChecksum(self):
+        packet = struct.pack('!BBHHH', 8, 0, 0, 1, 1) + b'abcd'
+        cksum = icmp.checksum(packet)
+        packet = packet[:2] + struct.pack('!H', cksum) + packet[4:]
+        self.assertEqual(icmp.checksum(packet), 0)
+
+    def testPing(self):
+        d1 = self.engine.ping('192.0.2.1', 1)
+        d2 = self.engine.ping('192.0.2.2', 1)
+        self.assertEqual(len(self.socketFactory.sockets), 1)
+        sock = self.socketFactory.sockets[0]
+        self.assertEqual(sock.type, socket.SOCK_DGRAM)
+        self.assertEqual(sock.proto, socket.IPPROTO_ICMP)
+        self.assertIn(self.engine.sockets[socket.AF_INET], self.reactor.getReaders())
+
+        (request1, addr1), (request2, addr2) = sock.sent
+        self.assertEqual(addr1, ('192.0.2.1', 0))
+        self.assertEqual(icmp.checksum(request1), 0)
+
+        # Replies are matched by source address and sequence number
+        sock.received = [(echoReply(request1), ('192.0.2.2', 0)),
+                         (echoReply(request2), ('192.0.2.2', 0))]
+        self.engine.sockets[socket.AF_INET].doRead()
+        self.assertFalse(d1.called)
+        self.assertGreaterEqual(self.successResultOf(d2), 0)
+
+        sock.received = [(echoReply(request1), ('192.0.2.1', 0))]
+        self.engine.sockets[socket.AF_INET].doRead()
+        self.successResultOf(d1)
+        self.assertEqual(self.engine.pendingRequests, {})
+        self.assertEqual(self.reactor.getDelayedCalls(), [])
+
+    def testSequence(self):
+        self.engine.ping('192.0.2.1', 1)
+        self.engine.ping('192.0.2.1', 1)
+        self.engine.ping('192.0.2.2', 1)
+        sequences = [struct.unpack('!H', data[6:8])[0]
+                     for data, addr in self.socketFactory.sockets[0].sent]
+        self.assertEqual(sequences, [0, 1, 0])
+
+    def testRawSocket(self):
+        self.socketFactory.allowPing = False
+        d = self.engine.ping('192.0.2.1', 1)
+        sock = self.socketFactory.sockets[0]
+        self.assertEqual(sock.type, socket.SOCK_RAW)
+        request = sock.sent[0][0]
+
+        # Raw sockets receive replies to other processes' requests too
+        other = request[:4] + struct.pack('!H', (self.engine.identifier + 1) & 0xffff) + request[6:]
+        sock.received = [(echoReply(other, ipHeader=True), ('192.0.2.1', 0)),
+                         (echoReply(request, ipHeader=True), ('192.0.2.1', 0))]
+        self.engine.sockets[socket.AF_INET].doRead()
+        self.successResultOf(d)
+
+    def testPingIPv6(self):
+        d = self.engine.ping('2001:db8::1', 1)
+        sock = self.socketFactory.sockets[0]
+        self.assertEqual(sock.family, socket.AF_INET6)
+        self.assertEqual(sock.proto, socket.IPPROTO_ICMPV6)
+        request = sock.sent[0][0]
+        self.assertEqual(ord(request[0]), icmp.ICMP6_ECHO_REQUEST)
+        sock.received = [(echoReply(request), ('2001:db8:0::1', 0, 0, 0))]
+        self.engine.sockets[socket.AF_INET6].doRead()
+        self.successResultOf(d)
+
+    def testTimeout(self):
+        d = self.engine.ping('192.0.2.1', 1)
+        self.reactor.advance(1)
+        self.failureResultOf(d, defer.TimeoutError)
+        self.assertEqual(self.engine.pendingRequests, {})
+
+    def testPingWithoutSocket(self):
+        self.engine.socketFactory = mock.Mock(side_effect=socket.error(
+            errno.EPERM, 'Operation not permitted'))
+        self.assertRaises(socket.error, self.engine.openSocket, '192.0.2.1')
+        d = self.engine.ping('192.0.2.1', 1)
+        self.failureResultOf(d, socket.error)
+        self.assertEqual(self.engine.pendingRequests, {})
+        self.assertEqual(self.reactor.getDelayedCalls(), [])
+
+    def testStop(self):
+        d = self.engine.ping('192.0.2.1', 1)
+        icmpSocket = self.engine.sockets[socket.AF_INET]
+        self.engine.stop()
+        self.failureResultOf(d, defer.CancelledError)
+        self.assertNotIn(icmpSocket, self.reactor.getReaders())
+        self.assertTrue(self.socketFactory.sockets[0].closed)
+        self.assertEqual(self.reactor.getDelayedCalls(), [])
+
+
+class ICMPMonitoringProtocolTestCase(test_monitor.BaseLoopingCheckMonitoringProtocolTestCase):
+    """Test case for `pybal.monitors.icmp.ICMPMonitoringProtocol`."""
+
+    monitorClass = ICMPMonitoringProtocol
+
+    def setUp(self):
+        super(ICMPMonitoringProtocolTestCase, self).setUp()
+        patcher = mock.patch('pybal.monitors.icmp.ICMPEchoEngine')
+        self.mock_engine = patcher.start().return_value
+        self.mock_engine.monitors = set()
+        self.addCleanup(patcher.stop)
+
+    def testInit(self):
+        self.assertEqual(self.monitor.intvCheck, ICMPMonitoringProtocol.INTV_CHECK)
+        self.assertEqual(self.monitor.timeout, ICMPMonitoringProtocol.TIMEOUT)
+        self.assertEqual(self.monitor.window.maxlen, ICMPMonitoringProtocol.WINDOW)
+
+        self.config['icmp.interval'] = '0.5'
+        self.config['icmp.window'] = '4'
+        self.config['icmp.max-loss'] = '0.25'
+        monitor = ICMPMonitoringProtocol(self.coordinator, self.server, self.config)
+        self.assertEqual(monitor.intvCheck, 0.5)
+        self.assertEqual(monitor.window.maxlen, 4)
+        self.assertEqual(monitor.maxLoss, 0.25)
+
+    def testRunSharesEngine(self):
+        self.monitor.run()
+        monitor = ICMPMonitoringProtocol(self.coordinator, self.server, self.config,
+                                         reactor=self.reactor)
+        monitor.run()
+        self.assertIs(monitor.engine, self.mock_engine)
+        self.assertIs(self.monitor.engine, self.mock_engine)
+
+        monitor.stop()
+        self.mock_engine.stop.assert_not_called()
+        self.monitor.stop()
+        self.mock_engine.stop.assert_called_once()
+        self.assertIsNone(ICMPMonitoringProtocol.echoEngine)
+
+    def testNoSocket(self):
+        """Without ICMP sockets the monitor fails, without pinging"""
+        self.mock_engine.openSocket.side_effect = socket.error(
+            errno.EPERM, 'Operation not permitted')
+        self.monitor.run()
+        self.assertFalse(self.monitor.up)
+        self.assertIn('Could not open an ICMP socket', self.coordinator.reason)
+        self.monitor.check()
+        self.mock_engine.ping.assert_not_called()
+        self.assertFalse(self.monitor.up)
+
+    def testCheck(self):
+        d = defer.Deferred()
+        self.mock_engine.ping.return_value = d
+        self.monitor.run()
+        self.reactor.advance(self.monitor.intvCheck)
+        self.mock_engine.ping.assert_called_with(self.server.ip, self.monitor.timeout)
+        d.callback(0.001)
+        self.assertTrue(self.monitor.up)
+
+    def testLossWindow(self):
+        self.config['icmp.window'] = '4'
+        self.config['icmp.max-loss'] = '0.5'
+        monitor = ICMPMonitoringProtocol(self.coordinator, self.server, self.config)
+        monitor.active = True
+        results = []
+        for replied in (True, False, False, True, False, False, True, True, True):
+            monitor._update(replied)
+            results.append(monitor.up)
+        # Down while more than half of the last 4 requests were lost
+        self.assertEqual(results, [True, True, False, True, False, False, True, True, True])
+
+    def testEchoLost(self):
+        self.monitor.active = True
+        self.monitor._echoLost(failure.Failure(defer.TimeoutError()))
+        self.assertFalse(self.monitor.up)
+        self.assertEqual(list(self.monitor.window), [False])
+
+        # Cancelled requests are not counted
+        self.monitor._echoLost(failure.Failure(defer.CancelledError()))
+        self.assertEqual(list(self.monitor.window), [False])
@@ -14,6 +14,7 @@ import mock
 # Pybal imports
 import pybal.monitor
 from pybal.monitors.idleconnection import IdleConnectionMonitoringProtocol
+from pybal.monitors.idleconnection import TCP_INFO_FORMAT, TCP_USER_TIMEOUT, getTCPInfo
 
 # Twisted imports
 import twisted.internet.tcp
@@ -21,6 +22,18 @@ from twisted.python import failure
 
 # Python imports
 import socket
+import struct
+
+
+def tcpInfo(retransmits=0, probes=0, unacked=0, rtt=1000, rttvar=500):
+    """Returns an encoded struct tcp_info with the given field values"""
+    values = [0] * 32
+    values[2] = retransmits
+    values[3] = probes
+    values[12] = unacked
+    values[23] = rtt
+    values[24] = rttvar
+    return struct.pack(TCP_INFO_FORMAT, *values)
 
 
 class IdleConnectionMonitoringProtocolTestCase(test_monitor.BaseMonitoringProtocolTestCase):
@@ -42,6 +55,10 @@ class IdleConnectionMonitoringProtocolTestCase(test_monitor.BaseMonitoringProtoc
         self.assertEqual(monitor.keepAliveRetries, IC.KEEPALIVE_RETRIES)
         self.assertEqual(monitor.keepAliveIdle, IC.KEEPALIVE_IDLE)
         self.assertEqual(monitor.keepAliveInterval, IC.KEEPALIVE_INTERVAL)
+        self.assertEqual(monitor.userTimeout, IC.USER_TIMEOUT)
+        self.assertEqual(monitor.tcpInfoInterval, IC.TCP_INFO_INTERVAL)
+        self.assertEqual(monitor.maxRetransmits, IC.MAX_RETRANSMITS)
+        self.assertEqual(monitor.maxRTT, IC.MAX_RTT)
 
         self.config.update({
             'idleconnection.max-delay': '123',
@@ -49,7 +66,11 @@ class IdleConnectionMonitoringProtocolTestCase(test_monitor.BaseMonitoringProtoc
             'idleconnection.keepalive': 'true',
             'idleconnection.keepalive-retries': 5,
             'idleconnection.keepalive-idle': 8,
-            'idleconnection.keepalive-interval': 60
+            'idleconnection.keepalive-interval': 60,
+            'idleconnection.user-timeout': '7.5',
+            'idleconnection.tcp-info-interval': '2',
+            'idleconnection.max-retransmits': '4',
+            'idleconnection.max-rtt': '0.25'
         })
         monitor = IdleConnectionMonitoringProtocol(None, self.server, self.config)
         self.assertEqual(monitor.maxDelay, 123)
@@ -58,6 +79,10 @@ class IdleConnectionMonitoringProtocolTestCase(test_monitor.BaseMonitoringProtoc
         self.assertEqual(monitor.keepAliveRetries, 5)
         self.assertEqual(monitor.keepAliveIdle, 8)
         self.assertEqual(monitor.keepAliveInterval, 60)
+        self.assertEqual(monitor.userTimeout, 7.5)
+        self.assertEqual(monitor.tcpInfoInterval, 2)
+        self.assertEqual(monitor.maxRetransmits, 4)
+        self.assertEqual(monitor.maxRTT, 0.25)
 
     def testRun(self):
         """Test `IdleConnectionMonitoringProtocol.run`."""
@@ -142,12 +167,14 @@ class IdleConnectionMonitoringProtocolTestCase(test_monitor.BaseMonitoringProtoc
         self.monitor.transport = mock.Mock(spec=twisted.internet.tcp.Connection)
         self.monitor.active = True
         self.monitor.keepAlive = True
+        self.assertEqual(self.monitor.userTimeout, 60)
         self.monitor.clientConnectionMade()
         testSocket = self.monitor.transport.getHandle()
         testSocket.setsockopt.assert_called()
         setsockopt_args = {args[0] for args in testSocket.setsockopt.call_args_list}
         expected_args = {
-            (socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+            (socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1),
+            (socket.SOL_TCP, TCP_USER_TIMEOUT, int(self.monitor.userTimeout * 1000))
         }
         try:
             expected_args.update({
@@ -159,6 +186,16 @@ class IdleConnectionMonitoringProtocolTestCase(test_monitor.BaseMonitoringProtoc
             pass    # Not Linux
         self.assertEqual(setsockopt_args, expected_args)
 
+    def testClientConnectionMadeNoUserTimeout(self):
+        """TCP_USER_TIMEOUT is left unset when disabled"""
+        self.monitor.transport = mock.Mock(spec=twisted.internet.tcp.Connection)
+        self.monitor.active = True
+        self.monitor.userTimeout = 0
+        self.monitor.clientConnectionMade()
+        setsockopt_args = {args[0] for args in
+                           self.monitor.transport.getHandle().setsockopt.call_args_list}
+        self.assertNotIn(TCP_USER_TIMEOUT, {args[1] for args in setsockopt_args})
+
     def testclientConnectionMadeKeepaliveNotActive(self):
         self.monitor.active = False
         with mock.patch.object(self.monitor, '_resultUp') as mock_resultUp:
@@ -180,3 +217,81 @@ class IdleConnectionMonitoringProtocolTestCase(test_monitor.BaseMonitoringProtoc
             self.monitor.server.port,
             self.monitor,
             mock.sentinel.arg1)
+
+    def _connectionMade(self):
+        self.monitor.run()
+        self.monitor.transport = mock.Mock(spec=twisted.internet.tcp.Connection)
+        self.monitor.clientConnectionMade()
+        return self.monitor.transport.getHandle()
+
+    def testGetTCPInfo(self):
+        testSocket = mock.Mock()
+        testSocket.getsockopt.return_value = tcpInfo(
+            retransmits=1, probes=2, unacked=3, rtt=12500, rttvar=2500)
+        info = getTCPInfo(testSocket)
+        testSocket.getsockopt.assert_called_once_with(
+            socket.SOL_TCP, socket.TCP_INFO, struct.calcsize(TCP_INFO_FORMAT))
+        self.assertEqual(info, {'retransmits': 1, 'probes': 2, 'unacked': 3,
+                                'rtt': 0.0125, 'rttvar': 0.0025})
+
+    def testSampleTCPInfoMetricsOnly(self):
+        """By default, retransmits are only exported, not acted upon"""
+        testSocket = self._connectionMade()
+        testSocket.getsockopt.return_value = tcpInfo(retransmits=5, probes=5)
+        gauge = self.monitor.idleconnection_metrics['tcp_retransmits']
+        with mock.patch.object(gauge, 'labels') as mock_labels:
+            self.reactor.advance(self.monitor.tcpInfoInterval)
+        mock_labels.return_value.set.assert_called_once_with(5)
+        self.assertTrue(self.monitor.up)
+
+    def testSampleTCPInfo(self):
+        self.monitor.maxRetransmits = 2
+        testSocket = self._connectionMade()
+        testSocket.getsockopt.return_value = tcpInfo()
+        self.reactor.advance(self.monitor.tcpInfoInterval)
+        testSocket.getsockopt.assert_called_once()
+        self.assertTrue(self.monitor.up)
+
+        # Unanswered keepalive probes set the status to down until answered
+        testSocket.getsockopt.return_value = tcpInfo(probes=self.monitor.maxRetransmits)
+        self.reactor.advance(self.monitor.tcpInfoInterval)
+        self.assertFalse(self.monitor.up)
+        testSocket.getsockopt.return_value = tcpInfo(retransmits=1)
+        self.reactor.advance(self.monitor.tcpInfoInterval)
+        self.assertTrue(self.monitor.up)
+
+    def testSampleTCPInfoDegraded(self):
+        self.monitor.maxRTT = 0.1
+        testSocket = self._connectionMade()
+        testSocket.getsockopt.return_value = tcpInfo(rtt=200000)
+        gauge = self.monitor.idleconnection_metrics['degraded']
+        with mock.patch.object(self.monitor, 'report') as mock_report, \
+                mock.patch.object(gauge, 'labels') as mock_labels:
+            self.reactor.advance(self.monitor.tcpInfoInterval)
+            self.reactor.advance(self.monitor.tcpInfoInterval)
+            mock_report.assert_called_once()
+            self.assertTrue(self.monitor.degraded)
+            self.assertTrue(self.monitor.up)
+            mock_labels.assert_called_with(**self.monitor.metric_labels)
+            mock_labels.return_value.set.assert_called_with(1)
+
+            testSocket.getsockopt.return_value = tcpInfo(rtt=50000)
+            self.reactor.advance(self.monitor.tcpInfoInterval)
+            self.assertFalse(self.monitor.degraded)
+            mock_labels.return_value.set.assert_called_with(0)
+
+    def testSampleTCPInfoUnsupported(self):
+        testSocket = self._connectionMade()
+        testSocket.getsockopt.side_effect = socket.error(92, 'Protocol not available')
+        self.reactor.advance(self.monitor.tcpInfoInterval)
+        self.assertIsNone(self.monitor.tcpInfoCall)
+        self.assertTrue(self.monitor.up)
+
+    def testSamplingStopsOnConnectionLost(self):
+        self._connectionMade()
+        self.assertTrue(self.monitor.tcpInfoCall.running)
+        testFailure = failure.Failure(
+            twisted.internet.error.ConnectionLost("Testing lost connection"))
+        with mock.patch.object(self.monitor, 'retry'):
+            self.monitor.clientConnectionLost(mock.Mock(), testFailure)
+        self.assertIsNone(self.monitor.tcpInfoCall)
@@ -0,0 +1,218 @@
+# -*- coding: utf-8 -*-
+"""
+  PyBal unit tests
+  ~~~~~~~~~~~~~~~~
+
+  This module contains tests for `pybal.monitors.ipvsconn`.
+"""
+
+# Python imports
+import mock
+
+# Twisted imports
+from twisted.internet import defer
+
+# Testing imports
+from .. import test_monitor
+from ..fixtures import PyBalTestCase, ServerStub
+
+# Pybal imports
+from pybal.monitors import ipvsconn
+from pybal.monitors.ipvsconn import IPVSConnMonitoringProtocol, IPVSConnectionTable
+
+
+HEADER = "Pro FromIP   FPrt ToIP     TPrt DestIP   DPrt State       Expires PEName PEData\n"
+
+
+def connectionLine(rip, state, protocol='TCP', vip='127.0.0.1', port=80):
+    return "%s C0000201 D9A4 %s %04X %s %04X %-11s 59\n" % (
+        protocol, ipvsconn.ipvsAddress(vip), port, ipvsconn.ipvsAddress(rip), port, state)
+
+
+def deferToThreadPool(reactor, threadpool, f, *args):
+    return defer.maybeDeferred(f, *args)
+
+
+class IPVSConnFunctionsTestCase(PyBalTestCase):
+    """Test case for the parsing functions in `pybal.monitors.ipvsconn`."""
+
+    def testIPVSAddress(self):
+        self.assertEqual(ipvsconn.ipvsAddress('10.64.0.1'), '0A400001')
+        self.assertEqual(ipvsconn.ipvsAddress('2001:db8::1'),
+                         '2001:0db8:0000:0000:0000:0000:0000:0001')
+
+    def testCountConnections(self):
+        key = ipvsconn.connectionKey('tcp', '127.0.0.1', 80, '10.0.0.1', 80)
+        lines = [HEADER,
+                 connectionLine('10.0.0.1', 'ESTABLISHED'),
+                 connectionLine('10.0.0.1', 'ESTABLISHED'),
+                 connectionLine('10.0.0.1', 'SYN_RECV'),
+                 connectionLine('10.0.0.1', 'UDP', protocol='UDP'),
+                 connectionLine('10.0.0.2', 'ESTABLISHED'),
+                 "\n"]
+        self.assertEqual(ipvsconn.countConnections(lines, frozenset([key])),
+                         {key: {'ESTABLISHED': 2, 'SYN_RECV': 1}})
+
+
+class IPVSConnectionTableTestCase(PyBalTestCase):
+    """Test case for `pybal.monitors.ipvsconn.IPVSConnectionTable`."""
+
+    def setUp(self):
+        super(IPVSConnectionTableTestCase, self).setUp()
+        self.reactor.getThreadPool = mock.Mock()
+        self.table = IPVSConnectionTable(self.reactor, path=mock.sentinel.path)
+        self.pending = []
+        patcher = mock.patch.object(ipvsconn.threads, 'deferToThreadPool',
+                                    side_effect=self._deferToThreadPool)
+        self.deferToThreadPool = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def _deferToThreadPool(self, reactor, threadpool, f, *args):
+        self.pending.append(defer.Deferred())
+        return self.pending[-1]
+
+    def testCoalesced(self):
+        d1 = self.table.getCounts(10)
+        d2 = self.table.getCounts(10)
+        self.deferToThreadPool.assert_called_once()
+        self.pending[0].callback({'key': {}})
+        self.assertEqual(self.successResultOf(d1), {'key': {}})
+        self.assertEqual(self.successResultOf(d2), {'key': {}})
+
+        # Fresh counts are reused
+        self.reactor.advance(5)
+        self.successResultOf(self.table.getCounts(10))
+        self.deferToThreadPool.assert_called_once()
+        self.reactor.advance(5)
+        self.table.getCounts(10)
+        self.assertEqual(self.deferToThreadPool.call_count, 2)
+
+    def testCancelled(self):
+        d1 = self.table.getCounts(10)
+        d2 = self.table.getCounts(10)
+        d1.cancel()
+        self.failureResultOf(d1, defer.CancelledError)
+        self.pending[0].errback(IOError("No such file"))
+        self.failureResultOf(d2, IOError)
+        self.assertIsNone(self.table.counts)
+
+
+class IPVSConnMonitoringProtocolTestCase(test_monitor.BaseLoopingCheckMonitoringProtocolTestCase):
+    """Test case for `pybal.monitors.ipvsconn.IPVSConnMonitoringProtocol`."""
+
+    monitorClass = IPVSConnMonitoringProtocol
+
+    def setUp(self):
+        self.path = self.mktemp()
+        self.config['ipvsconn.max-syn-recv'] = '3'
+        self.config['ipvsconn.min-peer-connections'] = '2'
+        super(IPVSConnMonitoringProtocolTestCase, self).setUp()
+        self.reactor.getThreadPool = mock.Mock()
+        patcher = mock.patch.object(ipvsconn.threads, 'deferToThreadPool',
+                                    side_effect=deferToThreadPool)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.patch(ipvsconn, 'PROC_IPVS_CONN', self.path)
+        self.server.pool = True
+
+        peerServer = ServerStub('peer', '10.0.0.2', self.port, lvsservice=self.lvsservice)
+        peerServer.pool = True
+        self.peer = IPVSConnMonitoringProtocol(self.coordinator, peerServer, self.config,
+                                               reactor=self.reactor)
+        self.addCleanup(self._stopPeer)
+
+    def _stopPeer(self):
+        if self.peer.active:
+            self.peer.stop()
+
+    def _writeTable(self, own={}, peer={}):
+        with open(self.path, 'w') as f:
+            f.write(HEADER)
+            for ip, states in ((self.ip, own), ('10.0.0.2', peer)):
+                for state, count in states.items():
+                    f.write(connectionLine(ip, state) * count)
+
+    def _check(self):
+        self.reactor.advance(self.monitor.intvCheck)
+        return self.monitor.check()
+
+    def testInit(self):
+        self.assertEqual(self.monitor.maxSynRecv, 3)
+        self.assertEqual(self.monitor.synRecvRatio, IPVSConnMonitoringProtocol.SYN_RECV_RATIO)
+        self.assertEqual(self.monitor.minPeerConnections, 2)
+        self.assertFalse(self.monitor.idleDown)
+
+    def testRunSharesTable(self):
+        self.monitor.run()
+        self.peer.run()
+        self.assertIs(self.monitor.connectionTable, self.peer.connectionTable)
+        self.assertEqual(self.monitor.connectionTable.destinations, set([
+            ('TCP', '7F000001', '0050', '7F000001', '0050'),
+            ('TCP', '7F000001', '0050', '0A000002', '0050')]))
+        self.peer.stop()
+        self.assertIsNotNone(IPVSConnMonitoringProtocol.connectionTable)
+        self.monitor.stop()
+        self.assertIsNone(IPVSConnMonitoringProtocol.connectionTable)
+
+    def testUp(self):
+        self._writeTable(own={'ESTABLISHED': 5, 'SYN_RECV': 2, 'FIN_WAIT': 1})
+        self.monitor.run()
+        self._check()
+        self.assertTrue(self.monitor.up)
+        self.assertIsNone(self.monitor.checkDeferred)
+
+    def testSynRecv(self):
+        self._writeTable(own={'ESTABLISHED': 2, 'SYN_RECV': 3})
+        self.monitor.run()
+        self._check()
+        self.assertFalse(self.monitor.up)
+        self.assertEqual(self.coordinator.reason, "3 connections stuck in SYN_RECV")
+
+        # Not down while most connections get established
+        self._writeTable(own={'ESTABLISHED': 4, 'SYN_RECV': 3})
+        self._check()
+        self.assertTrue(self.monitor.up)
+
+    def testIdle(self):
+        self._writeTable(peer={'ESTABLISHED': 2})
+        self.monitor.run()
+        self.peer.run()
+        gauge = self.monitor.ipvsconn_metrics['degraded']
+        with mock.patch.object(self.monitor, 'report') as report, \
+                mock.patch.object(gauge, 'labels') as mock_labels:
+            self._check()
+        self.assertTrue(self.monitor.up)
+        self.assertTrue(self.monitor.degraded)
+        report.assert_called_once()
+        mock_labels.assert_any_call(**self.monitor.metric_labels)
+        mock_labels.return_value.set.assert_any_call(1)
+
+        self.monitor.idleDown = True
+        self._check()
+        self.assertFalse(self.monitor.up)
+
+        # Not idle if the server isn't pooled, or the peers aren't busy
+        self.server.pool = False
+        self._check()
+        self.assertTrue(self.monitor.up)
+        self.server.pool = True
+        self._writeTable(peer={'ESTABLISHED': 1})
+        self._check()
+        self.assertTrue(self.monitor.up)
+        self.assertFalse(self.monitor.degraded)
+
+    def testIdleDepooledPeers(self):
+        """Depooled peers don't count towards the peer average"""
+        self._writeTable(peer={'ESTABLISHED': 2})
+        self.monitor.run()
+        self.peer.run()
+        self.peer.server.pool = False
+        self._check()
+        self.assertTrue(self.monitor.up)
+        self.assertFalse(self.monitor.degraded)
+
+    def testReadFailed(self):
+        self.monitor.run()
+        self._check()
+        self.assertIsNone(self.monitor.up)
+        self.assertIsNone(self.monitor.checkDeferred)
@@ -7,22 +7,47 @@
 """
 
 # Python imports
+import os
 import unittest, mock
 
+# PyOpenSSL imports
+from OpenSSL import SSL
+
 # Twisted imports
 import twisted.internet.base
+import twisted.test
 from twisted.internet import defer, reactor, task
 from twisted.python import failure
 from twisted.python.runtime import seconds
+from twisted.web import client, error as weberror
+from twisted.web.client import ResponseDone
 
 # Pybal imports
 import pybal.monitor
 from pybal.monitors.proxyfetch import ProxyFetchMonitoringProtocol
+from pybal.monitors.proxyfetch import ResumingTLSConnectionCreator, sessionReused
+from pybal.monitors.proxyfetch import RequestTimings, TimedEndpoint
 
 # Testing imports
 from .. import test_monitor
 
 
+class FakeResponse(object):
+    """Minimal `twisted.web.iweb.IResponse` delivering a fixed body."""
+
+    def __init__(self, code, body, phrase='OK', reason=ResponseDone):
+        self.code = code
+        self.phrase = phrase
+        self.body = body
+        self.reason = reason
+
+    def deliverBody(self, protocol):
+        self.transport = mock.Mock()
+        protocol.makeConnection(self.transport)
+        protocol.dataReceived(self.body)
+        protocol.connectionLost(failure.Failure(self.reason()))
+
+
 class ProxyFetchMonitoringProtocolTestCase(test_monitor.BaseLoopingCheckMonitoringProtocolTestCase):
     """Test case for `pybal.monitors.ProxyFetchMonitoringProtocol`."""
 
@@ -80,24 +105,20 @@ class ProxyFetchMonitoringProtocolTestCase(test_monitor.BaseLoopingCheckMonitori
         startSeconds = seconds()
         self.monitor.active = True
         with mock.patch.multiple(self.monitor,
-                                 getProxyPage=mock.DEFAULT,
+                                 getPooledPage=mock.DEFAULT,
                                  _fetchSuccessful=mock.DEFAULT,
                                  _fetchFailed=mock.DEFAULT,
                                  _checkFinished=mock.DEFAULT) as mocks:
-            mocks['getProxyPage'].return_value = defer.Deferred()
+            mocks['getPooledPage'].return_value = defer.Deferred()
             d = self.monitor.check()
 
         self.assertIsInstance(d, defer.DeferredList)
         self.assertGreaterEqual(self.monitor.checkStartTime.values()[0], startSeconds)
 
-        # Check getProxyPage keyword arguments
-        kwargs = mocks['getProxyPage'].call_args[1]
-        self.assertEqual(kwargs['method'], "GET")
-        self.assertEqual(kwargs['host'], self.server.ip)
-        self.assertEqual(kwargs['port'], self.server.port)
+        # Check getPooledPage keyword arguments
+        kwargs = mocks['getPooledPage'].call_args[1]
         self.assertEqual(kwargs['status'], self.monitor.expectedStatus)
         self.assertEqual(kwargs['timeout'], self.monitor.toGET)
-        self.assertFalse(kwargs['followRedirect'])
 
         # Check whether the callback works
         testResult = "Test page"
@@ -110,14 +131,217 @@ class ProxyFetchMonitoringProtocolTestCase(test_monitor.BaseLoopingCheckMonitori
         mocks['_fetchFailed'].assert_not_called()
         mocks['_checkFinished'].assert_called()
 
+    def testCheckAdaptiveTimeout(self):
+        self.config['proxyfetch.timeout-adaptive'] = 'true'
+        self.config['proxyfetch.timeout-min'] = '0.5'
+        monitor = ProxyFetchMonitoringProtocol(
+            self.coordinator, self.server, self.config)
+        monitor.active = True
+        monitor.adaptiveTimeout.sample(0.25)
+        with mock.patch.object(monitor, 'getPooledPage') as mock_getPooledPage:
+            mock_getPooledPage.return_value = defer.Deferred()
+            monitor.check()
+        kwargs = mock_getPooledPage.call_args[1]
+        self.assertEqual(kwargs['timeout'], 0.75)
+
+        # A timed out fetch backs off the timeout
+        url = monitor.URLs[0]
+        testFailure = failure.Failure(defer.TimeoutError("Test failure"))
+        with mock.patch.object(monitor, 'report'):
+            monitor._fetchFailed(testFailure, url=url)
+        self.assertEqual(monitor.adaptiveTimeout.timeout, 1.5)
+        monitor.stop()
+
+    def testInitKeepAlive(self):
+        self.assertFalse(self.monitor.keepAlive)
+        self.config['proxyfetch.keepalive'] = 'yes'
+        self.config['proxyfetch.keepalive-max-connections'] = '1'
+        self.config['proxyfetch.keepalive-idle-timeout'] = '30'
+        monitor = ProxyFetchMonitoringProtocol(None, self.server, self.config)
+        self.assertTrue(monitor.keepAlive)
+        self.assertIsNone(monitor.pool)
+        monitor.reactor = self.reactor
+        agent = monitor._getAgent()
+        self.assertEqual(monitor.pool.maxPersistentPerHost, 1)
+        self.assertEqual(monitor.pool.cachedConnectionTimeout, 30)
+        self.assertTrue(monitor.pool.persistent)
+        # The pool is shared by the agents of all checks
+        self.assertIs(agent._pool, monitor.pool)
+        self.assertIs(monitor._getAgent()._pool, monitor.pool)
+
+    def testStopClosesPool(self):
+        self.monitor.run()
+        self.monitor._getAgent()
+        pool = self.monitor.pool
+        with mock.patch.object(pool, 'closeCachedConnections') as mock_close:
+            self.monitor.stop()
+        mock_close.assert_called_once()
+        self.assertIsNone(self.monitor.pool)
+
+    def testGetPooledPageConnectsToServer(self):
+        self.monitor.getPooledPage('http://en.wikipedia.org/test.php')
+        self.assertEqual(len(self.reactor.tcpClients), 1)
+        self.assertEqual(self.reactor.tcpClients[0][:2],
+                         (self.server.ip, self.server.port))
+
+        self.monitor.getPooledPage('https://en.wikipedia.org/test.php')
+        self.assertEqual(len(self.reactor.sslClients), 1)
+        self.assertEqual(self.reactor.sslClients[0][:2],
+                         (self.server.ip, self.server.port))
+
+    def testGetPooledPageTimeout(self):
+        with mock.patch.object(self.monitor, '_getAgent') as mock_getAgent:
+            mock_getAgent.return_value.request.return_value = defer.Deferred()
+            d = self.monitor.getPooledPage('http://en.wikipedia.org/test.php',
+                                           timeout=5)
+        self.reactor.advance(5)
+        self.failureResultOf(d, defer.TimeoutError)
+
+    def testPooledResponseReceived(self):
+        self.monitor.keepAlive = True
+        d = self.monitor._pooledResponseReceived(FakeResponse(200, 'body'), 200)
+        self.assertEqual(self.successResultOf(d), 'body')
+
+        # Responses without a Content-Length
+        d = self.monitor._pooledResponseReceived(
+            FakeResponse(200, 'body', reason=client.PotentialDataLoss), 200)
+        self.assertEqual(self.successResultOf(d), 'body')
+
+        d = self.monitor._pooledResponseReceived(
+            FakeResponse(500, 'oops', phrase='Internal Server Error'), 200)
+        f = self.failureResultOf(d, weberror.Error)
+        self.assertEqual(f.value.status, '500')
+
+        # Redirects are only accepted if expected
+        d = self.monitor._pooledResponseReceived(FakeResponse(301, ''), 200)
+        self.failureResultOf(d, weberror.Error)
+        d = self.monitor._pooledResponseReceived(FakeResponse(301, ''), 301)
+        self.successResultOf(d)
+        d = self.monitor._pooledResponseReceived(FakeResponse(200, ''), 301)
+        self.failureResultOf(d, weberror.Error)
+
+    def testGetTLSConnectionCreator(self):
+        creator = self.monitor._getTLSConnectionCreator()
+        self.assertIsInstance(creator, ResumingTLSConnectionCreator)
+        self.assertTrue(creator.resume)
+        self.assertIs(self.monitor._getTLSConnectionCreator(), creator)
+
+        # Monitors of the same service share the SSL context, but not the
+        # session to resume
+        self.config['proxyfetch.tls-session-resumption'] = 'no'
+        monitor = ProxyFetchMonitoringProtocol(None, self.server, self.config)
+        otherCreator = monitor._getTLSConnectionCreator()
+        self.assertIsNot(otherCreator, creator)
+        self.assertIs(otherCreator.context, creator.context)
+        self.assertFalse(otherCreator.resume)
+
+    def testAgentTLSContextFactory(self):
+        agent = self.monitor._getAgent()
+        endpoint = agent._getEndpoint(
+            client.URI.fromBytes('https://en.wikipedia.org/'))
+        self.assertIs(endpoint._sslContextFactory,
+                      self.monitor._getTLSConnectionCreator())
+
+    def testAgentTimedEndpoint(self):
+        timings = RequestTimings()
+        agent = self.monitor._getAgent(timings)
+        endpoint = agent._getEndpoint(
+            client.URI.fromBytes('http://en.wikipedia.org/'))
+        self.assertIsInstance(endpoint, TimedEndpoint)
+        self.assertIs(endpoint.timings, timings)
+
+    def testObserveTimings(self):
+        timings = RequestTimings()
+        timings.start = 10.0
+        timings.connected = 10.5
+        timings.tlsConnection = self.monitor._getTLSConnectionCreator(
+            ).clientConnectionForTLS(None)
+        self.monitor.tlsConnectionCreator.handshakenConnections[
+            timings.tlsConnection] = 11.0
+        timings.responseReceived = 12.0
+        url = 'https://en.wikipedia.org/test.php'
+        with mock.patch.object(self.monitor, '_getHistogram') as mock_getHistogram, \
+                mock.patch('pybal.monitors.proxyfetch.seconds', return_value=13.0):
+            self.assertEqual(self.monitor._observeTimings('body', timings, url),
+                             'body')
+        self.assertEqual(timings.handshakeDone, 11.0)
+        histogram = mock_getHistogram.return_value
+        for phase in ('connect', 'tls', 'ttfb', 'total'):
+            histogram.labels.assert_any_call(url=url, phase=phase,
+                                             **self.monitor.metric_labels)
+        observed = sorted(c[0][0] for c in histogram.labels.return_value.observe.call_args_list)
+        self.assertEqual(observed, [0.5, 0.5, 2.0, 3.0])
+
+    def testTLSHandshakeDone(self):
+        pm = self.monitor.proxyfetch_metrics['tls_handshakes_total']
+        with mock.patch.object(pm, 'labels') as mock_labels:
+            self.monitor._tlsHandshakeDone(False)
+            mock_labels.assert_called_with(type='full',
+                                           **self.monitor.metric_labels)
+            self.monitor._tlsHandshakeDone(True)
+            mock_labels.assert_called_with(type='resumed',
+                                           **self.monitor.metric_labels)
+            mock_labels.reset_mock()
+            self.monitor._tlsHandshakeDone(None)
+            mock_labels.assert_not_called()
+
+    def testPooledResponseReceivedNoBody(self):
+        """Without keep-alive or body-match the body is not read."""
+        response = FakeResponse(200, 'body')
+        d = self.monitor._pooledResponseReceived(response, 200)
+        self.assertEqual(self.successResultOf(d), '')
+        response.transport.stopProducing.assert_called_once()
+
+    def testPooledResponseReceivedMaxBodySize(self):
+        self.monitor.keepAlive = True
+        self.monitor.maxBodySize = 4
+        response = FakeResponse(200, 'long body')
+        d = self.monitor._pooledResponseReceived(response, 200)
+        self.assertEqual(self.successResultOf(d), 'long')
+        response.transport.stopProducing.assert_called_once()
+
+        response = FakeResponse(200, 'body')
+        d = self.monitor._pooledResponseReceived(response, 200)
+        self.assertEqual(self.successResultOf(d), 'body')
+        response.transport.stopProducing.assert_not_called()
+
+    def testPooledResponseReceivedBodyMatch(self):
+        self.config['proxyfetch.body-match'] = 'status: (ok|fine)'
+        self.config['proxyfetch.max-body-size'] = '16'
+        monitor = ProxyFetchMonitoringProtocol(None, self.server, self.config)
+        self.assertEqual(monitor.maxBodySize, 16)
+
+        d = monitor._pooledResponseReceived(FakeResponse(200, 'status: fine'), 200)
+        self.assertEqual(self.successResultOf(d), 'status: fine')
+
+        d = monitor._pooledResponseReceived(FakeResponse(200, 'status: bad'), 200)
+        f = self.failureResultOf(d, weberror.Error)
+        self.assertIn('does not match', f.getErrorMessage())
+
+        # Only the prefix of the body is matched
+        d = monitor._pooledResponseReceived(
+            FakeResponse(200, 'x' * 16 + 'status: ok'), 200)
+        self.failureResultOf(d, weberror.Error)
+
+    def testPooledResponseReceivedCancel(self):
+        response = mock.Mock()
+        d = self.monitor._pooledResponseReceived(response, 200)
+        bodyReader = response.deliverBody.call_args[0][0]
+        bodyReader.makeConnection(mock.Mock())
+        d.cancel()
+        self.failureResultOf(d, defer.CancelledError)
+        bodyReader.transport.stopProducing.assert_called_once()
+        # The connection being closed afterwards is ignored
+        bodyReader.connectionLost(failure.Failure(client.ResponseFailed([])))
+
     def testCheckFailure(self):
         self.monitor.active = True
         with mock.patch.multiple(self.monitor,
-                                 getProxyPage=mock.DEFAULT,
+                                 getPooledPage=mock.DEFAULT,
                                  _fetchSuccessful=mock.DEFAULT,
                                  _fetchFailed=mock.DEFAULT,
                                  _checkFinished=mock.DEFAULT) as mocks:
-            mocks['getProxyPage'].return_value = defer.Deferred()
+            mocks['getPooledPage'].return_value = defer.Deferred()
             self.monitor.check()
 
         # Check whether the callback works
@@ -154,7 +378,7 @@ class ProxyFetchMonitoringProtocolTestCase(test_monitor.BaseLoopingCheckMonitori
         clock = task.Clock()
         checkCall = task.LoopingCall(self.monitor.check)
         checkCall.clock = clock
-        self.monitor.getProxyPage = mock.MagicMock(
+        self.monitor.getPooledPage = mock.MagicMock(
             return_value=defer.Deferred()
         )
         self.assertTrue(self.monitor.firstCheck)
@@ -162,7 +386,7 @@ class ProxyFetchMonitoringProtocolTestCase(test_monitor.BaseLoopingCheckMonitori
 
         def to_test(result):
             self.assertEqual(self.monitor.currentFailures, [])
-            self.assertEqual(self.monitor.getProxyPage.call_count, 2)
+            self.assertEqual(self.monitor.getPooledPage.call_count, 2)
             self.assertTrue(self.monitor.up)
             return result
         checkCall.deferred.addCallback(to_test)
@@ -179,7 +403,7 @@ class ProxyFetchMonitoringProtocolTestCase(test_monitor.BaseLoopingCheckMonitori
         checkCall = task.LoopingCall(self.monitor.check)
         checkCall.clock = clock
         testFailure = defer.fail(defer.TimeoutError("Test failure"))
-        self.monitor.getProxyPage = mock.MagicMock(
+        self.monitor.getPooledPage = mock.MagicMock(
             side_effect=[defer.Deferred(), testFailure]
         )
         checkCall.start(200)
@@ -187,7 +411,7 @@ class ProxyFetchMonitoringProtocolTestCase(test_monitor.BaseLoopingCheckMonitori
         self.assertEqual(self.monitor.currentFailures, ["Test failure"])
 
         def to_test(result):
-            self.assertEqual(self.monitor.getProxyPage.call_count, 2)
+            self.assertEqual(self.monitor.getPooledPage.call_count, 2)
             self.assertFalse(self.monitor.up)
             self.assertEqual(self.monitor.currentFailures, [])
             return result
@@ -208,7 +432,7 @@ class ProxyFetchMonitoringProtocolTestCase(test_monitor.BaseLoopingCheckMonitori
         checkCall = task.LoopingCall(self.monitor.check)
         checkCall.clock = clock
         testFailure = defer.fail(defer.TimeoutError("Test failure"))
-        self.monitor.getProxyPage = mock.MagicMock(
+        self.monitor.getPooledPage = mock.MagicMock(
             side_effect=[defer.Deferred(), testFailure]
         )
         checkCall.start(200)
@@ -216,7 +440,7 @@ class ProxyFetchMonitoringProtocolTestCase(test_monitor.BaseLoopingCheckMonitori
         self.assertEqual(self.monitor.currentFailures, ["Test failure"])
 
         def to_test(result):
-            self.assertEqual(self.monitor.getProxyPage.call_count, 2)
+            self.assertEqual(self.monitor.getPooledPage.call_count, 2)
             self.assertTrue(self.monitor.up)
             self.assertEqual(self.monitor.currentFailures, [])
             return result
@@ -310,77 +534,132 @@ class ProxyFetchMonitoringProtocolTestCase(test_monitor.BaseLoopingCheckMonitori
         self.assertIsNone(self.monitor.checkStartTime)
         self.assertEqual(self.monitor.currentFailures, [])
 
-    def testGetProxyPageHTTP(self):
-        testURL = "http://en.wikipedia.org/"
-        host = "cp1001.eqiad.wmnet"
-        port = 80
-        r = ProxyFetchMonitoringProtocol.getProxyPage(
-            testURL,
-            host=host,
-            port=port,
-            reactor=self.reactor)
-        self.assertIsInstance(r, defer.Deferred)
-        # Test whether connectTCP has been called with at least
-        # host and port args and the correct factory
-        self.assertEqual(len(self.reactor.tcpClients), 1)
-        tcpClient = self.reactor.tcpClients[0]
-        self.assertEqual(tcpClient[:2], (host, port))
-        self.assertIsInstance(tcpClient[2], twisted.web.client.HTTPClientFactory)
-        self.assertEqual(tcpClient[2].url, testURL)
-
-    def testGetProxyPageRedir(self):
-        testURL = "http://en.wikipedia.org/"
-        host = "cp1001.eqiad.wmnet"
-        port = 80
-        r = ProxyFetchMonitoringProtocol.getProxyPage(testURL,
-            host=host,
-            port=port,
-            status=301,
-            reactor=self.reactor)
-        self.assertIsInstance(r, defer.Deferred)
-        # Test whether connectTCP has been called with at least
-        # host and port args and the correct factory
-        self.assertEqual(len(self.reactor.tcpClients), 1)
-        tcpClient = self.reactor.tcpClients[0]
-        self.assertEqual(tcpClient[:2], (host, port))
-        self.assertIsInstance(tcpClient[2], pybal.monitors.proxyfetch.RedirHTTPClientFactory)
-        self.assertEqual(tcpClient[2].url, testURL)
-
-    def testGetProxyPageHTTPS(self):
-        testURL = "https://en.wikipedia.org/"
-        host = "cp1001.eqiad.wmnet"
-        port = 80
-        r = ProxyFetchMonitoringProtocol.getProxyPage(testURL,
-            host=host,
-            port=port,
-            reactor=self.reactor)
-        self.assertIsInstance(r, defer.Deferred)
-        # Test whether connectTCP has been called with at least
-        # host and port args and the correct factory
-        self.assertEqual(len(self.reactor.sslClients), 1)
-        sslClient = self.reactor.sslClients[0]
-        self.assertEqual(sslClient[:2], (host, port))
-        self.assertIsInstance(sslClient[2], twisted.web.client.HTTPClientFactory)
-        self.assertEqual(sslClient[2].url, testURL)
 
+class ResumingTLSConnectionCreatorTestCase(unittest.TestCase):
+    """Test case for `pybal.monitors.proxyfetch.ResumingTLSConnectionCreator`."""
+
+    def setUp(self):
+        pem = os.path.join(os.path.dirname(twisted.test.__file__), 'server.pem')
+        self.serverContext = SSL.Context(SSL.SSLv23_METHOD)
+        self.serverContext.use_certificate_file(pem)
+        self.serverContext.use_privatekey_file(pem)
+        self.serverContext.set_session_id(b'pybal-test')
+        self.handshakes = []
+        self.creator = ResumingTLSConnectionCreator(
+            ResumingTLSConnectionCreator.createContext(),
+            onHandshake=self.handshakes.append)
+
+    def connect(self):
+        """Does a TLS handshake in memory, followed by some data exchange
+        to deliver TLS 1.3 session tickets, and a clean shutdown (without
+        which OpenSSL considers the session not resumable)."""
+        client = self.creator.clientConnectionForTLS(None)
+        client.set_connect_state()
+        server = SSL.Connection(self.serverContext, None)
+        server.set_accept_state()
+
+        def pump(source, destination):
+            try:
+                data = source.bio_read(65536)
+            except SSL.WantReadError:
+                return False
+            destination.bio_write(data)
+            return True
+
+        for i in range(10):
+            for conn in (client, server):
+                try:
+                    conn.do_handshake()
+                except SSL.WantReadError:
+                    pass
+            pump(client, server)
+            pump(server, client)
+        server.send(b'data')
+        pump(server, client)
+        client.recv(1024)
+        client.shutdown()
+        return client
+
+    def testFullHandshake(self):
+        self.creator.resume = False
+        self.connect()
+        self.connect()
+        self.assertEqual(self.handshakes, [False, False])
+        self.assertIsNone(self.creator.session)
+
+    def testResumedHandshake(self):
+        self.connect()
+        self.assertIsNotNone(self.creator.session)
+        self.connect()
+        self.connect()
+        self.assertEqual(self.handshakes, [False, True, True])
+
+    def testSessionReusedUnknown(self):
+        """Without pyOpenSSL's bindings, resumption is unknown."""
+        connection = self.connect()
+        with mock.patch.object(SSL, '_lib', None):
+            self.assertIsNone(sessionReused(connection))
+
+    def testHandshakeTime(self):
+        connection = self.connect()
+        self.assertIn(connection, self.creator.handshakenConnections)
+        self.assertLessEqual(self.creator.handshakenConnections[connection],
+                             seconds())
+
+    def testConnectionAppData(self):
+        connection = self.creator.clientConnectionForTLS(None)
+        self.assertIs(connection.get_app_data(), self.creator)
+        self.assertIs(connection.get_context(), self.creator.context)
+
+
+class RequestTimingsTestCase(unittest.TestCase):
+    """Test case for `pybal.monitors.proxyfetch.RequestTimings`."""
+
+    def setUp(self):
+        self.timings = RequestTimings()
+        self.timings.start = 1.0
+
+    def testDurations(self):
+        self.timings.connected = 1.25
+        self.timings.handshakeDone = 1.5
+        self.timings.responseReceived = 2.0
+        self.timings.finished = 3.0
+        self.assertEqual(self.timings.durations(),
+                         {'connect': 0.25, 'tls': 0.25, 'ttfb': 1.0, 'total': 2.0})
+
+    def testDurationsReusedConnection(self):
+        """A reused connection has no connect or TLS phase."""
+        self.timings.responseReceived = 2.0
+        self.timings.finished = 3.0
+        self.assertEqual(self.timings.durations(), {'ttfb': 1.0, 'total': 2.0})
+
+
+class TimedEndpointTestCase(unittest.TestCase):
+    """Test case for `pybal.monitors.proxyfetch.TimedEndpoint`."""
 
-class RedirHTTPPageGetterTestCase(unittest.TestCase):
     def setUp(self):
-        self.protocol = pybal.monitors.proxyfetch.RedirHTTPPageGetter()
-        self.protocol.factory = mock.Mock(spec=pybal.monitors.proxyfetch.RedirHTTPClientFactory)
-        self.protocol.headers = {}
-
-    def testHandleStatus3xx(self):
-        for status in range(301, 304):
-            self.protocol.handleStatus(b'1.1', bytes(str(status)), b'Message')
-            # handleEndHeaders calls the appropriate handleStatus_xxx method
-            self.protocol.handleEndHeaders()
-            # Ensure self.factory.failed is not 1 as set by handleStatusDefault
-            self.assertEqual(self.protocol.failed, 0, "Status: {}".format(status))
-
-    def testHandleStatus200(self):
-        self.protocol.handleStatus(b'1.1', b'200', b'OK')
-        # handleEndHeaders calls the appropriate handleStatus_xxx method
-        self.protocol.handleEndHeaders()
-        # Ensure self.factory.failed is 1 as set by handleStatusDefault
-        self.assertEqual(self.protocol.failed, 1)
+        self.timings = RequestTimings()
+        self.endpoint = mock.Mock()
+        self.connectDeferred = self.endpoint.connect.return_value = defer.Deferred()
+        self.timedEndpoint = TimedEndpoint(self.endpoint, self.timings)
+
+    def testConnect(self):
+        factory = mock.Mock()
+        d = self.timedEndpoint.connect(factory)
+        self.endpoint.connect.assert_called_once_with(factory)
+        self.assertIsNone(self.timings.connected)
+
+        protocol = mock.Mock()
+        protocol.transport.getHandle.return_value = mock.Mock()
+        self.connectDeferred.callback(protocol)
+        self.assertIs(d.result, protocol)
+        self.assertIsNotNone(self.timings.connected)
+        self.assertIsNone(self.timings.tlsConnection)
+
+    def testConnectTLS(self):
+        d = self.timedEndpoint.connect(mock.Mock())
+        protocol = mock.Mock()
+        connection = SSL.Connection(ResumingTLSConnectionCreator.createContext(), None)
+        protocol.transport.getHandle.return_value = connection
+        self.connectDeferred.callback(protocol)
+        self.assertIs(self.timings.tlsConnection, connection)
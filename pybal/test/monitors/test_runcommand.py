@@ -8,7 +8,7 @@
 
 # Python imports
 import unittest, mock
-import signal, errno
+import signal, errno, json
 
 # Twisted imports
 import twisted.internet.process
@@ -24,6 +24,7 @@ from .. import test_monitor
 # Pybal imports
 import pybal.monitor
 from pybal.monitors.runcommand import RunCommandMonitoringProtocol, ProcessGroupProcess
+from pybal.monitors.runcommand import CheckWorker, WorkerError
 
 
 class RunCommandMonitoringProtocolTestCase(test_monitor.BaseLoopingCheckMonitoringProtocolTestCase):
@@ -137,6 +138,19 @@ class RunCommandMonitoringProtocolTestCase(test_monitor.BaseLoopingCheckMonitori
         mocks['_resultDown'].assert_called()
         mocks['_resultUp'].assert_not_called()
 
+    def testProcessEndedHistogram(self):
+        """Assert that command durations are recorded in the histogram"""
+
+        self.monitor.checkStartTime = runtime.seconds()
+        self.monitor.runningProcessDeferred = twisted.internet.defer.Deferred()
+        reason = failure.Failure(twisted.internet.error.ProcessTerminated(exitCode=1))
+        with mock.patch.object(self.monitor, '_getHistogram') as mock_getHistogram:
+            self.monitor.processEnded(reason)
+        histogram = mock_getHistogram.return_value
+        histogram.labels.assert_called_once_with(
+            result='failed', **self.monitor.metric_labels)
+        histogram.labels.return_value.observe.assert_called_once()
+
     def testProcessEndedProcessUnknownError(self):
         """Assert that any other (unknown) error also reports the monitor as down"""
 
@@ -162,6 +176,145 @@ class RunCommandMonitoringProtocolTestCase(test_monitor.BaseLoopingCheckMonitori
         self.assertNotEqual(mock_report.call_args[0], mock_report.call_args[1])
 
 
+class RunCommandWorkerTestCase(test_monitor.BaseLoopingCheckMonitoringProtocolTestCase):
+    """Test case for `pybal.monitors.RunCommandMonitoringProtocol` using a
+    check worker."""
+
+    monitorClass = RunCommandMonitoringProtocol
+
+    def setUp(self):
+        self.config['runcommand.command'] = '/usr/bin/check-worker'
+        self.config['runcommand.worker'] = 'yes'
+        self.config['runcommand.worker-arguments'] = '"--verbose"'
+        self.config['runcommand.arguments'] = '[ server.host ]'
+        super(RunCommandWorkerTestCase, self).setUp()
+        patcher = mock.patch('pybal.monitors.runcommand.spawnProcessGroup')
+        self.mock_spawn = patcher.start()
+        self.addCleanup(patcher.stop)
+        self.addCleanup(RunCommandMonitoringProtocol.workers.clear)
+
+    def lastRequest(self):
+        process = self.mock_spawn.return_value
+        return json.loads(process.write.call_args[0][0])
+
+    def testInit(self):
+        self.assertTrue(self.monitor.useWorker)
+        self.assertEqual(self.monitor.workerArguments, ["--verbose"])
+        self.assertIsNone(self.monitor.worker)
+
+    def testRequestCheck(self):
+        self.monitor.active = True
+        d = self.monitor.runCommand()
+        worker = self.monitor.worker
+        self.assertIsInstance(worker, CheckWorker)
+        self.mock_spawn.assert_called_once_with(
+            self.reactor, worker, '/usr/bin/check-worker',
+            ['/usr/bin/check-worker', '--verbose'], sessionLeader=True)
+        request = self.lastRequest()
+        self.assertEqual(request['host'], self.server.host)
+        self.assertEqual(request['arguments'], [self.server.host])
+
+        with mock.patch.object(self.monitor, '_resultDown') as mock_resultDown:
+            worker.outReceived(json.dumps({'id': request['id'], 'up': False,
+                                           'reason': 'broken'}) + '\n')
+        self.successResultOf(d)
+        mock_resultDown.assert_called_once_with('broken')
+        self.assertIsNone(self.monitor.runningProcessDeferred)
+
+        d = self.monitor.runCommand()
+        with mock.patch.object(self.monitor, '_resultUp') as mock_resultUp:
+            worker.outReceived(json.dumps({'id': self.lastRequest()['id'],
+                                           'up': True}) + '\n')
+        self.successResultOf(d)
+        mock_resultUp.assert_called_once()
+        # The worker is only started once
+        self.mock_spawn.assert_called_once()
+
+    def testRequestCheckTimeout(self):
+        self.monitor.active = True
+        d = self.monitor.runCommand()
+        with mock.patch.object(self.monitor, '_resultDown') as mock_resultDown:
+            self.reactor.advance(self.monitor.timeout)
+        self.successResultOf(d)
+        mock_resultDown.assert_called_once()
+        self.assertIn('timed out', mock_resultDown.call_args[0][0])
+        self.assertEqual(self.monitor.worker.pendingRequests, {})
+
+    def testRequestCheckWorkerExited(self):
+        self.monitor.active = True
+        d = self.monitor.runCommand()
+        with mock.patch.object(self.monitor, '_resultDown') as mock_resultDown:
+            self.monitor.worker.processEnded(failure.Failure(
+                twisted.internet.error.ProcessTerminated(exitCode=1)))
+        self.successResultOf(d)
+        mock_resultDown.assert_called_once()
+        self.assertIn('exited', mock_resultDown.call_args[0][0])
+
+        # The worker is restarted on the next request
+        self.monitor.runCommand()
+        self.assertEqual(self.mock_spawn.call_count, 2)
+
+    def testSharedWorker(self):
+        monitor = RunCommandMonitoringProtocol(
+            self.coordinator, self.server, self.config, reactor=self.reactor)
+        self.assertIs(monitor._getWorker(), self.monitor._getWorker())
+
+        self.monitor.run()
+        self.monitor.stop()
+        self.assertIsNone(self.monitor.worker)
+        self.mock_spawn.return_value.signalProcess.assert_not_called()
+        self.assertEqual(len(RunCommandMonitoringProtocol.workers), 1)
+
+    def testStop(self):
+        self.monitor.runCommand()
+        worker = self.monitor.worker
+        super(RunCommandWorkerTestCase, self).testStop()
+        self.assertEqual(worker.pendingRequests, {})
+        self.mock_spawn.return_value.signalProcess.assert_called_with(signal.SIGKILL)
+        self.assertEqual(RunCommandMonitoringProtocol.workers, {})
+
+
+class CheckWorkerTestCase(unittest.TestCase):
+    """Test case for `pybal.monitors.runcommand.CheckWorker`."""
+
+    def setUp(self):
+        patcher = mock.patch('pybal.monitors.runcommand.spawnProcessGroup')
+        self.mock_spawn = patcher.start()
+        self.addCleanup(patcher.stop)
+        self.worker = CheckWorker(twisted.internet.task.Clock(), '/bin/worker')
+
+    def testOutOfOrderResponses(self):
+        results = []
+        for i in range(2):
+            self.worker.request(host='host%d' % i).addCallback(results.append)
+        self.worker.outReceived('{"id": 2, "up": true}\n{"id": 1,')
+        self.assertEqual(results, [(True, None)])
+        self.worker.outReceived(' "up": false, "reason": "down"}\n')
+        self.assertEqual(results, [(True, None), (False, 'down')])
+        self.assertEqual(self.worker.pendingRequests, {})
+
+    def testInvalidResponse(self):
+        d = self.worker.request()
+        self.worker.outReceived('garbage\n{"id": 99, "up": true}\n{"up": true}\n')
+        self.assertFalse(d.called)
+
+    def testCancel(self):
+        d = self.worker.request()
+        d.addErrback(lambda f: None)
+        d.cancel()
+        self.assertEqual(self.worker.pendingRequests, {})
+        # A late response is ignored
+        self.worker.outReceived('{"id": 1, "up": true}\n')
+
+    def testProcessEnded(self):
+        failures = []
+        self.worker.request().addErrback(failures.append)
+        self.worker.processEnded(failure.Failure(
+            twisted.internet.error.ProcessTerminated(exitCode=1)))
+        self.assertIsNone(self.worker.process)
+        self.assertTrue(failures[0].check(WorkerError))
+
+
 class ProcessGroupProcessTestCase(unittest.TestCase):
     @mock.patch('twisted.internet.process.Process.__init__')
     def setUp(self, mock_init):
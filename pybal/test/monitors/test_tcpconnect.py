@@ -0,0 +1,114 @@
+# -*- coding: utf-8 -*-
+"""
+  PyBal unit tests
+  ~~~~~~~~~~~~~~~~
+
+  This module contains tests for `pybal.monitors.tcpconnect`.
+"""
+
+# Python imports
+import mock
+
+# Twisted imports
+from twisted.internet import error
+from twisted.python import failure
+from twisted.test import proto_helpers
+
+# Testing imports
+from .. import test_monitor
+
+# Pybal imports
+from pybal.monitors.tcpconnect import TCPConnectMonitoringProtocol, PrefixMismatchError
+
+
+class TCPConnectMonitoringProtocolTestCase(test_monitor.BaseLoopingCheckMonitoringProtocolTestCase):
+    """Test case for `pybal.monitors.tcpconnect.TCPConnectMonitoringProtocol`."""
+
+    monitorClass = TCPConnectMonitoringProtocol
+
+    def _check(self):
+        """Runs a check, and returns the factory and protocol of the
+        connection it made"""
+        self.monitor.active = True
+        self.monitor.check()
+        host, port, factory, timeout, bindAddress = self.reactor.tcpClients[-1]
+        proto = factory.buildProtocol(None)
+        transport = proto_helpers.StringTransport()
+        proto.makeConnection(transport)
+        return factory, proto, transport
+
+    def testInit(self):
+        self.assertEqual(self.monitor.intvCheck, TCPConnectMonitoringProtocol.INTV_CHECK)
+        self.assertEqual(self.monitor.toConnect, TCPConnectMonitoringProtocol.TIMEOUT)
+        self.assertEqual(self.monitor.port, self.server.port)
+        self.assertEqual(self.monitor.send, b'')
+        self.assertEqual(self.monitor.expect, b'')
+
+        self.config['tcpconnect.port'] = '8080'
+        self.config['tcpconnect.send'] = 'PING\\r\\n'
+        self.config['tcpconnect.expect'] = '+PONG'
+        monitor = TCPConnectMonitoringProtocol(self.coordinator, self.server, self.config)
+        self.assertEqual(monitor.port, 8080)
+        self.assertEqual(monitor.send, b'PING\r\n')
+        self.assertEqual(monitor.expect, b'+PONG')
+
+    def testConnect(self):
+        factory, proto, transport = self._check()
+        host, port = self.reactor.tcpClients[-1][:2]
+        self.assertEqual((host, port), (self.server.ip, self.server.port))
+        self.assertEqual(transport.value(), b'')
+        self.assertTrue(transport.disconnecting)
+        self.assertTrue(self.monitor.up)
+        self.assertIsNone(self.monitor.checkDeferred)
+
+    def testConnectFailed(self):
+        self.monitor.active = True
+        self.monitor.check()
+        factory = self.reactor.tcpClients[-1][2]
+        factory.clientConnectionFailed(None, failure.Failure(error.ConnectionRefusedError()))
+        self.assertFalse(self.monitor.up)
+
+    def testTimeout(self):
+        self.monitor.active = True
+        self.monitor.check()
+        self.reactor.advance(self.monitor.toConnect)
+        self.assertFalse(self.monitor.up)
+        self.assertIsNone(self.monitor.checkDeferred)
+
+    def testExpect(self):
+        self.monitor.send = b'PING\r\n'
+        self.monitor.expect = b'+PONG'
+        factory, proto, transport = self._check()
+        self.assertEqual(transport.value(), b'PING\r\n')
+        self.assertFalse(transport.disconnecting)
+
+        proto.dataReceived(b'+PO')
+        self.assertIsNone(self.monitor.up)
+        proto.dataReceived(b'NG\r\n')
+        self.assertTrue(transport.disconnecting)
+        self.assertTrue(self.monitor.up)
+
+    def testExpectMismatch(self):
+        self.monitor.expect = b'SSH-'
+        with mock.patch.object(self.monitor, '_connectFailed',
+                               wraps=self.monitor._connectFailed) as connectFailed:
+            factory, proto, transport = self._check()
+            proto.dataReceived(b'220 smtp')
+        self.assertTrue(transport.disconnecting)
+        self.assertFalse(self.monitor.up)
+        self.assertTrue(connectFailed.call_args[0][0].check(PrefixMismatchError))
+        self.assertEqual(self.coordinator.reason, "Reply does not start with 'SSH-'")
+
+    def testExpectConnectionClosed(self):
+        self.monitor.expect = b'SSH-'
+        factory, proto, transport = self._check()
+        factory.clientConnectionLost(None, failure.Failure(error.ConnectionDone()))
+        self.assertFalse(self.monitor.up)
+
+    def testStopCancelsCheck(self):
+        self.monitor.run()
+        self.reactor.advance(self.monitor.intvCheck)
+        connector = self.reactor.connectors[-1]
+        self.monitor.stop()
+        self.assertTrue(connector._disconnected)
+        self.assertIsNone(self.monitor.up)
@@ -7,10 +7,18 @@
 """
 
 # Python imports
+import errno
 import mock
+import socket
+import time
+import unittest
 
 # Twisted imports
 import twisted.test.proto_helpers
+from twisted.internet import task
+from twisted.internet.error import ConnectionDone
+from twisted.internet.interfaces import IHalfCloseableDescriptor
+from twisted.python import failure
 
 # Testing imports
 from .. import test_monitor
@@ -18,7 +26,8 @@ from .. import test_monitor
 # Pybal imports
 import pybal.monitor
 import pybal.util
-from pybal.monitors.udp import UDPMonitoringProtocol
+from pybal.monitors import udp
+from pybal.monitors.udp import UDPMonitoringProtocol, UDPProbeEngine
 
 
 class UDPMonitoringProtocolTestCase(test_monitor.BaseLoopingCheckMonitoringProtocolTestCase):
@@ -65,3 +74,152 @@ class UDPMonitoringProtocolTestCase(test_monitor.BaseLoopingCheckMonitoringProto
         monitor.connectionRefused()
         self.assertFalse(monitor.up)
         self.assertNotEquals(monitor.last_down_timestamp, 0)
+
+    def testSharedSocket(self):
+        self.config['udp.shared-socket'] = 'yes'
+        monitor = UDPMonitoringProtocol(
+            self.coordinator, self.server, self.config, reactor=self.reactor)
+        self.assertTrue(monitor.sharedSocket)
+        monitor.run()
+        self.reactor.listenUDP.assert_not_called()
+        engine = UDPMonitoringProtocol.probeEngine
+        self.assertIsInstance(engine, UDPProbeEngine)
+
+        with mock.patch.object(engine, 'probe') as mock_probe:
+            monitor.check()
+        mock_probe.assert_called_once_with(self.server.ip, self.server.port)
+        self.assertTrue(monitor.up)
+
+        # A probe that can't be sent fails the check
+        with mock.patch.object(engine, 'probe',
+                               side_effect=socket.error(errno.EPERM, 'denied')):
+            monitor.check()
+        self.assertFalse(monitor.up)
+
+        with mock.patch.object(engine, 'stop') as mock_stop:
+            monitor.stop()
+        mock_stop.assert_called_once()
+        self.assertIsNone(UDPMonitoringProtocol.probeEngine)
+
+
+class UDPProbeEngineTestCase(unittest.TestCase):
+    """Test case for `pybal.monitors.udp.UDPProbeEngine`."""
+
+    def setUp(self):
+        self.reactor = task.Clock()
+        self.reactor.addReader = mock.Mock()
+        self.reactor.removeReader = mock.Mock()
+        self.socketFactory = mock.Mock()
+        self.engine = UDPProbeEngine(self.reactor, socketFactory=self.socketFactory)
+        self.monitor = mock.Mock()
+        self.monitor.server.ip = '192.0.2.1'
+        self.monitor.server.port = 53
+        patcher = mock.patch('pybal.monitors.udp.recvErrorQueue')
+        self.mock_recvErrorQueue = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def testProbe(self):
+        self.engine.probe('192.0.2.1', 53)
+        self.engine.probe('192.0.2.2', 53)
+        self.socketFactory.assert_called_once_with(socket.AF_INET, socket.SOCK_DGRAM)
+        sock = self.socketFactory.return_value
+        sock.setsockopt.assert_called_once_with(socket.SOL_IP, udp.IP_RECVERR, 1)
+        sock.sendto.assert_called_with(b'', ('192.0.2.2', 53))
+
+        self.engine.probe('2001:db8::1', 53)
+        self.socketFactory.assert_called_with(socket.AF_INET6, socket.SOCK_DGRAM)
+        sock.setsockopt.assert_called_with(socket.IPPROTO_IPV6, udp.IPV6_RECVERR, 1)
+        self.assertEqual(len(self.engine.sockets), 2)
+
+    def testProbePendingError(self):
+        """A send failing with the error of an earlier ICMP message is retried"""
+        sock = self.socketFactory.return_value
+        sock.sendto.side_effect = [socket.error(errno.ECONNREFUSED, 'refused'), None]
+        self.engine.probe('192.0.2.1', 53)
+        self.assertEqual(sock.sendto.call_count, 2)
+
+    def testProbeFailed(self):
+        """A send that keeps failing raises"""
+        sock = self.socketFactory.return_value
+        sock.sendto.side_effect = socket.error(errno.ENETUNREACH, 'unreachable')
+        self.assertRaises(socket.error, self.engine.probe, '192.0.2.1', 53)
+        self.assertEqual(sock.sendto.call_count, 2)
+
+    def testReadErrors(self):
+        self.engine.register(self.monitor)
+        self.engine.probe('192.0.2.1', 53)
+        sock = self.socketFactory.return_value
+        sock.recv.side_effect = socket.error(errno.EAGAIN, 'again')
+        self.mock_recvErrorQueue.side_effect = [
+            # TTL exceeded, not for this monitor
+            (errno.EHOSTUNREACH, udp.SO_EE_ORIGIN_ICMP, 11, 0, ('192.0.2.1', 53)),
+            # Port unreachable, for another destination
+            (errno.ECONNREFUSED, udp.SO_EE_ORIGIN_ICMP, 3, 3, ('192.0.2.1', 54)),
+            (errno.ECONNREFUSED, udp.SO_EE_ORIGIN_ICMP, 3, 3, ('192.0.2.1', 53)),
+            None]
+        reader = self.reactor.addReader.call_args[0][0]
+        reader.doRead()
+        self.monitor.connectionRefused.assert_called_once()
+        sock.getsockopt.assert_called_once_with(socket.SOL_SOCKET, socket.SO_ERROR)
+
+    def testErrorCondition(self):
+        """Errors reported as a lost connection are read, and the reader
+        is added back"""
+        self.engine.register(self.monitor)
+        self.engine.probe('192.0.2.1', 53)
+        sock = self.socketFactory.return_value
+        sock.recv.side_effect = socket.error(errno.EAGAIN, 'again')
+        self.mock_recvErrorQueue.side_effect = [
+            (errno.ECONNREFUSED, udp.SO_EE_ORIGIN_ICMP, 3, 3, ('192.0.2.1', 53)),
+            None]
+        reader = self.reactor.addReader.call_args[0][0]
+        self.assertTrue(IHalfCloseableDescriptor.providedBy(reader))
+        reader.readConnectionLost(failure.Failure(ConnectionDone()))
+        self.monitor.connectionRefused.assert_called_once()
+        self.assertEqual(self.reactor.addReader.call_count, 2)
+
+        # Not after the engine has stopped
+        self.engine.stop()
+        reader.readConnectionLost(failure.Failure(ConnectionDone()))
+        self.assertEqual(self.reactor.addReader.call_count, 2)
+
+    def testRegister(self):
+        self.engine.register(self.monitor)
+        self.assertTrue(self.engine.unregister(self.monitor))
+        self.assertEqual(self.engine.monitors, {})
+
+        self.engine.probe('192.0.2.1', 53)
+        reader = self.reactor.addReader.call_args[0][0]
+        self.assertIs(reader.sock, self.socketFactory.return_value)
+        self.engine.stop()
+        self.reactor.removeReader.assert_called_once_with(reader)
+        self.socketFactory.return_value.close.assert_called_once()
+
+
+class RecvErrorQueueTestCase(unittest.TestCase):
+    """Test case for `pybal.monitors.udp.recvErrorQueue`."""
+
+    def testEmptyQueue(self):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.addCleanup(sock.close)
+        sock.setsockopt(socket.SOL_IP, udp.IP_RECVERR, 1)
+        self.assertIsNone(udp.recvErrorQueue(sock))
+
+    def testPortUnreachable(self):
+        closed = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        closed.bind(('127.0.0.1', 0))
+        destination = closed.getsockname()
+        closed.close()
+
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.addCleanup(sock.close)
+        sock.setsockopt(socket.SOL_IP, udp.IP_RECVERR, 1)
+        sock.sendto(b'', destination)
+        result = None
+        for attempt in range(100):
+            result = udp.recvErrorQueue(sock)
+            if result is not None:
+                break
+            time.sleep(0.01)
+        self.assertEqual(result, (errno.ECONNREFUSED, udp.SO_EE_ORIGIN_ICMP,
+                                  udp.ICMP_DEST_UNREACH, 3, destination))
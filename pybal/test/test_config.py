@@ -6,15 +6,20 @@
   This module contains tests for `pybal.config`.
 
 """
+import errno
 import json
 import mock
+import os
+import stat
 
+from twisted.internet import defer, task
+from twisted.web.http_headers import Headers
 
 import pybal
 import pybal.config
 import pybal.etcd
 
-from .fixtures import PyBalTestCase, MockClientGetPage
+from .fixtures import PyBalTestCase
 
 
 class DummyConfigurationObserver(pybal.config.ConfigurationObserver):
@@ -35,6 +40,164 @@ class ConfigurationObserverTestCase(PyBalTestCase):
         )
 
 
+class ConfigCacheTestCase(PyBalTestCase):
+    """Test case for `pybal.config.ConfigCache`."""
+
+    def setUp(self):
+        super(ConfigCacheTestCase, self).setUp()
+        self.path = self.mktemp()
+        self.cache = pybal.config.ConfigCache(self.path, reactor=self.reactor)
+
+    def testMissing(self):
+        self.assertIsNone(self.cache.load())
+        self.assertNotEqual(self.cache.age(), self.cache.age())     # NaN
+
+    def testInvalid(self):
+        for content in ('{', '[1, 2]'):
+            with open(self.path, 'w') as f:
+                f.write(content)
+            self.assertIsNone(self.cache.load())
+
+    def testSave(self):
+        config = {'mw1': {'enabled': True, 'weight': 10}}
+        self.reactor.advance(1000)
+        self.cache.update({})
+        self.cache.update(config)
+        self.assertFalse(os.path.exists(self.path))
+
+        # Updates are coalesced into a single write
+        with mock.patch('os.rename', side_effect=os.rename) as mock_rename:
+            self.reactor.advance(self.cache.saveDelay)
+            self.assertEqual(mock_rename.call_count, 1)
+            tmpPath, path = mock_rename.call_args[0]
+            self.assertEqual(path, self.path)
+            self.assertEqual(os.path.dirname(tmpPath),
+                             os.path.dirname(os.path.abspath(self.path)))
+        self.assertEqual(self.cache.age(), 0)
+        self.reactor.advance(5)
+        self.assertEqual(self.cache.age(), 5)
+
+        cache = pybal.config.ConfigCache(self.path, reactor=self.reactor)
+        self.assertEqual(cache.load(), config)
+        self.assertIsNotNone(cache.savedAt)
+
+    def testWriteAtomically(self):
+        """The file keeps its mode and owner"""
+        with open(self.path, 'w') as f:
+            f.write('old')
+        os.chmod(self.path, 0o640)
+        with mock.patch('os.fchown') as mock_fchown, \
+                mock.patch('os.stat', side_effect=lambda path: mock.Mock(
+                    st_mode=0o100640, st_uid=1234, st_gid=5678)):
+            pybal.config.write_atomically(self.path, 'new')
+        with open(self.path) as f:
+            self.assertEqual(f.read(), 'new')
+        self.assertEqual(stat.S_IMODE(os.stat(self.path).st_mode), 0o640)
+        mock_fchown.assert_called_once_with(mock.ANY, 1234, 5678)
+        # No temporary files are left behind
+        self.assertEqual(os.listdir(os.path.dirname(self.path)),
+                         [os.path.basename(self.path)])
+
+    def testWriteAtomicallyFailed(self):
+        with mock.patch('os.rename', side_effect=OSError(errno.EXDEV, 'rename')):
+            self.assertRaises(OSError, pybal.config.write_atomically, self.path, 'new')
+        self.assertEqual(os.listdir(os.path.dirname(self.path)), [])
+
+    def testSaveFailed(self):
+        cache = pybal.config.ConfigCache(os.path.join(self.path, 'missing', 'cache'),
+                                         reactor=self.reactor)
+        cache.update({'mw1': {'enabled': True, 'weight': 10}})
+        self.reactor.advance(cache.saveDelay)
+        self.assertIsNone(cache.savedAt)
+
+
+class FileWatcherTestCase(PyBalTestCase):
+    """Test case for `pybal.config.FileWatcher`."""
+
+    def setUp(self):
+        super(FileWatcherTestCase, self).setUp()
+        self.watcher = pybal.config.FileWatcher(reactor=self.reactor)
+        self.observer = mock.Mock()
+
+    @mock.patch('twisted.internet.inotify.INotify')
+    def testSharedNotifier(self, mock_inotify):
+        """Test `FileWatcher.watch` and `FileWatcher.unwatch`"""
+        other = mock.Mock()
+        self.assertTrue(self.watcher.watch('/etc/pybal/pools/apache', self.observer))
+        self.assertTrue(self.watcher.watch('/etc/pybal/pools/squid', other))
+        mock_inotify.assert_called_once_with(self.reactor)
+        notifier = mock_inotify.return_value
+        notifier.watch.assert_called_once()
+        self.assertEqual(notifier.watch.call_args[0][0].path, '/etc/pybal/pools')
+
+        self.watcher.unwatch('/etc/pybal/pools/apache', self.observer)
+        notifier.ignore.assert_not_called()
+        self.watcher.unwatch('/etc/pybal/pools/squid', other)
+        notifier.ignore.assert_called_once()
+        notifier.loseConnection.assert_called_once()
+        self.assertIsNone(self.watcher.notifier)
+
+    @mock.patch('twisted.internet.inotify.INotify')
+    def testNotify(self, mock_inotify):
+        """Test `FileWatcher._notify`"""
+        self.watcher.watch('/etc/pybal/pools/apache', self.observer)
+        pools = pybal.config.filepath.FilePath('/etc/pybal/pools')
+        self.watcher._notify(None, pools.child('squid'), pybal.config.inotify.IN_MOVED_TO)
+        self.observer.fileChanged.assert_not_called()
+        self.watcher._notify(None, pools.child('apache'), pybal.config.inotify.IN_MOVED_TO)
+        self.observer.fileChanged.assert_called_once_with()
+
+        # The directory itself is removed
+        self.watcher._notify(None, pools, pybal.config.inotify.IN_DELETE_SELF)
+        self.observer.watchLost.assert_called_once_with()
+        self.assertEqual(self.watcher.observers, {})
+        self.assertEqual(self.watcher.realPaths, {})
+        self.assertIsNone(self.watcher.notifier)
+
+    def testUnwatchable(self):
+        """Test `FileWatcher.watch` with a missing directory"""
+        self.assertFalse(self.watcher.watch('/nonexistent/pybal/apache', self.observer))
+        self.assertIsNone(self.watcher.notifier)
+
+    def testRenamedIntoPlace(self):
+        """Test that files atomically renamed into place are noticed"""
+        from twisted.internet import reactor
+        directory = self.mktemp()
+        os.mkdir(directory)
+        path = os.path.join(directory, 'pool')
+        watcher = pybal.config.FileWatcher(reactor=reactor)
+        changed = defer.Deferred()
+        self.observer.fileChanged.side_effect = lambda: changed.callback(None)
+        self.assertTrue(watcher.watch(path, self.observer))
+        self.addCleanup(watcher.unwatch, path, self.observer)
+
+        with open(path + '.tmp', 'w') as f:
+            f.write("{'host': 'mw1200', 'weight': 10, 'enabled': True }\n")
+        os.rename(path + '.tmp', path)
+        return changed
+
+    def testSymlink(self):
+        """Test that files written through a symbolic link are noticed"""
+        from twisted.internet import reactor
+        target = self.mktemp()
+        os.mkdir(target)
+        links = self.mktemp()
+        os.mkdir(links)
+        path = os.path.join(links, 'pool')
+        os.symlink(os.path.join(os.path.abspath(target), 'pool'), path)
+        watcher = pybal.config.FileWatcher(reactor=reactor)
+        changed = defer.Deferred()
+        self.observer.fileChanged.side_effect = lambda: changed.callback(None)
+        self.assertTrue(watcher.watch(path, self.observer))
+        self.addCleanup(watcher.unwatch, path, self.observer)
+        self.assertEqual(list(watcher.observers),
+                         [os.path.realpath(target)])
+
+        with open(path, 'w') as f:
+            f.write("{'host': 'mw1200', 'weight': 10, 'enabled': True }\n")
+        return changed
+
+
 class FileConfigurationObserverTestCase(PyBalTestCase):
     """Test case for `pybal.config.FileConfigurationObserver`."""
 
@@ -72,6 +235,60 @@ class FileConfigurationObserverTestCase(PyBalTestCase):
         self.observer.parseConfig.assert_called_with('123')
         self.assertEquals(self.observer.lastConfig, 'some_config')
         self.assertEquals(self.observer.coordinator.config, 'some_config')
+        # Stat change with the same content means no config parsing
+        self.observer.parseConfig.reset_mock()
+        mock_stat.return_value = 'WMF!!'
+        with mock.patch('__builtin__.open', m, True) as mock_open:
+            self.observer.reloadConfig()
+        mock_open.assert_called_with('/something/here', 'rt')
+        self.observer.parseConfig.assert_not_called()
+
+    def mockReloadConfig(self):
+        self.observer.reloadConfig = mock.MagicMock()
+        self.observer.reloadTask = task.LoopingCall(self.observer.reloadConfig)
+        self.observer.reloadTask.clock = self.reactor
+
+    def testStartObserving(self):
+        """Test `FileConfigurationObserver.startObserving`"""
+        self.patch(pybal.config.FileConfigurationObserver, 'fileWatcher', mock.Mock())
+        watcher = pybal.config.FileConfigurationObserver.fileWatcher
+        watcher.watch.return_value = True
+        self.mockReloadConfig()
+        self.observer.startObserving()
+        watcher.watch.assert_called_once_with('/something/here', self.observer)
+        self.observer.reloadConfig.assert_called_once_with()
+        self.assertFalse(self.observer.reloadTask.running)
+
+        # File changes trigger a reload, errors don't start polling
+        self.observer.reloadConfig.side_effect = OSError("No such file")
+        self.observer.fileChanged()
+        self.assertEqual(self.observer.reloadConfig.call_count, 2)
+        self.flushLoggedErrors(OSError)
+        self.assertFalse(self.observer.reloadTask.running)
+
+        self.observer.stopObserving()
+        watcher.unwatch.assert_called_once_with('/something/here', self.observer)
+        self.assertFalse(self.observer.watching)
+
+    def testStartObservingPolling(self):
+        """Test `FileConfigurationObserver.startObserving` without inotify"""
+        self.patch(pybal.config.FileConfigurationObserver, 'fileWatcher', mock.Mock())
+        pybal.config.FileConfigurationObserver.fileWatcher.watch.return_value = False
+        self.mockReloadConfig()
+        self.observer.startObserving()
+        self.assertTrue(self.observer.reloadTask.running)
+        self.observer.reloadConfig.assert_called_once_with()
+        self.observer.stopObserving()
+        self.assertFalse(self.observer.reloadTask.running)
+
+    def testWatchLost(self):
+        """Test `FileConfigurationObserver.watchLost`"""
+        self.observer.watching = True
+        self.mockReloadConfig()
+        self.observer.watchLost()
+        self.assertFalse(self.observer.watching)
+        self.assertTrue(self.observer.reloadTask.running)
+        self.observer.stopObserving()
 
     def testParseConfig(self):
         """Test `FileConfigurationObserver.parseConfig`"""
@@ -120,6 +337,43 @@ class FileConfigurationObserverTestCase(PyBalTestCase):
         self.assertEquals(self.observer.parseLegacyConfig(invalid_config), {})
         self.flushLoggedErrors(KeyError)
 
+    def testPersistLegacy(self):
+        """Test `FileConfigurationObserver.persist` on a legacy file"""
+        path = self.mktemp()
+        with open(path, 'w') as f:
+            f.write('\n'.join((
+                "# Text servers",
+                "{'host': 'mw1200', 'weight': 10, 'enabled': True }",
+                "{ 'host': 'mw1201', 'weight': 1, 'enabled': False }",
+                "  {'host': 'mw1202', 'weight': 1, 'enabled': False}  # T1234, '#' kept",
+                "")))
+        observer = self.getObserver('file://' + os.path.abspath(path))
+        observer.persist({'mw1201': {'enabled': True, 'weight': 5},
+                          'mw1202': {'enabled': True}})
+        with open(path) as f:
+            rawConfig = f.read()
+        self.assertEquals(rawConfig, '\n'.join((
+            "# Text servers",
+            "{'host': 'mw1200', 'weight': 10, 'enabled': True }",
+            "{ 'host': 'mw1201', 'weight': 5, 'enabled': True }",
+            "  { 'host': 'mw1202', 'weight': 1, 'enabled': True }  # T1234, '#' kept",
+            "")))
+        self.assertEquals(observer.parseConfig(rawConfig)['mw1201'],
+                          {'enabled': True, 'weight': 5})
+
+    def testPersistJson(self):
+        """Test `FileConfigurationObserver.persist` on a JSON file"""
+        path = self.mktemp() + '.json'
+        with open(path, 'w') as f:
+            json.dump({'mw1200': {'enabled': True, 'weight': 10},
+                       'mw1201': {'enabled': True, 'weight': 10}}, f)
+        observer = self.getObserver('file://' + os.path.abspath(path))
+        observer.persist({'mw1200': {'enabled': False}})
+        with open(path) as f:
+            self.assertEquals(json.load(f), {
+                'mw1200': {'enabled': False, 'weight': 10},
+                'mw1201': {'enabled': True, 'weight': 10}})
+
 
 class HttpConfigurationObserverTestCase(PyBalTestCase):
     data = """
@@ -131,28 +385,96 @@ class HttpConfigurationObserverTestCase(PyBalTestCase):
 
     def setUp(self):
         super(HttpConfigurationObserverTestCase, self).setUp()
+        self.config['config-interval'] = '10'
+        self.coordinator.lvsservice = self.lvsservice
         self.observer = self.getObserver()
+        self.observer.reactor = self.reactor
+        self.observer.client = mock.Mock()
+        self.observer.client.get.side_effect = lambda *args, **kwargs: defer.succeed(
+            self.response)
+        self.respond(200, self.data, ETag='"v1"',
+                     **{'Last-Modified': 'Mon, 19 Oct 2026 10:00:00 GMT'})
+        self.addCleanup(self.observer.stopObserving)
 
     def getObserver(self, url='http://example.com/pybal-config/example.json'):
         return pybal.config.HttpConfigurationObserver(
             self.coordinator, url)
 
+    def respond(self, code, data='', **headers):
+        self.response = mock.Mock(code=code, headers=Headers(
+            {name: [value] for name, value in headers.items()}))
+        self.response.content.side_effect = lambda: defer.succeed(data)
+
+    def testInit(self):
+        """Test `HttpConfigurationObserver.__init__`"""
+        self.assertEquals(self.observer.reloadIntervalSeconds, 10)
+        self.assertEquals(self.observer.maxBackoffSeconds, 60)
+        self.assertEquals(self.observer.pool.maxPersistentPerHost, 1)
+
+    def testPersist(self):
+        """Test `HttpConfigurationObserver.persist`"""
+        self.assertRaises(NotImplementedError, self.observer.persist,
+                          {'mw1200': {'enabled': False}})
+
     def testReloadConfig(self):
         """Test `HttpConfigurationObserver.reloadConfig`"""
-        m = MockClientGetPage(self.data)
-        with mock.patch('twisted.web.client.getPage', m.getPage):
-            self.observer.reloadConfig()
+        self.observer.reloadConfig()
         self.assertEquals(self.coordinator.config, json.loads(self.data))
+        self.assertEquals(self.observer.etag, '"v1"')
+        headers = self.observer.client.get.call_args[1]['headers']
+        self.assertNotIn('If-None-Match', headers)
 
-        errMsg = 'Hamsters!'
-        m.addErr(errMsg)
-        self.observer.logError = mock.MagicMock()
-        with mock.patch('twisted.web.client.getPage', m.getPageError):
-            self.observer.reloadConfig()
-        # Configuration hasn't changed
-        self.assertEquals(self.coordinator.config, json.loads(self.data))
-        # Error was logged
-        self.assertTrue(self.observer.logError.called)
+        # Later requests are conditional, and not modified is no change
+        self.coordinator.config = None
+        self.respond(304)
+        self.observer.reloadConfig()
+        headers = self.observer.client.get.call_args[1]['headers']
+        self.assertEquals(headers['If-None-Match'], '"v1"')
+        self.assertEquals(headers['If-Modified-Since'], 'Mon, 19 Oct 2026 10:00:00 GMT')
+        self.assertIsNone(self.coordinator.config)
+        self.response.content.assert_not_called()
+
+        self.respond(500)
+        self.failureResultOf(self.observer.reloadConfig(),
+                             pybal.config.PyBalConfigurationError)
+
+    def testInvalidConfig(self):
+        """Test that validators of unparsable configuration are not kept"""
+        self.respond(200, '{[]', ETag='"v2"')
+        self.failureResultOf(self.observer.reloadConfig(), ValueError)
+        self.assertIsNone(self.observer.etag)
+
+    def testObserving(self):
+        """Test `HttpConfigurationObserver.startObserving`"""
+        with mock.patch('random.uniform', return_value=1):
+            self.observer.startObserving()
+            self.reactor.advance(0)
+            self.assertEquals(self.coordinator.config, json.loads(self.data))
+            self.reactor.advance(10)
+            self.assertEquals(self.observer.client.get.call_count, 2)
+
+            # Back off exponentially on errors, up to the maximum
+            self.respond(500)
+            for delay in (10, 20, 40, 60, 60):
+                self.reactor.advance(delay)
+            self.assertEquals(self.observer.client.get.call_count, 7)
+            self.assertEquals(self.observer.failures, 5)
+            self.flushLoggedErrors(pybal.config.PyBalConfigurationError)
+
+            self.respond(304)
+            self.reactor.advance(60)
+            self.assertEquals(self.observer.failures, 0)
+            self.reactor.advance(10)
+            self.assertEquals(self.observer.client.get.call_count, 9)
+
+        self.observer.stopObserving()
+        self.assertEquals(self.reactor.getDelayedCalls(), [])
+
+    def testJitter(self):
+        """Test `HttpConfigurationObserver.getReloadDelay`"""
+        delays = [self.observer.getReloadDelay() for i in range(100)]
+        self.assertTrue(all(9 <= delay <= 11 for delay in delays))
+        self.assertGreater(len(set(delays)), 1)
 
     def testOnConfigReceived(self):
         """Test `HttpConfigurationObserver.OnConfigReceived`"""
@@ -163,5 +485,10 @@ class HttpConfigurationObserverTestCase(PyBalTestCase):
         self.assertEquals(self.coordinator.config, None)
         # Config gets updated
         self.observer.lastConfig['mw1201']["enabled"] = True
+        self.observer.lastHash = None
         self.observer.onConfigReceived(self.data)
         self.assertEquals(self.coordinator.config, json.loads(self.data))
+        # Unchanged content isn't parsed again
+        self.observer.parseConfig = mock.MagicMock()
+        self.observer.onConfigReceived(self.data)
+        self.observer.parseConfig.assert_not_called()
@@ -0,0 +1,282 @@
+# -*- coding: utf-8 -*-
+"""
+  PyBal unit tests
+  ~~~~~~~~~~~~~~~~
+
+  This module contains tests for `pybal.consul`.
+
+"""
+
+import base64
+import json
+import mock
+
+from twisted.internet import defer, reactor
+from twisted.web import resource, server
+
+import pybal
+import pybal.config
+import pybal.consul
+from .fixtures import PyBalTestCase, RecordingCoordinator
+
+
+def _kvEntry(key, value, index):
+    return {'Key': key, 'Value': base64.b64encode(json.dumps(value)),
+            'ModifyIndex': index}
+
+
+def _healthEntry(address, *statuses, **weights):
+    return {'Node': {'Node': 'node-' + address, 'Address': address},
+            'Service': {'Service': 'appserver', 'Address': '',
+                        'Weights': weights or {'Passing': 1, 'Warning': 1}},
+            'Checks': [{'Status': status} for status in statuses]}
+
+
+class ConsulStubResource(resource.Resource):
+    """Local stand-in for the Consul HTTP API, answering blocking queries
+    on a single set of entries."""
+
+    isLeaf = True
+
+    def __init__(self):
+        resource.Resource.__init__(self)
+        self.index = 10
+        self.entries = []
+        self.blocked = []
+        self.queries = []
+        self.queryWaiters = []
+        self.clientPorts = set()
+        self.txns = []
+
+    def waitForQuery(self):
+        self.queryWaiters.append(defer.Deferred())
+        return self.queryWaiters[-1]
+
+    def setEntries(self, entries):
+        self.index += 1
+        self.entries = entries
+        blocked, self.blocked = self.blocked, []
+        for request in blocked:
+            self.respond(request)
+
+    def respond(self, request):
+        request.setHeader('Content-Type', 'application/json')
+        request.setHeader('X-Consul-Index', str(self.index))
+        request.write(json.dumps(self.entries))
+        request.finish()
+
+    def render_GET(self, request):
+        self.clientPorts.add(request.transport.getPeer().port)
+        self.queries.append((request.path, request.args))
+        waiters, self.queryWaiters = self.queryWaiters, []
+        for waiter in waiters:
+            waiter.callback(request.args)
+
+        # Block until the index changes; a reset index answers right away
+        index = int(request.args.get('index', ['0'])[0])
+        if index == self.index:
+            self.blocked.append(request)
+            request.notifyFinish().addErrback(lambda failure: self.blocked.remove(request))
+        else:
+            self.respond(request)
+        return server.NOT_DONE_YET
+
+    def render_PUT(self, request):
+        ops = json.loads(request.content.read())
+        self.txns.append(ops)
+        entries = {entry['Key']: entry for entry in self.entries}
+        for op in ops:
+            kv = op['KV']
+            entries[kv['Key']] = {'Key': kv['Key'], 'Value': kv['Value'],
+                                  'ModifyIndex': self.index + 1}
+        self.setEntries(sorted(entries.values(), key=lambda entry: entry['Key']))
+        request.setHeader('Content-Type', 'application/json')
+        return json.dumps({'Results': [{'KV': op['KV']} for op in ops],
+                           'Errors': None})
+
+
+class ConsulDecodeTestCase(PyBalTestCase):
+    """Test case for the decoding of Consul responses."""
+
+    def testDecodeKVEntries(self):
+        entries = [
+            {'Key': 'pools/text/', 'Value': None, 'ModifyIndex': 1},
+            _kvEntry('pools/text/mw1', {'enabled': True, 'weight': 10}, 2),
+            _kvEntry('pools/text/mw2', {'pooled': 'no', 'weight': 5}, 3),
+            _kvEntry('pools/text/mw3', {'pooled': 'inactive', 'weight': 5}, 4),
+        ]
+        self.assertEquals(pybal.consul.decode_kv_entries(entries), {
+            'mw1': {'enabled': True, 'weight': 10},
+            'mw2': {'enabled': False, 'weight': 5}})
+
+    def testDecodeHealthEntries(self):
+        entries = [
+            _healthEntry('10.0.0.1', 'passing', 'passing', Passing=10, Warning=2),
+            _healthEntry('10.0.0.2', 'passing', 'warning', Passing=10, Warning=2),
+            _healthEntry('10.0.0.3', 'warning', 'critical', Passing=10, Warning=2),
+        ]
+        entries[0]['Service']['Address'] = '10.1.0.1'
+        self.assertEquals(pybal.consul.decode_health_entries(entries), {
+            '10.1.0.1': {'enabled': True, 'weight': 10},
+            '10.0.0.2': {'enabled': True, 'weight': 2},
+            '10.0.0.3': {'enabled': False, 'weight': 10}})
+
+    def testDecodeHealthEntriesDuplicate(self):
+        """Of several instances on one address, only the first is used"""
+        entries = [
+            _healthEntry('10.0.0.1', 'passing', Passing=10),
+            _healthEntry('10.0.0.1', 'critical', Passing=5),
+        ]
+        with mock.patch('pybal.consul.log') as mock_log:
+            self.assertEquals(pybal.consul.decode_health_entries(entries), {
+                '10.0.0.1': {'enabled': True, 'weight': 10}})
+        self.assertEqual(mock_log.warn.call_count, 1)
+
+
+class ConsulConfigurationObserverTestCase(PyBalTestCase):
+    """Test case for `pybal.consul.ConsulConfigurationObserver`."""
+
+    def setUp(self):
+        super(ConsulConfigurationObserverTestCase, self).setUp()
+        self.consul = ConsulStubResource()
+        self.port = reactor.listenTCP(0, server.Site(self.consul), interface='127.0.0.1')
+        self.coordinator = RecordingCoordinator()
+        self.observer = None
+
+    def getObserver(self, path):
+        observer = pybal.config.ConfigurationObserver.fromUrl(
+            self.coordinator, 'consul://sekrit@127.0.0.1:%d%s' % (
+                self.port.getHost().port, path))
+        observer.reconnectTimeout = 0
+        return observer
+
+    @defer.inlineCallbacks
+    def tearDown(self):
+        if self.observer is not None:
+            yield self.observer.stopObserving()
+        yield self.port.stopListening()
+
+    def testParseConfigUrl(self):
+        observer = self.getObserver('/health/appserver?dc=eqiad&tag=v2&stale=1')
+        self.assertIsInstance(observer, pybal.consul.ConsulConfigurationObserver)
+        self.assertEquals(observer.token, 'sekrit')
+        self.assertEquals((observer.endpoint, observer.name), ('health', 'appserver'))
+        self.assertEquals(observer.params, {'dc': 'eqiad', 'tag': 'v2'})
+        self.assertTrue(observer.getURL().endswith('/v1/health/service/appserver'))
+        self.assertFalse(observer.writable)
+        self.assertTrue(self.getObserver('/kv/pools/text').writable)
+
+        for path in ('/catalog/appserver', '/kv/', '/'):
+            self.assertRaises(ValueError, self.getObserver, path)
+
+    @defer.inlineCallbacks
+    def testKVBlockingQueries(self):
+        self.consul.setEntries([
+            _kvEntry('pools/text/mw1', {'enabled': True, 'weight': 10}, 11),
+            _kvEntry('pools/text/mw2', {'enabled': True, 'weight': 10}, 11)])
+        self.observer = self.getObserver('/kv/pools/text')
+        self.observer.startObserving()
+        args = yield self.consul.waitForQuery()
+        self.assertEquals(args['recurse'], ['true'])
+        self.assertNotIn('index', args)
+
+        # After the first read, queries block on the last index seen
+        args = yield self.consul.waitForQuery()
+        self.assertEquals(args['index'], ['11'])
+        self.assertEquals(args['wait'], ['300s'])
+        self.assertEquals(self.coordinator.config, {
+            'mw1': {'enabled': True, 'weight': 10},
+            'mw2': {'enabled': True, 'weight': 10}})
+
+        # Changes are handed to the coordinator as deltas
+        updated = self.coordinator.waitForUpdate()
+        self.consul.setEntries([
+            _kvEntry('pools/text/mw1', {'pooled': 'no', 'weight': 10}, 12)])
+        yield updated
+        self.assertEquals(self.coordinator.delta,
+                          ({'mw1': {'enabled': False, 'weight': 10}}, ['mw2']))
+        args = yield self.consul.waitForQuery()
+        self.assertEquals(args['index'], ['12'])
+
+        # All queries went over a single connection
+        self.assertEquals(len(self.consul.clientPorts), 1)
+
+    @defer.inlineCallbacks
+    def testHealthBlockingQueries(self):
+        self.consul.setEntries([_healthEntry('10.0.0.1', 'passing'),
+                                _healthEntry('10.0.0.2', 'passing')])
+        self.observer = self.getObserver('/health/appserver')
+        self.observer.startObserving()
+        yield self.consul.waitForQuery()
+        yield self.consul.waitForQuery()
+        self.assertEquals(self.consul.queries[0][0], '/v1/health/service/appserver')
+        self.assertEquals(sorted(self.coordinator.config), ['10.0.0.1', '10.0.0.2'])
+
+        updated = self.coordinator.waitForUpdate()
+        self.consul.setEntries([_healthEntry('10.0.0.1', 'passing'),
+                                _healthEntry('10.0.0.2', 'critical')])
+        yield updated
+        self.assertEquals(self.coordinator.delta,
+                          ({'10.0.0.2': {'enabled': False, 'weight': 1}}, []))
+
+    @defer.inlineCallbacks
+    def testIndexReset(self):
+        self.observer = self.getObserver('/kv/pools/text')
+        self.observer.index = 50
+        self.observer.observing = True
+        self.observer.lastConfig = {'mw1': {'enabled': True, 'weight': 10}}
+        self.coordinator.config = dict(self.observer.lastConfig)
+        yield self.observer.query()
+        self.assertEquals(self.observer.index, 0)
+        self.assertEquals(self.coordinator.config, {})
+
+    @defer.inlineCallbacks
+    def testMissingPrefix(self):
+        self.consul.respond = lambda request: (
+            request.setResponseCode(404),
+            request.setHeader('X-Consul-Index', str(self.consul.index)),
+            request.finish())
+        self.observer = self.getObserver('/kv/pools/text')
+        # Servers from the config cache
+        self.coordinator.config = {'mw1': {'enabled': True, 'weight': 10}}
+        yield self.observer.query()
+        self.assertEquals(self.observer.index, 10)
+        self.assertEquals(self.observer.lastConfig, {})
+        # The first answer replaces them, even when empty
+        self.assertEquals(self.coordinator.config, {})
+
+    @defer.inlineCallbacks
+    def testPersist(self):
+        self.consul.setEntries([
+            _kvEntry('pools/text/mw1', {'enabled': True, 'weight': 10}, 11),
+            _kvEntry('pools/text/mw2', {'enabled': True, 'weight': 10}, 11)])
+        self.observer = self.getObserver('/kv/pools/text')
+        self.observer.maxTxnOps = 1
+        yield self.observer.query()
+        yield self.observer.persist({'mw1': {'enabled': False},
+                                     'mw2': {'weight': 5}})
+        # One transaction per maxTxnOps changes
+        self.assertEquals([[op['KV']['Key'] for op in ops] for ops in self.consul.txns],
+                          [['pools/text/mw1'], ['pools/text/mw2']])
+        self.assertEquals(pybal.consul.decode_kv_entries(self.consul.entries), {
+            'mw1': {'enabled': False, 'weight': 10},
+            'mw2': {'enabled': True, 'weight': 5}})
+
+    @defer.inlineCallbacks
+    def testPersistUnknownHost(self):
+        """Hosts the coordinator doesn't know are rejected, and nothing
+        is written"""
+        self.consul.setEntries([
+            _kvEntry('pools/text/mw1', {'enabled': True, 'weight': 10}, 11)])
+        self.observer = self.getObserver('/kv/pools/text')
+        yield self.observer.query()
+        yield self.assertFailure(
+            self.observer.persist({'mw1': {'enabled': False}, 'mw3': {'weight': 5}}),
+            ValueError)
+        self.assertEquals(self.consul.txns, [])
+
+    def testPersistHealth(self):
+        self.observer = self.getObserver('/health/appserver')
+        return self.assertFailure(
+            self.observer.persist({'10.0.0.1': {'enabled': False}}),
+            NotImplementedError)
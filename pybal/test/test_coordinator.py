@@ -7,7 +7,9 @@
 
 """
 
+import json
 import mock
+import os
 import unittest
 
 import pybal.coordinator
@@ -15,7 +17,7 @@ import pybal.server
 import pybal.util
 
 from twisted.internet.reactor import getDelayedCalls
-from twisted.internet import defer
+from twisted.internet import defer, task
 
 from .fixtures import PyBalTestCase
 
@@ -28,8 +30,9 @@ class CoordinatorTestCase(PyBalTestCase):
 
         configUrl = "file:///dev/null"
 
-        self.coordinator = pybal.coordinator.Coordinator(
-                mock.MagicMock(), configUrl)
+        lvsservice = mock.MagicMock()
+        lvsservice.configuration = pybal.util.ConfigDict({'config-cache': 'no'})
+        self.coordinator = pybal.coordinator.Coordinator(lvsservice, configUrl)
 
         self.coordinator.lvsservice.getDepoolThreshold = mock.MagicMock(
                 return_value=0.5)
@@ -42,7 +45,7 @@ class CoordinatorTestCase(PyBalTestCase):
             side_effect=self.lvsservice.removeServer)
 
     def tearDown(self):
-        self.coordinator.configObserver.reloadTask.stop()
+        self.coordinator.configObserver.stopObserving()
 
         for call in getDelayedCalls():
             if call.func.func_name == 'maybeParseConfig':
@@ -528,6 +531,102 @@ class CoordinatorTestCase(PyBalTestCase):
         # The new server should have been added now.
         self.assertIn('shiny-new-server.eqiad.wmnet', self.coordinator.servers)
 
+    def testIPAddressServers(self):
+        """
+        Servers configured by IP address, as discovery backends do, become
+        ready and pooled without DNS lookups.
+        """
+
+        self.coordinator.lvsservice.ip = '10.2.1.1'
+        servers = {
+            '10.64.0.12': {'enabled': True, 'weight': 10},
+            '10.64.0.13': {'enabled': True, 'weight': 10},
+        }
+        with mock.patch('pybal.server.client') as mock_client:
+            self.successResultOf(self.coordinator.onConfigUpdate(config=servers))
+        self.assertFalse(mock_client.lookupAddress.called)
+
+        for host, server in self.coordinator.servers.iteritems():
+            self.assertTrue(server.ready)
+            self.assertTrue(server.pool)
+            self.assertEqual(server.ip, host)
+        self.coordinator.lvsservice.assignServers.assert_called_with(
+            set(self.coordinator.servers.itervalues()))
+        self.assertServerInvariants(coordinator=self.coordinator)
+
+    def testConfigDelta(self):
+        """
+        Test whether only the servers in a configuration delta get added,
+        removed or updated.
+        """
+
+        servers = {
+            'cp1045.eqiad.wmnet': {},
+            'cp1046.eqiad.wmnet': {},
+            'cp1047.eqiad.wmnet': {},
+        }
+        self.setServers(servers, up=True, enabled=True)
+        untouchedServer = self.coordinator.servers['cp1045.eqiad.wmnet']
+        untouchedServer.merge = mock.Mock()
+        updatedServer = self.coordinator.servers['cp1046.eqiad.wmnet']
+        updatedServer.merge = mock.Mock()
+        removedServer = self.coordinator.servers['cp1047.eqiad.wmnet']
+        removedServer.destroy = mock.Mock()
+
+        with mock.patch.object(pybal.server.Server,
+                               'initialize',
+                               return_value=defer.succeed(True)), \
+                mock.patch.object(self.coordinator,
+                                  'refreshPreexistingServer') as mock_rPS:
+            self.coordinator.onConfigDelta(
+                {'cp1046.eqiad.wmnet': {'weight': 5},
+                 'shiny-new-server.eqiad.wmnet': {}},
+                ['cp1047.eqiad.wmnet', 'unknown.eqiad.wmnet'])
+
+        untouchedServer.merge.assert_not_called()
+        updatedServer.merge.assert_called_once_with({'weight': 5})
+        mock_rPS.assert_called_once_with(updatedServer)
+        removedServer.destroy.assert_called_once_with()
+        self.assertEqual(set(self.coordinator.servers),
+                         {'cp1045.eqiad.wmnet', 'cp1046.eqiad.wmnet',
+                          'shiny-new-server.eqiad.wmnet'})
+        self.coordinator.lvsservice.assignServers.assert_called()
+
+    def testConfigCache(self):
+        path = self.mktemp()
+        with open(path, 'w') as f:
+            json.dump({'cp1045.eqiad.wmnet': {'enabled': True, 'weight': 10}}, f)
+
+        lvsservice = mock.MagicMock()
+        lvsservice.configuration = pybal.util.ConfigDict({'config-cache': path})
+        with mock.patch.object(pybal.server.Server, 'initialize',
+                               return_value=defer.succeed(True)):
+            # A configuration source that doesn't answer
+            coordinator = pybal.coordinator.Coordinator(
+                lvsservice, "file://" + os.path.abspath(self.mktemp()))
+        self.addCleanup(coordinator.configObserver.stopObserving)
+        self.flushLoggedErrors(OSError)
+
+        # The cached configuration is applied until the source answers
+        self.assertEqual(set(coordinator.servers), {'cp1045.eqiad.wmnet'})
+        self.assertEqual(coordinator.servers['cp1045.eqiad.wmnet'].weight, 10)
+
+        # and replaced by what it answers, which is cached in turn
+        coordinator.configCache.reactor = task.Clock()
+        with mock.patch.object(pybal.server.Server, 'initialize',
+                               return_value=defer.succeed(True)):
+            coordinator.onConfigUpdate({'cp1046.eqiad.wmnet': {'enabled': True, 'weight': 1}})
+            coordinator.onConfigDelta({'cp1047.eqiad.wmnet': {'enabled': False, 'weight': 1}}, [])
+        self.assertEqual(set(coordinator.servers), {'cp1046.eqiad.wmnet', 'cp1047.eqiad.wmnet'})
+        coordinator.configCache.reactor.advance(coordinator.configCache.saveDelay)
+        with open(path) as f:
+            self.assertEqual(json.load(f), {
+                'cp1046.eqiad.wmnet': {'enabled': True, 'weight': 1},
+                'cp1047.eqiad.wmnet': {'enabled': False, 'weight': 1}})
+
+        # The cache is off with config-cache = no
+        self.assertIsNone(self.coordinator.configCache)
+
     def testEnsureDepoolThreshold(self):
         servers = {
             'cp1045.eqiad.wmnet': {},
@@ -7,18 +7,23 @@
 
 """
 
+import base64
 import copy
 import json
 import mock
 import urlparse
 
-from twisted.internet import task
+from twisted.internet import defer, reactor, task
 from twisted.internet.error import ConnectionDone
+from twisted.python import failure
+from twisted.web import resource, server
+from twisted.web.error import Error
+from twisted.web.client import ResponseDone
 
 import pybal
 import pybal.config
 import pybal.etcd
-from .fixtures import PyBalTestCase
+from .fixtures import PyBalTestCase, RecordingCoordinator
 
 
 class EtcdConfigurationObserverTestCase(PyBalTestCase):
@@ -149,38 +154,87 @@ class EtcdConfigurationObserverTestCase(PyBalTestCase):
             }
         }
         self.observer.coordinator.onConfigUpdate = mock.MagicMock()
+        self.observer.coordinator.onConfigDelta = mock.MagicMock()
         self.observer.lastConfig = {}
-        # Add a node
+        # Add a node; the initial load passes the full configuration
         self.observer.onUpdate(create, 0)
         self.observer.coordinator.onConfigUpdate.assert_called_with({'1': {'enabled': True, u'weight': 10}})
-        # Add another one
+        # Add another one; watches pass only the changes
         self.observer.onUpdate(create_another, 11)
-        self.observer.coordinator.onConfigUpdate.assert_called_with(
+        self.observer.coordinator.onConfigDelta.assert_called_with(
+            {'2': {'enabled': True, u'weight': 10}}, []
+        )
+        self.assertEquals(self.observer.lastConfig,
             {'1': {'enabled': True, u'weight': 10},
              '2': {'enabled': True, u'weight': 10}}
         )
 
         # Depool a server
         self.observer.onUpdate(depool, 12)
-        self.observer.coordinator.onConfigUpdate.assert_called_with(
-            {'1': {'enabled': False, u'weight': 10},
-             '2': {'enabled': True, u'weight': 10}}
+        self.observer.coordinator.onConfigDelta.assert_called_with(
+            {'1': {'enabled': False, u'weight': 10}}, []
         )
 
         # Set it to inactive
         self.observer.onUpdate(inactive, 12)
-        self.observer.coordinator.onConfigUpdate.assert_called_with(
+        self.observer.coordinator.onConfigDelta.assert_called_with({}, ['1'])
+        self.assertEquals(self.observer.lastConfig,
             {'2': {'enabled': True, u'weight': 10}}
         )
 
         # repool it
         self.observer.onUpdate(create, 11)
+        self.observer.coordinator.onConfigDelta.assert_called_with(
+            {'1': {'enabled': True, u'weight': 10}}, []
+        )
+
+        # Unchanged servers are not passed on
+        self.observer.coordinator.onConfigDelta.reset_mock()
+        self.observer.onUpdate(create, 11)
+        self.observer.coordinator.onConfigDelta.assert_not_called()
 
         # Delete a server
         self.observer.onUpdate(delete, 13)
+        self.observer.coordinator.onConfigDelta.assert_called_with({}, ['1'])
+
+        # Reloads replace the whole configuration
+        self.observer.waitIndex = None
+        self.observer.onUpdate(create, 14)
         self.observer.coordinator.onConfigUpdate.assert_called_with(
-            {'2': {'enabled': True, u'weight': 10}}
+            {'1': {'enabled': True, u'weight': 10}}
         )
+        self.assertEquals(self.observer.coordinator.onConfigUpdate.call_count, 2)
+
+    def testOnUpdateEmpty(self):
+        """The first load is handed over even when it has no servers"""
+        self.observer.coordinator.onConfigUpdate = mock.MagicMock()
+        self.observer.onUpdate({'action': 'get',
+                                'node': {'key': '/config/text', 'dir': True,
+                                         'modifiedIndex': 10, 'createdIndex': 10}}, 10)
+        self.observer.coordinator.onConfigUpdate.assert_called_once_with({})
+        self.assertEquals(self.observer.lastConfig, {})
+
+    def testPersist(self):
+        """Changes are written with a PUT per host key"""
+        self.coordinator.serverConfig = {'mw1': {'enabled': True, 'weight': 10},
+                                         'mw2': {'enabled': True, 'weight': 10}}
+        response = mock.Mock(code=200)
+        response.content.side_effect = lambda: defer.succeed('{}')
+        self.observer.client = mock.Mock()
+        self.observer.client.put.side_effect = lambda *args, **kwargs: defer.succeed(response)
+        self.successResultOf(self.observer.persist({'mw1': {'enabled': False},
+                                                    'mw2': {'weight': 5}}))
+        self.assertEquals(
+            [(args[0], kwargs['data']) for args, kwargs in
+             self.observer.client.put.call_args_list],
+            [('https://example.com:2379/v2/keys/config/text/mw1',
+              {'value': '{"pooled": "no", "weight": 10}'}),
+             ('https://example.com:2379/v2/keys/config/text/mw2',
+              {'value': '{"pooled": "yes", "weight": 5}'})])
+
+        # Failed writes fail the whole change
+        response.code = 403
+        self.failureResultOf(self.observer.persist({'mw1': {'weight': 1}}), Error)
 
 
 class EtcdClientTestCase(PyBalTestCase):
@@ -242,3 +296,217 @@ class EtcdClientTestCase(PyBalTestCase):
         self.assertTrue(self.protocol.transport.loseConnection.called)
         self.protocol.factory.onFailure.reset_mock()
         self.protocol.transport.loseConnection.reset_mock()
+
+
+class EtcdStubResource(resource.Resource):
+    """Local stand-in for the etcd v3 JSON gateway, serving range and
+    watch requests from an in-memory history of changes."""
+
+    isLeaf = True
+
+    def __init__(self):
+        resource.Resource.__init__(self)
+        self.revision = 1
+        self.kvs = {}
+        self.history = []
+        self.watches = []
+        self.watchWaiters = []
+
+    def waitForWatch(self):
+        self.watchWaiters.append(defer.Deferred())
+        return self.watchWaiters[-1]
+
+    def put(self, key, value):
+        self.revision += 1
+        kv = {'key': base64.b64encode(key),
+              'value': base64.b64encode(json.dumps(value)),
+              'mod_revision': str(self.revision)}
+        self.kvs[key] = kv
+        self.addEvent({'kv': kv})
+
+    def delete(self, key):
+        self.revision += 1
+        del self.kvs[key]
+        self.addEvent({'type': 'DELETE',
+                       'kv': {'key': base64.b64encode(key),
+                              'mod_revision': str(self.revision)}})
+
+    def addEvent(self, event):
+        self.history.append((self.revision, event))
+        for request, createRequest in self.watches:
+            self.sendEvents(request, [event])
+
+    def sendEvents(self, request, events):
+        request.write(json.dumps({'result': {
+            'header': {'revision': str(self.revision)},
+            'events': events}}) + '\n')
+
+    def dropWatches(self):
+        for request, createRequest in self.watches:
+            request.transport.loseConnection()
+        self.watches = []
+
+    def render_POST(self, request):
+        body = json.loads(request.content.read())
+        request.setHeader('Content-Type', 'application/json')
+        if request.path == '/v3/kv/range':
+            prefix = base64.b64decode(body['key'])
+            return json.dumps({
+                'header': {'revision': str(self.revision)},
+                'kvs': [kv for key, kv in sorted(self.kvs.items())
+                        if key.startswith(prefix)]})
+        elif request.path == '/v3/watch':
+            createRequest = body['create_request']
+            request.write(json.dumps({'result': {
+                'header': {'revision': str(self.revision)},
+                'created': True}}) + '\n')
+            events = [event for revision, event in self.history
+                      if revision >= int(createRequest['start_revision'])]
+            if events:
+                self.sendEvents(request, events)
+            self.watches.append((request, createRequest))
+            request.notifyFinish().addErrback(lambda failure: None)
+            waiters, self.watchWaiters = self.watchWaiters, []
+            for waiter in waiters:
+                waiter.callback(createRequest)
+            return server.NOT_DONE_YET
+        elif request.path == '/v3/kv/txn':
+            for op in body['success']:
+                put = op['request_put']
+                self.put(base64.b64decode(put['key']),
+                         json.loads(base64.b64decode(put['value'])))
+            return json.dumps({'header': {'revision': str(self.revision)},
+                               'succeeded': True})
+        request.setResponseCode(404)
+        return ''
+
+
+class Etcd3ConfigurationObserverTestCase(PyBalTestCase):
+    """Test case for `pybal.etcd.Etcd3ConfigurationObserver`."""
+
+    def setUp(self):
+        super(Etcd3ConfigurationObserverTestCase, self).setUp()
+        self.etcd = EtcdStubResource()
+        self.etcd.put('/config/text/mw1', {'enabled': True, 'weight': 10})
+        self.etcd.put('/config/other/mw9', {'enabled': True, 'weight': 10})
+        self.port = reactor.listenTCP(0, server.Site(self.etcd), interface='127.0.0.1')
+        self.coordinator = RecordingCoordinator()
+        self.observer = pybal.config.ConfigurationObserver.fromUrl(
+            self.coordinator,
+            'etcd3://127.0.0.1:%d/config/text' % self.port.getHost().port)
+        self.observer.scheme = 'http'
+        self.observer.reconnectTimeout = 0
+
+    @defer.inlineCallbacks
+    def tearDown(self):
+        yield self.observer.stopObserving()
+        self.etcd.dropWatches()
+        yield self.port.stopListening()
+
+    def testParseConfigUrl(self):
+        self.assertIsInstance(self.observer, pybal.etcd.Etcd3ConfigurationObserver)
+        self.assertEquals(self.observer.host, '127.0.0.1')
+        self.assertEquals(self.observer.prefix, '/config/text/')
+        self.assertEquals(pybal.etcd.prefix_range('/a/'),
+                          {'key': base64.b64encode('/a/'),
+                           'range_end': base64.b64encode('/a0')})
+
+    @defer.inlineCallbacks
+    def testWatch(self):
+        self.observer.startObserving()
+        createRequest = yield self.etcd.waitForWatch()
+        self.assertEquals(self.coordinator.config,
+                          {'mw1': {'enabled': True, 'weight': 10}})
+        self.assertEquals(createRequest['start_revision'], 4)
+        self.assertTrue(createRequest['progress_notify'])
+
+        # Changes are streamed over the watch
+        updated = self.coordinator.waitForUpdate()
+        self.etcd.put('/config/text/mw2', {'pooled': 'yes', 'weight': 5})
+        config = yield updated
+        self.assertEquals(config, {'mw1': {'enabled': True, 'weight': 10},
+                                   'mw2': {'enabled': True, 'weight': 5}})
+        self.assertEquals(self.observer.revision, 4)
+
+        # After a disconnect, the watch resumes from the last revision
+        self.etcd.dropWatches()
+        self.etcd.delete('/config/text/mw1')
+        updated = self.coordinator.waitForUpdate()
+        createRequest = yield self.etcd.waitForWatch()
+        self.assertEquals(createRequest['start_revision'], 5)
+        config = yield updated
+        self.assertEquals(config, {'mw2': {'enabled': True, 'weight': 5}})
+        self.assertEquals(self.observer.revision, 5)
+
+    @defer.inlineCallbacks
+    def testEmptyPrefix(self):
+        """The first load replaces the servers from the config cache,
+        even when there are none"""
+        self.coordinator.config = {'mw1': {'enabled': True, 'weight': 10}}
+        self.etcd.delete('/config/text/mw1')
+        self.observer.startObserving()
+        yield self.etcd.waitForWatch()
+        self.assertEquals(self.coordinator.config, {})
+
+    @defer.inlineCallbacks
+    def testWatchIdle(self):
+        """Silent watch streams are stopped, and the watch resumed"""
+        self.observer.watchIdleTimeout = 0.1
+        self.observer.startObserving()
+        createRequest = yield self.etcd.waitForWatch()
+        createRequest = yield self.etcd.waitForWatch()
+        self.assertEquals(createRequest['start_revision'], 4)
+
+    def testWatchIdleTimer(self):
+        """Every response, including progress notifications, resets the
+        idle timer"""
+        observer = mock.Mock(reactor=task.Clock(), watchIdleTimeout=60)
+        watch = pybal.etcd.EtcdWatchProtocol(observer)
+        watch.makeConnection(mock.Mock())
+        observer.reactor.advance(59)
+        watch.lineReceived(json.dumps({'result': {'header': {'revision': '20'}}}))
+        observer.reactor.advance(59)
+        self.assertFalse(watch.stopped)
+        observer.reactor.advance(1)
+        self.assertTrue(watch.stopped)
+        watch.transport.stopProducing.assert_called_once_with()
+        watch.connectionLost(failure.Failure(ResponseDone()))
+        self.assertEqual(observer.reactor.getDelayedCalls(), [])
+
+    def testWatchCompacted(self):
+        self.observer.revision = 10
+        self.observer.watch = mock.Mock()
+        self.observer.onWatchResponse({'header': {'revision': '20'},
+                                       'canceled': True, 'compact_revision': '15'})
+        self.assertIsNone(self.observer.revision)
+        self.observer.watch.stop.assert_called_once_with()
+
+    def testProgressNotify(self):
+        self.observer.revision = 10
+        self.observer.onWatchResponse({'header': {'revision': '20'}, 'created': True})
+        self.assertEquals(self.observer.revision, 10)
+        self.observer.onWatchResponse({'header': {'revision': '20'}})
+        self.assertEquals(self.observer.revision, 20)
+
+    @defer.inlineCallbacks
+    def testPersist(self):
+        self.etcd.put('/config/text/mw2', {'enabled': True, 'weight': 10})
+        yield self.observer.loadConfig()
+        yield self.observer.persist({'mw1': {'enabled': False},
+                                     'mw2': {'weight': 5}})
+        self.assertEquals(pybal.etcd.decode_kv(self.etcd.kvs['/config/text/mw1']),
+                          ('mw1', {'enabled': False, 'weight': 10}))
+        self.assertEquals(pybal.etcd.decode_kv(self.etcd.kvs['/config/text/mw2']),
+                          ('mw2', {'enabled': True, 'weight': 5}))
+
+    @defer.inlineCallbacks
+    def testPersistUnknownHost(self):
+        """Hosts the coordinator doesn't know are rejected, and nothing
+        is written"""
+        yield self.observer.loadConfig()
+        yield self.assertFailure(
+            self.observer.persist({'mw1': {'enabled': False}, 'mw3': {'weight': 5}}),
+            ValueError)
+        self.assertNotIn('/config/text/mw3', self.etcd.kvs)
+        self.assertEquals(pybal.etcd.decode_kv(self.etcd.kvs['/config/text/mw1']),
+                          ('mw1', {'enabled': True, 'weight': 10}))
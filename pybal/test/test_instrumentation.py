@@ -9,6 +9,7 @@
 
 import mock
 import json
+from twisted.internet import defer
 from twisted.python.failure import Failure
 from twisted.web.http import Request
 from twisted.web.server import Site
@@ -230,3 +231,150 @@ class SiteTest(WebBaseTestCase):
 
     def tearDown(self):
         self.proto.connectionLost(Failure(TypeError("whatever")))
+
+
+class AdminTest(WebBaseTestCase):
+    """Test case for the admin requests of `pybal.instrumentation`"""
+
+    def setUp(self):
+        super(AdminTest, self).setUp()
+        self.site = Site(ServerRoot())
+        self.patch(PoolsRoot, 'adminToken', 'sekrit')
+        for coord in self.coordinators:
+            coord.serverConfig = {host: {'enabled': True, 'weight': 10}
+                                  for host in coord.servers}
+        PoolsRoot.addPool('test_pool1', self.coordinators[1])
+        self.addCleanup(PoolsRoot._pools.pop, 'test_pool1')
+
+    def _connect(self):
+        self.proto = self.site.buildProtocol(('127.0.0.1', 0))
+        tr = proto_helpers.StringTransport()
+        self.proto.makeConnection(tr)
+        return tr
+
+    def _httpPost(self, uri, body, token='sekrit'):
+        data = json.dumps(body)
+        req = ("POST {} HTTP/1.0\r\nHost: localhost\r\n"
+               "Accept: application/json\r\n".format(uri))
+        if token is not None:
+            req += "Authorization: Bearer {}\r\n".format(token)
+        req += "Content-Length: {}\r\n\r\n".format(len(data))
+        tr = self._connect()
+        self.proto.dataReceived(req + data)
+        hdrs, body = tr.value().split("\r\n\r\n", 1)
+        return (hdrs, json.loads(body))
+
+    def test_host(self):
+        """Test case for changing a single host"""
+        hdr, body = self._httpPost('/pools/test_pool0/mw1001',
+                                   {'enabled': False})
+        self.assertTrue(hdr.startswith('HTTP/1.0 200 OK'))
+        self.assertEquals(body, {'test_pool0': {'changed': ['mw1001'],
+                                                'persisted': True}})
+        crd = self.coordinators[0]
+        crd.onConfigDelta.assert_called_once_with(
+            {'mw1001': {'enabled': False, 'weight': 10}}, [])
+        crd.configObserver.persist.assert_called_once_with(
+            {'mw1001': {'enabled': False}})
+
+    def test_pool(self):
+        """Test case for changing several hosts of a pool in one batch"""
+        _, body = self._httpPost('/pools/test_pool0', {
+            'mw1001': {'weight': 0}, 'mw1002': {'enabled': False, 'weight': 5}})
+        self.assertEquals(body['test_pool0']['changed'], ['mw1001', 'mw1002'])
+        self.coordinators[0].onConfigDelta.assert_called_once_with(
+            {'mw1001': {'enabled': True, 'weight': 0},
+             'mw1002': {'enabled': False, 'weight': 5}}, [])
+
+    def test_pattern(self):
+        """Test case for changing the hosts matching a pattern in all pools"""
+        _, body = self._httpPost('/pools', {'pattern': 'mw100[12]', 'enabled': False})
+        self.assertEquals(sorted(body), ['test_pool0', 'test_pool1'])
+        for crd in self.coordinators[:2]:
+            crd.onConfigDelta.assert_called_once_with(
+                {'mw1001': {'enabled': False, 'weight': 10},
+                 'mw1002': {'enabled': False, 'weight': 10}}, [])
+        self.coordinators[1].onConfigDelta.reset_mock()
+
+        # Limited to some pools
+        _, body = self._httpPost('/pools', {'pattern': 'mw1*', 'weight': 1,
+                                            'pools': ['test_pool0']})
+        self.assertEquals(len(body['test_pool0']['changed']), 10)
+        self.coordinators[1].onConfigDelta.assert_not_called()
+
+    def test_not_writable(self):
+        """Test case for pools whose configuration source can't be written"""
+        self.coordinators[1].configObserver.writable = False
+        hdr, body = self._httpPost('/pools', {'pattern': 'mw1001', 'weight': 1})
+        self.assertTrue(hdr.startswith('HTTP/1.0 409'))
+        self.assertEquals(body, {'error': "The configuration of test_pool1 can't be written"})
+        # No pool is changed
+        for crd in self.coordinators[:2]:
+            crd.configObserver.persist.assert_not_called()
+            crd.onConfigDelta.assert_not_called()
+
+    def test_not_persisted(self):
+        """Test case for changes the configuration source failed to store"""
+        crd = self.coordinators[0]
+        crd.configObserver.persist.side_effect = IOError("Connection refused")
+        hdr, body = self._httpPost('/pools/test_pool0/mw1001', {'weight': 1})
+        self.assertTrue(hdr.startswith('HTTP/1.0 502'))
+        self.assertEquals(body, {'test_pool0': {
+            'changed': [], 'persisted': False, 'error': "Connection refused"}})
+        crd.onConfigDelta.assert_not_called()
+
+    def test_asynchronous_persist(self):
+        """Test case for the response waiting for the changes to persist"""
+        persisted = defer.Deferred()
+        crd = self.coordinators[0]
+        crd.configObserver.persist.return_value = persisted
+        tr = self._connect()
+        self.proto.dataReceived(
+            "POST /pools/test_pool0/mw1001 HTTP/1.1\r\nHost: localhost\r\n"
+            "Authorization: Bearer sekrit\r\nContent-Length: 17\r\n\r\n"
+            '{"enabled": true}')
+        self.assertEquals(tr.value(), '')
+        # Changes are applied once written
+        crd.onConfigDelta.assert_not_called()
+        persisted.callback(None)
+        crd.onConfigDelta.assert_called_once_with(
+            {'mw1001': {'enabled': True, 'weight': 10}}, [])
+        self.assertTrue(tr.value().startswith('HTTP/1.1 200 OK'))
+        self.proto.connectionLost(Failure(TypeError("whatever")))
+
+    def test_unauthorized(self):
+        """Test case for requests without a valid token"""
+        hdr, _ = self._httpPost('/pools/test_pool0/mw1001', {'enabled': False},
+                                token='wrong')
+        self.assertTrue(hdr.startswith('HTTP/1.0 401'))
+        hdr, _ = self._httpPost('/pools/test_pool0/mw1001', {'enabled': False},
+                                token=None)
+        self.assertTrue(hdr.startswith('HTTP/1.0 401'))
+        self.coordinators[0].onConfigDelta.assert_not_called()
+
+    def test_disabled(self):
+        """Test case for the admin API without a configured token"""
+        self.patch(PoolsRoot, 'adminToken', None)
+        hdr, _ = self._httpPost('/pools/test_pool0/mw1001', {'enabled': False},
+                                token='None')
+        self.assertTrue(hdr.startswith('HTTP/1.0 403'))
+        self.coordinators[0].onConfigDelta.assert_not_called()
+
+    def test_invalid(self):
+        """Test case for invalid changes"""
+        for uri, body, code in (
+                ('/pools/test_pool0/mw1001', {'enabled': 'no'}, '400'),
+                ('/pools/test_pool0/mw1001', {'weight': -1}, '400'),
+                ('/pools/test_pool0/mw1001', {'weight': 1.5}, '400'),
+                ('/pools/test_pool0/mw1001', {}, '400'),
+                ('/pools/test_pool0/mw1001', [], '400'),
+                ('/pools/test_pool0', {'mw1001': {'weight': 1},
+                                       'mw2001': {'weight': 1}}, '404'),
+                ('/pools', {'weight': 1}, '400'),
+                ('/pools', {'pattern': 'mw2*', 'weight': 1}, '404'),
+                ('/pools', {'pattern': '*', 'weight': 1, 'pools': ['other']}, '404'),
+                ('/pools/test_pool0/mw2001', {'weight': 1}, '404')):
+            hdr, _ = self._httpPost(uri, body)
+            self.assertTrue(hdr.startswith('HTTP/1.0 ' + code), (uri, body, hdr))
+        for crd in self.coordinators:
+            crd.onConfigDelta.assert_not_called()
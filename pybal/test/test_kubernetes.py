@@ -15,24 +15,24 @@ from mock import patch
 from treq.client import HTTPClient
 from treq.testing import (HasHeaders, RequestSequence, StringStubbingResource,
                           StubTreq)
-from twisted.internet import task
+from twisted.internet import defer, reactor, task
 from twisted.internet.endpoints import TCP4ClientEndpoint
 from twisted.internet.error import ConnectingCancelledError
 from twisted.logger import Logger
 from twisted.test.proto_helpers import MemoryReactorClock
-from twisted.trial.unittest import SynchronousTestCase
+from twisted.trial.unittest import SynchronousTestCase, TestCase
 from twisted.web import http
 from twisted.web.client import Agent
 from twisted.web.error import SchemeNotSupported
 from twisted.web.iweb import IAgentEndpointFactory
 from twisted.web.resource import Resource
-from twisted.web.server import NOT_DONE_YET
+from twisted.web.server import NOT_DONE_YET, Site
 from zope.interface import implementer
 
 import pybal
 import pybal.kubernetes
-from pybal.kubernetes import UNSCHEDULABLE_SPEC
-from pybal.test.fixtures import StubCoordinator
+from pybal.kubernetes import SERVICE_NAME_LABEL, UNSCHEDULABLE_SPEC
+from pybal.test.fixtures import RecordingCoordinator, StubCoordinator
 
 log = Logger()
 
@@ -142,6 +142,12 @@ class KubernetesConfigurationObserverTestCase(SynchronousTestCase):
         url = "k8s://token@k8s.wmnet.test:1234"
         self.observer = pybal.config.ConfigurationObserver.fromUrl(StubCoordinator(),
                                                                    url)
+        # Decode node lists synchronously
+        patcher = patch.object(pybal.kubernetes.threads, 'deferToThreadPool',
+                               side_effect=lambda reactor, threadpool, f, *args:
+                               defer.maybeDeferred(f, *args))
+        patcher.start()
+        self.addCleanup(patcher.stop)
 
     def testFromURL(self):
         self.assertIsInstance(self.observer,
@@ -151,16 +157,31 @@ class KubernetesConfigurationObserverTestCase(SynchronousTestCase):
         self.assertEquals(self.observer.token, 'token')
         self.assertEquals(self.observer.host, 'k8s.wmnet.test')
         self.assertEquals(self.observer.port, 1234)
+        self.assertEquals(self.observer.selectors, {})
+
+    def testSelectors(self):
+        observer = pybal.config.ConfigurationObserver.fromUrl(
+            StubCoordinator(),
+            'k8s://token@k8s.wmnet.test:1234/?labelSelector=node-role%3Dlvs'
+            '&fieldSelector=spec.unschedulable%3Dfalse&pretty=true')
+        self.assertEquals(observer.getParams(), {
+            'labelSelector': 'node-role=lvs',
+            'fieldSelector': 'spec.unschedulable=false',
+            'pretty': 'false'})
+
+    def _request(self, response, statusCode=http.OK, params=None):
+        params = params or {}
+        params.setdefault(b'pretty', [b'false'])
+        params.setdefault(b'limit', [b'250'])
+        return ((b'get', 'https://k8s.wmnet.test:1234/v1/nodes', params,
+                 HasHeaders({
+                     'Accept': ['application/json'],
+                     'Authorization': ['Bearer token'],
+                 }), b''),
+                (statusCode, {b'Content-Type': b'application/json'}, response))
 
     def _requestSequenceGenerator(self, response, statusCode=http.OK):
-        return RequestSequence([
-            ((b'get', 'https://k8s.wmnet.test:1234/v1/nodes', {b'pretty': [b'false']},
-              HasHeaders({
-                  'Accept': ['application/json'],
-                  'Authorization': ['Bearer token'],
-              }), b''),
-             (statusCode, {b'Content-Type': b'application/json'}, response))
-        ], log.error)
+        return RequestSequence([self._request(response, statusCode)], log.error)
 
     def _successfulRequestHelper(self, response, expectedConfig):
         req_seq = self._requestSequenceGenerator(response)
@@ -208,6 +229,62 @@ class KubernetesConfigurationObserverTestCase(SynchronousTestCase):
 
         self._successfulRequestHelper(json.dumps(response), expectedConfig)
 
+    def testUnschedulableNodeBoolean(self):
+        """The API server sends spec.unschedulable as a JSON boolean"""
+        response = copy.deepcopy(MOCKED_RESPONSE)
+        response['items'][0]['spec'][UNSCHEDULABLE_SPEC] = True
+        response['items'][1]['spec'][UNSCHEDULABLE_SPEC] = False
+
+        expectedConfig = {
+            'kubernetes1002.eqiad.wmnet': {'enabled': True, 'weight': 1},
+            'kubernetes1003.eqiad.wmnet': {'enabled': True, 'weight': 1},
+            'kubernetes1004.eqiad.wmnet': {'enabled': True, 'weight': 1},
+        }
+
+        self._successfulRequestHelper(json.dumps(response), expectedConfig)
+
+    def testPagination(self):
+        page1 = {'metadata': {'continue': 'page2'},
+                 'items': MOCKED_RESPONSE['items'][:3]}
+        page2 = {'metadata': {'resourceVersion': '42'},
+                 'items': MOCKED_RESPONSE['items'][3:]}
+        req_seq = RequestSequence([
+            self._request(json.dumps(page1)),
+            self._request(json.dumps(page2), params={b'continue': [b'page2']}),
+        ], log.error)
+
+        treq_stub = StubTreq(StringStubbingResource(req_seq))
+        with patch.object(self.observer, 'client', treq_stub):
+            with req_seq.consume(self.fail):
+                self.successResultOf(self.observer.list())
+        self.assertEquals(sorted(self.observer.coordinator.config), [
+            'kubernetes1001.eqiad.wmnet', 'kubernetes1002.eqiad.wmnet',
+            'kubernetes1003.eqiad.wmnet', 'kubernetes1004.eqiad.wmnet'])
+        self.assertEquals(self.observer.resourceVersion, '42')
+
+    def testPaginationExpired(self):
+        page1 = {'metadata': {'continue': 'page2'},
+                 'items': MOCKED_RESPONSE['items'][:1]}
+        expired = {'kind': 'Status', 'code': 410, 'reason': 'Expired'}
+        full = {'metadata': {'resourceVersion': '43'},
+                'items': MOCKED_RESPONSE['items'][1:]}
+        req_seq = RequestSequence([
+            self._request(json.dumps(page1)),
+            self._request(json.dumps(expired), statusCode=http.GONE,
+                          params={b'continue': [b'page2']}),
+            self._request(json.dumps(full)),
+        ], log.error)
+
+        treq_stub = StubTreq(StringStubbingResource(req_seq))
+        with patch.object(self.observer, 'client', treq_stub):
+            with req_seq.consume(self.fail):
+                self.successResultOf(self.observer.list())
+        # Nodes of pages of the expired list are not kept
+        self.assertEquals(sorted(self.observer.coordinator.config), [
+            'kubernetes1002.eqiad.wmnet', 'kubernetes1003.eqiad.wmnet',
+            'kubernetes1004.eqiad.wmnet'])
+        self.assertEquals(self.observer.resourceVersion, '43')
+
     def testInvalidPayload(self):
         req_seqs = [
             self._requestSequenceGenerator(b'{[`'),
@@ -292,3 +369,288 @@ class KubernetesConfigurationObserverTestCase(SynchronousTestCase):
                     self.observer.reactor.advance(self.observer.timeout)
                     self.assertFalse(self.observer.loop.running)
                     mockStartObserving.assert_called_once_with(now=False)
+
+    def testWatchBackoff(self):
+        """Watches that fail or end early are retried with backoff"""
+        clock = task.Clock()
+        watches = []
+
+        def watch():
+            watches.append(defer.Deferred())
+            return watches[-1]
+
+        with patch.object(self.observer, 'reactor', clock), \
+                patch.object(self.observer, 'watch', side_effect=watch), \
+                patch.object(self.observer, 'list', return_value=defer.succeed(None)):
+            self.observer.watching = True
+            d = self.observer.observe()
+            self.assertEqual(len(watches), 1)
+
+            # A short watch waits reconnectTimeout
+            watches[-1].callback(None)
+            clock.advance(self.observer.reconnectTimeout - 0.1)
+            self.assertEqual(len(watches), 1)
+            clock.advance(0.1)
+            self.assertEqual(len(watches), 2)
+
+            # Consecutive failures double it
+            watches[-1].errback(Exception("Unexpected status code: 500"))
+            clock.advance(self.observer.reconnectTimeout * 2 - 0.1)
+            self.assertEqual(len(watches), 2)
+            clock.advance(0.1)
+            self.assertEqual(len(watches), 3)
+
+            # Watches that last resume right away
+            clock.advance(self.observer.minWatchSeconds)
+            watches[-1].callback(None)
+            self.assertEqual(len(watches), 4)
+
+            # Stopping cancels the backoff
+            watches[-1].callback(None)
+            self.observer.stopObserving()
+            self.assertIsNone(self.successResultOf(d))
+            self.assertIsNone(self.observer.backoffCall)
+            self.assertEqual(clock.getDelayedCalls(), [])
+
+
+def _node(name, ready=True, resourceVersion='1', unschedulable=False):
+    return {
+        'metadata': {'name': name, 'resourceVersion': resourceVersion},
+        'spec': {UNSCHEDULABLE_SPEC: True} if unschedulable else {},
+        'status': {'conditions': [
+            {'type': 'Ready', 'status': ready and 'True' or 'False'}]}
+    }
+
+
+class _StubAPIServerResource(Resource):
+    """Local stand-in for the Kubernetes API server, serving node lists
+    and watches."""
+
+    isLeaf = True
+
+    def __init__(self):
+        Resource.__init__(self)
+        self.resourceVersion = 10
+        self.nodes = {}
+        self.watches = []
+        self.watchWaiters = []
+        self.lists = 0
+
+    def waitForWatch(self):
+        self.watchWaiters.append(defer.Deferred())
+        return self.watchWaiters[-1]
+
+    def sendEvent(self, eventType, item):
+        for request in self.watches:
+            request.write(json.dumps({'type': eventType, 'object': item}) + '\n')
+
+    def setNode(self, name, **kwargs):
+        self.resourceVersion += 1
+        eventType = name in self.nodes and 'MODIFIED' or 'ADDED'
+        self.nodes[name] = _node(name, resourceVersion=str(self.resourceVersion), **kwargs)
+        self.sendEvent(eventType, self.nodes[name])
+
+    def deleteNode(self, name):
+        self.resourceVersion += 1
+        node = self.nodes.pop(name)
+        node['metadata']['resourceVersion'] = str(self.resourceVersion)
+        self.sendEvent('DELETED', node)
+
+    def expireWatches(self):
+        self.sendEvent('ERROR', {'kind': 'Status', 'code': 410,
+                                 'message': 'too old resource version'})
+
+    def render_GET(self, request):
+        request.setHeader('Content-Type', 'application/json')
+        if request.args.get('watch') != ['true']:
+            self.lists += 1
+            return json.dumps({
+                'metadata': {'resourceVersion': str(self.resourceVersion)},
+                'items': [node for name, node in sorted(self.nodes.items())]})
+
+        self.watches.append(request)
+        request.write('')
+        request.notifyFinish().addBoth(lambda result: self.watches.remove(request))
+        waiters, self.watchWaiters = self.watchWaiters, []
+        for waiter in waiters:
+            waiter.callback(request.args)
+        return NOT_DONE_YET
+
+
+class KubernetesWatchTestCase(TestCase):
+    """Tests `pybal.kubernetes.KubernetesConfigurationObserver` watches
+    against a local stub API server."""
+
+    def setUp(self):
+        self.apiServer = _StubAPIServerResource()
+        self.apiServer.setNode('kubernetes1001.eqiad.wmnet')
+        self.apiServer.setNode('kubernetes1002.eqiad.wmnet', ready=False)
+        self.port = reactor.listenTCP(0, Site(self.apiServer), interface='127.0.0.1')
+        self.coordinator = RecordingCoordinator()
+        self.observer = pybal.config.ConfigurationObserver.fromUrl(
+            self.coordinator, 'k8s://token@127.0.0.1:%d' % self.port.getHost().port)
+        self.observer.scheme = 'http'
+        self.observer.reconnectTimeout = 0
+
+    @defer.inlineCallbacks
+    def tearDown(self):
+        self.observer.stopObserving()
+        for request in self.apiServer.watches:
+            request.finish()
+        yield self.observer.client._agent._pool.closeCachedConnections()
+        yield self.port.stopListening()
+
+    @defer.inlineCallbacks
+    def testWatch(self):
+        self.observer.startObserving()
+        args = yield self.apiServer.waitForWatch()
+        self.assertEquals(args['resourceVersion'], ['12'])
+        self.assertEquals(args['allowWatchBookmarks'], ['true'])
+        self.assertEquals(self.coordinator.config, {
+            'kubernetes1001.eqiad.wmnet': {'enabled': True, 'weight': 1},
+            'kubernetes1002.eqiad.wmnet': {'enabled': False, 'weight': 1}})
+
+        # Events are applied as deltas
+        updated = self.coordinator.waitForUpdate()
+        self.apiServer.setNode('kubernetes1002.eqiad.wmnet')
+        yield updated
+        self.assertEquals(self.coordinator.delta,
+                          ({'kubernetes1002.eqiad.wmnet': {'enabled': True, 'weight': 1}}, []))
+
+        updated = self.coordinator.waitForUpdate()
+        self.apiServer.setNode('kubernetes1001.eqiad.wmnet', unschedulable=True)
+        yield updated
+        self.assertEquals(self.coordinator.delta, ({}, ['kubernetes1001.eqiad.wmnet']))
+
+        updated = self.coordinator.waitForUpdate()
+        self.apiServer.deleteNode('kubernetes1002.eqiad.wmnet')
+        yield updated
+        self.assertEquals(self.coordinator.config, {})
+        self.assertEquals(self.observer.resourceVersion, '15')
+        self.assertEquals(self.apiServer.lists, 1)
+
+        # Watches that end are resumed from the last resourceVersion
+        for request in self.apiServer.watches:
+            request.finish()
+        args = yield self.apiServer.waitForWatch()
+        self.assertEquals(args['resourceVersion'], ['15'])
+        self.assertEquals(self.apiServer.lists, 1)
+
+    @defer.inlineCallbacks
+    def testWatchExpired(self):
+        self.observer.startObserving()
+        yield self.apiServer.waitForWatch()
+
+        # After 410 Gone, the nodes are listed again
+        self.apiServer.setNode('kubernetes1003.eqiad.wmnet')
+        self.apiServer.expireWatches()
+        args = yield self.apiServer.waitForWatch()
+        self.assertEquals(self.apiServer.lists, 2)
+        self.assertEquals(args['resourceVersion'], ['13'])
+        self.assertIn('kubernetes1003.eqiad.wmnet', self.coordinator.config)
+
+
+def _endpointSlice(name, endpoints, addressType='IPv4', resourceVersion='1'):
+    return {
+        'metadata': {'name': name, 'resourceVersion': resourceVersion,
+                     'labels': {SERVICE_NAME_LABEL: 'appserver'}},
+        'addressType': addressType,
+        'endpoints': endpoints,
+        'ports': [{'port': 80, 'protocol': 'TCP'}]
+    }
+
+
+class KubernetesEndpointSliceObserverTestCase(SynchronousTestCase):
+    """Test case for `pybal.kubernetes.KubernetesEndpointSliceObserver`."""
+
+    def setUp(self):
+        self.coordinator = StubCoordinator()
+        self.observer = pybal.config.ConfigurationObserver.fromUrl(
+            self.coordinator,
+            'k8s-endpointslices://token@k8s.wmnet.test:1234/web/appserver?zone=eqiad-a')
+        patcher = patch.object(pybal.kubernetes.threads, 'deferToThreadPool',
+                               side_effect=lambda reactor, threadpool, f, *args:
+                               defer.maybeDeferred(f, *args))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def testFromURL(self):
+        self.assertIsInstance(self.observer,
+                              pybal.kubernetes.KubernetesEndpointSliceObserver)
+        self.assertEquals((self.observer.namespace, self.observer.service),
+                          ('web', 'appserver'))
+        self.assertEquals(self.observer.zone, 'eqiad-a')
+        self.assertEquals(
+            self.observer.getResourceURL(),
+            'https://k8s.wmnet.test:1234/apis/discovery.k8s.io/v1/namespaces/web/endpointslices')
+        self.assertEquals(self.observer.getParams()['labelSelector'],
+                          'kubernetes.io/service-name=appserver')
+
+        self.assertRaises(ValueError, pybal.config.ConfigurationObserver.fromUrl,
+                          self.coordinator, 'k8s-endpointslices://token@k8s.wmnet.test:1234/web')
+
+    def testParseItem(self):
+        item = _endpointSlice('appserver-1', [
+            {'addresses': ['10.0.0.1'], 'conditions': {'ready': True},
+             'zone': 'eqiad-a'},
+            {'addresses': ['10.0.0.2'], 'conditions': {'ready': False},
+             'zone': 'eqiad-b'},
+            {'addresses': ['10.0.0.3'], 'conditions': {},
+             'zone': 'eqiad-a', 'hints': {'forZones': [{'name': 'eqiad-b'}]}},
+            {'addresses': ['10.0.0.4'],
+             'zone': 'eqiad-b', 'hints': {'forZones': [{'name': 'eqiad-a'}]}},
+        ])
+        self.assertEquals(self.observer.parseItem(item), {
+            '10.0.0.1': {'enabled': True, 'weight': 10},
+            '10.0.0.2': {'enabled': False, 'weight': 1},
+            '10.0.0.3': {'enabled': True, 'weight': 1},
+            '10.0.0.4': {'enabled': True, 'weight': 10},
+        })
+
+        # Slices of other address families are ignored
+        item['addressType'] = 'IPv6'
+        self.assertEquals(self.observer.parseItem(item), {})
+
+    def testListAndWatch(self):
+        payload = {'metadata': {'resourceVersion': '5'}, 'items': [
+            _endpointSlice('appserver-1', [
+                {'addresses': ['10.0.0.1'], 'conditions': {'ready': True}},
+                {'addresses': ['10.0.0.2'], 'conditions': {'ready': True}}]),
+            _endpointSlice('appserver-2', [
+                {'addresses': ['10.0.0.3'], 'conditions': {'ready': False}}]),
+        ]}
+        req_seq = RequestSequence([
+            ((b'get', self.observer.getResourceURL(),
+              {b'pretty': [b'false'], b'limit': [b'250'],
+               b'labelSelector': [b'kubernetes.io/service-name=appserver']},
+              HasHeaders({'Authorization': ['Bearer token']}), b''),
+             (http.OK, {b'Content-Type': b'application/json'}, json.dumps(payload)))
+        ], log.error)
+        treq_stub = StubTreq(StringStubbingResource(req_seq))
+        with patch.object(self.observer, 'client', treq_stub):
+            with req_seq.consume(self.fail):
+                self.successResultOf(self.observer.list())
+        self.assertEquals(self.coordinator.config, {
+            '10.0.0.1': {'enabled': True, 'weight': 1},
+            '10.0.0.2': {'enabled': True, 'weight': 1},
+            '10.0.0.3': {'enabled': False, 'weight': 1}})
+
+        # Only the servers of the changed slice are updated
+        self.observer.onWatchEvent({'type': 'MODIFIED', 'object': _endpointSlice(
+            'appserver-1', [{'addresses': ['10.0.0.1'], 'conditions': {'ready': False}}],
+            resourceVersion='6')})
+        self.assertEquals(self.coordinator.delta, (
+            {'10.0.0.1': {'enabled': False, 'weight': 1}}, ['10.0.0.2']))
+        self.assertEquals(self.observer.resourceVersion, '6')
+
+        # Endpoints moving between slices stay
+        self.observer.onWatchEvent({'type': 'ADDED', 'object': _endpointSlice(
+            'appserver-3', [{'addresses': ['10.0.0.3'], 'conditions': {'ready': True}}],
+            resourceVersion='7')})
+        self.observer.onWatchEvent({'type': 'DELETED', 'object': _endpointSlice(
+            'appserver-2', [], resourceVersion='8')})
+        self.assertEquals(self.coordinator.delta, (
+            {'10.0.0.3': {'enabled': True, 'weight': 1}}, []))
+        self.assertEquals(self.observer.lastConfig, {
+            '10.0.0.1': {'enabled': False, 'weight': 1},
+            '10.0.0.3': {'enabled': True, 'weight': 1}})
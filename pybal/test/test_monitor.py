@@ -247,6 +247,25 @@ class MonitoringProtocolTestCase(PyBalTestCase):
         self.monitor._resultDown()
         self.assertIsNone(self.coordinator.up)
 
+    def testGetAdaptiveTimeout(self):
+        """Test `MonitoringProtocol._getAdaptiveTimeout`."""
+        self.assertIsNone(self.monitor._getAdaptiveTimeout(5))
+        self.assertEquals(self.monitor._currentTimeout(5), 5)
+
+        self.config['testmonitor.timeout-adaptive'] = 'true'
+        self.config['testmonitor.timeout-min'] = '0.5'
+        adaptiveTimeout = self.monitor._getAdaptiveTimeout(5)
+        self.assertIsInstance(adaptiveTimeout, pybal.monitor.AdaptiveTimeout)
+        self.assertEquals(adaptiveTimeout.minimum, 0.5)
+        self.assertEquals(adaptiveTimeout.maximum, 5)
+
+        self.monitor.adaptiveTimeout = adaptiveTimeout
+        self.assertEquals(self.monitor._currentTimeout(5), 5)
+        self.monitor._sampleTimeout(0.1)
+        self.assertEquals(self.monitor._currentTimeout(5), 0.5)
+        self.monitor._backoffTimeout()
+        self.assertEquals(self.monitor._currentTimeout(5), 1)
+
     def testGetConfigString(self):
         """Test `MonitoringProtocol._getConfigString`."""
         self.config['testmonitor.strValue'] = 'abc'
@@ -287,3 +306,170 @@ class MonitoringProtocolTestCase(PyBalTestCase):
         self.config['testmonitor.emptyStrListValue'] = '[]'
         with self.assertRaises(ValueError):
             self.monitor._getConfigStringList('emptyStrListValue')
+
+    def testGetConfigBuckets(self):
+        """Test `MonitoringProtocol._getConfigBuckets`."""
+        self.assertEquals(self.monitor._getConfigBuckets('buckets'),
+                          self.monitor.HISTOGRAM_BUCKETS)
+
+        self.config['testmonitor.buckets'] = '[0.1, 1, 10]'
+        self.assertEquals(self.monitor._getConfigBuckets('buckets'), (0.1, 1, 10))
+
+        for value in ('[]', '[1, 0.1]', '[1, 1]', '["abc"]', '1'):
+            self.config['testmonitor.buckets'] = value
+            with self.assertRaises(ValueError):
+                self.monitor._getConfigBuckets('buckets')
+
+    def testGetHistogram(self):
+        """Test `MonitoringProtocol._getHistogram`."""
+        self.config['testmonitor.histogram-buckets'] = '[0.1, 1]'
+        with mock.patch('pybal.monitor.Histogram') as mock_histogram, \
+                mock.patch.object(self.monitor, 'histograms', {}):
+            histogram = self.monitor._getHistogram('test_seconds', 'Test',
+                                                   labelnames=('result',))
+            mock_histogram.assert_called_once_with(
+                'test_seconds', 'Test',
+                labelnames=('service', 'host', 'monitor', 'result'),
+                namespace='pybal',
+                subsystem='monitor_testmonitor',
+                buckets=(0.1, 1))
+            # Histograms are created once, for all monitors of a type
+            self.assertIs(self.monitor._getHistogram('test_seconds', 'Test'),
+                          histogram)
+            mock_histogram.assert_called_once()
+
+
+class AdaptiveTimeoutTestCase(unittest.TestCase):
+    """Test case for `pybal.monitor.AdaptiveTimeout`."""
+
+    def setUp(self):
+        self.timeout = pybal.monitor.AdaptiveTimeout(0.5, 10)
+
+    def testInit(self):
+        self.assertEquals(self.timeout.timeout, 10)
+        self.assertIsNone(self.timeout.srtt)
+        with self.assertRaises(ValueError):
+            pybal.monitor.AdaptiveTimeout(5, 1)
+        with self.assertRaises(ValueError):
+            pybal.monitor.AdaptiveTimeout(0, 1)
+
+    def testSample(self):
+        # First sample: srtt = 1, rttvar = 0.5
+        self.assertEquals(self.timeout.sample(1.0), 3.0)
+        # rttvar = 0.75 * 0.5 + 0.25 * 1 = 0.625, srtt = 0.875 + 0.25 = 1.125
+        self.assertAlmostEqual(self.timeout.sample(2.0), 1.125 + 4 * 0.625)
+        # Stable durations converge towards the minimum
+        for i in range(100):
+            self.timeout.sample(0.01)
+        self.assertEquals(self.timeout.timeout, 0.5)
+        # Very slow checks are capped at the maximum
+        for i in range(5):
+            self.timeout.sample(60)
+        self.assertEquals(self.timeout.timeout, 10)
+
+    def testBackoff(self):
+        self.timeout.sample(0.25)
+        self.assertEquals(self.timeout.timeout, 0.75)
+        self.assertEquals(self.timeout.backoff(), 1.5)
+        for i in range(10):
+            self.timeout.backoff()
+        self.assertEquals(self.timeout.timeout, 10)
+
+
+class AdaptiveIntervalMonitoringProtocol(pybal.monitor.LoopingCheckMonitoringProtocol):
+    __name__ = 'TestMonitor'
+
+    def check(self):
+        pass
+
+
+class LoopingCheckMonitoringProtocolTestCase(PyBalTestCase):
+    """
+    Test case for `pybal.monitor.LoopingCheckMonitoringProtocol`.
+    """
+
+    def setUp(self):
+        super(LoopingCheckMonitoringProtocolTestCase, self).setUp()
+        self.config['testmonitor.interval-min'] = '1'
+        self.config['testmonitor.interval-max'] = '8'
+        self.config['testmonitor.interval-stable-checks'] = '2'
+        self.monitor = AdaptiveIntervalMonitoringProtocol(
+            self.coordinator,
+            self.server,
+            self.config,
+            reactor=self.reactor)
+
+    def tearDown(self):
+        self.monitor.stop()
+
+    def testInit(self):
+        self.assertTrue(self.monitor.adaptiveInterval)
+        self.assertEquals(self.monitor.intvCheckMin, 1)
+        self.assertEquals(self.monitor.intvCheckMax, 8)
+        self.assertEquals(self.monitor.intvStableChecks, 2)
+
+        monitor = AdaptiveIntervalMonitoringProtocol(
+            self.coordinator, self.server, pybal.util.ConfigDict())
+        self.assertFalse(monitor.adaptiveInterval)
+        self.assertEquals(monitor.intvCheckMin, monitor.INTV_CHECK)
+        self.assertEquals(monitor.intvCheckMax, monitor.INTV_CHECK)
+
+        self.config['testmonitor.interval-min'] = '10'
+        with self.assertRaises(ValueError):
+            AdaptiveIntervalMonitoringProtocol(
+                self.coordinator, self.server, self.config)
+
+        # Without interval-max, interval-min may exceed the check interval
+        del self.config['testmonitor.interval-max']
+        monitor = AdaptiveIntervalMonitoringProtocol(
+            self.coordinator, self.server, self.config)
+        self.assertEquals(monitor.intvCheckMax, 10)
+        self.assertFalse(monitor.adaptiveInterval)
+
+        self.config['testmonitor.interval-stable-checks'] = '0'
+        with self.assertRaises(ValueError):
+            AdaptiveIntervalMonitoringProtocol(
+                self.coordinator, self.server, self.config)
+
+    def testRunStartsAtMinimum(self):
+        self.monitor.run()
+        self.assertEquals(self.monitor.checkCall.interval, 1)
+
+    def testBackOffWhileStable(self):
+        self.monitor.run()
+        intervals = []
+        for i in range(8):
+            self.monitor._resultUp()
+            intervals.append(self.monitor.checkCall.interval)
+        self.assertEquals(intervals, [1, 1, 2, 2, 4, 4, 8, 8])
+
+    def testResetOnDown(self):
+        self.monitor.run()
+        for i in range(5):
+            self.monitor._resultUp()
+        self.assertEquals(self.monitor.checkCall.interval, 4)
+        self.monitor._resultDown()
+        self.assertEquals(self.monitor.checkCall.interval, 1)
+        self.assertEquals(self.monitor.stableChecks, 0)
+        # Recovering: stay at the minimum interval for a while
+        self.monitor._resultUp()
+        self.assertEquals(self.monitor.checkCall.interval, 1)
+        self.monitor._resultUp()
+        self.monitor._resultUp()
+        self.assertEquals(self.monitor.checkCall.interval, 2)
+
+    def testIntervalApplied(self):
+        """A changed interval is used when scheduling the next check."""
+
+        def backOff():
+            self.monitor.checkCall.interval = 4
+
+        with mock.patch.object(self.monitor, 'check') as mock_check:
+            mock_check.side_effect = backOff
+            self.monitor.run()
+            self.reactor.advance(1)
+            mock_check.assert_called_once()
+            self.reactor.advance(2.5)
+            mock_check.assert_called_once()
+            self.reactor.advance(0.5)
+            self.assertEqual(mock_check.call_count, 2)
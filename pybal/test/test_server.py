@@ -91,6 +91,26 @@ class ServerTestCase(PyBalTestCase):
         deferred.addCallback(callback)
         return deferred
 
+    def testResolveIPAddress(self):
+        server = pybal.server.Server('10.2.3.4', self.lvsservice)
+        with mock.patch('pybal.server.client') as mock_client:
+            self.assertEqual(self.successResultOf(server.resolveHostname()),
+                             '10.2.3.4')
+        self.assertFalse(mock_client.lookupAddress.called)
+        self.assertFalse(mock_client.lookupIPV6Address.called)
+        self.assertEqual(server.ip, '10.2.3.4')
+        self.assertEqual(server.ip4_addresses, {'10.2.3.4'})
+
+        server = pybal.server.Server('2001:db8::4', self.lvsservice,
+                                     addressFamily=socket.AF_INET6)
+        self.assertEqual(self.successResultOf(server.resolveHostname()),
+                         '2001:db8::4')
+        self.assertEqual(server.ip6_addresses, {'2001:db8::4'})
+
+        # An IP literal of the wrong address family doesn't resolve
+        server = pybal.server.Server('2001:db8::4', self.lvsservice)
+        self.failureResultOf(server.resolveHostname(), AuthoritativeDomainError)
+
     def testResolveNonexistentHostname(self):
         def errback(err):
             self.assertTrue(isinstance(err, failure.Failure))
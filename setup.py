@@ -45,6 +45,7 @@ setup(
         'twisted',
         'PyOpenSSL',
         'treq',
+        'h2',
     ),
     tests_require=(
         'mock',